@@ -16,8 +16,10 @@
 print('\n*** MAVLink MinMonitor ***\n')
 print('Loading modules...')
 
+import sys
 from collections import OrderedDict
 from os import getcwd, path
+from time import time
 
 import clr
 
@@ -26,19 +28,56 @@ clr.AddReference('System.Drawing')
 clr.AddReference('System.Windows.Forms')
 
 import MAVLink
-from System import Char, Func, Array
+from System import Char, Array
 from System.Windows.Forms import Application, Screen, Form, Keys, HorizontalAlignment, \
-    FlatStyle, BorderStyle, ComboBoxStyle, Button, Label, ListBox, TextBox, CheckBox, ComboBox, NumericUpDown
+    FlatStyle, BorderStyle, ComboBoxStyle, Button, Label, ListBox, TextBox, CheckBox, ComboBox, NumericUpDown, \
+    ToolTip, VScrollBar, Timer
+from System.Media import SystemSounds
 from System.Drawing import Point, Color
 
 # ************************** USER DEFINABLE VALUES ************************** #
 
-DEFAULT_NUM_MESSAGES = 5
-CONFIG_FILENAME = 'min_monitor.cfg'
+CONFIG_FILENAME = 'min_monitor.json'  # rows, window settings and derived field definitions
+LEGACY_CONFIG_FILENAME = 'min_monitor.cfg'  # migrated to CONFIG_FILENAME if that does not exist yet
+LEGACY_DERIVED_FILENAME = 'min_monitor_derived.cfg'
+MAX_VISIBLE_ROWS = 40  # upper limit for the 'Visible rows' setting
+LIB_PATH = None  # directory containing the 'mower' package (None for this script's directory)
+HISTORY_LENGTH = 600  # samples of history kept per monitored field
+SPARKLINE_WIDTH = 20  # characters
+SPARKLINE_INTERVAL = 0.25  # seconds between sparkline/statistics redraws
+UPDATE_INTERVAL = 100  # milliseconds between display updates (and threshold alert evaluations)
+ALARM_SOUND = True  # beep (at most every few seconds) while any threshold alert is active
+STATUS_LOG_ROWS = 6  # visible lines of the STATUSTEXT log
+RECORD_PATH = None  # directory for recorded .tlog files (None for the current directory)
+RECORD_MAX_FILE_MB = 64  # start a new .tlog file after this many megabytes
+PARAM_FILENAME = None  # .param file to use if Mission Planner has no parameters loaded (e.g. not connected)
 
 # *************************************************************************** #
 
-SEVERITY = ['EMERGENCY: ', 'ALERT: ', 'CRITICAL: ', 'ERROR: ', 'WARNING: ', 'NOTICE: ', 'INFO: ', 'DEBUG: ']
+if LIB_PATH is None:
+    try:
+        LIB_PATH = path.dirname(path.abspath(__file__))
+    except NameError:  # Mission Planner does not always define __file__
+        LIB_PATH = getcwd()
+if LIB_PATH not in sys.path:
+    sys.path.append(LIB_PATH)
+
+from mower.backend import MissionPlannerBackend
+from mower.expressions import DerivedFields, DERIVED_MESSAGE_NAME
+from mower.monitor import MessageMonitor, DEFAULT_VISIBLE_ROWS, load_config, save_config
+from mower.recorder import TelemetryRecorder
+from mower.statustext import SEVERITY, StatusTextLog, StatusTextView
+
+BACKEND = MissionPlannerBackend(MAV, Script, PARAM_FILENAME)
+PARAMS = BACKEND.params  # kept current from PARAM_VALUE by the backend
+print(BACKEND.status_text())
+
+# slot control: width - ROW_SETTINGS_CONTROLS hold the row's settings, the labels show its data
+ROW_COLUMN_WIDTHS = OrderedDict([('btn_remove', 22), ('cbo_msg_id', 175), ('cbo_msg_dataframes', 120),
+                                 ('lbl_data', 120), ('lbl_spark', 120),
+                                 ('txt_min', 75), ('txt_max', 75), ('txt_factor', 75)])
+ROW_SETTINGS_CONTROLS = OrderedDict([('message', 'cbo_msg_id'), ('field', 'cbo_msg_dataframes'),
+                                     ('min', 'txt_min'), ('max', 'txt_max'), ('factor', 'txt_factor')])
 
 
 class MPColor:
@@ -62,26 +101,28 @@ CustomColor = MPColor()
 
 class MinMonitorForm(Form):
     def __init__(self):
-        self.received_messages = {}
         self.msg_ids = {}
-
-        self.config = None
-        self.num_messages = DEFAULT_NUM_MESSAGES
-        if path.exists(CONFIG_FILENAME):
-            print('Reading config...')
-            self.config = open(CONFIG_FILENAME, 'r').readlines()
-            for x in range(len(self.config)):
-                self.config[x] = self.config[x].strip('\n')
-            self.num_messages = int(self.config[0].split(',')[0])
-
-        # we subscribe to every possible MAVLink message here
-        # super inefficient, but much easier to just collect 'em all!
+        self.recorder = TelemetryRecorder(RECORD_PATH or getcwd(), 'min_monitor',
+                                          max_file_size=RECORD_MAX_FILE_MB * 1024 * 1024)
+        self.next_record_status = 0.0
+        self.config = None  # read when the form is first shown
+        self.params_version = PARAMS.version
+        self.status_log = StatusTextLog()
+        self.status_view = StatusTextView(self.status_log)
+
+        # we subscribe to every possible MAVLink message here - much easier to just collect 'em all,
+        # and the dispatcher finds a packet's handlers with one lookup however many msgids are subscribed
         for attr_name in dir(MAVLink.MAVLINK_MSG_ID):
             if attr_name.upper() == attr_name:
                 attr = getattr(MAVLink.MAVLINK_MSG_ID, attr_name)
                 self.msg_ids[attr.value__] = attr
-                MAV.SubscribeToPacketType(attr, Func[MAVLink.MAVLinkMessage, bool](self.get_message_data))
-        MAV.OnPacketReceived += self.packet_handler
+        self.monitor = MessageMonitor(dict((msgid, str(attr)) for msgid, attr in self.msg_ids.items()),
+                                      0, HISTORY_LENGTH, SPARKLINE_INTERVAL)
+        self.handlers = BACKEND.subscriber('MinMonitor')
+        self.handlers.subscribe_all(self.record_packet)
+        for msgid in self.msg_ids:
+            self.handlers.subscribe(msgid, self.monitor.get_message_data)
+        self.handlers.subscribe(MAVLink.MAVLINK_MSG_ID.STATUSTEXT, self.statustext_received)
 
         self.Text = 'MAVLink MinMonitor'
         self.Location = Point(0, 0)
@@ -90,100 +131,62 @@ class MinMonitorForm(Form):
         self.ForeColor = CustomColor.White
         self.Shown += self.on_load
         self.FormClosing += self.on_exit
+        self.MouseWheel += self.on_mouse_wheel
 
         self.margin = 5
-        start_x, start_y = 12, 10
-
-        self.msg_widgets = []
-        for x in range(self.num_messages):
-            cbo_msg_id = ComboBox()
-            cbo_msg_id.Width = 175
-            cbo_msg_id.DropDownStyle = ComboBoxStyle.DropDown
-            cbo_msg_id.FlatStyle = FlatStyle.Flat
-            cbo_msg_id.BackColor = CustomColor.MPLightGray
-            cbo_msg_id.ForeColor = CustomColor.White
-            cbo_msg_id.DataSource = self.received_messages.keys()
-            cbo_msg_id.MouseDown += self.update_message_ids
-            cbo_msg_id.SelectionChangeCommitted += self.update_datasource
-            cbo_msg_id.Text = ''
-
-            cbo_msg_dataframes = ComboBox()
-            cbo_msg_dataframes.Width = 120
-            cbo_msg_dataframes.DropDownStyle = ComboBoxStyle.DropDown
-            cbo_msg_dataframes.FlatStyle = FlatStyle.Flat
-            cbo_msg_dataframes.BackColor = CustomColor.MPLightGray
-            cbo_msg_dataframes.ForeColor = CustomColor.White
-            cbo_msg_dataframes.Text = ''
-
-            lbl_data = Label()
-            lbl_data.Text = 'NO DATA'
-            lbl_data.BackColor = CustomColor.MPMediumGray
-            lbl_data.Width = 120
-            lbl_data.Height = cbo_msg_id.Height - 5
-
-            txt_min = TextBox()
-            txt_min.Width = 75
-            txt_min.BorderStyle = BorderStyle.FixedSingle
-            txt_min.BackColor = CustomColor.MPLightGray
-            txt_min.ForeColor = CustomColor.White
-            txt_min.MaxLength = 10
-            txt_min.TextAlign = HorizontalAlignment.Center
-            txt_min.KeyPress += self.limit_to_decimal_digits
-
-            txt_max = TextBox()
-            txt_max.Width = 75
-            txt_max.BorderStyle = BorderStyle.FixedSingle
-            txt_max.BackColor = CustomColor.MPLightGray
-            txt_max.ForeColor = CustomColor.White
-            txt_max.MaxLength = 10
-            txt_max.TextAlign = HorizontalAlignment.Center
-            txt_max.KeyPress += self.limit_to_decimal_digits
-
-            txt_factor = TextBox()
-            txt_factor.Width = 75
-            txt_factor.BorderStyle = BorderStyle.FixedSingle
-            txt_factor.BackColor = CustomColor.MPLightGray
-            txt_factor.ForeColor = CustomColor.White
-            txt_factor.MaxLength = 10
-            txt_factor.TextAlign = HorizontalAlignment.Center
-            txt_factor.KeyPress += self.limit_to_decimal_digits
-
-            self.msg_widgets.append(OrderedDict([('cbo_msg_id', cbo_msg_id),
-                                                 ('cbo_msg_dataframes', cbo_msg_dataframes),
-                                                 ('lbl_data', lbl_data),
-                                                 ('txt_min', txt_min),
-                                                 ('txt_max', txt_max),
-                                                 ('txt_factor', txt_factor)]))
+        self.start_x, self.start_y = 12, 10
+        self.row_height = ComboBox().Height + self.margin
+
+        # row controls are only created for the rows on screen (slots) and rebound to rows as the grid scrolls
+        self.slots = []
+        self.num_slots = 0
+        self.first_row = 0
+        self.visible_rows = DEFAULT_VISIBLE_ROWS
+        self.binding = False
+        self.Tips = ToolTip()
 
         self.lbl_min = Label()
         self.lbl_min.Text = 'Min'
         self.lbl_min.BackColor = CustomColor.MPDarkGray
-        self.lbl_min.Width = self.msg_widgets[0]['txt_min'].Width
-        self.lbl_min.Height = self.msg_widgets[0]['txt_min'].Height - 5
+        self.lbl_min.Width = ROW_COLUMN_WIDTHS['txt_min']
+        self.lbl_min.Height = self.row_height - self.margin - 5
 
         self.lbl_max = Label()
         self.lbl_max.Text = 'Max'
         self.lbl_max.BackColor = CustomColor.MPDarkGray
-        self.lbl_max.Width = self.msg_widgets[0]['txt_max'].Width
-        self.lbl_max.Height = self.msg_widgets[0]['txt_max'].Height - 5
+        self.lbl_max.Width = ROW_COLUMN_WIDTHS['txt_max']
+        self.lbl_max.Height = self.row_height - self.margin - 5
 
         self.lbl_factor = Label()
         self.lbl_factor.Text = 'Factor'
         self.lbl_factor.BackColor = CustomColor.MPDarkGray
-        self.lbl_factor.Width = self.msg_widgets[0]['txt_factor'].Width
-        self.lbl_factor.Height = self.msg_widgets[0]['txt_factor'].Height - 5
-
-        self.lbl_num_messages = Label()
-        self.lbl_num_messages.Text = 'Number of messages to monitor (restart to take effect)'
-        self.lbl_num_messages.BackColor = CustomColor.MPDarkGray
-        self.lbl_num_messages.AutoSize = True
-
-        self.spn_num_messages = NumericUpDown()
-        self.spn_num_messages.Width = 40
-        self.spn_num_messages.BorderStyle = BorderStyle.FixedSingle
-        self.spn_num_messages.BackColor = CustomColor.MPLightGray
-        self.spn_num_messages.ForeColor = CustomColor.White
-        self.spn_num_messages.Value = self.num_messages
+        self.lbl_factor.Width = ROW_COLUMN_WIDTHS['txt_factor']
+        self.lbl_factor.Height = self.row_height - self.margin - 5
+
+        self.scr_rows = VScrollBar()
+        self.scr_rows.Minimum = 0
+        self.scr_rows.SmallChange = 1
+        self.scr_rows.Visible = False
+
+        self.btn_add_row = Button()
+        self.btn_add_row.Text = 'Add row'
+        self.btn_add_row.FlatStyle = FlatStyle.Flat
+        self.btn_add_row.BackColor = CustomColor.MPLightGray
+        self.btn_add_row.ForeColor = CustomColor.White
+
+        self.lbl_visible_rows = Label()
+        self.lbl_visible_rows.Text = 'Visible rows'
+        self.lbl_visible_rows.BackColor = CustomColor.MPDarkGray
+        self.lbl_visible_rows.AutoSize = True
+
+        self.spn_visible_rows = NumericUpDown()
+        self.spn_visible_rows.Width = 40
+        self.spn_visible_rows.BorderStyle = BorderStyle.FixedSingle
+        self.spn_visible_rows.BackColor = CustomColor.MPLightGray
+        self.spn_visible_rows.ForeColor = CustomColor.White
+        self.spn_visible_rows.Minimum = 1
+        self.spn_visible_rows.Maximum = MAX_VISIBLE_ROWS
+        self.spn_visible_rows.Value = self.visible_rows
 
         self.chk_hide_factors = CheckBox()
         self.chk_hide_factors.FlatAppearance.BorderSize = 1
@@ -197,65 +200,237 @@ class MinMonitorForm(Form):
         self.chk_sticky.Text = 'Always on top'
         self.chk_sticky.AutoSize = True
 
+        self.chk_record = CheckBox()
+        self.chk_record.FlatAppearance.BorderSize = 1
+        self.chk_record.FlatAppearance.BorderColor = CustomColor.MPLightGray
+        self.chk_record.Text = 'Record telemetry (.tlog)'
+        self.chk_record.AutoSize = True
+
+        self.lbl_alerts = Label()
+        self.lbl_alerts.Text = 'No alerts'
+        self.lbl_alerts.BackColor = CustomColor.MPMediumGray
+        self.lbl_alerts.Height = self.row_height - self.margin - 5
+
         self.lbl_status = Label()
         self.lbl_status.Text = 'No messages received'
         self.lbl_status.BackColor = CustomColor.MPMediumGray
-        self.lbl_status.Height = self.msg_widgets[0]['txt_min'].Height - 5
-
-        # pseudo-responsive form layout
-        x, y = start_x, start_y
-        max_x = 0
-        x = start_x + (self.msg_widgets[0]['cbo_msg_id'].Width +
-                       self.msg_widgets[0]['cbo_msg_dataframes'].Width +
-                       self.msg_widgets[0]['lbl_data'].Width) + self.margin * 4
-        x, y, x_extent = \
-            self.add_control_horizontal(self.lbl_min, x, y, self.margin)
-        x, y, x_extent = \
-            self.add_control_horizontal(self.lbl_max, x, y, self.margin)
-        x, y, x_extent = \
-            self.add_control_vertical(self.lbl_factor, x, y, self.margin)
-        for widget in self.msg_widgets:
-            x = start_x
-            for control in widget.items():
-                x, y, x_extent = self.add_control_horizontal(control[1], x, y, self.margin)
-            max_x = max([x_extent, max_x])
-            y += widget.items()[0][1].Height + self.margin
-        self.Width = max_x + self.margin * 4
-        self.WideWidth = self.Width
-        self.NarrowWidth = self.msg_widgets[0]['lbl_data'].Location.X + \
-                           self.msg_widgets[0]['lbl_data'].Width + self.margin * 5
+        self.lbl_status.Height = self.row_height - self.margin - 5
+
+        self.cbo_severity = ComboBox()
+        self.cbo_severity.Width = 100
+        self.cbo_severity.DropDownStyle = ComboBoxStyle.DropDownList
+        self.cbo_severity.FlatStyle = FlatStyle.Flat
+        self.cbo_severity.BackColor = CustomColor.MPLightGray
+        self.cbo_severity.ForeColor = CustomColor.White
+        for severity in SEVERITY:
+            self.cbo_severity.Items.Add(severity.rstrip(': '))
+        self.cbo_severity.SelectedIndex = len(SEVERITY) - 1
+
+        self.txt_search = TextBox()
+        self.txt_search.Width = 150
+        self.txt_search.BorderStyle = BorderStyle.FixedSingle
+        self.txt_search.BackColor = CustomColor.MPLightGray
+        self.txt_search.ForeColor = CustomColor.White
+
+        self.lst_status = ListBox()
+        self.lst_status.BorderStyle = BorderStyle.FixedSingle
+        self.lst_status.BackColor = CustomColor.MPMediumGray
+        self.lst_status.ForeColor = CustomColor.White
+        self.lst_status.IntegralHeight = False
+        self.lst_status.Height = self.lst_status.ItemHeight * STATUS_LOG_ROWS + 4
+        self.lst_status.HorizontalScrollbar = True
+        self.Tips.SetToolTip(self.cbo_severity, 'Show messages of this severity or worse')
+        self.Tips.SetToolTip(self.txt_search, 'Show messages containing this text')
+
+        # rows are painted and alerts evaluated on this timer, never from the packet handlers
+        self.tmr_update = Timer()
+        self.tmr_update.Interval = UPDATE_INTERVAL
+        self.tmr_update.Tick += self.update_tick
+
+        self.layout()
+
+    def create_slot(self):
+        cbo_msg_id = ComboBox()
+        cbo_msg_id.DropDownStyle = ComboBoxStyle.DropDown
+        cbo_msg_id.FlatStyle = FlatStyle.Flat
+        cbo_msg_id.BackColor = CustomColor.MPLightGray
+        cbo_msg_id.ForeColor = CustomColor.White
+        cbo_msg_id.DataSource = self.monitor.received_messages.keys()
+        cbo_msg_id.MouseDown += self.update_message_ids
+        cbo_msg_id.SelectionChangeCommitted += self.update_datasource
+        cbo_msg_id.Text = ''
+
+        btn_remove = Button()
+        btn_remove.Text = u'×'
+        btn_remove.FlatStyle = FlatStyle.Flat
+        btn_remove.BackColor = CustomColor.MPLightGray
+        btn_remove.ForeColor = CustomColor.White
+        btn_remove.Height = cbo_msg_id.Height
+        btn_remove.Click += self.remove_row
+        self.Tips.SetToolTip(btn_remove, 'Remove row')
+
+        cbo_msg_dataframes = ComboBox()
+        cbo_msg_dataframes.DropDownStyle = ComboBoxStyle.DropDown
+        cbo_msg_dataframes.FlatStyle = FlatStyle.Flat
+        cbo_msg_dataframes.BackColor = CustomColor.MPLightGray
+        cbo_msg_dataframes.ForeColor = CustomColor.White
+        cbo_msg_dataframes.Text = ''
+
+        lbl_data = Label()
+        lbl_data.Text = 'NO DATA'
+        lbl_data.BackColor = CustomColor.MPMediumGray
+        lbl_data.Height = cbo_msg_id.Height - 5
+
+        lbl_spark = Label()
+        lbl_spark.Text = ''
+        lbl_spark.BackColor = CustomColor.MPMediumGray
+        lbl_spark.ForeColor = CustomColor.MPGreen
+        lbl_spark.Height = cbo_msg_id.Height - 5
+
+        slot = OrderedDict([('btn_remove', btn_remove),
+                            ('cbo_msg_id', cbo_msg_id),
+                            ('cbo_msg_dataframes', cbo_msg_dataframes),
+                            ('lbl_data', lbl_data),
+                            ('lbl_spark', lbl_spark)])
+        for name in ('txt_min', 'txt_max', 'txt_factor'):
+            txt = TextBox()
+            txt.BorderStyle = BorderStyle.FixedSingle
+            txt.BackColor = CustomColor.MPLightGray
+            txt.ForeColor = CustomColor.White
+            txt.MaxLength = 10
+            txt.TextAlign = HorizontalAlignment.Center
+            txt.KeyPress += self.limit_to_decimal_digits
+            slot[name] = txt
+        for name, control in slot.items():
+            control.Width = ROW_COLUMN_WIDTHS[name]
+        for name in ROW_SETTINGS_CONTROLS.values():
+            slot[name].TextChanged += self.update_row_settings
+        return slot
+
+    def layout(self):
+        """ creates any missing slots and positions everything for the current row count and width setting """
+        self.SuspendLayout()
+        self.num_slots = min(self.visible_rows, len(self.monitor.rows))
+        while len(self.slots) < self.num_slots:
+            self.slots.append(self.create_slot())
+        self.first_row = max(0, min(self.first_row, len(self.monitor.rows) - self.num_slots))
+
+        show_factors = not self.chk_hide_factors.Checked
+        columns = {}
+        x = self.start_x
+        for name, width in ROW_COLUMN_WIDTHS.items():
+            if show_factors or 'txt' not in name:
+                columns[name] = x
+                x += width + self.margin
+        x_extent = x
+        for label, name in ((self.lbl_min, 'txt_min'), (self.lbl_max, 'txt_max'), (self.lbl_factor, 'txt_factor')):
+            label.Visible = show_factors
+            self.add_control_horizontal(label, columns.get(name, 0), self.start_y, self.margin)
+
+        y = grid_y = self.start_y + self.lbl_min.Height + self.margin
+        for index, slot in enumerate(self.slots):
+            for name, control in slot.items():
+                control.Visible = index < self.num_slots and name in columns
+                self.add_control_horizontal(control, columns.get(name, 0), y, self.margin)
+            if index < self.num_slots:
+                y += self.row_height
+        self.scr_rows.Visible = len(self.monitor.rows) > self.num_slots
+        self.scr_rows.Maximum = max(len(self.monitor.rows) - 1, 0)
+        self.scr_rows.LargeChange = max(self.num_slots, 1)
+        self.scr_rows.Value = self.first_row
+        self.scr_rows.Height = max(y - grid_y - self.margin, self.row_height)
+        self.add_control_horizontal(self.scr_rows, x_extent, grid_y, self.margin)
+        self.Width = x_extent + self.scr_rows.Width + self.margin * 4
+
         y += 20
-        x, y, x_extent = self.add_control_horizontal(self.spn_num_messages, start_x, y, self.margin)
-        x, y, x_extent = self.add_control_vertical(self.lbl_num_messages, x, y + 3, self.margin)
-        x, y, x_extent = self.add_control_vertical(self.chk_hide_factors, start_x + 3, y + 5, self.margin)
+        x, y, x_extent = self.add_control_horizontal(self.btn_add_row, self.start_x, y, self.margin)
+        x, y, x_extent = self.add_control_horizontal(self.spn_visible_rows, x + self.margin * 2, y + 1, self.margin)
+        x, y, x_extent = self.add_control_vertical(self.lbl_visible_rows, x, y + 2, self.margin)
+        x, y, x_extent = self.add_control_vertical(self.chk_hide_factors, self.start_x + 3, y + 5, self.margin)
         x, y, x_extent = self.add_control_vertical(self.chk_sticky, x, y, self.margin)
+        x, y, x_extent = self.add_control_vertical(self.chk_record, x, y, self.margin)
+        self.lbl_alerts.Width = self.Width - self.margin * 7
+        x, y, x_extent = self.add_control_vertical(self.lbl_alerts, self.start_x, y + 3, self.margin)
         self.lbl_status.Width = self.Width - self.margin * 7
-        x, y, x_extent = self.add_control_vertical(self.lbl_status, start_x, y + 3, self.margin)
+        x, y, x_extent = self.add_control_vertical(self.lbl_status, self.start_x, y, self.margin)
+        x, y, x_extent = self.add_control_horizontal(self.cbo_severity, self.start_x, y, self.margin)
+        x, y, x_extent = self.add_control_vertical(self.txt_search, x, y, self.margin)
+        self.lst_status.Width = self.lbl_status.Width
+        x, y, x_extent = self.add_control_vertical(self.lst_status, self.start_x, y, self.margin)
         self.Height = y + self.lbl_status.Height + self.margin * 5
-
-    def configure_messages(self):
-        line_num = 1
-        for widget in self.msg_widgets:
-            line_index = 0
-            for control in widget.items():
-                if 'lbl' not in control[0]:
-                    try:
-                        control[1].Text = str(self.config[line_num].split(',')[line_index])
-                    except IndexError:
-                        pass
-                    line_index += 1
-            line_num += 1
+        self.ResumeLayout()
+
+    def bind_rows(self):
+        """ shows the rows currently scrolled into view in the slots - edits made here are not row edits """
+        self.binding = True
+        for slot, row in zip(self.slots, self.monitor.rows[self.first_row:self.first_row + self.num_slots]):
+            settings = row.settings()
+            slot['cbo_msg_dataframes'].DataSource = None
+            if row.message_name in self.monitor.received_messages:
+                slot['cbo_msg_dataframes'].DataSource = \
+                    sorted(self.monitor.received_messages[row.message_name].keys())
+            for key, name in ROW_SETTINGS_CONTROLS.items():
+                slot[name].Text = settings[key]
+            self.paint_row(slot, row, True)
+        self.binding = False
+
+    def slot_row(self, sender):
+        """ returns (slot, row) for the slot containing sender """
+        for index, slot in enumerate(self.slots[:self.num_slots]):
+            if sender in slot.values():
+                return slot, self.monitor.rows[self.first_row + index]
+        return None, None
+
+    def add_row(self, sender, event):
+        self.monitor.add_row()
+        self.first_row = len(self.monitor.rows)  # scrolls to the end, layout() clamps
+        self.layout()
+        self.bind_rows()
+        self.slots[self.num_slots - 1]['cbo_msg_id'].Focus()
+
+    def remove_row(self, sender, event):
+        slot, row = self.slot_row(sender)
+        if row is not None:
+            self.monitor.remove_row(self.monitor.rows.index(row))
+            self.layout()
+            self.bind_rows()
+
+    def set_visible_rows(self, sender, event):
+        self.visible_rows = int(sender.Value)
+        self.layout()
+        self.bind_rows()
+
+    def scroll_rows(self, sender, event):
+        if sender.Value != self.first_row:
+            self.first_row = sender.Value
+            self.bind_rows()
+
+    def on_mouse_wheel(self, sender, event):
+        if self.scr_rows.Visible:
+            self.scr_rows.Value = max(0, min(self.first_row - event.Delta // 120,
+                                             len(self.monitor.rows) - self.num_slots))
 
     def update_message_ids(self, sender, event):
-        sender.DataSource = sorted(self.received_messages.keys())
+        sender.DataSource = sorted(self.monitor.received_messages.keys())
 
     def update_datasource(self, sender, event):
-        for widget in self.msg_widgets:
-            if widget['cbo_msg_id'] == sender:
-                widget['cbo_msg_dataframes'].DataSource = None
-                widget['cbo_msg_dataframes'].DataSource = sorted(self.received_messages[sender.SelectedItem].keys())
-                widget['cbo_msg_dataframes'].Text = ''
-                widget['lbl_data'].Text = 'NO DATA'
+        slot, row = self.slot_row(sender)
+        if row is None:
+            return
+        slot['cbo_msg_dataframes'].DataSource = None
+        slot['cbo_msg_dataframes'].DataSource = sorted(self.monitor.received_messages[sender.SelectedItem].keys())
+        slot['cbo_msg_dataframes'].Text = ''
+        row.clear()
+        self.paint_row(slot, row, False)
+        slot['lbl_spark'].Text = ''
+
+    def update_row_settings(self, sender, event):
+        """ copies a row's settings to the monitor when they are edited, rather than parsing them per packet """
+        if self.binding:
+            return
+        slot, row = self.slot_row(sender)
+        if row is not None:
+            row.configure(**dict((key, slot[name].Text) for key, name in ROW_SETTINGS_CONTROLS.items()))
 
     @staticmethod
     def limit_to_decimal_digits(sender, event):
@@ -273,107 +448,163 @@ class MinMonitorForm(Form):
             return
         self.TopMost = False
 
-    def toggle_width(self, sender, event):
-        self.lbl_min.Visible = not sender.Checked
-        self.lbl_max.Visible = not sender.Checked
-        self.lbl_factor.Visible = not sender.Checked
-        for widget in self.msg_widgets:
-            for control in widget.items():
-                if 'txt' in control[0]:
-                    control[1].Visible = not sender.Checked
+    def toggle_recording(self, sender, event):
         if sender.Checked:
-            self.Width = self.NarrowWidth
-            self.lbl_status.Width = self.Width - self.margin * 7
+            if not self.recorder.start():
+                self.update_record_status()
             return
-        self.Width = self.WideWidth
-        self.lbl_status.Width = self.Width - self.margin * 7
+        if not self.recorder.stop():
+            print('Recorder still writing the queued packets')
+        self.update_record_status()
+        print('Recorder stopped: {}'.format(self.recorder.status_text()))
+
+    def update_record_status(self):
+        self.next_record_status = time() + 1.0
+        text = 'Record telemetry (.tlog)'
+        if self.recorder.error is not None:
+            text += ' - ERROR: ' + self.recorder.error
+        elif self.recorder.files:
+            text += ' - ' + self.recorder.status_text()
+        self.chk_record.Text = text
+
+    def toggle_width(self, sender, event):
+        self.layout()
 
     def add_control_vertical(self, control, x, y, margin):
         control.Location = Point(x, y)
-        self.Controls.Add(control)
+        if control.Parent is None:
+            self.Controls.Add(control)
         return x, y + control.Height + margin, x + control.Width + margin
 
     def add_control_horizontal(self, control, x, y, margin):
         control.Location = Point(x, y)
-        self.Controls.Add(control)
+        if control.Parent is None:
+            self.Controls.Add(control)
         return x + control.Width + margin, y, x + control.Width + margin
 
-    def display_message_data(self, message_name, msg_data):
-        for widget in self.msg_widgets:
-            if message_name == widget['cbo_msg_id'].Text:
-                data = msg_data[widget['cbo_msg_dataframes'].Text]
-                min, max, factor = None, None, 1.0
-                try:
-                    min = float(widget['txt_min'].Text)
-                    max = float(widget['txt_max'].Text)
-                except ValueError:
-                    pass
-                try:
-                    factor = float(widget['txt_factor'].Text)
-                except ValueError:
-                    pass
-                if isinstance(data, Array):
-                    data = bytes(data)
-                try:
-                    data = float(data) * factor
-                    widget['lbl_data'].Text = str(data)
-                    if min <= data <= max:
-                        widget['lbl_data'].BackColor = CustomColor.MPMediumGray
-                        continue
-                    if min is not None and max is not None:
-                        widget['lbl_data'].BackColor = CustomColor.DarkRed
-                        continue
-                    widget['lbl_data'].BackColor = CustomColor.MPMediumGray
-                except ValueError:
-                    pass
-
-    def get_message_data(self, message):
-        message_name = str(self.msg_ids[message.msgid])
-        msg_data = {}
-        for attr_name in dir(message.data):
-            attr = getattr(message.data, attr_name)
-            if not callable(attr) and '__' not in attr_name:
-                msg_data[attr_name] = getattr(message.data, attr_name)
-        self.received_messages[message_name] = msg_data
-        self.display_message_data(message_name, msg_data)
+    def paint_row(self, slot, row, sparkline):
+        slot['lbl_data'].Text = row.text
+        slot['lbl_data'].BackColor = CustomColor.DarkRed if row.alarm else CustomColor.MPMediumGray
+        if sparkline:
+            slot['lbl_spark'].Text = row.history.stats.sparkline(SPARKLINE_WIDTH)
+            self.Tips.SetToolTip(slot['lbl_spark'], row.history.stats.summary())
+
+    def update_tick(self, sender, event):
+        """ evaluates every alert rule in one pass, then repaints the visible rows that changed
+            rows scrolled out of view keep updating their values, history and alerts, but nothing is painted """
+        now = time()
+        if PARAMS.version != self.params_version and self.monitor.derived is not None:
+            self.params_version = PARAMS.version
+            self.monitor.display_message_data(DERIVED_MESSAGE_NAME, self.monitor.derived.rebind_params())
+        changed = self.monitor.evaluate_alerts(now)
+        if changed:
+            for alert_event in list(self.monitor.alerts.history)[-len(changed):]:
+                print(alert_event)
+            self.display_alerts()
+        self.display_status_log()
+        for slot, row in zip(self.slots, self.monitor.rows[self.first_row:self.first_row + self.num_slots]):
+            sparkline = row.history.sparkline_due()
+            if row.dirty or sparkline or row in changed:
+                row.dirty = False
+                self.paint_row(slot, row, sparkline)
+        if self.monitor.alerts.alarm_due(now):
+            self.lbl_alerts.BackColor = CustomColor.DarkRed
+            if ALARM_SOUND:
+                SystemSounds.Exclamation.Play()
+        elif not self.monitor.alerts.active_count:
+            self.lbl_alerts.BackColor = CustomColor.MPMediumGray
+
+    def set_status_filter(self, sender, event):
+        self.apply_status_operations(self.status_view.set_filter(self.cbo_severity.SelectedIndex,
+                                                                 self.txt_search.Text))
+
+    def display_status_log(self):
+        operations = self.status_view.update()
+        if operations:
+            self.apply_status_operations(operations)
+
+    def apply_status_operations(self, operations):
+        """ edits the list in place rather than rebuilding it """
+        items = self.lst_status.Items
+        visible_items = self.lst_status.ClientSize.Height // self.lst_status.ItemHeight
+        follow = self.lst_status.TopIndex >= items.Count - visible_items
+        self.lst_status.BeginUpdate()
+        for operation in operations:
+            if operation[0] == 'add':
+                items.Add(operation[1])
+            elif operation[0] == 'set':
+                items[operation[1]] = operation[2]
+            elif operation[0] == 'remove':
+                items.RemoveAt(operation[1])
+            else:
+                items.Clear()
+        if follow and items.Count:
+            self.lst_status.TopIndex = items.Count - 1  # keep the newest visible unless scrolled back
+        self.lst_status.EndUpdate()
+
+    def display_alerts(self):
+        alerts = self.monitor.alerts
+        text = 'No alerts' if not alerts.active_count else '{} active alert(s)'.format(alerts.active_count)
+        if alerts.history:
+            text += ' - last: {}'.format(alerts.history[-1])
+        self.lbl_alerts.Text = text
+        self.Tips.SetToolTip(self.lbl_alerts, alerts.summary())
+
+    def record_packet(self, message):
+        if self.recorder.recording:
+            self.recorder.push(message.buffer)
+            if time() >= self.next_record_status:
+                self.update_record_status()
         return True
 
-    def packet_handler(self, obj, message):
-        try:
-            if message.msgid == MAVLink.MAVLINK_MSG_ID.STATUSTEXT.value__:
-                self.lbl_status.Text = SEVERITY[message.data.severity] + str(bytes(message.data.text))
-        except Exception as inst:
-            print(inst)  # not sure what situation would raise this, so leaving it for debugging
+    def statustext_received(self, message):
+        entry = self.status_log.add(message.data.severity, str(bytes(message.data.text)))
+        self.lbl_status.Text = SEVERITY[entry.severity] + entry.text
+        return True
 
     def on_load(self, sender, event):
+        print('Reading config...')
+        self.config = load_config(CONFIG_FILENAME, LEGACY_CONFIG_FILENAME, LEGACY_DERIVED_FILENAME)
+        for settings in self.config['rows']:
+            self.monitor.add_row(settings)
+        derived = DerivedFields(PARAMS.__getitem__)
+        self.params_version = PARAMS.version
+        for error in derived.load(self.config['derived']):
+            print('Derived field error: ' + error)
+        self.monitor.set_derived(derived)
+        self.visible_rows = max(1, min(int(self.config['visible_rows']), MAX_VISIBLE_ROWS))
+        self.spn_visible_rows.Value = self.visible_rows
+        self.chk_hide_factors.Checked = self.config['hide_factors']
+        self.chk_sticky.Checked = self.config['always_on_top']
+
         self.chk_hide_factors.CheckedChanged += self.toggle_width
         self.chk_sticky.CheckedChanged += self.set_sticky
-        if self.config is not None:
-            self.chk_hide_factors.Checked = bool(int(self.config[0].split(',')[1]))
-            self.chk_sticky.Checked = bool(int(self.config[0].split(',')[2]))
-        self.toggle_width(self.chk_hide_factors, None)
+        self.chk_record.CheckedChanged += self.toggle_recording
+        self.spn_visible_rows.ValueChanged += self.set_visible_rows
+        self.scr_rows.ValueChanged += self.scroll_rows
+        self.btn_add_row.Click += self.add_row
+        self.cbo_severity.SelectedIndexChanged += self.set_status_filter
+        self.txt_search.TextChanged += self.set_status_filter
         self.set_sticky(self.chk_sticky, None)
-        if self.config is not None:
-            self.configure_messages()
+        self.layout()
+        self.bind_rows()
+        self.tmr_update.Start()
         print('Running...')
 
     def on_exit(self, sender, event):
-        for attr_name in dir(MAVLink.MAVLINK_MSG_ID):
-            if attr_name.upper() == attr_name:
-                attr = getattr(MAVLink.MAVLINK_MSG_ID, attr_name)
-                self.msg_ids[attr.value__] = attr
-                MAV.UnSubscribeToPacketType(attr)
+        self.tmr_update.Stop()
+        self.recorder.stop()
+        print('\n'.join(self.handlers.timing_table()))
+        self.handlers.close()
+        BACKEND.close()
+        if self.config is None:
+            return
+        self.config['hide_factors'] = self.chk_hide_factors.Checked
+        self.config['always_on_top'] = self.chk_sticky.Checked
+        self.config['visible_rows'] = self.visible_rows
+        self.config['rows'] = [row.settings() for row in self.monitor.rows]
         print('Saving config: {}'.format(path.join(getcwd(), CONFIG_FILENAME)))
-        f = open(CONFIG_FILENAME, 'w')
-        f.write(str(self.spn_num_messages.Text) + ',')
-        f.write(str(int(self.chk_hide_factors.Checked)) + ',')
-        f.write(str(int(self.chk_sticky.Checked)) + ',\n')
-        for widget in self.msg_widgets:
-            for control in widget.items():
-                if 'lbl' not in control[0]:
-                    f.write('{},'.format(control[1].Text))
-            f.write('\n')
-        f.close()
+        save_config(CONFIG_FILENAME, self.config)
 
 
 print('Loading interface...')
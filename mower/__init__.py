@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+"""
+    mower
+
+    Shared, UI-independent helpers for the Mission Planner scripts and tools in this repository
+
+    Modules imported by the Mission Planner scripts must stay IronPython 2.7 compatible
+    (no f-strings, no annotations, no Python 3 only syntax)
+
+    The offline analysis modules (dataflash, steering_fit, plants, pid_batch, ardupilot_steering) need numpy,
+    so they run under CPython only and are never imported by the Mission Planner scripts
+
+"""
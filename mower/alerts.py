@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+    mower/alerts.py
+
+    Threshold alerts with hysteresis and debounce, evaluated in batches rather than per packet
+
+    Packet handlers only store the latest value of each rule.  AlertEngine.evaluate() is called once per
+    display update (a WinForms Timer tick in the dialogs) and walks every rule in one pass.  A rule raises
+    only after its value has been outside [low, high] for `debounce` seconds, and clears only after the value
+    has been back inside the band, narrowed by `hysteresis` at both ends, for the same time.
+
+"""
+
+from collections import deque
+from time import time, localtime, strftime
+
+ALERT_HISTORY_LENGTH = 200  # raise/clear events kept
+ALARM_INTERVAL = 5.0  # seconds between repeated alarms while any rule is active
+DEFAULT_HYSTERESIS = 0.02  # fraction of the band width, used when a rule has no explicit hysteresis
+DEFAULT_DEBOUNCE = 0.5  # seconds
+
+
+class AlertRule:
+    def __init__(self, name, low=None, high=None, hysteresis=None, debounce=DEFAULT_DEBOUNCE):
+        self.name = name
+        self.value = None  # latest value, written by the packet handler
+        self.active = False
+        self.pending_since = None  # time the value first disagreed with the current state
+        self.since = None  # time of the last raise/clear
+        self.raised_count = 0
+        self.debounce = debounce
+        self.set_band(low, high, hysteresis)
+
+    def set_band(self, low, high, hysteresis=None):
+        """ both limits must be set for the rule to apply - hysteresis is in the units of the value """
+        self.low, self.high = low, high
+        self.hysteresis = 0.0
+        if low is not None and high is not None:
+            width = high - low
+            if hysteresis is None:
+                hysteresis = width * DEFAULT_HYSTERESIS
+            self.hysteresis = max(0.0, min(hysteresis, width / 2.0))
+
+    @property
+    def enabled(self):
+        return self.low is not None and self.high is not None
+
+    @property
+    def pending(self):
+        return self.pending_since is not None
+
+    def reset(self):
+        self.value = None
+        self.active = False
+        self.pending_since = None
+
+    def evaluate(self, now):
+        """ returns True if the rule was raised or cleared """
+        if self.value is None or not self.enabled:
+            self.pending_since = None
+            if not self.active:
+                return False
+            self.active = False
+            self.since = now
+            return True
+        if self.active:
+            violating = not self.low + self.hysteresis <= self.value <= self.high - self.hysteresis
+        else:
+            violating = not self.low <= self.value <= self.high
+        if violating == self.active:
+            self.pending_since = None
+            return False
+        if self.pending_since is None:
+            self.pending_since = now
+        if now - self.pending_since < self.debounce:
+            return False
+        self.active = violating
+        self.pending_since = None
+        self.since = now
+        if violating:
+            self.raised_count += 1
+        return True
+
+
+class AlertEvent:
+    def __init__(self, timestamp, name, active, value):
+        self.timestamp = timestamp
+        self.name = name
+        self.active = active
+        self.value = value
+
+    def __str__(self):
+        return '{} {} {} ({})'.format(strftime('%H:%M:%S', localtime(self.timestamp)),
+                                      'RAISED' if self.active else 'cleared', self.name, self.value)
+
+
+class AlertEngine:
+    def __init__(self, history_length=ALERT_HISTORY_LENGTH, alarm_interval=ALARM_INTERVAL):
+        self.history = deque(maxlen=history_length)
+        self.alarm_interval = alarm_interval
+        self.next_alarm = 0.0
+        self.active_count = 0
+
+    def evaluate(self, rules, now=None):
+        """ one pass over all rules - returns the rules that were raised or cleared """
+        if now is None:
+            now = time()
+        changed = []
+        active_count = 0
+        for rule in rules:
+            if rule.evaluate(now):
+                changed.append(rule)
+                self.history.append(AlertEvent(now, rule.name, rule.active, rule.value))
+            if rule.active:
+                active_count += 1
+        self.active_count = active_count
+        return changed
+
+    def alarm_due(self, now=None):
+        """ True at most once per alarm_interval while any rule is active """
+        if not self.active_count:
+            return False
+        if now is None:
+            now = time()
+        if now < self.next_alarm:
+            return False
+        self.next_alarm = now + self.alarm_interval
+        return True
+
+    def summary(self, num_events=10):
+        lines = ['{} active alert(s)'.format(self.active_count)]
+        lines.extend(str(event) for event in list(self.history)[-num_events:][::-1])
+        return '\n'.join(lines)
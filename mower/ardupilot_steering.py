@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+    mower/ardupilot_steering.py
+
+    ArduRover's steering rate controller (AR_AttitudeControl + AC_PID, 4.1) for the PID simulators
+
+    Mirrors the structure of get_steering_out_rate(): the desired turn rate is acceleration limited by
+    ATC_STR_ACC_MAX and clipped to ATC_STR_RAT_MAX, then AC_PID filters the target (FLTT), error (FLTE) and
+    derivative (FLTD), adds FF * target, and only grows the I term while the output is unsaturated, within
+    +/- IMAX.  The output is the -1..1 steering demand.  Rates are in rad/s, as in ArduPilot.
+    Not modelled: the slew rate limiter (SMAX), lateral acceleration limits and low-speed I term freezing.
+
+    Gains come straight from .param dumps, one controller per dump, so several dumps can be stepped side by
+    side on the same scenario and skid-steer plant:
+        python -m mower.ardupilot_steering "20200718 Working GPS Yaw Params 4.1.0 DEV.param" \\
+            "20210714 Cube Orange 4.1.0-dev (custom) GPS UART2.param" --step 0.3 0.6
+
+"""
+
+from __future__ import division
+
+import argparse
+import sys
+from math import pi
+
+import numpy as np
+
+from mower.params import ParamCache
+from mower.pid_batch import DEFAULT_DT, DEFAULT_DURATION, run
+from mower.plants import DEFAULT_TRACK_WIDTH, Chain, DeadTime, SkidSteerYaw, full_output_speed
+
+RATE_PREFIX = 'ATC_STR_RAT_'
+RATE_GAINS = ('FF', 'P', 'I', 'D', 'IMAX', 'FLTT', 'FLTE', 'FLTD')
+DEFAULTS = {'ATC_STR_RAT_FF': 0.2, 'ATC_STR_RAT_P': 0.2, 'ATC_STR_RAT_I': 0.2, 'ATC_STR_RAT_D': 0.0,
+            'ATC_STR_RAT_IMAX': 1.0, 'ATC_STR_RAT_FLTT': 0.0, 'ATC_STR_RAT_FLTE': 10.0, 'ATC_STR_RAT_FLTD': 0.0,
+            'ATC_STR_RAT_MAX': 120.0, 'ATC_STR_ACC_MAX': 120.0, 'ATC_STR_ANG_P': 2.0}  # ArduRover 4.1 defaults
+
+
+def load_param_files(filenames):
+    caches = []
+    for filename in filenames:
+        cache = ParamCache()
+        cache.load_file(filename)
+        caches.append(cache)
+    return caches
+
+
+def lowpass_alpha(dt, cutoff):
+    """ AC_PID's calc_lowpass_alpha_dt() - 1 (no filtering) where the cutoff is 0 """
+    cutoff = np.asarray(cutoff, float)
+    rc = 1.0 / (2 * pi * np.where(cutoff > 0, cutoff, 1.0))
+    return np.where(cutoff > 0, dt / (dt + rc), 1.0)
+
+
+class SteeringRateController:
+    """ one ArduRover steering rate controller per element of the gain arrays """
+
+    def __init__(self, ff, kp, ki, kd, imax=1.0, filt_t_hz=0.0, filt_e_hz=10.0, filt_d_hz=0.0, rate_max=120.0,
+                 accel_max=120.0, angle_p=2.0, names=None):
+        arrays = np.broadcast_arrays(*[np.asarray(value, float) for value in (
+            ff, kp, ki, kd, imax, filt_t_hz, filt_e_hz, filt_d_hz, rate_max, accel_max, angle_p)])
+        (self.ff, self.kp, self.ki, self.kd, self.imax, self.filt_t_hz, self.filt_e_hz, self.filt_d_hz,
+         self.rate_max, self.accel_max, self.angle_p) = [np.atleast_1d(array).copy() for array in arrays]
+        self.names = names if names is not None else [str(x) for x in range(len(self.kp))]
+        self.reset()
+
+    def __len__(self):
+        return len(self.kp)
+
+    @classmethod
+    def from_params(cls, *params, **kwargs):
+        """ one controller per ParamCache (or mapping with get()) - names=[...] labels them """
+        def values(name):
+            return [source.get(name, DEFAULTS[name]) for source in params]
+        return cls(*[values(RATE_PREFIX + gain) for gain in RATE_GAINS],
+                   rate_max=values('ATC_STR_RAT_MAX'), accel_max=values('ATC_STR_ACC_MAX'),
+                   angle_p=values('ATC_STR_ANG_P'), names=kwargs.get('names'))
+
+    @classmethod
+    def from_param_files(cls, *filenames):
+        return cls.from_params(*load_param_files(filenames), names=list(filenames))
+
+    def reset(self, dt=DEFAULT_DT):
+        count = len(self)
+        self.desired = np.zeros(count)  # acceleration limited desired rate
+        self.target = np.zeros(count)
+        self.error = np.zeros(count)
+        self.derivative = np.zeros(count)
+        self.integrator = np.zeros(count)
+        self.output = np.zeros(count)
+        self.first = True
+
+    def desired_rate_for_heading(self, heading_error):
+        """ get_steering_out_heading(): heading error (rad) to desired turn rate (rad/s) """
+        return np.clip(heading_error * self.angle_p, -np.radians(self.rate_max), np.radians(self.rate_max))
+
+    def update(self, desired_rate, measured_rate, dt):
+        """ get_steering_out_rate() - returns the -1..1 steering output """
+        desired = np.broadcast_to(np.asarray(desired_rate, float), self.desired.shape)
+        if not self.first:
+            change_max = np.where(self.accel_max > 0, np.radians(self.accel_max) * dt, np.inf)
+            desired = np.clip(desired, self.desired - change_max, self.desired + change_max)
+        rate_max = np.where(self.rate_max > 0, np.radians(self.rate_max), np.inf)
+        desired = np.clip(desired, -rate_max, rate_max)
+        self.desired = desired
+
+        # AC_PID::update_all()
+        if self.first:
+            self.target = desired.copy()
+            self.error = self.target - measured_rate
+            self.derivative = np.zeros(len(self))
+            self.first = False
+        else:
+            error_last = self.error
+            self.target = self.target + lowpass_alpha(dt, self.filt_t_hz) * (desired - self.target)
+            self.error = self.error + lowpass_alpha(dt, self.filt_e_hz) * ((self.target - measured_rate) - self.error)
+            derivative = (self.error - error_last) / dt
+            self.derivative = self.derivative + lowpass_alpha(dt, self.filt_d_hz) * (derivative - self.derivative)
+
+        # AC_PID::update_i() - saturated outputs ("motor limits") only let the integrator shrink
+        limited = np.abs(self.output) >= 1.0
+        shrinking = ((self.integrator > 0) & (self.error < 0)) | ((self.integrator < 0) & (self.error > 0))
+        grow = (self.ki != 0) & (~limited | shrinking)
+        self.integrator = np.where(grow, np.clip(self.integrator + self.error * self.ki * dt, -self.imax, self.imax),
+                                   np.where(self.ki != 0, self.integrator, 0.0))
+
+        output = self.ff * self.target + self.kp * self.error + self.integrator + self.kd * self.derivative
+        self.output = np.clip(output, -1.0, 1.0)
+        return self.output
+
+    def summary(self, index):
+        return 'FF {:.3g} P {:.3g} I {:.3g} D {:.3g} IMAX {:.3g} FLTE {:.3g} RAT_MAX {:.3g} ACC_MAX {:.3g}'.format(
+            self.ff[index], self.kp[index], self.ki[index], self.kd[index], self.imax[index],
+            self.filt_e_hz[index], self.rate_max[index], self.accel_max[index])
+
+
+def compare(filenames, steps=(0.5,), dt=DEFAULT_DT, duration=DEFAULT_DURATION, track_width=DEFAULT_TRACK_WIDTH,
+            track_speed=None, tau=0.1, dead_time=0.0):
+    """ (controller, [(step, BatchResult)]) with one result row per .param file, each driving a skid-steer
+        plant limited by that file's ATC_ACCEL_MAX/ATC_DECEL_MAX (and CRUISE_SPEED/CRUISE_THROTTLE unless
+        track_speed is given) """
+    caches = load_param_files(filenames)
+    controller = SteeringRateController.from_params(*caches, names=list(filenames))
+    results = []
+    for step in steps:
+        plant = SkidSteerYaw([cache.get('ATC_ACCEL_MAX', 0.0) for cache in caches],
+                             [cache.get('ATC_DECEL_MAX', 0.0) for cache in caches], track_width,
+                             [full_output_speed(cache) if track_speed is None else track_speed for cache in caches],
+                             tau)
+        if dead_time > 0:
+            plant = Chain(DeadTime(dead_time), plant)
+        results.append((step, run(controller, step, dt, duration, plant)))
+    return controller, results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare ArduRover steering rate tunes from .param files')
+    parser.add_argument('param_files', nargs='+', help='.param dumps to compare')
+    parser.add_argument('--step', type=float, nargs='+', default=[0.5], help='desired turn rate steps (rad/s)')
+    parser.add_argument('--dt', type=float, default=DEFAULT_DT, help='simulation step (s)')
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION, help='simulated seconds per step')
+    parser.add_argument('--track-width', type=float, default=DEFAULT_TRACK_WIDTH, help='m')
+    parser.add_argument('--track-speed', type=float, default=None,
+                        help='m/s at full output (default: from CRUISE_SPEED and CRUISE_THROTTLE)')
+    parser.add_argument('--tau', type=float, default=0.1, help='motor time constant (s)')
+    parser.add_argument('--dead-time', type=float, default=0.0, help='plant dead time (s)')
+    args = parser.parse_args(argv)
+
+    controller, results = compare(args.param_files, args.step, args.dt, args.duration, args.track_width,
+                                  args.track_speed, args.tau, args.dead_time)
+    for index, name in enumerate(controller.names):
+        print('[{}] {}\n    {}'.format(index + 1, name, controller.summary(index)))
+    for step, result in results:
+        print('\nstep {} rad/s: {}'.format(step, result))
+        print('{:>5}  {:>9} {:>9} {:>8} {:>8}'.format('dump', 'overshoot', 'settling', 'IAE', 'effort'))
+        for index in range(len(controller)):
+            print('{:>5}  {:>8.1f}% {:>8.2f}s {:>8.4f} {:>8.3f}'.format(
+                '[{}]'.format(index + 1), result.overshoot[index], result.settling[index], result.iae[index],
+                result.effort[index]))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+    mower/backend.py
+
+    The vehicle link as the monitor and tuner see it: packet subscriptions, parameters and RC overrides
+
+    A Backend owns the parameter cache (kept current from PARAM_VALUE) and hands out mower.dispatch
+    Subscribers for its packet stream, so the packet handling in the dialogs does not care where packets
+    come from.  Each concrete backend provides set_param(name, value) and send_rc_override([(channel, pwm)]).
+    MissionPlannerBackend wraps the MAV and Script globals of a Mission Planner script:
+        BACKEND = MissionPlannerBackend(MAV, Script, PARAM_FILENAME)
+        handlers = BACKEND.subscriber('ServoTuner')
+        BACKEND.send_rc_override([(1, 1600), (3, 1500)])
+
+    mower/headless.py has the CPython backends (the built-in framing or pymavlink, over serial, UDP or TCP),
+    so the same monitoring code runs outside Mission Planner in its own process.
+
+    Used by the Mission Planner scripts (IronPython), so no CPython-only features.
+
+"""
+
+from mower.dispatch import subscriber
+from mower.mavlink import MSG_IDS
+from mower.params import ParamCache
+
+
+class Backend:
+    """ base class - mav is whatever raises OnPacketReceived(sender, message) with Mission Planner style messages
+        (msgid, data, buffer...), which is Mission Planner's MAV or the backend itself """
+
+    name = 'backend'
+
+    def __init__(self, mav):
+        self.mav = mav
+        self.params = ParamCache()
+        self.param_handlers = None  # the backend's own PARAM_VALUE subscription, made by start_params()
+
+    def start_params(self):
+        """ keeps the parameter cache current from PARAM_VALUE messages """
+        if self.param_handlers is None:
+            self.param_handlers = self.subscriber('params')
+            self.param_handlers.subscribe(MSG_IDS['PARAM_VALUE'], self.params.handle_param_value)
+
+    def subscriber(self, owner):
+        return subscriber(self.mav, owner)
+
+    def param(self, name, default=None):
+        return self.params.get(name, default)
+
+    def close(self):
+        if self.param_handlers is not None:
+            self.param_handlers.close()
+            self.param_handlers = None
+
+    def status_text(self):
+        return '{}: {} parameters from {}'.format(self.name, len(self.params), self.params.source)
+
+
+class MissionPlannerBackend(Backend):
+    """ the MAV and Script globals of a Mission Planner script """
+
+    name = 'Mission Planner'
+
+    def __init__(self, mav, script, param_filename=None):
+        Backend.__init__(self, mav)
+        self.script = script
+        self.params.load_mission_planner(mav.MAV.param)
+        if not len(self.params) and param_filename is not None:
+            self.params.load_file(param_filename)
+        self.start_params()
+
+    def set_param(self, name, value):
+        """ blocks until Mission Planner has the vehicle's acknowledgement - returns True if it was accepted (the
+            CPython backends return once PARAM_SET is sent, and the cache follows the PARAM_VALUE reply) """
+        accepted = self.script.ChangeParam(name, value)
+        if accepted:
+            self.params.set(name, value)
+        return accepted
+
+    def send_rc_override(self, channels):
+        """ one RC_CHANNELS_OVERRIDE for [(channel, pwm)], channels not listed are left alone - SendRC only stages
+            a channel until sendnow is True """
+        last = len(channels) - 1
+        for index, (chan, pwm) in enumerate(channels):
+            self.script.SendRC(chan, pwm, index == last)
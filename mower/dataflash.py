@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+    mower/dataflash.py
+
+    Memory-mapped, columnar reader for ArduPilot DataFlash (.bin) logs
+
+    Every message is 0xA3 0x95, a type byte and a fixed-length payload described by an FMT message.  The log is
+    memory-mapped and indexed in one vectorised pass: candidate headers are found with NumPy comparisons, FMT
+    definitions give each type its length, and a candidate is kept if it has a known length and leads to another
+    header.  Where two kept candidates overlap, the one the previous message does not lead to is a 0xA3 0x95
+    inside a payload, so false headers and corrupt stretches drop out without a per-message Python loop.
+    A requested type is then gathered into one (count, length) byte array and viewed as a NumPy structured
+    array named after the FMT columns - no per-row Python objects:
+        log = DataFlashLog('00000042.BIN')
+        ster = log.messages('STER')                      # structured array, raw field types
+        rate = log.column('STER', 'TurnRate')            # float64, scaled (centi-units, 1e-7 degrees...)
+        python -m mower.dataflash 00000042.BIN --dump STER --fields TimeUS,DesTurnRate,TurnRate --head 10
+
+    LogWriter writes (synthetic) logs in the same format for tests and the self-check:
+        python -m mower.dataflash --benchmark 200    # MB of synthetic log indexed and decoded
+
+"""
+
+from __future__ import division
+
+import argparse
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from time import perf_counter
+
+import numpy as np
+
+HEAD1 = 0xA3
+HEAD2 = 0x95
+HEADER_LEN = 3
+FMT_TYPE = 128
+FMT_LENGTH = 89
+FMT_STRUCT = struct.Struct('<BB4s16s64s')
+SCAN_CHUNK = 64 * 1024 * 1024  # bytes compared at a time while looking for headers
+GATHER_ROWS = 1 << 20  # messages gathered at a time
+
+# format character: (NumPy type, scale applied by column())
+FORMAT_TYPES = {'a': ('<i2', 32), 'b': 'i1', 'B': 'u1', 'h': '<i2', 'H': '<u2', 'i': '<i4', 'I': '<u4', 'f': '<f4',
+                'd': '<f8', 'n': 'S4', 'N': 'S16', 'Z': 'S64', 'c': '<i2', 'C': '<u2', 'e': '<i4', 'E': '<u4',
+                'L': '<i4', 'M': 'u1', 'q': '<i8', 'Q': '<u8', 'g': '<f2'}
+FORMAT_SCALES = {'c': 0.01, 'C': 0.01, 'e': 0.01, 'E': 0.01, 'L': 1e-7}
+
+
+class MessageFormat:
+    """ one FMT definition """
+
+    def __init__(self, msg_type, length, name, fmt, columns):
+        self.type = msg_type
+        self.length = length
+        self.name = name
+        self.format = fmt
+        self.columns = columns
+        self.dtype = np.dtype({'names': ['_header'] + columns,
+                               'formats': ['V{}'.format(HEADER_LEN)] + [FORMAT_TYPES[char] for char in fmt]})
+        if self.dtype.itemsize != length:
+            raise ValueError('{}: format {} is {} bytes, FMT says {}'.format(name, fmt, self.dtype.itemsize, length))
+
+    def scale(self, column):
+        return FORMAT_SCALES.get(self.format[self.columns.index(column)], 1.0)
+
+    def __repr__(self):
+        return 'MessageFormat({}, {}, {!r}, {!r}, {})'.format(self.type, self.length, self.name, self.format,
+                                                               self.columns)
+
+
+def _text(raw):
+    return raw.split(b'\x00', 1)[0].decode('ascii', 'replace')
+
+
+def find_headers(data):
+    """ int64 offsets of every 0xA3 0x95 pair in a uint8 array, compared a chunk at a time """
+    found = []
+    size = len(data)
+    for start in range(0, max(size - 1, 0), SCAN_CHUNK):
+        chunk = data[start:min(start + SCAN_CHUNK + 1, size)]
+        found.append(np.flatnonzero((chunk[:-1] == HEAD1) & (chunk[1:] == HEAD2)) + start)
+    return np.concatenate(found).astype(np.int64) if found else np.zeros(0, np.int64)
+
+
+class DataFlashLog:
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(
+            self._file.fileno()).st_size else None
+        self.data = np.frombuffer(self._mmap, np.uint8) if self._mmap is not None else np.zeros(0, np.uint8)
+        self.formats = {}  # type: MessageFormat
+        self.names = {}  # name: MessageFormat
+        self.offsets = None  # offsets of the messages kept, in log order
+        self.types = None  # their types
+        self.skipped_bytes = 0
+        self._index()
+
+    def close(self):
+        self.data = None
+        self.offsets = self.types = None
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _read_formats(self, candidates):
+        data = self.data
+        fmt = candidates[(candidates + FMT_LENGTH <= len(data))]
+        fmt = fmt[data[fmt + 2] == FMT_TYPE]
+        for offset in fmt:
+            msg_type, length, name, fmt_text, columns = FMT_STRUCT.unpack(
+                data[offset + HEADER_LEN:offset + FMT_LENGTH].tobytes())
+            try:
+                definition = MessageFormat(msg_type, length, _text(name), _text(fmt_text),
+                                           _text(columns).split(',') if columns.strip(b'\x00') else [])
+            except (KeyError, ValueError, TypeError):
+                continue  # not really an FMT (or an unsupported format character)
+            self.formats[msg_type] = definition
+            self.names[definition.name] = definition
+
+    def _index(self):
+        data = self.data
+        size = len(data)
+        candidates = find_headers(data)
+        candidates = candidates[candidates + HEADER_LEN <= size]
+        self._read_formats(candidates)
+        lengths = np.zeros(256, np.int64)
+        for msg_type, definition in self.formats.items():
+            lengths[msg_type] = definition.length
+        types = data[candidates + 2]
+        ends = candidates + lengths[types]
+        # a real message has a known length and is followed by another header (or the end of the log)
+        position = np.searchsorted(candidates, ends)
+        following = np.where(position < len(candidates), candidates[np.minimum(position, len(candidates) - 1)], -1)
+        keep = (lengths[types] > 0) & ((following == ends) | (ends == size))
+        # where two of those overlap, one is a 0xA3 0x95 inside the other's payload.  Payload bytes repeat from
+        # message to message, so false headers can chain among themselves - but such a chain starts inside a real
+        # message, later than the real chain it overlaps, so the candidate whose chain starts earlier wins
+        kept = np.flatnonzero(keep)
+        starts, kept_ends = candidates[kept], ends[kept]
+        order = np.argsort(kept_ends, kind='stable')  # already almost in order
+        position = np.minimum(np.searchsorted(kept_ends[order], starts), len(kept) - 1)
+        previous = np.where(kept_ends[order][position] == starts, order[position], np.arange(len(kept)))
+        while True:  # pointer jumping - log2(chain length) passes to each chain's first message
+            jumped = previous[previous]
+            if np.array_equal(jumped, previous):
+                break
+            previous = jumped
+        chain_start = starts[previous]
+        alive = np.ones(len(kept), bool)
+        while True:
+            index = np.flatnonzero(alive)
+            overlap = np.flatnonzero(starts[index[1:]] < kept_ends[index[:-1]])
+            if not len(overlap):
+                break
+            first, second = index[overlap], index[overlap + 1]
+            alive[np.where(chain_start[second] >= chain_start[first], second, first)] = False
+        keep[kept[~alive]] = False
+        self.offsets = candidates[keep]
+        self.types = types[keep]
+        self.skipped_bytes = size - int(lengths[self.types].sum())
+
+    def counts(self):
+        """ {name: messages} for every type present """
+        counts = np.bincount(self.types, minlength=256)
+        return dict((self.formats[msg_type].name, int(counts[msg_type])) for msg_type in np.flatnonzero(counts)
+                    if msg_type in self.formats)
+
+    def messages(self, name, instance=None):
+        """ structured array of every name message (fields as logged), optionally one instance ('I' column) """
+        definition = self.names[name]
+        offsets = self.offsets[self.types == definition.type]
+        rows = np.empty(len(offsets), definition.dtype)
+        raw = rows.view(np.uint8).reshape(len(offsets), definition.length)
+        span = np.arange(definition.length)
+        for start in range(0, len(offsets), GATHER_ROWS):
+            block = offsets[start:start + GATHER_ROWS]
+            raw[start:start + len(block)] = self.data[block[:, None] + span]
+        if instance is not None:
+            for column in ('I', 'Instance', 'Id'):
+                if column in definition.columns:
+                    rows = rows[rows[column] == instance]
+                    break
+        return rows
+
+    def column(self, name, field, instance=None, messages=None):
+        """ float64 column with the format's scaling applied (centi-units, 1e-7 degrees...) """
+        definition = self.names[name]
+        rows = messages if messages is not None else self.messages(name, instance)
+        values = rows[field].astype(np.float64)
+        scale = definition.scale(field)
+        return values * scale if scale != 1.0 else values
+
+    def time(self, name, instance=None, messages=None):
+        """ seconds since boot from TimeUS """
+        rows = messages if messages is not None else self.messages(name, instance)
+        return rows['TimeUS'] * 1e-6
+
+    def columns(self, name, fields=None, instance=None):
+        """ {field: float64 array} """
+        definition = self.names[name]
+        rows = self.messages(name, instance)
+        fields = fields or [column for column, char in zip(definition.columns, definition.format)
+                            if char not in 'nNZa']
+        return dict((field, self.column(name, field, messages=rows)) for field in fields)
+
+
+class LogWriter:
+    """ writes DataFlash messages - define() emits the FMT, write() one message """
+
+    def __init__(self, f):
+        self.f = f
+        self.definitions = {}
+        self.define(FMT_TYPE, 'FMT', 'BBnNZ', ['Type', 'Length', 'Name', 'Format', 'Columns'])
+
+    def define(self, msg_type, name, fmt, columns):
+        definition = MessageFormat(msg_type, HEADER_LEN + np.dtype([(str(x), FORMAT_TYPES[char])
+                                                                     for x, char in enumerate(fmt)]).itemsize,
+                                   name, fmt, list(columns))
+        self.definitions[name] = definition
+        if msg_type != FMT_TYPE:
+            self.write('FMT', msg_type, definition.length, name.encode('ascii'), fmt.encode('ascii'),
+                       ','.join(columns).encode('ascii'))
+        else:
+            self.write('FMT', FMT_TYPE, FMT_LENGTH, b'FMT', fmt.encode('ascii'), ','.join(columns).encode('ascii'))
+        return definition
+
+    def encode(self, name, rows):
+        """ bytes for many messages at once - rows is a {column: array} mapping of equal lengths """
+        definition = self.definitions[name]
+        count = len(next(iter(rows.values())))
+        out = np.zeros(count, definition.dtype)
+        header = out.view(np.uint8).reshape(count, definition.length)
+        for column, values in rows.items():
+            out[column] = values
+        header[:, 0], header[:, 1], header[:, 2] = HEAD1, HEAD2, definition.type
+        return out.tobytes()
+
+    def write(self, name, *values):
+        self.f.write(self.encode(name, dict((column, [value]) for column, value in
+                                            zip(self.definitions[name].columns, values))))
+
+    def write_many(self, name, rows):
+        self.f.write(self.encode(name, rows))
+
+
+def synthetic_log(f, seconds=60.0, rate=50.0, seed=0):
+    """ a plausible skid-steer log: STER and PIDS at rate Hz, GPS at 10 Hz, with junk mixed in """
+    rng = np.random.RandomState(seed)
+    writer = LogWriter(f)
+    writer.define(129, 'STER', 'Qhhffff', ['TimeUS', 'SteerIn', 'SteerOut', 'DesLatAcc', 'LatAcc', 'DesTurnRate',
+                                           'TurnRate'])
+    writer.define(130, 'PIDS', 'Qffffffffff', ['TimeUS', 'Tar', 'Act', 'Err', 'P', 'I', 'D', 'FF', 'Dmod', 'SRate',
+                                               'Flags'])
+    writer.define(131, 'GPS', 'QBBIHBcLLeffffB', ['TimeUS', 'I', 'Status', 'GMS', 'GWk', 'NSats', 'HDop', 'Lat',
+                                                  'Lng', 'Alt', 'Spd', 'GCrs', 'VZ', 'Yaw', 'U'])
+    count = int(seconds * rate)
+    time_us = (np.arange(count) / rate * 1e6).astype(np.uint64) + 1000000
+    desired = np.repeat(rng.uniform(-60, 60, count // 100 + 1), 100)[:count]  # deg/s steps every 2 s
+    achieved = np.zeros(count)
+    for index in range(1, count):  # first order response, so the log has both transients and steady states
+        achieved[index] = achieved[index - 1] + (desired[index] - achieved[index - 1]) * 0.08
+    achieved += rng.normal(0, 0.5, count)
+    error = np.radians(desired - achieved)
+    ff, p, i = 0.35 * np.radians(desired), 0.2 * error, np.cumsum(error) * 0.2 / rate
+    output = np.clip(ff + p + i, -1, 1)
+    ster = {'TimeUS': time_us, 'SteerIn': (output * 4500).astype(np.int16),
+            'SteerOut': (output * 4500).astype(np.int16), 'DesTurnRate': desired, 'TurnRate': achieved}
+    pids = {'TimeUS': time_us, 'Tar': np.radians(desired), 'Act': np.radians(achieved), 'Err': error, 'P': p, 'I': i,
+            'FF': ff}
+    gps_count = int(seconds * 10)
+    gps = {'TimeUS': (np.arange(gps_count) * 1e5).astype(np.uint64) + 1000000, 'Status': 6, 'NSats': 24,
+           'Lat': 333125600 + np.arange(gps_count), 'Lng': -1116836600, 'Alt': 133570, 'Spd': 1.2}
+    chunks = []
+    for start in range(0, count, int(rate)):  # one second at a time, interleaved as a real log would be
+        stop = start + int(rate)
+        chunks.append(writer.encode('STER', dict((key, np.broadcast_to(value, (count,))[start:stop])
+                                                 for key, value in ster.items())))
+        chunks.append(writer.encode('PIDS', dict((key, value[start:stop]) for key, value in pids.items())))
+        gps_slice = slice(start // int(rate) * 10, start // int(rate) * 10 + 10)
+        chunks.append(writer.encode('GPS', dict((key, np.broadcast_to(value, (gps_count,))[gps_slice])
+                                                for key, value in gps.items())))
+        chunks.append(bytes(bytearray([HEAD1, HEAD2, 250, HEAD1, HEAD2])) if rng.rand() < 0.05 else b'')
+    f.write(b''.join(chunks))
+    return writer
+
+
+def benchmark(megabytes=100.0):
+    """ writes a synthetic log of about megabytes, then times indexing and decoding it - returns the lines """
+    handle, filename = tempfile.mkstemp(suffix='.bin')
+    lines = []
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            seconds = megabytes * 1e6 / (50 * (27 + 47) + 10 * 49)  # bytes per second of synthetic_log()
+            synthetic_log(f, seconds)
+        size = os.path.getsize(filename) / 1e6
+        start = perf_counter()
+        with DataFlashLog(filename) as log:
+            indexed = perf_counter()
+            counts = log.counts()
+            rate = log.column('STER', 'TurnRate')
+            pids = log.columns('PIDS')
+            done = perf_counter()
+            lines.append('{:.0f} MB, {} messages ({}) indexed in {:.2f} s, STER + PIDS decoded in {:.2f} s'.format(
+                size, len(log.offsets),
+                ', '.join('{} {}'.format(name, count) for name, count in sorted(counts.items())),
+                indexed - start, done - indexed))
+            lines.append('{:.0f} MB/s, {} bytes skipped'.format(size / (done - start), log.skipped_bytes))
+            del rate, pids
+    finally:
+        os.remove(filename)
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='DataFlash .bin log reader')
+    parser.add_argument('log', nargs='?', help='.bin log')
+    parser.add_argument('--dump', metavar='NAME', help='message type to print')
+    parser.add_argument('--fields', help='comma separated columns (default: all numeric)')
+    parser.add_argument('--instance', type=int, help='only this instance (I column)')
+    parser.add_argument('--head', type=int, default=20, help='rows to print (0 for all)')
+    parser.add_argument('--csv', help='write the --dump columns to this CSV file instead')
+    parser.add_argument('--benchmark', type=float, metavar='MB', help='index and decode a synthetic log')
+    args = parser.parse_args(argv)
+
+    if args.benchmark:
+        print('\n'.join(benchmark(args.benchmark)))
+        return 0
+    if not args.log:
+        parser.error('a log file is required')
+    with DataFlashLog(args.log) as log:
+        if not args.dump:
+            print('{}: {} messages, {} bytes not in any message'.format(args.log, len(log.offsets),
+                                                                       log.skipped_bytes))
+            for name, count in sorted(log.counts().items()):
+                definition = log.names[name]
+                print('{:<6} {:>9}  {}'.format(name, count, ','.join(definition.columns)))
+            return 0
+        columns = log.columns(args.dump, args.fields.split(',') if args.fields else None, args.instance)
+        names = list(columns)
+        table = np.column_stack([columns[name] for name in names]) if names else np.zeros((0, 0))
+        if args.csv:
+            np.savetxt(args.csv, table, delimiter=',', header=','.join(names), comments='', fmt='%.10g')
+            print('{} {} rows -> {}'.format(args.dump, len(table), args.csv))
+            return 0
+        print('  '.join('{:>12}'.format(name) for name in names))
+        for row in table[:args.head] if args.head else table:
+            print('  '.join('{:>12.6g}'.format(value) for value in row))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+    mower/dispatch.py
+
+    One OnPacketReceived handler per MAV object, routing packets to the scripts' handlers by msgid
+
+    Instead of every dialog hooking OnPacketReceived (and testing each packet against STATUSTEXT, PARAM_VALUE...)
+    and managing its own SubscribeToPacketType calls, the first subscriber hooks a single Dispatcher to MAV and
+    every packet costs one dict lookup to find the handlers for its msgid.  Each script holds a Subscriber:
+    subscribing the same handler to the same msgid twice only counts a second reference, and closing the
+    Subscriber removes just that script's handlers - the Dispatcher unhooks itself from MAV when the last
+    Subscriber closes.  Handlers take the message, as SubscribeToPacketType handlers do:
+        handlers = subscriber(MAV, 'ServoTuner')
+        handlers.subscribe(MAVLink.MAVLINK_MSG_ID.HEARTBEAT, self.heartbeat_received)
+        handlers.subscribe_all(self.record_packet)  # every packet, whatever its msgid
+        ...
+        print('\\n'.join(handlers.timing_table()))  # calls, mean/worst time and errors per handler
+        handlers.close()
+
+    Handler exceptions are counted (and the first few printed) rather than stopping the other handlers.
+    Runs under IronPython (Mission Planner) and CPython (mower.replay), so no CPython-only features.
+
+"""
+
+from __future__ import print_function
+
+from collections import OrderedDict
+from threading import Lock, RLock
+from timeit import default_timer
+
+ALL = None  # msgid key of the handlers that see every packet
+MAX_PRINTED_ERRORS = 5  # per handler
+
+_dispatchers = {}  # id(mav): Dispatcher shared by every Subscriber of that MAV
+_dispatchers_lock = RLock()  # also held while a Dispatcher attaches or detaches, so the registry always agrees
+
+
+def message_id(msgid):
+    """ integer msgid from an int or a MAVLink.MAVLINK_MSG_ID enum member """
+    return getattr(msgid, 'value__', msgid)
+
+
+def handler_name(handler):
+    name = getattr(handler, '__name__', None) or type(handler).__name__
+    owner = getattr(handler, '__self__', None)
+    return '{}.{}'.format(type(owner).__name__, name) if owner is not None else name
+
+
+class HandlerStats:
+    def __init__(self, owner, name):
+        self.owner = owner
+        self.name = name
+        self.calls = 0
+        self.total = 0.0  # seconds
+        self.worst = 0.0
+        self.errors = 0
+
+    def record(self, seconds):
+        self.calls += 1
+        self.total += seconds
+        if seconds > self.worst:
+            self.worst = seconds
+
+    def error(self, inst):
+        self.errors += 1
+        if self.errors <= MAX_PRINTED_ERRORS:
+            print('{} {}: {}{}'.format(self.owner, self.name, inst,
+                                       ' (further errors not printed)' if self.errors == MAX_PRINTED_ERRORS else ''))
+
+    @property
+    def mean(self):
+        return self.total / self.calls if self.calls else 0.0
+
+    def __str__(self):
+        return '{:<12} {:<40} {:>9} {:>9.1f} {:>9.1f} {:>9.1f} {:>6}'.format(
+            self.owner[:12], self.name[:40], self.calls, self.mean * 1e6, self.worst * 1e6, self.total * 1e3,
+            self.errors)
+
+
+class Route:
+    """ one handler on one msgid - refs counts the subscriptions sharing it """
+
+    def __init__(self, handler, stats):
+        self.handler = handler
+        self.stats = stats
+        self.refs = 1
+
+
+class Dispatcher:
+    def __init__(self, mav, timing=True, clock=default_timer):
+        self.mav = mav
+        self.timing = timing
+        self.clock = clock
+        self.routes = {}  # msgid (or ALL): tuple of Route, replaced rather than modified so dispatch needs no lock
+        self.stats = OrderedDict()  # (owner, handler name): HandlerStats
+        self.subscribers = 0
+        self.packets = 0
+        self.unrouted = 0  # packets no handler wanted
+        self.attached = False
+        self._lock = Lock()
+
+    def add(self, msgid, handler, owner=''):
+        """ routes msgid (ALL for every packet) to handler - returns the handler's reference count """
+        msgid = message_id(msgid)
+        with self._lock:
+            routes = self.routes.get(msgid, ())
+            for route in routes:
+                if route.handler == handler:
+                    route.refs += 1
+                    return route.refs
+            key = (owner, handler_name(handler))
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = HandlerStats(*key)
+            self.routes[msgid] = routes + (Route(handler, stats),)
+        return 1
+
+    def remove(self, msgid, handler):
+        """ drops one reference - returns the references left (0 once the handler no longer sees msgid) """
+        msgid = message_id(msgid)
+        with self._lock:
+            routes = self.routes.get(msgid, ())
+            for route in routes:
+                if route.handler == handler:
+                    route.refs -= 1
+                    if route.refs > 0:
+                        return route.refs
+                    remaining = tuple(other for other in routes if other is not route)
+                    if remaining:
+                        self.routes[msgid] = remaining
+                    else:
+                        del self.routes[msgid]
+                    return 0
+        return 0
+
+    def acquire(self):
+        with _dispatchers_lock:
+            self.subscribers += 1
+            if not self.attached:
+                self.attached = True
+                _dispatchers.setdefault(id(self.mav), self)
+                self.mav.OnPacketReceived += self.dispatch
+
+    def release(self):
+        """ unhooks from MAV, clears every route and leaves the registry once the last subscriber has released -
+            all in one step, so a subscriber arriving meanwhile can neither reattach a dispatcher on its way out of
+            the registry nor create a second one on the same MAV """
+        with _dispatchers_lock:
+            self.subscribers = max(self.subscribers - 1, 0)
+            if not self.attached or self.subscribers:
+                return
+            self.attached = False
+            with self._lock:
+                self.routes = {}
+            self.mav.OnPacketReceived -= self.dispatch
+            if _dispatchers.get(id(self.mav)) is self:
+                del _dispatchers[id(self.mav)]
+
+    def dispatch(self, sender, message):
+        """ the OnPacketReceived handler """
+        self.packets += 1
+        routes = self.routes
+        specific = routes.get(message.msgid, ())
+        every = routes.get(ALL, ())
+        if not specific and not every:
+            self.unrouted += 1
+            return
+        for group in (every, specific):
+            for route in group:
+                if self.timing:
+                    start = self.clock()
+                    try:
+                        route.handler(message)
+                    except Exception as inst:
+                        route.stats.error(inst)
+                    route.stats.record(self.clock() - start)
+                else:
+                    route.stats.calls += 1
+                    try:
+                        route.handler(message)
+                    except Exception as inst:
+                        route.stats.error(inst)
+
+    def handler_count(self):
+        routes = self.routes
+        return sum(len(group) for group in routes.values())
+
+    def timing_table(self, owner=None):
+        """ text lines, busiest handler first """
+        stats = [entry for entry in self.stats.values() if owner is None or entry.owner == owner]
+        stats.sort(key=lambda entry: entry.total, reverse=True)
+        lines = ['{:<12} {:<40} {:>9} {:>9} {:>9} {:>9} {:>6}'.format('owner', 'handler', 'calls', 'mean us',
+                                                                       'worst us', 'total ms', 'errors')]
+        lines.extend(str(entry) for entry in stats)
+        return lines
+
+    def status_text(self):
+        return '{} packets, {} unrouted, {} handlers on {} msgids, {} subscribers'.format(
+            self.packets, self.unrouted, self.handler_count(), len(self.routes), self.subscribers)
+
+
+class Subscriber:
+    """ one script's handlers on the shared Dispatcher - close() removes exactly these """
+
+    def __init__(self, dispatcher, owner):
+        self.dispatcher = dispatcher
+        self.owner = owner
+        self.subscriptions = []  # (msgid, handler), one entry per reference taken
+        self.closed = False
+        dispatcher.acquire()
+
+    def subscribe(self, msgid, handler):
+        self.dispatcher.add(msgid, handler, self.owner)
+        self.subscriptions.append((message_id(msgid), handler))
+
+    def subscribe_all(self, handler):
+        self.subscribe(ALL, handler)
+
+    def unsubscribe(self, msgid, handler):
+        msgid = message_id(msgid)
+        for index, (subscribed, subscribed_handler) in enumerate(self.subscriptions):
+            if subscribed == msgid and subscribed_handler == handler:
+                del self.subscriptions[index]
+                return self.dispatcher.remove(msgid, handler)
+        return 0
+
+    def timing_table(self):
+        return self.dispatcher.timing_table(self.owner)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for msgid, handler in self.subscriptions:
+            self.dispatcher.remove(msgid, handler)
+        self.subscriptions = []
+        self.dispatcher.release()
+
+
+def subscriber(mav, owner, timing=True):
+    """ a Subscriber on mav's shared Dispatcher, creating (and hooking) the Dispatcher on first use """
+    with _dispatchers_lock:
+        dispatcher = _dispatchers.get(id(mav))
+        if dispatcher is None:
+            dispatcher = _dispatchers[id(mav)] = Dispatcher(mav, timing)
+        return Subscriber(dispatcher, owner)
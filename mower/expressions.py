@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+    mower/expressions.py
+
+    User-defined derived fields computed from fields of any MAVLink message type
+
+    Definitions look like:
+        power_w = SYS_STATUS.voltage_battery / 1000 * SYS_STATUS.current_battery / 100
+        xtrack_cm = NAV_CONTROLLER_OUTPUT.xtrack_error * 100
+        speed_error = VFR_HUD.groundspeed - WP_SPEED
+
+    MESSAGE.field references are inputs, bare UPPER_CASE names are vehicle parameters (resolved once, when the
+    expression is bound).  Each expression is compiled to a code object once.  Incoming messages only trigger
+    re-evaluation of the expressions that depend on a field that actually changed.
+
+"""
+
+from __future__ import division
+
+import math
+import re
+
+DERIVED_MESSAGE_NAME = 'DERIVED'
+
+FIELD_REFERENCE = re.compile(r'\b([A-Z][A-Z0-9_]*)\.([A-Za-z_][A-Za-z0-9_]*)\b')
+PARAM_REFERENCE = re.compile(r'(?<![\w.])([A-Z][A-Z0-9_]*[A-Z0-9])\b(?!\s*\()')
+DEFINITION = re.compile(r'^\s*([A-Za-z_][A-Za-z0-9_]*)\s*=\s*(.+?)\s*$')
+
+FUNCTIONS = {'abs': abs, 'min': min, 'max': max, 'round': round, 'sqrt': math.sqrt, 'hypot': math.hypot,
+             'sin': math.sin, 'cos': math.cos, 'tan': math.tan, 'atan2': math.atan2, 'degrees': math.degrees,
+             'radians': math.radians, 'log': math.log, 'exp': math.exp, 'pi': math.pi}
+
+
+class ExpressionError(Exception):
+    pass
+
+
+def code_names(code):
+    """ the global and attribute names used by code and every code object nested in it (lambdas, comprehensions) """
+    names = list(code.co_names)
+    for const in code.co_consts:
+        if hasattr(const, 'co_names'):
+            names.extend(code_names(const))
+    return names
+
+
+class DerivedField:
+    def __init__(self, name, source):
+        self.name = name
+        self.source = source
+        self.inputs = []  # [(message_name, field_name)], position i is variable _i in the compiled code
+        self.params = []  # parameter names, variable _pi
+        self.value = None
+        self.error = None
+
+        def field_variable(match):
+            key = (match.group(1), match.group(2))
+            if key not in self.inputs:
+                self.inputs.append(key)
+            return '_{}'.format(self.inputs.index(key))
+
+        def param_variable(match):
+            if match.group(1) not in self.params:
+                self.params.append(match.group(1))
+            return '_p{}'.format(self.params.index(match.group(1)))
+
+        rewritten = PARAM_REFERENCE.sub(param_variable, FIELD_REFERENCE.sub(field_variable, source))
+        try:
+            self.code = compile(rewritten, '<{}>'.format(name), 'eval')
+        except SyntaxError as inst:
+            raise ExpressionError('{}: {}'.format(name, inst))
+        allowed = set(FUNCTIONS)
+        allowed.update('_{}'.format(x) for x in range(len(self.inputs)))
+        allowed.update('_p{}'.format(x) for x in range(len(self.params)))
+        unknown = sorted(set(n for n in code_names(self.code) if n not in allowed))
+        if unknown:
+            raise ExpressionError('{}: unknown name(s) {}'.format(name, ', '.join(unknown)))
+        self.namespace = dict(FUNCTIONS)
+        self.namespace['__builtins__'] = {}
+
+    def bind_params(self, param_lookup):
+        """ resolves parameter references to constants - param_lookup(name) returns a number """
+        for index, param_name in enumerate(self.params):
+            try:
+                self.namespace['_p{}'.format(index)] = float(param_lookup(param_name))
+            except KeyError:
+                raise ExpressionError('{}: unknown parameter {}'.format(self.name, param_name))
+
+    def evaluate(self):
+        """ returns True if the value changed """
+        try:
+            value = eval(self.code, self.namespace)
+            self.error = None
+        except (ArithmeticError, ValueError, TypeError, NameError) as inst:
+            value = None
+            self.error = str(inst)
+        if value == self.value:
+            return False
+        self.value = value
+        return True
+
+
+class DerivedFields:
+    def __init__(self, param_lookup=None):
+        self.param_lookup = param_lookup
+        self.fields = []
+        self.values = {}  # name: latest value, in the same shape as MessageMonitor.received_messages entries
+        self._dependents = {}  # message name: [(field name, DerivedField, variable name)]
+        self._missing = {}  # DerivedField: number of inputs not yet received
+
+    def __len__(self):
+        return len(self.fields)
+
+    def add(self, name, source):
+        if name in self.values:
+            raise ExpressionError('{}: defined more than once'.format(name))
+        field = DerivedField(name, source)
+        if field.params:
+            if self.param_lookup is None:
+                raise ExpressionError('{}: parameters referenced but no parameter source'.format(name))
+            field.bind_params(self.param_lookup)
+        for index, (message_name, field_name) in enumerate(field.inputs):
+            variable = '_{}'.format(index)
+            self._dependents.setdefault(message_name, []).append((field_name, field, variable))
+            field.namespace[variable] = None
+        self._missing[field] = len(field.inputs)
+        self.fields.append(field)
+        self.values[name] = None
+        if not field.inputs and field.evaluate():  # constant expression
+            self.values[name] = field.value
+        return field
+
+    def load(self, lines):
+        """ adds 'name = expression' definitions, skipping blanks and # comments - returns a list of errors """
+        errors = []
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            match = DEFINITION.match(line)
+            if match is None:
+                errors.append('not a definition: {}'.format(line))
+                continue
+            try:
+                self.add(match.group(1), match.group(2))
+            except ExpressionError as inst:
+                errors.append(str(inst))
+        return errors
+
+    def rebind_params(self):
+        """ re-resolves parameter constants (after a parameter change) - returns the changed values """
+        changed = {}
+        for field in self.fields:
+            if field.params:
+                try:
+                    field.bind_params(self.param_lookup)
+                except ExpressionError as inst:
+                    field.error = str(inst)
+                    continue
+                if not self._missing[field] and field.evaluate():
+                    self.values[field.name] = changed[field.name] = field.value
+        return changed
+
+    def update(self, message_name, msg_data):
+        """ feeds one message - returns {name: value} for derived fields whose value changed """
+        dependents = self._dependents.get(message_name)
+        if dependents is None:
+            return None
+        dirty = []
+        for field_name, field, variable in dependents:
+            try:
+                value = msg_data[field_name]
+            except KeyError:
+                continue
+            previous = field.namespace[variable]
+            if previous == value:
+                continue
+            if previous is None:
+                self._missing[field] -= 1
+            field.namespace[variable] = value
+            if field not in dirty:
+                dirty.append(field)
+        changed = {}
+        for field in dirty:
+            if not self._missing[field] and field.evaluate():
+                self.values[field.name] = changed[field.name] = field.value
+        return changed
@@ -0,0 +1,521 @@
+# -*- coding: utf-8 -*-
+"""
+    mower/headless.py
+
+    CPython backends for the vehicle link, and the monitor's packet handling running on them without Mission Planner
+
+    Both backends run on an asyncio loop in their own process, raise OnPacketReceived with the same message shape
+    Mission Planner uses (msgid, data.<field>, buffer), send GCS heartbeats, fetch the parameters on connection
+    and implement mower.backend's set_param() and send_rc_override():
+        FrameBackend        mower/mavlink.py framing, no dependencies - TCP (reconnecting), UDP or a serial device
+        PymavlinkBackend    pymavlink's mavutil (optional, pip install pymavlink) - every message decoded
+
+    Connection strings follow mavutil: tcp:HOST:PORT (e.g. the ser2net or serial_bridge port on the fixed base),
+    udpin:HOST:PORT to listen, udpout:HOST:PORT to send, anything else is a serial device (--baud):
+        python -m mower.headless --connect tcp:raspberrypi.local:2000 --watch VFR_HUD.groundspeed \\
+            --watch GPS_RAW_INT.eph:0:100
+        python -m mower.headless --connect /dev/ttyACM0 --baud 115200 --pymavlink --set CRUISE_SPEED=1.2
+        python -m mower.headless --self-test    # against mavmux's local stand-in vehicle, no hardware required
+
+    Requires CPython 3.7+ (asyncio), never imported by the Mission Planner scripts.
+
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+from abc import ABC, abstractmethod
+from time import time
+
+from mower.backend import Backend
+from mower.expressions import DERIVED_MESSAGE_NAME, DerivedFields
+from mower.mavlink import MSG_IDS, FrameParser, check_crc, encode_message
+from mower.overrides import override_fields
+from mower.params import text_field
+from mower.replay import Event, MessageData, ReplayMessage, attach_monitor, attach_servo_monitor, message_from_frame
+from mower.serial_bridge import READ_SIZE, open_serial, read_serial
+from mower.statustext import SEVERITY, StatusTextLog
+
+GCS_SYSID = 255  # SYSID_MYGCS default - the vehicle ignores RC overrides from any other system
+GCS_COMPID = 190  # MAV_COMP_ID_MISSIONPLANNER
+DEFAULT_BAUD = 115200
+HEARTBEAT_INTERVAL = 1.0  # seconds
+RECONNECT_INTERVAL = 2.0  # seconds
+POLL_INTERVAL = 0.01  # seconds, for pymavlink connections without a file descriptor (Windows serial)
+UPDATE_INTERVAL = 0.1  # seconds between alert evaluations, as min_monitor's display timer
+DEFAULT_REPORT_INTERVAL = 5.0  # seconds
+PARAM_TYPE_REAL32 = 9
+PARAM_TOLERANCE = 1e-6  # relative - values travel as float32
+DEFAULT_WATCHES = ['VFR_HUD.groundspeed', 'GPS_RAW_INT.eph:0:100', 'SYS_STATUS.voltage_battery',
+                   'NAV_CONTROLLER_OUTPUT.xtrack_error']
+SELF_TEST_PARAMS = {'CRUISE_SPEED': 1.5, 'CRUISE_THROTTLE': 40.0, 'ATC_STR_RAT_FF': 0.2, 'RCMAP_YAW': 4.0}
+
+log = logging.getLogger('headless')
+
+
+def parse_connection(text):
+    """ (kind, host or device, port) - kind is tcp, udpin, udpout or serial """
+    kind, _, address = text.partition(':')
+    if kind in ('tcp', 'udpin', 'udpout', 'udp'):
+        host, port = address.rsplit(':', 1)
+        return 'udpin' if kind == 'udp' else kind, host, int(port)
+    return 'serial', text, None
+
+
+class LinkBackend(Backend, ABC):
+    """ base for the CPython backends - the backend is its own MAV, raising OnPacketReceived on the asyncio loop """
+
+    def __init__(self, connection, baud=DEFAULT_BAUD, target_system=1, target_component=1, sysid=GCS_SYSID,
+                 compid=GCS_COMPID):
+        Backend.__init__(self, self)
+        self.OnPacketReceived = Event()
+        self.connection = connection
+        self.baud = baud
+        self.target_system = target_system
+        self.target_component = target_component
+        self.sysid = sysid
+        self.compid = compid
+        self.packets = 0
+        self.bad_crc = 0
+        self.sent = 0
+        self.dropped = 0  # messages sent while the link was down
+        self._tasks = []
+        self.start_params()
+
+    async def start(self):
+        await self.open()
+        self._tasks.append(asyncio.ensure_future(self._heartbeat()))
+        self.request_params()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self.close()
+        self.close_link()
+
+    @abstractmethod
+    async def open(self):
+        pass
+
+    @abstractmethod
+    def close_link(self):
+        pass
+
+    @abstractmethod
+    def send_message(self, name, **fields):
+        """ returns False if the link is down """
+
+    async def _heartbeat(self):
+        while True:
+            self.send_message('HEARTBEAT', type=6, autopilot=8, base_mode=0, custom_mode=0, system_status=4,
+                              mavlink_version=3)  # MAV_TYPE_GCS, MAV_AUTOPILOT_INVALID, MAV_STATE_ACTIVE
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    def receive(self, message):
+        self.packets += 1
+        self.OnPacketReceived(self, message)
+
+    def request_params(self):
+        self.params.source = self.connection
+        self.send_message('PARAM_REQUEST_LIST', target_system=self.target_system,
+                          target_component=self.target_component)
+
+    def set_param(self, name, value):
+        return self.send_message('PARAM_SET', target_system=self.target_system,
+                                 target_component=self.target_component, param_id=name.encode('ascii'),
+                                 param_value=float(value), param_type=PARAM_TYPE_REAL32)
+
+    async def wait_link(self, timeout=10.0):
+        """ True once anything has been received """
+        deadline = time() + timeout
+        while not self.packets and time() < deadline:
+            await asyncio.sleep(0.05)
+        return self.packets > 0
+
+    async def wait_param(self, name, value, timeout=5.0):
+        """ True once the cache holds value (the vehicle's PARAM_VALUE reply) """
+        deadline = time() + timeout
+        while time() < deadline:
+            current = self.params.get(name)
+            if current is not None and abs(current - value) <= PARAM_TOLERANCE * max(abs(value), 1.0):
+                return True
+            await asyncio.sleep(0.05)
+        return False
+
+    def send_rc_override(self, channels):
+        return self.send_message('RC_CHANNELS_OVERRIDE', **override_fields(channels, self.target_system,
+                                                                           self.target_component))
+
+    def status_text(self):
+        return '{} {}: {} packets ({} bad CRC), {} sent ({} dropped), {} parameters'.format(
+            self.name, self.connection, self.packets, self.bad_crc, self.sent, self.dropped, len(self.params))
+
+
+class DatagramLink(asyncio.DatagramProtocol):
+    def __init__(self, backend):
+        self.backend = backend
+
+    def datagram_received(self, data, addr):
+        self.backend.peer = addr  # udpin replies to whoever last sent
+        self.backend.feed(data)
+
+
+class FrameBackend(LinkBackend):
+    """ mower/mavlink.py framing - messages missing from mavlink.MESSAGES arrive with empty data """
+
+    name = 'mower.mavlink'
+
+    def __init__(self, *args, **kwargs):
+        LinkBackend.__init__(self, *args, **kwargs)
+        self.parser = FrameParser()
+        self.seq = 0
+        self.kind = None
+        self.writer = None  # tcp
+        self.transport = None  # udp
+        self.peer = None
+        self.fd = None  # serial
+
+    async def open(self):
+        self.kind, host, port = parse_connection(self.connection)
+        loop = asyncio.get_event_loop()
+        if self.kind == 'tcp':
+            self._tasks.append(asyncio.ensure_future(self._run_tcp(host, port)))
+        elif self.kind in ('udpin', 'udpout'):
+            address = {'local_addr': (host, port)} if self.kind == 'udpin' else {'remote_addr': (host, port)}
+            self.transport, protocol = await loop.create_datagram_endpoint(lambda: DatagramLink(self), **address)
+            self.peer = (host, port) if self.kind == 'udpout' else None
+        else:
+            self.fd = open_serial(host, self.baud)
+            self._tasks.append(asyncio.ensure_future(self._run_serial(host)))
+
+    async def _run_tcp(self, host, port):
+        """ reads the link, reconnecting whenever it drops (as mavmux does with the vehicle) """
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(host, port)
+            except OSError as inst:
+                log.info('%s: %s', self.connection, inst)
+                await asyncio.sleep(RECONNECT_INTERVAL)
+                continue
+            self.writer = writer
+            log.info('%s connected', self.connection)
+            if len(self.params) == 0:
+                self.request_params()
+            try:
+                while True:
+                    data = await reader.read(READ_SIZE)
+                    if not data:
+                        break
+                    self.feed(data)
+            except (ConnectionError, OSError) as inst:
+                log.info('%s: %s', self.connection, inst)
+            finally:
+                self.writer = None
+                writer.close()
+            await asyncio.sleep(RECONNECT_INTERVAL)
+
+    async def _run_serial(self, device):
+        """ reads the device until it goes away (EOF or EIO, e.g. an unplugged USB adapter), then reopens it """
+        loop = asyncio.get_event_loop()
+        while True:
+            hangup = loop.create_future()
+            loop.add_reader(self.fd, self._read_serial, hangup)
+            log.info('%s: %s', self.connection, await hangup)
+            self.close_serial()
+            while self.fd is None:
+                await asyncio.sleep(RECONNECT_INTERVAL)
+                try:
+                    self.fd = open_serial(device, self.baud)
+                except OSError as inst:
+                    log.info('%s: %s', self.connection, inst)
+            log.info('%s reopened', self.connection)
+            if len(self.params) == 0:
+                self.request_params()
+
+    def _read_serial(self, hangup):
+        try:
+            data = read_serial(self.fd)
+        except EOFError as inst:
+            asyncio.get_event_loop().remove_reader(self.fd)  # a dead fd stays readable - stop watching it at once
+            if not hangup.done():
+                hangup.set_result(inst)
+            return
+        if data is not None:
+            self.feed(data)
+
+    def feed(self, data):
+        for frame in self.parser.feed(data):
+            if not check_crc(frame):
+                self.bad_crc += 1
+                continue
+            self.receive(message_from_frame(frame))
+
+    def send_message(self, name, **fields):
+        data = encode_message(name, self.seq, self.sysid, self.compid, **fields)
+        self.seq = (self.seq + 1) & 0xFF
+        try:
+            if self.kind == 'tcp' and self.writer is not None:
+                self.writer.write(data)
+            elif self.transport is not None and self.peer is not None:
+                self.transport.sendto(data, self.peer)
+            elif self.fd is not None:
+                os.write(self.fd, data)
+            else:
+                self.dropped += 1
+                return False
+        except (BlockingIOError, ConnectionError, OSError):
+            self.dropped += 1
+            return False
+        self.sent += 1
+        return True
+
+    def close_link(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        self.close_serial()
+
+    def close_serial(self):
+        if self.fd is not None:
+            asyncio.get_event_loop().remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+
+class PymavlinkBackend(LinkBackend):
+    """ pymavlink's mavutil connection, read on the asyncio loop whenever its file descriptor is readable """
+
+    name = 'pymavlink'
+
+    def __init__(self, *args, **kwargs):
+        LinkBackend.__init__(self, *args, **kwargs)
+        self.link = None
+        self.fd = None
+
+    async def open(self):
+        try:
+            from pymavlink import mavutil
+        except ImportError:
+            raise RuntimeError('pymavlink is not installed (pip install pymavlink) - leave out --pymavlink to use '
+                               'the built-in framing')
+        self.link = mavutil.mavlink_connection(self.connection, baud=self.baud, source_system=self.sysid,
+                                               source_component=self.compid, autoreconnect=True)
+        self.fd = getattr(self.link, 'fd', None)
+        if self.fd is not None:
+            asyncio.get_event_loop().add_reader(self.fd, self._readable)
+        else:
+            self._tasks.append(asyncio.ensure_future(self._poll()))
+
+    async def _poll(self):
+        while True:
+            self._readable()
+            await asyncio.sleep(POLL_INTERVAL)
+
+    def _readable(self):
+        while True:
+            msg = self.link.recv_msg()
+            if msg is None:
+                return
+            if msg.get_type() == 'BAD_DATA':
+                self.bad_crc += 1
+                continue
+            self.receive(self.adapt(msg))
+
+    @staticmethod
+    def adapt(msg):
+        """ a pymavlink message in the shape Mission Planner's handlers expect """
+        fields = msg.to_dict()
+        fields.pop('mavpackettype', None)
+        return ReplayMessage(msg.get_msgId(), MessageData(**fields), bytes(msg.get_msgbuf()), msg.get_srcSystem(),
+                             msg.get_srcComponent(), msg.get_seq())
+
+    def send_message(self, name, **fields):
+        try:
+            getattr(self.link.mav, name.lower() + '_send')(**fields)
+        except (ConnectionError, OSError):
+            self.dropped += 1
+            return False
+        self.sent += 1
+        return True
+
+    def close_link(self):
+        if self.link is not None:
+            if self.fd is not None:
+                asyncio.get_event_loop().remove_reader(self.fd)
+            self.link.close()
+            self.link = None
+
+
+class HeadlessMonitor:
+    """ MinMonitor's rows and alerts, ServoTuner's servo outputs and the STATUSTEXT log on any backend,
+        reported as text """
+
+    def __init__(self, backend, watches=(), definitions=(), echo_status=True):
+        self.backend = backend
+        self.handlers = backend.subscriber('Headless')
+        self.monitor = attach_monitor(self.handlers, watches)  # the backend keeps its own params current
+        self.definitions = list(definitions)
+        self.params_version = None  # of the parameters the derived fields were loaded or last bound with
+        self.servos = attach_servo_monitor(self.handlers)
+        self.status_log = StatusTextLog()
+        self.echo_status = echo_status
+        self.handlers.subscribe(MSG_IDS['STATUSTEXT'], self.statustext_received)
+
+    def statustext_received(self, message):
+        entry = self.status_log.add(message.data.severity, text_field(message.data.text))
+        if self.echo_status:
+            print(SEVERITY[entry.severity] + entry.text)
+        return True
+
+    def update_params(self):
+        """ loads the derived fields once the backend has fetched the parameters, then rebinds them whenever a
+            parameter changes, as MinMonitorForm's update_tick does - returns True if anything was (re)bound """
+        params = self.backend.params
+        if not self.definitions or params.version == self.params_version or not params.complete():
+            return False
+        if self.params_version is None:
+            derived = DerivedFields(params.__getitem__)
+            for error in derived.load(self.definitions):
+                print('Derived field error: ' + error)
+            self.monitor.set_derived(derived)
+        else:
+            self.monitor.display_message_data(DERIVED_MESSAGE_NAME, self.monitor.derived.rebind_params())
+        self.params_version = params.version
+        return True
+
+    def evaluate_alerts(self, now=None):
+        changed = self.monitor.evaluate_alerts(now)
+        if changed:
+            for alert_event in list(self.monitor.alerts.history)[-len(changed):]:
+                print(alert_event)
+        return changed
+
+    def report(self):
+        lines = [self.backend.status_text(), self.monitor.alerts.summary()]
+        for row in self.monitor.rows:
+            lines.append('  {}.{}: {}{}  [{}]'.format(row.message_name, row.field_name, row.text,
+                                                     ' ALERT' if row.alarm else '', row.history.stats.summary()))
+        servos = self.servos
+        outputs = ['{}={}'.format(x + 1, servos.value[x]) for x in range(servos.num_servos) if servos.has_extremes(x)]
+        if outputs:
+            lines.append('  servos: ' + '  '.join(outputs))
+        return lines
+
+    async def run(self, interval=DEFAULT_REPORT_INTERVAL, duration=None):
+        start = next_report = time()
+        while duration is None or time() - start < duration:
+            await asyncio.sleep(UPDATE_INTERVAL)
+            now = time()
+            self.update_params()
+            self.evaluate_alerts(now)
+            if interval and now >= next_report:
+                next_report = now + interval
+                print('\n'.join(self.report()))
+
+    def close(self):
+        self.handlers.close()
+
+
+def make_backend(connection, baud=DEFAULT_BAUD, use_pymavlink=False):
+    return (PymavlinkBackend if use_pymavlink else FrameBackend)(connection, baud)
+
+
+async def run(args):
+    backend = make_backend(args.connect, args.baud, args.pymavlink)
+    await backend.start()
+    monitor = HeadlessMonitor(backend, args.watch or DEFAULT_WATCHES, args.derive)
+    try:
+        if args.set and not await backend.wait_link():
+            print('{}: nothing received, parameters not set'.format(args.connect))
+        else:
+            for setting in args.set:
+                name, value = setting.split('=', 1)
+                backend.set_param(name, float(value))
+                ok = await backend.wait_param(name, float(value))
+                print('{} = {}: {}'.format(name, value, 'acknowledged' if ok else 'no reply'))
+        await monitor.run(args.interval, args.duration)
+    finally:
+        print('\n'.join(monitor.handlers.timing_table()))
+        monitor.close()
+        await backend.stop()
+
+
+async def self_test(seconds=3.0, use_pymavlink=False):
+    """ the headless monitor on a backend connected to mavmux's stand-in vehicle - checks packets are routed to
+        the monitor rows and servo monitor, parameters are fetched and set, and RC overrides arrive """
+    from mower.mavmux import StandInVehicle  # only the self-test needs the router module
+    vehicle = StandInVehicle(speed=5.0, params=SELF_TEST_PARAMS)
+    await vehicle.start()
+    backend = make_backend('tcp:127.0.0.1:{}'.format(vehicle.port), use_pymavlink=use_pymavlink)
+    await backend.start()
+    monitor = HeadlessMonitor(backend, DEFAULT_WATCHES, echo_status=False)
+    linked = await backend.wait_link(RECONNECT_INTERVAL * 2)
+    await monitor.run(seconds, seconds)
+    set_ok = backend.set_param('CRUISE_SPEED', 2.0) and await backend.wait_param('CRUISE_SPEED', 2.0)
+    backend.send_rc_override([(1, 1600), (3, 1400), (9, 1200)])
+    await asyncio.sleep(0.5)
+    monitor.close()
+    heartbeats = vehicle.received.get((GCS_SYSID, MSG_IDS['HEARTBEAT']), 0)
+    await backend.stop()
+    await vehicle.stop()
+
+    checks = [(linked, '{} connected to the stand-in vehicle'.format(backend.name))]
+    checks.append((len(backend.params) == len(SELF_TEST_PARAMS), '{} of {} parameters fetched'.format(
+        len(backend.params), len(SELF_TEST_PARAMS))))
+    updated = [len(row.history.stats) for row in monitor.monitor.rows]
+    checks.append((backend.packets > 0 and all(updated), '{} packets, monitor row samples {}'.format(
+        backend.packets, updated)))
+    checks.append((monitor.servos.samples[0] > 0, 'servo monitor saw {} SERVO_OUTPUT_RAW'.format(
+        monitor.servos.samples[0])))
+    checks.append((monitor.status_log.received > 0, '{} STATUSTEXT messages logged'.format(
+        monitor.status_log.received)))
+    checks.append((bool(set_ok) and vehicle.params['CRUISE_SPEED'] == 2.0, 'CRUISE_SPEED set and acknowledged'))
+    checks.append((vehicle.overrides == {1: 1600, 3: 1400, 9: 1200}, 'RC override arrived as {}'.format(
+        vehicle.overrides)))
+    checks.append((heartbeats > 0 and not vehicle.bad_crc, 'vehicle received {} GCS heartbeats, {} bad CRC'.format(
+        heartbeats, vehicle.bad_crc)))
+    for ok, text in checks:
+        print(('ok    ' if ok else 'FAIL  ') + text)
+    return all(ok for ok, text in checks)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='MinMonitor/ServoTuner packet handling without Mission Planner')
+    parser.add_argument('--connect', help='tcp:HOST:PORT, udpin:HOST:PORT, udpout:HOST:PORT or a serial device')
+    parser.add_argument('--baud', type=int, default=DEFAULT_BAUD, help='serial baud rate')
+    parser.add_argument('--pymavlink', action='store_true', help='use pymavlink instead of the built-in framing')
+    parser.add_argument('--watch', action='append', default=None, metavar='MESSAGE.field[:min:max]',
+                        help='monitor row, optionally with alert thresholds (repeatable)')
+    parser.add_argument('--derive', action='append', default=[], metavar='NAME=EXPRESSION',
+                        help='derived field, watched as DERIVED.NAME (repeatable)')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE', help='set a parameter first')
+    parser.add_argument('--interval', type=float, default=DEFAULT_REPORT_INTERVAL, help='seconds between reports')
+    parser.add_argument('--duration', type=float, default=None, help='seconds to run (default: until Ctrl-C)')
+    parser.add_argument('--self-test', action='store_true', help='run against a local stand-in vehicle')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s %(name)s %(message)s')
+
+    if not args.connect and not args.self_test:
+        parser.error('--connect is required')
+    try:
+        if args.self_test:
+            ok = asyncio.run(self_test(use_pymavlink=args.pymavlink))
+            print('PASS' if ok else 'FAIL')
+            return 0 if ok else 1
+        asyncio.run(run(args))
+    except RuntimeError as inst:
+        print(inst)
+        return 1
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+    mower/history.py
+
+    Fixed-capacity value history with incrementally maintained rolling statistics
+
+    Everything is preallocated when a history is created, so memory use stays constant
+    no matter how long a session runs.  Statistics are updated as samples enter and leave
+    the window rather than by rescanning it.
+
+"""
+
+from __future__ import division
+
+from array import array
+from bisect import bisect_left, insort
+from collections import deque
+from math import isinf, isnan, sqrt
+from time import time
+
+SPARK_CHARS = u'▁▂▃▄▅▆▇█'
+
+
+def finite(value):
+    """ not NaN or infinite (math.isfinite is not available in IronPython 2.7) """
+    return not (isnan(value) or isinf(value))
+
+
+class RingBuffer:
+    """ preallocated circular buffer of (timestamp, value) pairs stored as arrays of doubles """
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1')
+        self.capacity = int(capacity)
+        self.values = array('d', [0.0] * self.capacity)
+        self.times = array('d', [0.0] * self.capacity)
+        self.head = 0  # index of the next write
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, value, timestamp):
+        """ stores a sample, returning the evicted value (or None if the buffer was not yet full) """
+        evicted = None
+        if self.count == self.capacity:
+            evicted = self.values[self.head]
+        else:
+            self.count += 1
+        self.values[self.head] = value
+        self.times[self.head] = timestamp
+        self.head = (self.head + 1) % self.capacity
+        return evicted
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+
+    def oldest_index(self):
+        return (self.head - self.count) % self.capacity
+
+    def latest(self):
+        if not self.count:
+            return None
+        return self.values[(self.head - 1) % self.capacity]
+
+    def ordered_values(self):
+        """ oldest to newest copy of the stored values """
+        start = self.oldest_index()
+        if start + self.count <= self.capacity:
+            return self.values[start:start + self.count]
+        return self.values[start:] + self.values[:self.head]
+
+    def ordered_times(self):
+        start = self.oldest_index()
+        if start + self.count <= self.capacity:
+            return self.times[start:start + self.count]
+        return self.times[start:] + self.times[:self.head]
+
+
+class RollingStats:
+    """ min/max/mean/stddev/percentiles over the samples currently held in a RingBuffer
+
+        mean and variance use Welford's update (and its inverse for evicted samples),
+        min and max use monotonic queues and percentiles use a sorted copy of the window,
+        so no operation rescans the whole window - NaN and infinite samples are rejected, as one would
+        poison the running sums for good """
+
+    def __init__(self, capacity):
+        self.buffer = RingBuffer(capacity)
+        self._sorted = array('d')
+        self._min_queue = deque()  # (sequence, value), values increasing
+        self._max_queue = deque()  # (sequence, value), values decreasing
+        self._sequence = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        self.rejected = 0  # non-finite samples not added
+
+    def __len__(self):
+        return self.buffer.count
+
+    def append(self, value, timestamp=None):
+        """ returns False (and stores nothing) for a NaN or infinite value """
+        value = float(value)
+        if not finite(value):
+            self.rejected += 1
+            return False
+        if timestamp is None:
+            timestamp = time()
+        full = self.buffer.count == self.buffer.capacity
+        evicted = self.buffer.append(value, timestamp)
+        if full:
+            self._remove(evicted)
+        self._add(value)
+        return True
+
+    def _add(self, value):
+        n = self.buffer.count
+        delta = value - self._mean
+        self._mean += delta / n
+        self._m2 += delta * (value - self._mean)
+
+        insort(self._sorted, value)
+
+        oldest = self._sequence - self.buffer.capacity + 1
+        while self._min_queue and self._min_queue[-1][1] >= value:
+            self._min_queue.pop()
+        self._min_queue.append((self._sequence, value))
+        while self._min_queue[0][0] < oldest:
+            self._min_queue.popleft()
+        while self._max_queue and self._max_queue[-1][1] <= value:
+            self._max_queue.pop()
+        self._max_queue.append((self._sequence, value))
+        while self._max_queue[0][0] < oldest:
+            self._max_queue.popleft()
+        self._sequence += 1
+
+    def _remove(self, value):
+        """ inverse Welford step for the sample leaving the window (count already excludes it) """
+        n = self.buffer.count - 1
+        if n <= 0:
+            self._mean, self._m2 = 0.0, 0.0
+        else:
+            delta = value - self._mean
+            self._mean -= delta / n
+            self._m2 = max(self._m2 - delta * (value - self._mean), 0.0)
+        del self._sorted[bisect_left(self._sorted, value)]
+
+    def clear(self):
+        self.buffer.clear()
+        self._sorted = array('d')
+        self._min_queue.clear()
+        self._max_queue.clear()
+        self._sequence = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        self.rejected = 0
+
+    @property
+    def minimum(self):
+        return self._min_queue[0][1] if self.buffer.count else None
+
+    @property
+    def maximum(self):
+        return self._max_queue[0][1] if self.buffer.count else None
+
+    @property
+    def mean(self):
+        return self._mean if self.buffer.count else None
+
+    @property
+    def stddev(self):
+        if self.buffer.count < 2:
+            return 0.0 if self.buffer.count else None
+        return sqrt(self._m2 / (self.buffer.count - 1))
+
+    def percentile(self, pct):
+        """ linearly interpolated percentile (0-100) of the current window """
+        n = len(self._sorted)
+        if not n:
+            return None
+        rank = max(0.0, min(100.0, pct)) / 100.0 * (n - 1)
+        lower = int(rank)
+        if lower + 1 >= n:
+            return self._sorted[-1]
+        return self._sorted[lower] + (self._sorted[lower + 1] - self._sorted[lower]) * (rank - lower)
+
+    def summary(self, fmt='{:.3f}'):
+        """ one line text description of the window, for tooltips and status labels """
+        if not self.buffer.count:
+            return 'NO DATA'
+        return 'n={}  min={}  max={}  mean={}  sd={}  p50={}  p95={}'.format(
+            self.buffer.count, fmt.format(self.minimum), fmt.format(self.maximum), fmt.format(self.mean),
+            fmt.format(self.stddev), fmt.format(self.percentile(50)), fmt.format(self.percentile(95)))
+
+    def sparkline(self, width=20):
+        """ unicode block sparkline of the window, each character the mean of an equal slice of samples """
+        n = self.buffer.count
+        if not n:
+            return u''
+        values = self.buffer.ordered_values()
+        width = min(width, n)
+        low, high = self.minimum, self.maximum
+        span = high - low
+        chars = []
+        for x in range(width):
+            start = x * n // width
+            end = (x + 1) * n // width
+            bucket = sum(values[start:end]) / (end - start)
+            level = 0 if span <= 0 else int((bucket - low) / span * (len(SPARK_CHARS) - 1) + 0.5)
+            chars.append(SPARK_CHARS[level])
+        return u''.join(chars)
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+    mower/mavlink.py
+
+    Minimal MAVLink v1/v2 framing and a small message table for the messages these tools care about
+
+    This is not a replacement for pymavlink - it exists so the replay harness, base station tools and
+    fake vehicle can parse, route and generate packets without any dependencies.  Messages missing from
+    MESSAGES can still be framed and routed, they just are not decoded.
+
+"""
+
+from struct import Struct
+
+STX_V1 = 0xFE
+STX_V2 = 0xFD
+V1_HEADER_LEN = 6
+V2_HEADER_LEN = 10
+CHECKSUM_LEN = 2
+SIGNATURE_LEN = 13
+IFLAG_SIGNED = 0x01
+
+TYPE_FORMATS = {'uint8_t': 'B', 'int8_t': 'b', 'uint16_t': 'H', 'int16_t': 'h', 'uint32_t': 'I', 'int32_t': 'i',
+                'uint64_t': 'Q', 'int64_t': 'q', 'float': 'f', 'double': 'd', 'char': 's'}
+
+
+class MessageDef:
+    """ wire layout of one message - fields must be listed in MAVLink wire order (base fields, then extensions) """
+
+    def __init__(self, msgid, name, crc_extra, fields, extensions=()):
+        self.msgid = msgid
+        self.name = name
+        self.crc_extra = crc_extra
+        self.fields = list(fields) + list(extensions)
+        self.field_names = [f[0] for f in self.fields]
+        self.struct = Struct('<' + self._format(fields) + self._format(extensions))
+        self.base_length = Struct('<' + self._format(fields)).size
+        self.length = self.struct.size
+        self.array_fields = set(f[0] for f in self.fields if len(f) > 2 and f[1] != 'char')
+        self.char_fields = set(f[0] for f in self.fields if f[1] == 'char')
+
+    @staticmethod
+    def _format(fields):
+        fmt = ''
+        for field in fields:
+            count = field[2] if len(field) > 2 else 1
+            fmt += (str(count) if count > 1 else '') + TYPE_FORMATS[field[1]]
+        return fmt
+
+    def decode(self, payload):
+        """ returns a dict of field values - MAVLink 2 trims trailing zero bytes, so short payloads are padded """
+        payload = bytes(payload)
+        if len(payload) < self.length:
+            payload += b'\x00' * (self.length - len(payload))
+        values = self.struct.unpack(payload[:self.length])
+        fields = {}
+        index = 0
+        for field in self.fields:
+            name, count = field[0], field[2] if len(field) > 2 else 1
+            if name in self.array_fields:
+                fields[name] = list(values[index:index + count])
+                index += count
+                continue
+            value = values[index]
+            if name in self.char_fields:
+                value = value.split(b'\x00', 1)[0]
+            fields[name] = value
+            index += 1
+        return fields
+
+    def encode(self, **fields):
+        values = []
+        for field in self.fields:
+            name, field_type, count = field[0], field[1], field[2] if len(field) > 2 else 1
+            default = b'' if field_type == 'char' else 0.0 if field_type in ('float', 'double') else 0
+            value = fields.get(name, default)
+            if field_type == 'char' and not isinstance(value, bytes):
+                value = value.encode('ascii', 'replace')
+            if name in self.array_fields:
+                value = list(value) + [0] * (count - len(value))
+                values.extend(value[:count])
+                continue
+            values.append(value)
+        return self.struct.pack(*values)
+
+
+MESSAGES = {}
+
+
+def _define(msgid, name, crc_extra, fields, extensions=()):
+    MESSAGES[msgid] = MessageDef(msgid, name, crc_extra, fields, extensions)
+
+
+_define(0, 'HEARTBEAT', 50, [('custom_mode', 'uint32_t'), ('type', 'uint8_t'), ('autopilot', 'uint8_t'),
+                             ('base_mode', 'uint8_t'), ('system_status', 'uint8_t'), ('mavlink_version', 'uint8_t')])
+_define(1, 'SYS_STATUS', 124, [('onboard_control_sensors_present', 'uint32_t'),
+                               ('onboard_control_sensors_enabled', 'uint32_t'),
+                               ('onboard_control_sensors_health', 'uint32_t'), ('load', 'uint16_t'),
+                               ('voltage_battery', 'uint16_t'), ('current_battery', 'int16_t'),
+                               ('drop_rate_comm', 'uint16_t'), ('errors_comm', 'uint16_t'),
+                               ('errors_count1', 'uint16_t'), ('errors_count2', 'uint16_t'),
+                               ('errors_count3', 'uint16_t'), ('errors_count4', 'uint16_t'),
+                               ('battery_remaining', 'int8_t')])
+_define(21, 'PARAM_REQUEST_LIST', 159, [('target_system', 'uint8_t'), ('target_component', 'uint8_t')])
+_define(22, 'PARAM_VALUE', 220, [('param_value', 'float'), ('param_count', 'uint16_t'), ('param_index', 'uint16_t'),
+                                 ('param_id', 'char', 16), ('param_type', 'uint8_t')])
+_define(23, 'PARAM_SET', 168, [('param_value', 'float'), ('target_system', 'uint8_t'),
+                               ('target_component', 'uint8_t'), ('param_id', 'char', 16), ('param_type', 'uint8_t')])
+_define(24, 'GPS_RAW_INT', 24, [('time_usec', 'uint64_t'), ('lat', 'int32_t'), ('lon', 'int32_t'), ('alt', 'int32_t'),
+                                ('eph', 'uint16_t'), ('epv', 'uint16_t'), ('vel', 'uint16_t'), ('cog', 'uint16_t'),
+                                ('fix_type', 'uint8_t'), ('satellites_visible', 'uint8_t')])
+_define(30, 'ATTITUDE', 39, [('time_boot_ms', 'uint32_t'), ('roll', 'float'), ('pitch', 'float'), ('yaw', 'float'),
+                             ('rollspeed', 'float'), ('pitchspeed', 'float'), ('yawspeed', 'float')])
+_define(33, 'GLOBAL_POSITION_INT', 104, [('time_boot_ms', 'uint32_t'), ('lat', 'int32_t'), ('lon', 'int32_t'),
+                                         ('alt', 'int32_t'), ('relative_alt', 'int32_t'), ('vx', 'int16_t'),
+                                         ('vy', 'int16_t'), ('vz', 'int16_t'), ('hdg', 'uint16_t')])
+_define(36, 'SERVO_OUTPUT_RAW', 222,
+        [('time_usec', 'uint32_t')] + [('servo{}_raw'.format(x), 'uint16_t') for x in range(1, 9)] +
+        [('port', 'uint8_t')],
+        [('servo{}_raw'.format(x), 'uint16_t') for x in range(9, 17)])
+_define(62, 'NAV_CONTROLLER_OUTPUT', 183, [('nav_roll', 'float'), ('nav_pitch', 'float'), ('alt_error', 'float'),
+                                           ('aspd_error', 'float'), ('xtrack_error', 'float'),
+                                           ('nav_bearing', 'int16_t'), ('target_bearing', 'int16_t'),
+                                           ('wp_dist', 'uint16_t')])
+_define(65, 'RC_CHANNELS', 118,
+        [('time_boot_ms', 'uint32_t')] + [('chan{}_raw'.format(x), 'uint16_t') for x in range(1, 19)] +
+        [('chancount', 'uint8_t'), ('rssi', 'uint8_t')])
+_define(70, 'RC_CHANNELS_OVERRIDE', 124,
+        [('chan{}_raw'.format(x), 'uint16_t') for x in range(1, 9)] +
+        [('target_system', 'uint8_t'), ('target_component', 'uint8_t')],
+        [('chan{}_raw'.format(x), 'uint16_t') for x in range(9, 19)])
+_define(74, 'VFR_HUD', 20, [('airspeed', 'float'), ('groundspeed', 'float'), ('alt', 'float'), ('climb', 'float'),
+                            ('heading', 'int16_t'), ('throttle', 'uint16_t')])
+_define(253, 'STATUSTEXT', 83, [('severity', 'uint8_t'), ('text', 'char', 50)],
+        [('id', 'uint16_t'), ('chunk_seq', 'uint8_t')])
+
+MSG_IDS = dict((msg.name, msg.msgid) for msg in MESSAGES.values())
+
+
+def x25_crc(data, crc=0xFFFF):
+    """ MAVLink's CRC-16/MCRF4XX """
+    for byte in bytearray(data):
+        tmp = byte ^ (crc & 0xFF)
+        tmp = (tmp ^ (tmp << 4)) & 0xFF
+        crc = ((crc >> 8) ^ (tmp << 8) ^ (tmp << 3) ^ (tmp >> 4)) & 0xFFFF
+    return crc
+
+
+def frame_length(buf, offset=0):
+    """ total length of the frame starting at buf[offset], or None if the header is incomplete """
+    available = len(buf) - offset
+    if available < 2:
+        return None
+    stx, payload_len = buf[offset], buf[offset + 1]
+    if stx == STX_V1:
+        return V1_HEADER_LEN + payload_len + CHECKSUM_LEN
+    if available < 3:
+        return None
+    signed = buf[offset + 2] & IFLAG_SIGNED
+    return V2_HEADER_LEN + payload_len + CHECKSUM_LEN + (SIGNATURE_LEN if signed else 0)
+
+
+class Frame:
+    """ header fields of one MAVLink frame, with the raw frame and payload as memoryview slices (no copies) """
+
+    __slots__ = ('version', 'seq', 'sysid', 'compid', 'msgid', 'payload', 'raw')
+
+    def __init__(self, version, seq, sysid, compid, msgid, payload, raw):
+        self.version = version
+        self.seq = seq
+        self.sysid = sysid
+        self.compid = compid
+        self.msgid = msgid
+        self.payload = payload
+        self.raw = raw
+
+
+def parse_frame(buf, offset=0):
+    """ Frame for the complete frame at buf[offset] (buf must be a bytes-like object supporting memoryview) """
+    view = memoryview(buf)
+    stx, payload_len = buf[offset], buf[offset + 1]
+    if stx == STX_V1:
+        end = offset + V1_HEADER_LEN + payload_len + CHECKSUM_LEN
+        return Frame(1, buf[offset + 2], buf[offset + 3], buf[offset + 4], buf[offset + 5],
+                     view[offset + V1_HEADER_LEN:offset + V1_HEADER_LEN + payload_len], view[offset:end])
+    length = frame_length(buf, offset)
+    msgid = buf[offset + 7] | (buf[offset + 8] << 8) | (buf[offset + 9] << 16)
+    return Frame(2, buf[offset + 4], buf[offset + 5], buf[offset + 6], msgid,
+                 view[offset + V2_HEADER_LEN:offset + V2_HEADER_LEN + payload_len], view[offset:offset + length])
+
+
+def check_crc(frame):
+    """ True if the frame checksum is valid - unknown messages (no crc_extra) are accepted """
+    msg = MESSAGES.get(frame.msgid)
+    if msg is None:
+        return True
+    header_len = V1_HEADER_LEN if frame.version == 1 else V2_HEADER_LEN
+    end = header_len + len(frame.payload)
+    raw = frame.raw
+    crc = x25_crc(raw[1:end])
+    crc = x25_crc(bytearray([msg.crc_extra]), crc)
+    return crc == (raw[end] | (raw[end + 1] << 8))
+
+
+class FrameParser:
+    """ incremental MAVLink frame parser - feed() arbitrary chunks, complete frames come back in order """
+
+    def __init__(self, validate_crc=False):
+        self.validate_crc = validate_crc
+        self._buf = bytearray()
+        self.frames = 0
+        self.bad_crc = 0
+        self.skipped_bytes = 0
+
+    def feed(self, data):
+        buf = self._buf
+        buf += data
+        frames = []
+        offset = 0
+        size = len(buf)
+        while offset < size:
+            stx = buf[offset]
+            if stx != STX_V1 and stx != STX_V2:
+                next_v1 = buf.find(b'\xfe', offset)
+                next_v2 = buf.find(b'\xfd', offset)
+                candidates = [x for x in (next_v1, next_v2) if x >= 0]
+                next_offset = min(candidates) if candidates else size
+                self.skipped_bytes += next_offset - offset
+                offset = next_offset
+                continue
+            length = frame_length(buf, offset)
+            if length is None or offset + length > size:
+                break
+            frame = parse_frame(bytes(buf[offset:offset + length]))
+            if self.validate_crc and not check_crc(frame):
+                self.bad_crc += 1
+                self.skipped_bytes += 1
+                offset += 1
+                continue
+            frames.append(frame)
+            self.frames += 1
+            offset += length
+        del buf[:offset]
+        return frames
+
+
+def pack_frame(msgid, payload, seq=0, sysid=1, compid=1, version=2):
+    """ frames an already encoded payload (MAVLink 2 trailing zero truncation is applied) """
+    msg = MESSAGES.get(msgid)
+    crc_extra = msg.crc_extra if msg is not None else 0
+    if version == 1:
+        header = bytearray([STX_V1, len(payload), seq & 0xFF, sysid, compid, msgid])
+    else:
+        payload = payload.rstrip(b'\x00') or payload[:1]
+        header = bytearray([STX_V2, len(payload), 0, 0, seq & 0xFF, sysid, compid,
+                            msgid & 0xFF, (msgid >> 8) & 0xFF, (msgid >> 16) & 0xFF])
+    body = bytes(header[1:]) + payload
+    crc = x25_crc(bytearray([crc_extra]), x25_crc(body))
+    return bytes(header[:1]) + body + bytes(bytearray([crc & 0xFF, crc >> 8]))
+
+
+def encode_message(name, seq=0, sysid=1, compid=1, version=2, **fields):
+    msg = MESSAGES[MSG_IDS[name]]
+    payload = msg.encode(**fields)
+    if version == 1:
+        payload = payload[:msg.base_length]
+    return pack_frame(msg.msgid, payload, seq, sysid, compid, version)
+
+
+def decode_payload(msgid, payload):
+    """ dict of decoded fields, or None for messages missing from MESSAGES """
+    msg = MESSAGES.get(msgid)
+    if msg is None:
+        return None
+    return msg.decode(payload)
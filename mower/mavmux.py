@@ -0,0 +1,487 @@
+# -*- coding: utf-8 -*-
+"""
+    mower/mavmux.py
+
+    MAVLink router for the base station - one telemetry link shared by many clients, each at its own rates
+
+    The vehicle link (ser2net or mower/serial_bridge.py on TCP 2000) is read once and parsed incrementally with
+    mower/mavlink.py's FrameParser.  Every frame is counted per route (sysid, compid, msgid) and offered to each
+    client, which may only want some systems/components and may cap the rate of any message - e.g. ATTITUDE
+    at 5 Hz for a dashboard while Mission Planner gets everything.  Clients are served by
+    serial_bridge.BridgeClient, so a slow one is throttled by its own bounded queue without holding up the
+    others.  Frames sent by clients are re-framed before being merged onto the vehicle link, so uplink traffic
+    from several clients never interleaves mid-frame.
+
+    Each --listen port has its own rules, PORT[:RULE,RULE...] where a rule is NAME=HZ (0 blocks the message,
+    a numeric msgid works too), *=HZ for every other message, sysid=N or compid=N:
+        python3 -m mower.mavmux --vehicle 127.0.0.1:2000 --listen 5760 --listen 5761:ATTITUDE=5,VFR_HUD=2,*=1
+        python3 -m mower.mavmux --self-test    # against a local stand-in vehicle, no hardware required
+
+"""
+
+import argparse
+import asyncio
+import logging
+import socket
+import sys
+from time import time
+
+from mower.mavlink import MESSAGES, MSG_IDS, FrameParser, check_crc, decode_payload, encode_message
+from mower.serial_bridge import DEFAULT_QUEUE_BYTES, DEFAULT_SOCKET_BUFFER, DEFAULT_STATS_INTERVAL, POLICIES, \
+    READ_SIZE, BridgeClient, report
+
+DEFAULT_HOST = '0.0.0.0'
+RECONNECT_INTERVAL = 2.0  # seconds
+RATE_TOLERANCE = 0.95  # of the capped interval, so a source already at the cap is not thinned by jitter
+UPLINK_BUFFER = 64 * 1024  # bytes waiting for the vehicle link before uplink frames are dropped
+TOP_ROUTES = 12
+
+log = logging.getLogger('mavmux')
+
+
+def message_name(msgid):
+    return MESSAGES[msgid].name if msgid in MESSAGES else str(msgid)
+
+
+class ClientRules:
+    """ what one listening port passes on - caps maps msgid to Hz (0 blocks), default caps everything else """
+
+    def __init__(self, caps=None, default=None, sysid=None, compid=None):
+        self.caps = dict(caps or {})
+        self.default = default
+        self.sysid = sysid
+        self.compid = compid
+
+    @classmethod
+    def parse(cls, text):
+        """ 'ATTITUDE=5,VFR_HUD=2,*=1,sysid=1' """
+        rules = cls()
+        for rule in filter(None, (rule.strip() for rule in text.split(','))):
+            name, value = rule.split('=', 1)
+            if name == 'sysid':
+                rules.sysid = int(value)
+            elif name == 'compid':
+                rules.compid = int(value)
+            elif name == '*':
+                rules.default = float(value)
+            elif name.isdigit():
+                rules.caps[int(name)] = float(value)
+            elif name in MSG_IDS:
+                rules.caps[MSG_IDS[name]] = float(value)
+            else:
+                raise ValueError('unknown message {}'.format(name))
+        return rules
+
+    def interval(self, msgid):
+        """ minimum seconds between frames of msgid, None for no limit """
+        rate = self.caps.get(msgid, self.default)
+        if rate is None:
+            return None
+        return 1.0 / rate if rate > 0 else float('inf')
+
+    def accepts(self, frame):
+        return ((self.sysid is None or frame.sysid == self.sysid) and
+                (self.compid is None or frame.compid == self.compid))
+
+    def __str__(self):
+        parts = ['{}={:g}'.format(message_name(msgid), rate) for msgid, rate in sorted(self.caps.items())]
+        if self.default is not None:
+            parts.append('*={:g}'.format(self.default))
+        parts.extend('{}={}'.format(name, value) for name, value in (('sysid', self.sysid), ('compid', self.compid))
+                     if value is not None)
+        return ','.join(parts) or 'full rate'
+
+
+class RouteStats:
+    __slots__ = ('frames', 'bytes', 'first', 'last')
+
+    def __init__(self, timestamp):
+        self.frames = 0
+        self.bytes = 0
+        self.first = timestamp
+        self.last = timestamp
+
+    def rate(self):
+        span = self.last - self.first
+        return (self.frames - 1) / span if span > 0 else 0.0
+
+
+class MuxClient:
+    """ one connected client - its link, rules and counters """
+
+    def __init__(self, link, rules):
+        self.link = link
+        self.rules = rules
+        self.parser = FrameParser(validate_crc=True)
+        self.due = {}  # (sysid, compid, msgid): earliest time the next frame may go
+        self.forwarded = {}  # msgid: frames
+        self.capped = {}  # msgid: frames withheld by the rate caps
+        self.uplink_frames = 0
+
+    def offer(self, frame, timestamp):
+        rules = self.rules
+        if not rules.accepts(frame):
+            return
+        msgid = frame.msgid
+        interval = rules.interval(msgid)
+        if interval is not None:
+            key = (frame.sysid, frame.compid, msgid)
+            if interval == float('inf') or timestamp < self.due.get(key, 0.0):  # a rate of 0 blocks every frame
+                self.capped[msgid] = self.capped.get(msgid, 0) + 1
+                return
+            self.due[key] = timestamp + interval * RATE_TOLERANCE
+        self.forwarded[msgid] = self.forwarded.get(msgid, 0) + 1
+        self.link.push(frame.raw, timestamp)
+
+    def status_text(self):
+        capped = sorted(self.capped.items(), key=lambda item: -item[1])
+        text = '{} [{}] forwarded {} frames, capped {}, uplink {} frames ({} bad CRC)'.format(
+            self.link.status_text(), self.rules, sum(self.forwarded.values()), sum(self.capped.values()),
+            self.uplink_frames, self.parser.bad_crc)
+        if capped:
+            text += ' - capped ' + ', '.join('{} {}'.format(message_name(msgid), count) for msgid, count in capped[:5])
+        return text
+
+
+class MavlinkRouter:
+    def __init__(self, vehicle, listens, host=DEFAULT_HOST, max_queue_bytes=DEFAULT_QUEUE_BYTES, policy='drop',
+                 socket_buffer=DEFAULT_SOCKET_BUFFER):
+        self.vehicle = vehicle  # (host, port) of the telemetry link
+        self.listens = listens  # [(tcp port, ClientRules)]
+        self.host = host
+        self.max_queue_bytes = max_queue_bytes
+        self.policy = policy
+        self.socket_buffer = socket_buffer
+        self.parser = FrameParser(validate_crc=True)
+        self.routes = {}  # (sysid, compid, msgid): RouteStats
+        self.clients = []
+        self.servers = []
+        self.bytes_read = 0
+        self.uplink_bytes = 0
+        self.uplink_dropped = 0
+        self.connects = 0
+        self.vehicle_writer = None
+        self._vehicle_task = None
+        self._tasks = set()
+
+    async def start(self):
+        for index, (tcp_port, rules) in enumerate(self.listens):
+            server = await asyncio.start_server(lambda reader, writer, rules=rules: self._accept(reader, writer, rules),
+                                                self.host, tcp_port)
+            self.listens[index] = (server.sockets[0].getsockname()[1], rules)  # resolves port 0
+            self.servers.append(server)
+            log.info('tcp %s:%d <- %s:%d (%s)', self.host, self.listens[index][0], self.vehicle[0], self.vehicle[1],
+                     rules)
+        self._vehicle_task = asyncio.ensure_future(self._run_vehicle())
+
+    async def stop(self):
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        if self._vehicle_task is not None:
+            self._vehicle_task.cancel()
+            await asyncio.gather(self._vehicle_task, return_exceptions=True)
+        for client in self.clients:
+            client.link.close('router stopped')
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _run_vehicle(self):
+        """ reads the vehicle link, reconnecting whenever it drops """
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(*self.vehicle)
+            except OSError as inst:
+                log.info('vehicle %s:%d: %s', self.vehicle[0], self.vehicle[1], inst)
+                await asyncio.sleep(RECONNECT_INTERVAL)
+                continue
+            self.connects += 1
+            self.vehicle_writer = writer
+            log.info('vehicle %s:%d connected', *self.vehicle)
+            try:
+                while True:
+                    data = await reader.read(READ_SIZE)
+                    if not data:
+                        break
+                    self.feed(data, time())
+            except (ConnectionError, OSError) as inst:
+                log.info('vehicle %s:%d: %s', self.vehicle[0], self.vehicle[1], inst)
+            finally:
+                self.vehicle_writer = None
+                writer.close()
+            await asyncio.sleep(RECONNECT_INTERVAL)
+
+    def feed(self, data, timestamp):
+        """ routes vehicle data to the clients """
+        self.bytes_read += len(data)
+        routes = self.routes
+        clients = self.clients
+        for frame in self.parser.feed(data):
+            key = (frame.sysid, frame.compid, frame.msgid)
+            route = routes.get(key)
+            if route is None:
+                route = routes[key] = RouteStats(timestamp)
+            route.frames += 1
+            route.bytes += len(frame.raw)
+            route.last = timestamp
+            for client in clients:
+                client.offer(frame, timestamp)
+
+    def send_vehicle(self, client, data):
+        """ whole frames only, so uplink traffic from several clients merges cleanly """
+        writer = self.vehicle_writer
+        for frame in client.parser.feed(data):
+            client.uplink_frames += 1
+            if writer is None or writer.transport.get_write_buffer_size() > UPLINK_BUFFER:
+                self.uplink_dropped += 1
+                continue
+            writer.write(frame.raw)
+            self.uplink_bytes += len(frame.raw)
+
+    async def _accept(self, reader, writer, rules):
+        link = BridgeClient(reader, writer, self.max_queue_bytes, self.policy)
+        sock = writer.get_extra_info('socket')
+        if sock is not None and self.socket_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.socket_buffer)
+            writer.transport.set_write_buffer_limits(self.socket_buffer)
+        client = MuxClient(link, rules)
+        self.clients.append(client)
+        log.info('client %s:%d connected (%s)', link.peer[0], link.peer[1], rules)
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            await asyncio.gather(link.send(), link.receive(lambda data: self.send_vehicle(client, data)))
+        finally:
+            link.close('disconnected')
+            self.clients.remove(client)
+            self._tasks.discard(task)
+            log.info('client closed (%s) - %s', link.close_reason, client.status_text())
+
+    def status_text(self):
+        lines = ['vehicle {}:{} ({}): read {} B, {} frames ({} bad CRC, {} bytes skipped), uplink {} B ({} frames '
+                 'dropped), {} clients'.format(self.vehicle[0], self.vehicle[1],
+                                               'connected' if self.vehicle_writer else 'disconnected',
+                                               self.bytes_read, self.parser.frames, self.parser.bad_crc,
+                                               self.parser.skipped_bytes, self.uplink_bytes, self.uplink_dropped,
+                                               len(self.clients))]
+        routes = sorted(self.routes.items(), key=lambda item: -item[1].frames)
+        for (sysid, compid, msgid), route in routes[:TOP_ROUTES]:
+            lines.append('    {}/{} {:<24} {:>8} frames {:>9} B {:>6.1f} Hz'.format(
+                sysid, compid, message_name(msgid), route.frames, route.bytes, route.rate()))
+        lines.extend('    ' + client.status_text() for client in self.clients)
+        return '\n'.join(lines)
+
+
+class StandInVehicle:
+    """ local TCP server playing the vehicle end of the telemetry link - streams replay.synthetic_messages()
+        in real time (times speed) to whoever connects and counts the frames it receives back, answers
+        PARAM_REQUEST_LIST and PARAM_SET from params and keeps the last RC override of each channel """
+
+    def __init__(self, host='127.0.0.1', port=0, speed=1.0, seed=0, sysid=1, compid=1, params=None):
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.seed = seed
+        self.sysid = sysid
+        self.compid = compid
+        self.params = dict(params or {})  # NAME: value
+        self.overrides = {}  # channel: PWM, 0 once released
+        self.sent = {}  # msgid: frames
+        self.received = {}  # (sysid, msgid): frames
+        self.bad_crc = 0
+        self.server = None
+        self.running = False
+        self._writers = set()
+        self._tasks = set()
+
+    async def start(self):
+        self.running = True
+        self.server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.running = False
+        self.server.close()
+        for writer in self._writers:
+            writer.close()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        from mower.replay import synthetic_messages  # replay imports this package's heavier modules
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        self._writers.add(writer)
+        receiver = asyncio.ensure_future(self._receive(reader, writer))
+        start = time()
+        try:
+            for timestamp, message in synthetic_messages(3600.0, self.seed):
+                if not self.running:
+                    break
+                delay = timestamp / self.speed - (time() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                writer.write(message.buffer)
+                self.sent[message.msgid] = self.sent.get(message.msgid, 0) + 1
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+            await asyncio.gather(receiver, return_exceptions=True)
+            self._writers.discard(writer)
+            self._tasks.discard(task)
+
+    async def _receive(self, reader, writer):
+        parser = FrameParser()
+        while True:
+            data = await reader.read(READ_SIZE)
+            if not data:
+                return
+            for frame in parser.feed(data):
+                if not check_crc(frame):
+                    self.bad_crc += 1
+                    continue
+                key = (frame.sysid, frame.msgid)
+                self.received[key] = self.received.get(key, 0) + 1
+                self._answer(frame, writer)
+
+    def _answer(self, frame, writer):
+        if frame.msgid == MSG_IDS['PARAM_REQUEST_LIST']:
+            for index, name in enumerate(sorted(self.params)):
+                writer.write(self._param_value(name, index))
+        elif frame.msgid == MSG_IDS['PARAM_SET']:
+            fields = decode_payload(frame.msgid, frame.payload)
+            name = fields['param_id'].decode('ascii', 'replace')
+            if name in self.params:
+                self.params[name] = fields['param_value']
+                writer.write(self._param_value(name, sorted(self.params).index(name)))
+        elif frame.msgid == MSG_IDS['RC_CHANNELS_OVERRIDE']:
+            fields = decode_payload(frame.msgid, frame.payload)
+            for chan in range(1, 19):
+                pwm = fields['chan{}_raw'.format(chan)]
+                if pwm not in ((0xFFFF,) if chan <= 8 else (0, 0xFFFF)):  # "ignore this channel"
+                    self.overrides[chan] = 0 if pwm == 0xFFFE else pwm
+
+    def _param_value(self, name, index):
+        return encode_message('PARAM_VALUE', sysid=self.sysid, compid=self.compid, param_id=name,
+                              param_value=self.params[name], param_count=len(self.params), param_index=index,
+                              param_type=9)
+
+
+async def self_test(seconds=3.0):
+    """ a full rate client and a capped client on a stand-in vehicle, both sending heartbeats upstream - checks
+        the full rate client saw every frame, the caps held and both uplinks arrived intact """
+    vehicle = StandInVehicle()
+    await vehicle.start()
+    capped_rules = ClientRules.parse('ATTITUDE=2,SERVO_OUTPUT_RAW=0,*=1')
+    router = MavlinkRouter(('127.0.0.1', vehicle.port), [(0, ClientRules()), (0, capped_rules)], '127.0.0.1')
+    await router.start()
+    counts = [{}, {}]
+    done = asyncio.Event()  # rather than cancelling: wait_for() can swallow a cancel that races its timeout
+
+    async def client(index, sysid):
+        tcp_port = router.listens[index][0]
+        reader, writer = await asyncio.open_connection('127.0.0.1', tcp_port)
+        parser = FrameParser(validate_crc=True)
+        next_heartbeat = 0.0
+        try:
+            while not done.is_set():
+                if time() >= next_heartbeat:  # a GCS heartbeat, split in two writes to exercise re-framing
+                    frame = encode_message('HEARTBEAT', sysid=sysid, compid=190, type=6, autopilot=8)
+                    writer.write(frame[:5])
+                    await writer.drain()
+                    writer.write(frame[5:])
+                    next_heartbeat = time() + 0.25
+                try:
+                    data = await asyncio.wait_for(reader.read(READ_SIZE), 0.05)
+                except asyncio.TimeoutError:
+                    continue
+                if not data:
+                    return
+                for frame in parser.feed(data):
+                    counts[index][frame.msgid] = counts[index].get(frame.msgid, 0) + 1
+        finally:
+            writer.close()
+
+    await asyncio.sleep(RECONNECT_INTERVAL / 4)
+    tasks = [asyncio.ensure_future(client(0, 255)), asyncio.ensure_future(client(1, 254))]
+    await asyncio.sleep(0.5)  # let the clients and the vehicle link settle before counting
+    baseline = [dict(count) for count in counts]
+    sent_before = dict(vehicle.sent)
+    await asyncio.sleep(seconds)
+    print(router.status_text())
+    done.set()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await router.stop()
+    sent = dict((msgid, count - sent_before.get(msgid, 0)) for msgid, count in vehicle.sent.items())
+    await vehicle.stop()
+
+    def window(index, msgid):
+        return counts[index].get(msgid, 0) - baseline[index].get(msgid, 0)
+
+    checks = []
+    full = all(abs(window(0, msgid) - count) <= 1 for msgid, count in sent.items())
+    checks.append((full, 'full rate client received every frame ({})'.format(
+        ', '.join('{} {}/{}'.format(message_name(msgid), window(0, msgid), count) for msgid, count in sent.items()))))
+    attitude = window(1, MSG_IDS['ATTITUDE'])
+    checks.append((abs(attitude - 2 * seconds) <= 2, 'capped client ATTITUDE {} in {:g} s (cap 2 Hz, sent {})'.format(
+        attitude, seconds, sent.get(MSG_IDS['ATTITUDE'], 0))))
+    servo_outputs = counts[1].get(MSG_IDS['SERVO_OUTPUT_RAW'], 0)  # the whole session - not even the first frame
+    checks.append((servo_outputs == 0, 'capped client SERVO_OUTPUT_RAW blocked ({} received)'.format(servo_outputs)))
+    heartbeats = [vehicle.received.get((sysid, MSG_IDS['HEARTBEAT']), 0) for sysid in (255, 254)]
+    checks.append((min(heartbeats) > 0 and not vehicle.bad_crc, 'vehicle received heartbeats {} from both clients, '
+                                                                '{} bad CRC'.format(heartbeats, vehicle.bad_crc)))
+    for ok, text in checks:
+        print(('ok    ' if ok else 'FAIL  ') + text)
+    return all(ok for ok, text in checks)
+
+
+def parse_listen(text):
+    """ PORT[:RULES] """
+    tcp_port, rules = (text.split(':', 1) + [''])[:2]
+    return int(tcp_port), ClientRules.parse(rules)
+
+
+def parse_address(text):
+    host, tcp_port = text.rsplit(':', 1)
+    return host, int(tcp_port)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='MAVLink router with per-client rate caps')
+    parser.add_argument('--vehicle', type=parse_address, default=('127.0.0.1', 2000), metavar='HOST:PORT',
+                        help='telemetry link (ser2net or serial_bridge)')
+    parser.add_argument('--listen', type=parse_listen, action='append', default=[], metavar='PORT[:RULES]',
+                        help='client port and its rules, e.g. 5761:ATTITUDE=5,*=1 (repeatable)')
+    parser.add_argument('--host', default=DEFAULT_HOST, help='address to listen on')
+    parser.add_argument('--queue-bytes', type=int, default=DEFAULT_QUEUE_BYTES, help='per client queue limit')
+    parser.add_argument('--policy', choices=POLICIES, default='drop', help='what to do with a slow client')
+    parser.add_argument('--stats', type=float, default=DEFAULT_STATS_INTERVAL, help='seconds between reports')
+    parser.add_argument('--self-test', action='store_true', help='run against a stand-in vehicle and exit')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    if args.self_test:
+        ok = asyncio.run(self_test())
+        print('PASS' if ok else 'FAIL')
+        return 0 if ok else 1
+    if not args.listen:
+        parser.error('at least one --listen port is required')
+    router = MavlinkRouter(args.vehicle, args.listen, args.host, args.queue_bytes, args.policy)
+
+    async def run():
+        await router.start()
+        try:
+            await report([router], args.stats)
+        finally:
+            await router.stop()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+    mower/mission_pack.py
+
+    Fixed-width ("packed") mission files with a sidecar offset index, for LongMission.lua on the SD card
+
+    A packed file is still a QGC WPL 110 .waypoints file - every line, the header included, is padded to the
+    same RECORD_LEN bytes with '\\n' line endings, so Mission Planner and the existing LongMission.lua read it
+    unchanged, while a reader that knows the format finds item N at byte RECORD_LEN * (N + 1) with a single
+    seek instead of reading every line before it.  The sidecar (.idx, same base name) holds the record length,
+    item count and file size, then the offset of every Nth item with the CRC-32 of the block of records it
+    starts, also as fixed-width lines, so resuming or jumping to an item costs one seek in each file and a
+    damaged or mismatched card can be detected on the host:
+        python -m mower.mission_pack pack survey.waypoints --output LongMission.waypoints --every 50
+        python -m mower.mission_pack verify LongMission.waypoints
+
+    Used by waypoint_file_tool.py (IronPython) as well as from the command line, so no CPython-only features.
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import sys
+from binascii import crc32
+from os import path
+
+HEADER = 'QGC WPL 110'
+FIELDS = (('seq', '{:>7d}', int), ('current', '{:d}', int), ('frame', '{:>2d}', int), ('command', '{:>5d}', int),
+          ('param1', '{:>10.4f}', float), ('param2', '{:>10.4f}', float), ('param3', '{:>10.4f}', float),
+          ('param4', '{:>10.4f}', float), ('lat', '{:>13.8f}', float), ('lng', '{:>13.8f}', float),
+          ('alt', '{:>10.3f}', float), ('autocontinue', '{:d}', int))
+RECORD_LEN = 104  # bytes, including the '\n' - the width of the FIELDS formats joined by tabs
+INDEX_MAGIC = 'WPIDX'
+INDEX_VERSION = 1
+INDEX_LINE_LEN = 40
+INDEX_ENTRY = '{:>7d} {:>12d} {:08x}'
+DEFAULT_INDEX_INTERVAL = 50  # items per index entry
+MAX_ERRORS = 20
+
+
+def index_filename(filename):
+    return path.splitext(filename)[0] + '.idx'
+
+
+def pad_line(text, length):
+    if len(text) > length - 1:
+        raise ValueError('line too long for {} bytes: {}'.format(length, text))
+    return (text + ' ' * (length - 1 - len(text)) + '\n').encode('ascii')
+
+
+def format_record(item):
+    """ one RECORD_LEN line from the 12 values of a .waypoints line (seq, current, frame, command, ...) """
+    return pad_line('\t'.join(fmt.format(convert(value)) for (name, fmt, convert), value in zip(FIELDS, item)),
+                    RECORD_LEN)
+
+
+def parse_record(line):
+    """ the 12 values of a record (bytes or text) """
+    if isinstance(line, bytes) and not isinstance(line, str):
+        line = line.decode('ascii')
+    values = line.split()
+    if len(values) != len(FIELDS):
+        raise ValueError('{} fields, expected {}'.format(len(values), len(FIELDS)))
+    return tuple(convert(value) for (name, fmt, convert), value in zip(FIELDS, values))
+
+
+def write_packed(filename, items, every=DEFAULT_INDEX_INTERVAL):
+    """ writes items (home first) as a packed .waypoints file and its .idx sidecar - returns the index filename """
+    records = [format_record(item) for item in items]
+    with open(filename, 'wb') as f:  # binary, so Windows never turns '\n' into '\r\n' and breaks the offsets
+        f.write(pad_line(HEADER, RECORD_LEN))
+        for record in records:
+            f.write(record)
+    size = RECORD_LEN * (len(records) + 1)
+    index = index_filename(filename)
+    with open(index, 'wb') as f:
+        f.write(pad_line('{} {} {} {} {} {}'.format(INDEX_MAGIC, INDEX_VERSION, RECORD_LEN, len(records), every, size),
+                         INDEX_LINE_LEN))
+        for item in range(0, len(records), every):
+            block = b''.join(records[item:item + every])
+            f.write(pad_line(INDEX_ENTRY.format(item, RECORD_LEN * (item + 1), crc32(block) & 0xFFFFFFFF),
+                             INDEX_LINE_LEN))
+    return index
+
+
+def read_index(filename):
+    """ (record_len, count, every, size, [(item, offset, crc)]) from a .idx file """
+    with open(filename, 'rb') as f:
+        lines = f.read().decode('ascii').split('\n')
+    header = lines[0].split()
+    if len(header) != 6 or header[0] != INDEX_MAGIC or int(header[1]) != INDEX_VERSION:
+        raise ValueError('{}: not a version {} mission index'.format(filename, INDEX_VERSION))
+    record_len, count, every, size = [int(value) for value in header[2:]]
+    entries = []
+    for line in lines[1:]:
+        if line.strip():
+            item, offset, crc = line.split()
+            entries.append((int(item), int(offset), int(crc, 16)))
+    return record_len, count, every, size, entries
+
+
+def read_item(filename, item, record_len=RECORD_LEN):
+    """ the values of one item (0 = home) by seeking, as a Lua reader would """
+    with open(filename, 'rb') as f:
+        f.seek(record_len * (item + 1))
+        record = f.read(record_len)
+    if len(record) != record_len:
+        raise IndexError('item {} is past the end of {}'.format(item, filename))
+    return parse_record(record)
+
+
+def verify(filename, index=None):
+    """ [error text] - empty if the file and its index agree and every record is intact """
+    errors = []
+    index = index if index is not None else index_filename(filename)
+    with open(filename, 'rb') as f:
+        data = f.read()
+    try:
+        record_len, count, every, size, entries = read_index(index)
+    except (IOError, OSError, ValueError) as inst:
+        return ['index: {}'.format(inst)]
+    if record_len != RECORD_LEN:
+        errors.append('index record length {} (expected {})'.format(record_len, RECORD_LEN))
+    if len(data) != size or size != record_len * (count + 1):
+        errors.append('file is {} bytes, index says {} ({} items of {} bytes + header)'.format(
+            len(data), size, count, record_len))
+    header = data[:record_len]
+    if not header.startswith(HEADER.encode('ascii')) or header[-1:] != b'\n':
+        errors.append('header is not a padded "{}" line'.format(HEADER))
+    for item in range((len(data) // record_len) - 1):
+        record = data[record_len * (item + 1):record_len * (item + 2)]
+        try:
+            if record[-1:] != b'\n' or b'\n' in record[:-1]:
+                raise ValueError('not {} bytes ending in a newline'.format(record_len))
+            values = parse_record(record)
+            if values[0] != item:
+                raise ValueError('seq {}'.format(values[0]))
+            if format_record(values) != record:
+                raise ValueError('not in canonical fixed-width form')
+        except ValueError as inst:
+            errors.append('item {} at byte {}: {}'.format(item, record_len * (item + 1), inst))
+        if len(errors) >= MAX_ERRORS:
+            return errors + ['...']
+    expected_items = list(range(0, count, every))
+    if [entry[0] for entry in entries] != expected_items:
+        errors.append('index lists items {} (expected every {} from 0 to {})'.format(
+            [entry[0] for entry in entries][:10], every, count - 1))
+    for item, offset, crc in entries:
+        if offset != record_len * (item + 1):
+            errors.append('index entry {}: offset {} (expected {})'.format(item, offset, record_len * (item + 1)))
+            continue
+        block = data[offset:offset + record_len * min(every, count - item)]
+        if crc32(block) & 0xFFFFFFFF != crc:
+            errors.append('items {}-{}: CRC {:08x} does not match the index ({:08x})'.format(
+                item, min(item + every, count) - 1, crc32(block) & 0xFFFFFFFF, crc))
+        if len(errors) >= MAX_ERRORS:
+            return errors + ['...']
+    return errors
+
+
+def read_waypoints(filename):
+    """ the items of any QGC WPL 110 file, packed or not """
+    items = []
+    with open(filename, 'r') as f:
+        lines = f.read().splitlines()
+    if not lines or not lines[0].startswith(HEADER):
+        raise ValueError('{}: not a {} file'.format(filename, HEADER))
+    for line in lines[1:]:
+        if line.strip():
+            items.append(parse_record(line))
+    return items
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Packed (seekable) mission files for LongMission.lua')
+    commands = parser.add_subparsers(dest='command')
+    pack = commands.add_parser('pack', help='pack a .waypoints file and write its index')
+    pack.add_argument('waypoints')
+    pack.add_argument('--output', help='packed file (default: the input name with _packed)')
+    pack.add_argument('--every', type=int, default=DEFAULT_INDEX_INTERVAL, help='items per index entry')
+    check = commands.add_parser('verify', help='check a packed file against its index')
+    check.add_argument('waypoints')
+    check.add_argument('--index', help='.idx file (default: alongside the waypoints)')
+    check.add_argument('--item', type=int, action='append', default=[], help='also print this item (seek test)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'pack':
+        output = args.output or path.splitext(args.waypoints)[0] + '_packed.waypoints'
+        items = read_waypoints(args.waypoints)
+        index = write_packed(output, items, args.every)
+        print('{} items -> {} ({} bytes), index {}'.format(len(items), output, RECORD_LEN * (len(items) + 1), index))
+        args.waypoints, args.index, args.item = output, index, []
+    elif args.command != 'verify':
+        parser.error('choose pack or verify')
+    errors = verify(args.waypoints, args.index)
+    if args.item:
+        try:
+            count = read_index(args.index or index_filename(args.waypoints))[1]
+        except (IOError, OSError, ValueError):
+            count = None  # verify() has reported the index, so only what the file holds can be printed
+    for item in args.item:
+        if count is not None and not 0 <= item < count:
+            errors.append('item {}: out of range, the index has items 0 to {}'.format(item, count - 1))
+            continue
+        try:
+            print('{}: {}'.format(item, read_item(args.waypoints, item)))
+        except (IndexError, ValueError) as inst:
+            errors.append('item {}: {}'.format(item, inst))
+    for error in errors:
+        print(error)
+    print('{}: {}'.format(args.waypoints, 'FAILED' if errors else 'OK'))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+    mower/monitor.py
+
+    MinMonitor's packet path without the WinForms dialog
+
+    MinMonitorForm owns the controls and renders MonitorRow state, MessageMonitor does everything else.
+    Keeping the two apart allows the replay harness to drive exactly the same code without Mission Planner.
+
+    Packets only update row values.  Threshold alerts are evaluated for all rows at once by evaluate_alerts(),
+    which the dialog calls from its display timer.
+
+    The monitor configuration is stored as JSON - load_config() migrates the original positional .cfg files.
+
+"""
+
+import json
+from collections import OrderedDict
+from os import path
+from time import time
+
+from mower.alerts import AlertEngine, AlertRule, DEFAULT_DEBOUNCE
+from mower.expressions import DERIVED_MESSAGE_NAME
+from mower.history import RollingStats, finite
+
+HISTORY_LENGTH = 600  # samples
+SPARKLINE_INTERVAL = 0.25  # seconds
+DEFAULT_NUM_ROWS = 5
+DEFAULT_VISIBLE_ROWS = 10
+
+
+def parse_float(text, default=None):
+    try:
+        return float(text)
+    except ValueError:
+        return default
+
+
+def to_float(data):
+    try:
+        return float(data)
+    except TypeError:
+        return float(bytes(data))  # char arrays arrive as System.Array (or lists outside Mission Planner)
+
+
+class MonitoredHistory:
+    """ rolling history for one monitor row, cleared whenever the row starts watching a different field """
+
+    def __init__(self, history_length=HISTORY_LENGTH, sparkline_interval=SPARKLINE_INTERVAL):
+        self.key = None
+        self.stats = RollingStats(history_length)
+        self.sparkline_interval = sparkline_interval
+        self.next_render = 0.0
+
+    def append(self, message_name, field_name, value):
+        now = time()
+        if (message_name, field_name) != self.key:
+            self.key = (message_name, field_name)
+            self.stats.clear()
+            self.next_render = 0.0
+        self.stats.append(value, now)
+
+    def sparkline_due(self):
+        now = time()
+        if now < self.next_render:
+            return False
+        self.next_render = now + self.sparkline_interval
+        return True
+
+
+class MonitorRow:
+    """ what one row watches (message, field, thresholds, scaling) and what it last showed """
+
+    def __init__(self, history_length=HISTORY_LENGTH, sparkline_interval=SPARKLINE_INTERVAL):
+        self.message_name = ''
+        self.field_name = ''
+        self.min_text = ''
+        self.max_text = ''
+        self.factor_text = ''
+        self.hysteresis_text = ''
+        self.debounce_text = ''
+        self.factor = 1.0
+        self.value = None
+        self.text = 'NO DATA'
+        self.dirty = False  # value changed since the row was last painted
+        self.rule = AlertRule('')
+        self.history = MonitoredHistory(history_length, sparkline_interval)
+
+    @property
+    def minimum(self):
+        return self.rule.low
+
+    @property
+    def maximum(self):
+        return self.rule.high
+
+    @property
+    def alarm(self):
+        return self.rule.active
+
+    def set_thresholds(self, min_text, max_text, hysteresis_text='', debounce_text=''):
+        """ both thresholds must be valid for either to apply - blank hysteresis/debounce use the defaults """
+        self.min_text, self.max_text = min_text, max_text
+        self.hysteresis_text, self.debounce_text = hysteresis_text, debounce_text
+        self.rule.set_band(parse_float(min_text), parse_float(max_text), parse_float(hysteresis_text))
+        self.rule.debounce = parse_float(debounce_text, DEFAULT_DEBOUNCE)
+
+    def set_factor(self, factor_text):
+        self.factor_text = factor_text
+        self.factor = parse_float(factor_text, 1.0)
+
+    def configure(self, message=None, field=None, min=None, max=None, factor=None, hysteresis=None, debounce=None):
+        """ applies settings in the shape returned by settings() - settings left as None are unchanged """
+        settings = self.settings()
+        for key, value in (('message', message), ('field', field), ('min', min), ('max', max),
+                           ('factor', factor), ('hysteresis', hysteresis), ('debounce', debounce)):
+            if value is not None:
+                settings[key] = value
+        if (settings['message'], settings['field']) != (self.message_name, self.field_name):
+            self.clear()
+        self.message_name = settings['message']
+        self.field_name = settings['field']
+        self.rule.name = '{}.{}'.format(self.message_name, self.field_name)
+        self.set_thresholds(settings['min'], settings['max'], settings['hysteresis'], settings['debounce'])
+        self.set_factor(settings['factor'])
+
+    def settings(self):
+        return OrderedDict([('message', self.message_name), ('field', self.field_name), ('min', self.min_text),
+                            ('max', self.max_text), ('factor', self.factor_text),
+                            ('hysteresis', self.hysteresis_text), ('debounce', self.debounce_text)])
+
+    def clear(self):
+        self.value = None
+        self.text = 'NO DATA'
+        self.dirty = True
+        self.rule.reset()
+
+    def update(self, msg_data):
+        """ returns True if the row took a new value from msg_data """
+        try:
+            value = to_float(msg_data[self.field_name]) * self.factor
+        except (KeyError, TypeError, ValueError):
+            return False
+        if not finite(value):  # NaN from the vehicle or a derived field would stick in the alert and history
+            return False
+        self.value = self.rule.value = value
+        self.text = str(value)
+        self.dirty = True
+        self.history.append(self.message_name, self.field_name, value)
+        return True
+
+
+class MessageMonitor:
+    def __init__(self, msg_names, num_rows=0, history_length=HISTORY_LENGTH,
+                 sparkline_interval=SPARKLINE_INTERVAL, on_row_update=None, derived=None):
+        self.msg_names = msg_names  # msgid: message name
+        self.history_length = history_length
+        self.sparkline_interval = sparkline_interval
+        self.on_row_update = on_row_update  # called as on_row_update(index, row) after a row changes
+        self.received_messages = {}
+        self.field_names = {}  # msgid: data attribute names, discovered from the first message of each type
+        self.rows = []
+        self.alerts = AlertEngine()
+        for x in range(num_rows):
+            self.add_row()
+        self.derived = None
+        if derived is not None:
+            self.set_derived(derived)
+
+    def set_derived(self, derived):
+        """ derived fields appear as fields of a pseudo-message named DERIVED_MESSAGE_NAME """
+        self.derived = derived
+        if len(derived):
+            self.received_messages[DERIVED_MESSAGE_NAME] = derived.values
+
+    def add_row(self, settings=None):
+        row = MonitorRow(self.history_length, self.sparkline_interval)
+        if settings:
+            row.configure(**settings)
+        self.rows.append(row)
+        return row
+
+    def remove_row(self, index):
+        del self.rows[index]
+
+    def evaluate_alerts(self, now=None):
+        """ batched threshold check for every row - returns the rows whose alert was raised or cleared """
+        changed = self.alerts.evaluate([row.rule for row in self.rows], now)
+        return [row for row in self.rows if row.rule in changed]
+
+    def get_message_data(self, message):
+        message_name = self.msg_names[message.msgid]
+        data = message.data
+        field_names = self.field_names.get(message.msgid)
+        if field_names is None:
+            field_names = [attr_name for attr_name in dir(data)
+                           if '__' not in attr_name and not callable(getattr(data, attr_name))]
+            self.field_names[message.msgid] = field_names
+        msg_data = {}
+        for attr_name in field_names:
+            msg_data[attr_name] = getattr(data, attr_name)
+        self.received_messages[message_name] = msg_data
+        self.display_message_data(message_name, msg_data)
+        if self.derived is not None:
+            changed = self.derived.update(message_name, msg_data)
+            if changed:
+                self.display_message_data(DERIVED_MESSAGE_NAME, changed)
+        return True
+
+    def display_message_data(self, message_name, msg_data):
+        for index, row in enumerate(self.rows):
+            if row.message_name == message_name and row.update(msg_data) and self.on_row_update is not None:
+                self.on_row_update(index, row)
+
+
+def default_config():
+    return OrderedDict([('hide_factors', False),
+                        ('always_on_top', True),
+                        ('visible_rows', DEFAULT_VISIBLE_ROWS),
+                        ('rows', [MonitorRow().settings() for x in range(DEFAULT_NUM_ROWS)]),
+                        ('derived', [])])
+
+
+def read_legacy_config(filename):
+    """ converts the original positional format: 'num_rows,hide,sticky,' then 'message,field,min,max,factor,' """
+    config = default_config()
+    with open(filename, 'r') as f:
+        lines = [line.rstrip('\r\n') for line in f.readlines()]
+    header = lines[0].split(',')
+    config['hide_factors'] = bool(int(header[1]))
+    config['always_on_top'] = bool(int(header[2]))
+    config['rows'] = []
+    for line in lines[1:int(header[0]) + 1]:
+        values = (line.split(',') + [''] * 5)[:5]
+        config['rows'].append(OrderedDict(zip(('message', 'field', 'min', 'max', 'factor'), values)))
+    return config
+
+
+def load_config(filename, legacy_filename=None, legacy_derived_filename=None):
+    """ reads the JSON config, falling back to (and migrating) the legacy files, then to defaults """
+    if path.exists(filename):
+        with open(filename, 'r') as f:
+            config = default_config()
+            config.update(json.load(f, object_pairs_hook=OrderedDict))
+            return config
+    config = default_config()
+    if legacy_filename is not None and path.exists(legacy_filename):
+        config = read_legacy_config(legacy_filename)
+    if legacy_derived_filename is not None and path.exists(legacy_derived_filename):
+        with open(legacy_derived_filename, 'r') as f:
+            config['derived'] = [line.strip() for line in f.readlines() if line.strip()]
+    return config
+
+
+def save_config(filename, config):
+    with open(filename, 'w') as f:
+        json.dump(config, f, indent=2)
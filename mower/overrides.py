@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+    mower/overrides.py
+
+    RC override scheduler with its own send rate and a fail-safe watchdog
+
+    The UI only records the PWM wanted on each channel.  A scheduler thread sends every active channel as
+    one RC_CHANNELS_OVERRIDE per tick, so the refresh rate no longer depends on heartbeats or on how many
+    channels are overridden.  The UI must kick() the watchdog regularly (from a WinForms Timer, which stops
+    firing if the UI thread hangs) - if it does not, all overrides are released within watchdog_timeout.
+
+"""
+
+from threading import Event, Lock, Thread
+from time import time
+
+from mower.history import RollingStats
+
+OVERRIDE_RATE = 10.0  # Hz
+WATCHDOG_TIMEOUT = 1.0  # seconds without a kick() before overrides are released
+LATENCY_HISTORY = 200  # samples
+RELEASE = 0  # PWM that hands a channel back to the RC transmitter
+NUM_OVERRIDE_CHANNELS = 18
+UINT16_MAX = 65535
+
+
+def override_fields(channels, target_system=1, target_component=1):
+    """ RC_CHANNELS_OVERRIDE fields for [(channel, pwm)] - channels not listed are left alone """
+    fields = {'target_system': target_system, 'target_component': target_component}
+    for chan in range(1, NUM_OVERRIDE_CHANNELS + 1):
+        fields['chan{}_raw'.format(chan)] = UINT16_MAX if chan <= 8 else 0  # "ignore" differs above channel 8
+    for chan, pwm in channels:
+        if pwm == RELEASE and chan > 8:
+            pwm = UINT16_MAX - 1
+        fields['chan{}_raw'.format(chan)] = pwm
+    return fields
+
+
+class OverrideScheduler:
+    def __init__(self, send, rate=OVERRIDE_RATE, watchdog_timeout=WATCHDOG_TIMEOUT, clock=time):
+        self.send = send  # send([(channel, pwm)]) must emit a single override message
+        self.rate = rate
+        self.watchdog_timeout = watchdog_timeout
+        self.clock = clock
+        self.channels = {}  # channel: pwm, refreshed every tick
+        self.tripped = False  # set when the watchdog released the overrides, cleared by the UI
+        self.messages_sent = 0
+        self.send_time = RollingStats(LATENCY_HISTORY)  # seconds spent in send()
+        self.latency = RollingStats(LATENCY_HISTORY)  # seconds from a change to the message carrying it
+        self._released = set()  # channels to release in the next message
+        self._changed_at = None
+        self._last_kick = clock()
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.kick()
+        self._stop.clear()
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=2.0):
+        """ stops the thread, then releases anything still overridden """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join(timeout)
+            self._thread = None
+        self.release_all()
+        self.tick(check_watchdog=False)
+
+    def kick(self):
+        self._last_kick = self.clock()
+
+    def set(self, channel, pwm):
+        with self._lock:
+            if self.channels.get(channel) != pwm:
+                self.channels[channel] = pwm
+                self._released.discard(channel)
+                if self._changed_at is None:
+                    self._changed_at = self.clock()
+        self.kick()
+
+    def release(self, channel):
+        with self._lock:
+            if self.channels.pop(channel, None) is not None:
+                self._released.add(channel)
+                if self._changed_at is None:
+                    self._changed_at = self.clock()
+
+    def release_all(self):
+        with self._lock:
+            self._released.update(self.channels)
+            self.channels.clear()
+            if self._released and self._changed_at is None:
+                self._changed_at = self.clock()
+
+    def tick(self, check_watchdog=True):
+        """ sends one coalesced message if anything is overridden or waiting to be released """
+        now = self.clock()
+        if check_watchdog and self.channels and now - self._last_kick > self.watchdog_timeout:
+            self.tripped = True
+            self.release_all()
+        with self._lock:
+            batch = sorted(self.channels.items()) + [(chan, RELEASE) for chan in sorted(self._released)]
+            self._released.clear()
+            changed_at, self._changed_at = self._changed_at, None
+        if not batch:
+            return False
+        self.send(batch)
+        sent = self.clock()
+        self.messages_sent += 1
+        self.send_time.append(sent - now, sent)
+        if changed_at is not None:
+            self.latency.append(sent - changed_at, sent)
+        return True
+
+    def _run(self):
+        interval = 1.0 / self.rate
+        next_tick = self.clock()
+        while not self._stop.is_set():
+            self.tick()
+            next_tick += interval
+            delay = next_tick - self.clock()
+            if delay > 0:
+                self._stop.wait(delay)
+            else:
+                next_tick = self.clock()  # fell behind - skip ticks rather than bursting
+
+    def status_text(self):
+        if not self.latency.buffer.count:
+            return '{} override messages'.format(self.messages_sent)
+        return '{} override messages, latency p95 {:.0f} ms, send p95 {:.1f} ms'.format(
+            self.messages_sent, self.latency.percentile(95) * 1000, self.send_time.percentile(95) * 1000)
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+    mower/param_diff.py
+
+    N-way diff and history of .param dumps, like the dated files in this repository
+
+    ParamTable loads any number of dumps in one pass each into a single name-by-snapshot table (one row of
+    values per parameter, None where a dump lacks it).  From that it lists the parameters that differ
+    between any of the snapshots (with a float tolerance, since values round-trip through float32),
+    grouped by prefix, gives the timeline of a single parameter, and writes the minimal change set taking
+    one dump to another as a .param file Mission Planner can load.
+
+    Usage (from the repository root):
+        python -m mower.param_diff *.param
+        python -m mower.param_diff *.param --prefix ATC_ --prefix WP_ --timeline ATC_STR_RAT_FF
+        python -m mower.param_diff A.param B.param --changes 1 2 --output a_to_b.param
+
+"""
+
+import argparse
+import sys
+from collections import OrderedDict
+from os import path
+
+from mower.params import read_param_file
+
+REL_TOLERANCE = 1e-6  # values are stored as float32 on the vehicle
+ABS_TOLERANCE = 1e-6
+MISSING = '-'
+
+
+def snapshot_label(filename):
+    """ the leading date of the dated dumps (20210714), otherwise the file name """
+    name = path.splitext(path.basename(filename))[0]
+    first = name.split(' ', 1)[0]
+    return first if first.isdigit() else name
+
+
+def group_name(name):
+    """ default grouping - the text up to the first underscore (ATC_, WP_, NAVL1_...) """
+    return name.split('_', 1)[0] + '_' if '_' in name else name
+
+
+def format_value(value):
+    return MISSING if value is None else '{:.7g}'.format(value)
+
+
+class ParamTable:
+    def __init__(self, rel_tolerance=REL_TOLERANCE, abs_tolerance=ABS_TOLERANCE):
+        self.rel_tolerance = rel_tolerance
+        self.abs_tolerance = abs_tolerance
+        self.snapshots = []  # source file names, in column order
+        self.labels = []
+        self.rows = {}  # NAME: [value or None per snapshot]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, items, source, label=None):
+        """ adds a column from (name, value) pairs """
+        column = len(self.snapshots)
+        self.snapshots.append(source)
+        self.labels.append(label if label is not None else snapshot_label(source))
+        for row in self.rows.values():
+            row.append(None)
+        for name, value in items:
+            row = self.rows.get(name)
+            if row is None:
+                row = self.rows[name] = [None] * (column + 1)
+            row[column] = value
+        return column
+
+    def load_file(self, filename, label=None):
+        return self.add(read_param_file(filename), filename, label)
+
+    def load_files(self, filenames):
+        for filename in filenames:
+            self.load_file(filename)
+        return self
+
+    @property
+    def names(self):
+        return sorted(self.rows)
+
+    def column(self, key):
+        """ column index from an index (0 based), label or file name """
+        if isinstance(key, int):
+            return key
+        for keys in (self.labels, self.snapshots):
+            if key in keys:
+                return keys.index(key)
+        raise KeyError(key)
+
+    def equal(self, a, b):
+        if a is None or b is None:
+            return a is b
+        return abs(a - b) <= max(self.rel_tolerance * max(abs(a), abs(b)), self.abs_tolerance)
+
+    def differs(self, row, columns=None):
+        values = row if columns is None else [row[column] for column in columns]
+        return any(not self.equal(values[0], value) for value in values[1:])
+
+    def diff(self, columns=None, prefixes=None):
+        """ OrderedDict NAME: values of the parameters that are not equal in every (selected) snapshot """
+        if columns is not None:
+            columns = [self.column(column) for column in columns]
+        result = OrderedDict()
+        for name in self.names:
+            if prefixes and not name.startswith(tuple(prefixes)):
+                continue
+            row = self.rows[name]
+            if self.differs(row, columns):
+                result[name] = row if columns is None else [row[column] for column in columns]
+        return result
+
+    def group(self, names, prefixes=None):
+        """ OrderedDict prefix: [names] - by the given prefixes (others under 'other'), or by group_name() """
+        groups = OrderedDict((prefix, []) for prefix in prefixes or ())
+        for name in names:
+            if prefixes:
+                key = next((prefix for prefix in prefixes if name.startswith(prefix)), 'other')
+            else:
+                key = group_name(name)
+            groups.setdefault(key, []).append(name)
+        return OrderedDict((key, names) for key, names in groups.items() if names)
+
+    def timeline(self, name):
+        """ [(label, value)] - the first snapshot, then only those where the value changed """
+        row = self.rows.get(name)
+        if row is None:
+            raise KeyError(name)
+        changes = []
+        for label, value in zip(self.labels, row):
+            if not changes or not self.equal(changes[-1][1], value):
+                changes.append((label, value))
+        return changes
+
+    def change_set(self, source, target):
+        """ (OrderedDict NAME: value to set, [names only in the source]) taking source to target """
+        source, target = self.column(source), self.column(target)
+        changes = OrderedDict()
+        removed = []
+        for name in self.names:
+            row = self.rows[name]
+            if self.equal(row[source], row[target]):
+                continue
+            if row[target] is None:
+                removed.append(name)
+            else:
+                changes[name] = row[target]
+        return changes, removed
+
+    def write_change_set(self, filename, source, target):
+        """ .param file with only the changed values - returns the change set """
+        changes, removed = self.change_set(source, target)
+        with open(filename, 'w') as f:
+            for name, value in changes.items():
+                f.write('{},{}\n'.format(name, format_value(value)))
+        return changes, removed
+
+    def format_diff(self, diff, prefixes=None):
+        width = max([len(name) for name in diff] + [4])
+        columns = [max(len(label), 8) for label in self.labels]
+        header = '{:<{}}  '.format('', width) + '  '.join('{:>{}}'.format(label, column)
+                                                          for label, column in zip(self.labels, columns))
+        lines = [header]
+        for prefix, names in self.group(diff, prefixes).items():
+            lines.append('{} ({})'.format(prefix, len(names)))
+            for name in names:
+                row = diff[name]
+                cells = []
+                for index, (value, column) in enumerate(zip(row, columns)):
+                    changed = index and not self.equal(row[index - 1], value)
+                    cells.append('{:>{}}'.format(format_value(value) + ('*' if changed else ' '), column))
+                lines.append('{:<{}}  '.format(name, width) + '  '.join(cells))
+        return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='N-way diff of ArduPilot .param dumps')
+    parser.add_argument('param_files', nargs='+', help='.param dumps, oldest first')
+    parser.add_argument('--tolerance', type=float, default=REL_TOLERANCE, help='relative float tolerance')
+    parser.add_argument('--prefix', action='append', default=None, help='only (and group by) this prefix')
+    parser.add_argument('--timeline', action='append', default=[], metavar='NAME', help='history of a parameter')
+    parser.add_argument('--changes', nargs=2, metavar=('FROM', 'TO'),
+                        help='minimal change set between two dumps (1 based index, label or file name)')
+    parser.add_argument('--output', help='.param file for the --changes set')
+    args = parser.parse_args(argv)
+
+    table = ParamTable(args.tolerance).load_files(args.param_files)
+    for index, (label, filename) in enumerate(zip(table.labels, table.snapshots)):
+        print('[{}] {}  {}'.format(index + 1, label, filename))
+
+    if args.timeline:
+        for name in args.timeline:
+            if name not in table.rows:
+                print('{}: not in any dump'.format(name))
+                continue
+            print('{}: {}'.format(name, '  ->  '.join('{} {}'.format(format_value(value), label)
+                                                      for label, value in table.timeline(name))))
+    elif args.changes:
+        source, target = [int(key) - 1 if key.isdigit() and 0 < int(key) <= len(table.snapshots) else key
+                          for key in args.changes]
+        for key in (source, target):
+            try:
+                table.column(key)
+            except KeyError:
+                parser.error('--changes {}: not a dump index (1 to {}), label or file name'.format(
+                    key, len(table.snapshots)))
+        if args.output:
+            changes, removed = table.write_change_set(args.output, source, target)
+        else:
+            changes, removed = table.change_set(source, target)
+        for name, value in changes.items():
+            print('{},{}'.format(name, format_value(value)))
+        print('{} changed{}{}'.format(len(changes), ', {} not in the target: {}'.format(len(removed), ' '.join(removed))
+                                      if removed else '', ' - written to ' + args.output if args.output else ''))
+    else:
+        diff = table.diff(prefixes=args.prefix)
+        print(table.format_diff(diff, args.prefix))
+        print('{} of {} parameters differ'.format(len(diff), len(table)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+    mower/params.py
+
+    Local snapshot of the vehicle parameters, so the dialogs never wait on a parameter read
+
+    The cache is filled in one pass from the list Mission Planner already holds, or from a .param dump such as
+    the dated files in this repository, then kept current from PARAM_VALUE messages one parameter at a time.
+    A sorted name index serves prefix lookups like RC3_ or ATC_STR_.
+
+"""
+
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from threading import Lock
+
+
+class ParamError(KeyError):
+    pass
+
+
+def text_field(data):
+    """ char[] fields arrive as str (replay) or byte arrays (Mission Planner) """
+    if not isinstance(data, str):
+        data = bytes(bytearray(data)).decode('ascii', 'replace')
+    return data.split('\x00', 1)[0]
+
+
+def read_param_file(filename):
+    """ yields (name, value) from a Mission Planner (NAME,value) or whitespace separated parameter file """
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.replace(',', ' ').split()
+            if len(fields) < 2:
+                continue
+            try:
+                yield fields[0], float(fields[1])
+            except ValueError:
+                continue
+
+
+class ParamCache:
+    def __init__(self):
+        self.values = {}  # NAME: float
+        self.names = []  # sorted, for prefix lookups
+        self.version = 0  # incremented whenever a value changes
+        self.source = None  # where the bulk load came from
+        self.expected = None  # param_count of the last PARAM_VALUE, the length of the vehicle's parameter list
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, name):
+        return name in self.values
+
+    def __getitem__(self, name):
+        try:
+            return self.values[name]
+        except KeyError:
+            raise ParamError(name)
+
+    def get(self, name, default=None):
+        return self.values.get(name, default)
+
+    def get_int(self, name, default=None):
+        value = self.values.get(name)
+        return default if value is None else int(value)
+
+    def set(self, name, value):
+        """ returns True if the value changed """
+        value = float(value)
+        with self._lock:
+            previous = self.values.get(name)
+            if previous == value:
+                return False
+            if previous is None:
+                insort(self.names, name)
+            self.values[name] = value
+            self.version += 1
+        return True
+
+    def load(self, items, source=None):
+        """ replaces the cache with (name, value) pairs in a single pass - returns the number loaded """
+        values = dict((name, float(value)) for name, value in items)
+        with self._lock:
+            self.values = values
+            self.names = sorted(values)
+            self.version += 1
+        self.source = source
+        self.expected = None
+        return len(values)
+
+    def load_file(self, filename):
+        return self.load(read_param_file(filename), filename)
+
+    def load_mission_planner(self, param_list):
+        """ copies the parameter list Mission Planner fetched on connection (MAV.MAV.param) """
+        return self.load(((param.Name, param.Value) for param in param_list), 'Mission Planner')
+
+    def prefix(self, prefix):
+        """ OrderedDict of the parameters whose names start with prefix, in name order """
+        with self._lock:
+            start = bisect_left(self.names, prefix)
+            result = OrderedDict()
+            for name in self.names[start:]:
+                if not name.startswith(prefix):
+                    break
+                result[name] = self.values[name]
+        return result
+
+    def complete(self):
+        """ True once a bulk load, or every parameter the vehicle's PARAM_VALUE messages count, is in the cache """
+        return len(self.values) > 0 and (self.expected is None or len(self.values) >= self.expected)
+
+    def rc_channel(self, channel):
+        """ (min, max, trim) PWM of an RC input channel, None until all three are known """
+        pwm = tuple(self.get_int('RC{}_{}'.format(channel, name)) for name in ('MIN', 'MAX', 'TRIM'))
+        return None if None in pwm else pwm
+
+    def handle_param_value(self, message):
+        """ PARAM_VALUE handler - updates just the reported parameter """
+        self.expected = message.data.param_count
+        self.set(text_field(message.data.param_id), message.data.param_value)
+        return True
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+    mower/pid_batch.py
+
+    Headless batch PID simulator - thousands of (P, I, D) combinations stepped together as NumPy arrays
+
+    Every combination runs the same fixed-step step response against a plant from mower/plants.py, with the
+    controller arithmetic of simple-pid (derivative on measurement, integral clamped to the output limits)
+    so results carry over to pid-simulator.py.  Each is scored on overshoot, settling time, IAE (integral of
+    absolute error) and control effort (total output travel).  Results are ranked by a weighted,
+    median-normalised cost, and the Pareto front (combinations no other stable one beats on every metric) is
+    marked.
+
+    From the command line:
+        python -m mower.pid_batch --grid 20 --p 0 2 --i 0 2 --d 0 0.05
+        python -m mower.pid_batch --random 20000 --seed 1 --limits -1.5 1.5 --top 30
+        python -m mower.pid_batch --plant skid-steer --params "20210714 Cube Orange 4.1.0-dev (custom) GPS UART2.param"
+
+"""
+
+from __future__ import division
+
+import argparse
+import sys
+from timeit import default_timer
+
+import numpy as np
+
+from mower.params import ParamCache
+from mower.plants import PLANTS, Direct, make_plant
+
+METRICS = ('overshoot', 'settling', 'iae', 'effort')
+DEFAULT_WEIGHTS = {'overshoot': 1.0, 'settling': 1.0, 'iae': 1.0, 'effort': 0.5}
+SETTLING_BAND = 0.02  # fraction of the step the response must stay within to count as settled
+DEFAULT_DT = 0.01  # seconds
+DEFAULT_DURATION = 5.0  # seconds
+
+
+def grid(p_values, i_values, d_values):
+    """ every combination of the given gains, as flat (kp, ki, kd) arrays """
+    kp, ki, kd = np.meshgrid(np.asarray(p_values, float), np.asarray(i_values, float),
+                             np.asarray(d_values, float), indexing='ij')
+    return kp.ravel(), ki.ravel(), kd.ravel()
+
+
+def random_gains(count, p_range, i_range, d_range, seed=None):
+    """ count uniformly distributed combinations within (low, high) ranges """
+    rng = np.random.default_rng(seed)
+    return tuple(rng.uniform(low, high, count) for low, high in (p_range, i_range, d_range))
+
+
+class BatchResult:
+    def __init__(self, kp, ki, kd, overshoot, settling, iae, effort, stable, dt, duration, elapsed):
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.overshoot = overshoot  # percent of the step
+        self.settling = settling  # seconds until the response stays within SETTLING_BAND, inf if it never does
+        self.iae = iae
+        self.effort = effort
+        self.stable = stable  # settled by the end of the horizon, with finite values throughout
+        self.dt = dt
+        self.duration = duration
+        self.elapsed = elapsed  # wall clock seconds spent simulating
+
+    def __len__(self):
+        return len(self.kp)
+
+    def metrics(self):
+        """ (N, len(METRICS)) array """
+        return np.column_stack([getattr(self, name) for name in METRICS])
+
+    def cost(self, weights=None):
+        """ weighted sum of metrics, each divided by its median over the stable combinations - inf if unstable """
+        weights = DEFAULT_WEIGHTS if weights is None else weights
+        cost = np.zeros(len(self))
+        stable = self.stable
+        for name in METRICS:
+            weight = weights.get(name, 0.0)
+            if not weight or not stable.any():
+                continue
+            values = getattr(self, name)
+            scale = np.median(values[stable])
+            cost += weight * values / (scale if scale > 0 else 1.0)
+        cost[~stable] = np.inf
+        return cost
+
+    def ranked(self, weights=None):
+        """ indices from best to worst cost """
+        return np.argsort(self.cost(weights), kind='stable')
+
+    def pareto(self):
+        """ indices of the stable combinations not dominated on every metric by another stable one """
+        candidates = np.flatnonzero(self.stable)
+        if not len(candidates):
+            return candidates
+        metrics = self.metrics()[candidates]
+        order = np.lexsort(metrics.T[::-1])  # by the first metric, ties broken by the next
+        front = []
+        front_metrics = np.empty((0, metrics.shape[1]))
+        for index in order:
+            row = metrics[index]
+            if len(front) and (np.all(front_metrics <= row, axis=1) & np.any(front_metrics < row, axis=1)).any():
+                continue
+            front.append(candidates[index])
+            front_metrics = np.vstack([front_metrics, row])
+        return np.array(front, dtype=int)
+
+    def table(self, indices=None, limit=20, weights=None):
+        cost = self.cost(weights)
+        if indices is None:
+            indices = self.ranked(weights)
+        on_front = set(self.pareto().tolist())
+        lines = ['{:>5}  {:>8} {:>8} {:>8}  {:>9} {:>9} {:>8} {:>8} {:>7}'.format(
+            'rank', 'P', 'I', 'D', 'overshoot', 'settling', 'IAE', 'effort', 'cost')]
+        for rank, index in enumerate(indices[:limit]):
+            lines.append('{:>5}{} {:>8.4f} {:>8.4f} {:>8.4f}  {:>8.1f}% {:>8.2f}s {:>8.4f} {:>8.3f} {:>7.3f}'.format(
+                rank + 1, '*' if index in on_front else ' ', self.kp[index], self.ki[index], self.kd[index],
+                self.overshoot[index], self.settling[index], self.iae[index], self.effort[index], cost[index]))
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return '{} combinations x {} steps in {:.2f} s ({:.0f} combinations/s), {} stable, {} on the Pareto ' \
+               'front'.format(len(self), int(round(self.duration / self.dt)), self.elapsed,
+                              len(self) / max(self.elapsed, 1e-9), int(self.stable.sum()), len(self.pareto()))
+
+
+class SimplePID:
+    """ simple-pid's arithmetic on arrays of gains - derivative on measurement, integral clamped to the limits """
+
+    def __init__(self, kp, ki, kd, output_limits=(None, None)):
+        self.kp, self.ki, self.kd = (np.asarray(gains, float) for gains in np.broadcast_arrays(kp, ki, kd))
+        self.low, self.high = output_limits
+        self.integral = None
+        self.last_measurement = None
+
+    def __len__(self):
+        return len(self.kp)
+
+    def reset(self, dt=DEFAULT_DT):
+        self.integral = np.zeros(len(self))
+        self.last_measurement = None
+
+    def update(self, setpoint, measurement, dt):
+        error = setpoint - measurement
+        last_measurement = measurement if self.last_measurement is None else self.last_measurement
+        self.integral += self.ki * error * dt
+        if self.low is not None or self.high is not None:
+            np.clip(self.integral, self.low, self.high, out=self.integral)
+        output = self.kp * error + self.integral - self.kd * (measurement - last_measurement) / dt
+        if self.low is not None or self.high is not None:
+            np.clip(output, self.low, self.high, out=output)
+        self.last_measurement = measurement
+        return output
+
+
+def run(controller, step=1.0, dt=DEFAULT_DT, duration=DEFAULT_DURATION, plant=None):
+    """ step response of every controller in a batch (anything with kp/ki/kd arrays, reset(dt) and
+        update(setpoint, measurement, dt)) from rest to setpoint step - the default plant feeds the
+        controller output straight back, as pid-simulator.py originally did """
+    start = default_timer()
+    count = len(controller)
+    controller.reset(dt)
+    plant = Direct() if plant is None else plant
+    plant.reset(count, dt)
+    steps = int(round(duration / dt))
+    band = abs(step) * SETTLING_BAND
+    direction = 1.0 if step >= 0 else -1.0
+
+    measurement = np.zeros(count)
+    last_output = np.zeros(count)
+    peak = np.zeros(count)
+    iae = np.zeros(count)
+    effort = np.zeros(count)
+    last_unsettled = np.full(count, -1)
+    finite = np.ones(count, dtype=bool)
+
+    with np.errstate(over='ignore', invalid='ignore'):
+        for k in range(steps):
+            output = controller.update(step, measurement, dt)
+            measurement = plant.step(output)
+
+            error = step - measurement
+            iae += np.abs(error) * dt
+            effort += np.abs(output - last_output)
+            last_output = output
+            np.maximum(peak, measurement * direction, out=peak)
+            last_unsettled[np.abs(error) > band] = k
+            finite &= np.isfinite(measurement)
+        overshoot = np.maximum(peak - abs(step), 0.0) / abs(step) * 100 if step else np.zeros(count)
+
+    stable = finite & (last_unsettled < steps - 1)
+    settling = np.where(stable, (last_unsettled + 1) * dt, np.inf)
+    return BatchResult(controller.kp, controller.ki, controller.kd, overshoot, settling, iae, effort, stable, dt,
+                       duration, default_timer() - start)
+
+
+def simulate(kp, ki, kd, step=1.0, dt=DEFAULT_DT, duration=DEFAULT_DURATION, output_limits=(None, None),
+             plant=None):
+    """ step response of every (kp[n], ki[n], kd[n]) simple-pid controller """
+    return run(SimplePID(kp, ki, kd, output_limits), step, dt, duration, plant)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Batch PID step response search')
+    parser.add_argument('--p', type=float, nargs=2, default=(0.0, 2.0), metavar=('LOW', 'HIGH'))
+    parser.add_argument('--i', type=float, nargs=2, default=(0.0, 2.0), metavar=('LOW', 'HIGH'))
+    parser.add_argument('--d', type=float, nargs=2, default=(0.0, 0.05), metavar=('LOW', 'HIGH'))
+    parser.add_argument('--grid', type=int, default=20, help='points per gain for a grid search')
+    parser.add_argument('--random', type=int, default=None, help='combinations for a random search instead')
+    parser.add_argument('--seed', type=int, default=None, help='random search seed')
+    parser.add_argument('--step', type=float, default=1.0, help='setpoint step size')
+    parser.add_argument('--dt', type=float, default=DEFAULT_DT, help='simulation step (s)')
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION, help='simulated seconds')
+    parser.add_argument('--limits', type=float, nargs=2, default=(None, None), metavar=('LOW', 'HIGH'),
+                        help='controller output limits')
+    parser.add_argument('--plant', choices=PLANTS, default='direct', help='what the controller drives')
+    parser.add_argument('--params', help='.param file for the skid-steer plant (ATC_ACCEL_MAX, ATC_DECEL_MAX)')
+    parser.add_argument('--tau', type=float, default=0.1, help='plant time constant (s)')
+    parser.add_argument('--dead-time', type=float, default=0.0, help='plant dead time (s)')
+    parser.add_argument('--weight', action='append', default=[], metavar='METRIC=WEIGHT',
+                        help='ranking weight, metrics: ' + ', '.join(METRICS) + ' (repeatable)')
+    parser.add_argument('--top', type=int, default=20, help='rows of the ranked table to print')
+    args = parser.parse_args(argv)
+
+    weights = dict(DEFAULT_WEIGHTS)
+    for item in args.weight:
+        name, weight = item.split('=', 1)
+        if name not in METRICS:
+            parser.error('unknown metric ' + name)
+        weights[name] = float(weight)
+
+    if args.random:
+        kp, ki, kd = random_gains(args.random, args.p, args.i, args.d, args.seed)
+    else:
+        kp, ki, kd = grid(*(np.linspace(low, high, args.grid) for low, high in (args.p, args.i, args.d)))
+    params = None
+    if args.params:
+        params = ParamCache()
+        params.load_file(args.params)
+    plant = make_plant(args.plant, params, args.tau, args.dead_time)
+    result = simulate(kp, ki, kd, args.step, args.dt, args.duration, tuple(args.limits), plant)
+    print(result)
+    print(result.table(limit=args.top, weights=weights))
+    front = result.pareto()
+    print('\nPareto front ({} combinations, lowest IAE first):'.format(len(front)))
+    print(result.table(front[np.argsort(result.iae[front])], args.top, weights))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
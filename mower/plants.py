@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+    mower/plants.py
+
+    Plant models for the PID simulators - what the controller output actually drives
+
+    Every plant is stepped at a fixed dt on NumPy arrays holding one state per simulated controller, so the
+    same model serves the live view (one controller) and mower/pid_batch.py (thousands).  reset(count, dt)
+    preallocates the state, step(output) advances one dt and returns the measurement fed back to the
+    controller as a new array.  Plants can be chained:
+        Chain(Saturation(-1, 1), DeadTime(0.05), FirstOrderLag(0.1))
+
+    SkidSteerYaw turns a -1..1 steering output into yaw rate (rad/s) for a skid-steer vehicle like the mower,
+    with the yaw acceleration limited by ATC_ACCEL_MAX/ATC_DECEL_MAX acting on opposite tracks.
+
+"""
+
+from __future__ import division
+
+from math import exp
+
+import numpy as np
+
+DEFAULT_TRACK_WIDTH = 0.9  # m, centre to centre of the drive wheels
+DEFAULT_TRACK_SPEED = 1.5  # m/s of each track at full steering output
+
+
+def full_output_speed(params):
+    """ track speed at full output, extrapolated from CRUISE_SPEED at CRUISE_THROTTLE """
+    speed, throttle = params.get('CRUISE_SPEED', 0.0), params.get('CRUISE_THROTTLE', 0.0)
+    return speed * 100 / throttle if speed > 0 and throttle > 0 else DEFAULT_TRACK_SPEED
+
+
+class Direct:
+    """ the controller output is the measurement - pid-simulator.py's original behaviour """
+
+    def reset(self, count=1, dt=0.01):
+        pass
+
+    def step(self, output):
+        return output
+
+
+class Saturation:
+    def __init__(self, low=-1.0, high=1.0):
+        self.low = low
+        self.high = high
+
+    def reset(self, count=1, dt=0.01):
+        pass
+
+    def step(self, output):
+        return np.clip(output, self.low, self.high)
+
+
+class FirstOrderLag:
+    """ gain * output reached with time constant tau, discretised exactly for the step size """
+
+    def __init__(self, tau, gain=1.0):
+        self.tau = tau
+        self.gain = gain
+        self.alpha = 1.0
+        self.value = None
+
+    def reset(self, count=1, dt=0.01):
+        self.alpha = 1.0 - exp(-dt / self.tau) if self.tau > 0 else 1.0
+        self.value = np.zeros(count)
+
+    def step(self, output):
+        self.value = self.value + (self.gain * output - self.value) * self.alpha
+        return self.value
+
+
+class DeadTime:
+    """ delays the output by a whole number of steps, held in a preallocated ring """
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.buffer = None
+        self.index = 0
+
+    def reset(self, count=1, dt=0.01):
+        self.buffer = np.zeros((max(int(round(self.delay / dt)), 0) + 1, count))
+        self.index = 0
+
+    def step(self, output):
+        self.buffer[self.index] = output
+        self.index = (self.index + 1) % len(self.buffer)
+        return self.buffer[self.index].copy()  # the oldest entry, written delay steps ago
+
+
+class Chain:
+    """ plants in series, the first receives the controller output """
+
+    def __init__(self, *plants):
+        self.plants = plants
+
+    def reset(self, count=1, dt=0.01):
+        for plant in self.plants:
+            plant.reset(count, dt)
+
+    def step(self, output):
+        for plant in self.plants:
+            output = plant.step(output)
+        return output
+
+
+class SkidSteerYaw:
+    """ yaw rate (rad/s) of a skid-steer vehicle turning on the spot
+
+        A -1..1 steering output drives the tracks at +/- output * track_speed through a first order motor lag.
+        Each track's speed may only change by accel_max (or decel_max when slowing) per second, so the yaw
+        rate changes by at most 2 * accel_max / track_width - 0 disables a limit, as in ArduRover """
+
+    def __init__(self, accel_max=0.0, decel_max=0.0, track_width=DEFAULT_TRACK_WIDTH,
+                 track_speed=DEFAULT_TRACK_SPEED, tau=0.1):
+        self.track_width = track_width
+        self.max_rate = 2 * np.asarray(track_speed, float) / track_width
+        accel_max, decel_max = np.asarray(accel_max, float), np.asarray(decel_max, float)  # or one per controller
+        self.accel_limit = np.where(accel_max > 0, 2 * accel_max / track_width, np.inf)  # rad/s/s
+        self.decel_limit = np.where(decel_max > 0, 2 * decel_max / track_width, self.accel_limit)
+        self.motor = FirstOrderLag(tau)
+        self.rate = None
+        self.dt = 0.01
+
+    @classmethod
+    def from_params(cls, params, track_width=DEFAULT_TRACK_WIDTH, track_speed=None, tau=0.1):
+        """ acceleration limits (and track speed, unless given) from a ParamCache or any mapping with get() """
+        return cls(params.get('ATC_ACCEL_MAX', 0.0), params.get('ATC_DECEL_MAX', 0.0), track_width,
+                   full_output_speed(params) if track_speed is None else track_speed, tau)
+
+    def reset(self, count=1, dt=0.01):
+        self.dt = dt
+        self.motor.reset(count, dt)
+        self.rate = np.zeros(count)
+
+    def step(self, output):
+        demand = self.motor.step(np.clip(output, -1.0, 1.0) * self.max_rate)
+        change = demand - self.rate
+        speeding_up = change * self.rate >= 0  # moving away from zero (or starting from rest)
+        limit = np.where(speeding_up, self.accel_limit, self.decel_limit) * self.dt
+        self.rate = self.rate + np.clip(change, -limit, limit)
+        return self.rate
+
+
+PLANTS = ('direct', 'lag', 'skid-steer')
+
+
+def make_plant(name, params=None, tau=0.1, dead_time=0.0, track_width=DEFAULT_TRACK_WIDTH, track_speed=None,
+               limits=(-1.0, 1.0)):
+    """ one of PLANTS by name, optionally preceded by dead time - params supplies ATC_ACCEL/DECEL_MAX """
+    if name == 'direct':
+        plant = Direct()
+    elif name == 'lag':
+        plant = Chain(Saturation(*limits), FirstOrderLag(tau))
+    elif name == 'skid-steer':
+        plant = SkidSteerYaw.from_params(params if params is not None else {}, track_width, track_speed, tau)
+    else:
+        raise ValueError('unknown plant {} (choose from {})'.format(name, ', '.join(PLANTS)))
+    return Chain(DeadTime(dead_time), plant) if dead_time > 0 else plant
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+    mower/recorder.py
+
+    Background telemetry recorder that writes raw MAVLink packets to .tlog files
+
+    Packet handlers call push(), which only appends to a bounded deque and never touches the disk.
+    A dedicated writer thread drains the deque in large blocks and rotates output files by size.
+    deque.append() and deque.popleft() are atomic, so no lock is taken on the packet path.
+
+    Output uses the Mission Planner .tlog layout: each packet is preceded by a big-endian
+    64 bit timestamp in microseconds since the Unix epoch.
+
+"""
+
+from collections import deque
+from os import path, makedirs
+from struct import pack
+from threading import Thread
+from time import time, sleep, strftime, localtime
+
+DEFAULT_QUEUE_SIZE = 8192  # packets
+DEFAULT_BLOCK_SIZE = 256 * 1024  # bytes written per disk write
+DEFAULT_MAX_FILE_SIZE = 64 * 1024 * 1024  # bytes before rotating to a new file
+DEFAULT_FLUSH_INTERVAL = 1.0  # seconds before a partial block is written anyway
+POLL_INTERVAL = 0.02  # seconds the writer sleeps when the queue is empty
+
+
+class TelemetryRecorder:
+    def __init__(self,
+                 directory='.',
+                 prefix='telemetry',
+                 queue_size=DEFAULT_QUEUE_SIZE,
+                 block_size=DEFAULT_BLOCK_SIZE,
+                 max_file_size=DEFAULT_MAX_FILE_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.directory = directory
+        self.prefix = prefix
+        self.queue_size = queue_size
+        self.block_size = block_size
+        self.max_file_size = max_file_size
+        self.flush_interval = flush_interval
+
+        self._queue = deque()
+        self._thread = None
+        self._running = False
+        self._file = None
+        self._file_size = 0
+
+        self.high_water = 0
+        self.dropped = 0
+        self.packets_written = 0
+        self.bytes_written = 0
+        self.files = []
+        self.error = None
+
+    @property
+    def recording(self):
+        return self._running
+
+    def start(self):
+        """ returns False if the previous writer has not finished yet - two writers must never share the file """
+        if self._running:
+            return True
+        if self._thread is not None:
+            if self._thread.is_alive():
+                self.error = 'previous recording is still being written'
+                return False
+            self._thread = None
+        if not path.isdir(self.directory):
+            makedirs(self.directory)
+        self.error = None
+        self._running = True
+        self._thread = Thread(target=self._writer)
+        self._thread.daemon = True
+        self._thread.start()
+        return True
+
+    def stop(self, timeout=5.0):
+        """ stops accepting packets, then waits up to timeout for the writer to drain the queue and close the
+            file - returns False if it is still writing """
+        self._running = False
+        if self._thread is None:
+            return True
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            return False
+        self._thread = None
+        return True
+
+    def push(self, packet, timestamp=None):
+        """ queues one raw packet (anything bytes() accepts) - returns False if it was dropped """
+        if not self._running:
+            return False
+        queue = self._queue
+        if len(queue) >= self.queue_size:
+            self.dropped += 1
+            return False
+        queue.append((time() if timestamp is None else timestamp, packet))
+        depth = len(queue)
+        if depth > self.high_water:
+            self.high_water = depth
+        return True
+
+    def stats(self):
+        return {'recording': self._running,
+                'queued': len(self._queue),
+                'high_water': self.high_water,
+                'queue_size': self.queue_size,
+                'dropped': self.dropped,
+                'packets_written': self.packets_written,
+                'bytes_written': self.bytes_written,
+                'file': self.files[-1] if self.files else None,
+                'error': self.error}
+
+    def status_text(self):
+        return 'queue high water {}/{}, {} dropped, {} packets written'.format(
+            self.high_water, self.queue_size, self.dropped, self.packets_written)
+
+    def _next_filename(self):
+        stamp = strftime('%Y%m%d_%H%M%S', localtime())
+        count = 0
+        while True:
+            filename = path.join(self.directory, '{}_{}_{:03d}.tlog'.format(self.prefix, stamp, count))
+            if not path.exists(filename) and filename not in self.files:
+                return filename
+            count += 1
+
+    def _write_block(self, block):
+        if self._file is not None and self._file_size + len(block) > self.max_file_size:
+            self._file.close()
+            self._file = None
+        if self._file is None:
+            filename = self._next_filename()
+            self._file = open(filename, 'wb')
+            self._file_size = 0
+            self.files.append(filename)
+        self._file.write(bytes(block))
+        self._file_size += len(block)
+        self.bytes_written += len(block)
+
+    def _writer(self):
+        queue = self._queue
+        block = bytearray()
+        count = 0
+        last_write = time()
+        try:
+            while self._running or queue:
+                while queue and len(block) < self.block_size:
+                    timestamp, packet = queue.popleft()
+                    block += pack('>Q', int(timestamp * 1e6))
+                    block += bytes(packet)
+                    count += 1
+                if block and (len(block) >= self.block_size or not queue and
+                              (not self._running or time() - last_write >= self.flush_interval)):
+                    self._write_block(block)
+                    self.packets_written += count
+                    block = bytearray()
+                    count = 0
+                    last_write = time()
+                if not queue:
+                    sleep(POLL_INTERVAL)
+        except (IOError, OSError) as inst:
+            self.error = str(inst)
+            self._running = False
+        finally:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
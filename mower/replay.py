@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+    mower/replay.py
+
+    Headless replay harness for the MinMonitor and ServoTuner packet paths
+
+    Feeds a recorded .tlog (or a synthetic, seeded message generator) through FakeMAV, a local stand-in for
+    Mission Planner's MAV object, and the same mower.dispatch routing into the same MessageMonitor/ServoMonitor
+    code the dialogs use.  Runs as fast as possible or at a chosen multiple of real time and reports messages
+    processed per second (--timing adds the time spent in each handler).
+
+    Usage (CPython 3, from the repository root):
+        python -m mower.replay --duration 600
+        python -m mower.replay --tlog flight.tlog --speed 10 --watch VFR_HUD.groundspeed
+        python -m mower.replay --min-rate 20000    # exits non-zero if throughput regresses below the floor
+
+"""
+
+import argparse
+import random
+import sys
+from math import sin, cos, pi
+from struct import unpack_from
+from time import sleep
+from timeit import default_timer
+
+from mower.dispatch import subscriber
+from mower.mavlink import MESSAGES, MSG_IDS, check_crc, frame_length, parse_frame, decode_payload, encode_message, \
+    STX_V1, STX_V2
+from mower.expressions import DerivedFields
+from mower.monitor import MessageMonitor
+from mower.params import ParamCache
+from mower.servo import ServoMonitor
+from mower.trace import ServoTrace
+
+TLOG_TIMESTAMP_LEN = 8
+
+
+class Event:
+    """ mimics a .NET event: handlers are attached with += and detached with -= """
+
+    def __init__(self):
+        self.handlers = []
+
+    def __iadd__(self, handler):
+        self.handlers.append(handler)
+        return self
+
+    def __isub__(self, handler):
+        self.handlers.remove(handler)
+        return self
+
+    def __call__(self, *args):
+        for handler in list(self.handlers):
+            handler(*args)
+
+
+class MessageData:
+    """ attribute bag standing in for a MAVLink message struct """
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+class ReplayMessage:
+    """ the parts of Mission Planner's MAVLinkMessage that the scripts use """
+
+    def __init__(self, msgid, data, buffer=b'', sysid=1, compid=1, seq=0):
+        self.msgid = msgid
+        self.msgtypename = MESSAGES[msgid].name if msgid in MESSAGES else 'UNKNOWN_{}'.format(msgid)
+        self.data = data
+        self.buffer = buffer
+        self.sysid = sysid
+        self.compid = compid
+        self.seq = seq
+
+
+def message_from_frame(frame):
+    fields = decode_payload(frame.msgid, frame.payload)
+    return ReplayMessage(frame.msgid, MessageData(**(fields or {})), bytes(frame.raw),
+                         frame.sysid, frame.compid, frame.seq)
+
+
+def build_message(name, seq=0, **fields):
+    """ ReplayMessage with a real encoded frame in .buffer, so recorders see genuine packets """
+    buffer = encode_message(name, seq=seq, **fields)
+    return message_from_frame(parse_frame(buffer))
+
+
+class FakeMAV:
+    """ local stand-in for Mission Planner's MAV object - subscriptions are keyed by integer msgid """
+
+    def __init__(self):
+        self.OnPacketReceived = Event()
+        self.subscriptions = {}
+        self.packets_received = 0
+
+    def SubscribeToPacketType(self, msgid, handler):
+        self.subscriptions.setdefault(getattr(msgid, 'value__', msgid), []).append(handler)
+
+    def UnSubscribeToPacketType(self, msgid):
+        self.subscriptions.pop(getattr(msgid, 'value__', msgid), None)
+
+    def inject(self, message):
+        self.packets_received += 1
+        self.OnPacketReceived(self, message)
+        for handler in self.subscriptions.get(message.msgid, ()):
+            handler(message)
+
+
+def read_tlog(filename):
+    """ yields (timestamp, ReplayMessage) from a .tlog, resynchronising a byte at a time past corrupt records -
+        a frame that is truncated or fails its CRC is skipped (messages missing from mavlink.MESSAGES have no
+        crc_extra, so only their framing is checked) """
+    with open(filename, 'rb') as f:
+        buf = f.read()
+    offset = 0
+    size = len(buf)
+    while offset + TLOG_TIMESTAMP_LEN + 2 <= size:
+        start = offset + TLOG_TIMESTAMP_LEN
+        if buf[start] not in (STX_V1, STX_V2):
+            offset += 1
+            continue
+        length = frame_length(buf, start)
+        if length is None or start + length > size:  # a corrupt length byte, or the end of the file
+            offset += 1
+            continue
+        frame = parse_frame(buf, start)
+        if not check_crc(frame):
+            offset += 1
+            continue
+        timestamp = unpack_from('>Q', buf, offset)[0] / 1e6
+        yield timestamp, message_from_frame(frame)
+        offset = start + length
+
+
+def synthetic_messages(duration=60.0, seed=0, start_time=0.0):
+    """ yields (timestamp, ReplayMessage) for a plausible mowing session - deterministic for a given seed """
+    rng = random.Random(seed)
+    schedule = [(0.0, 1.0, 'HEARTBEAT'), (0.0, 0.1, 'SERVO_OUTPUT_RAW'), (0.0, 0.1, 'VFR_HUD'),
+                (0.0, 0.2, 'GPS_RAW_INT'), (0.0, 0.1, 'ATTITUDE'), (0.0, 0.5, 'SYS_STATUS'),
+                (0.0, 0.2, 'NAV_CONTROLLER_OUTPUT'), (3.0, 7.0, 'STATUSTEXT')]
+    next_times = [offset for offset, interval, name in schedule]
+    texts = ['EKF3 IMU0 is using GPS', 'GPS 1: detected as u-blox', 'EKF variance', 'Mission: 12 WP',
+             'Reached waypoint #12 dist 0m', 'Unhealthy GPS Signal']
+    seq = 0
+    t = 0.0
+    while True:
+        index = min(range(len(schedule)), key=next_times.__getitem__)
+        t = next_times[index]
+        if t > duration:
+            return
+        next_times[index] = t + schedule[index][1]
+        name = schedule[index][2]
+        phase = 2 * pi * t / 20.0
+        if name == 'HEARTBEAT':
+            fields = {'custom_mode': 10, 'type': 10, 'autopilot': 3, 'base_mode': 217, 'system_status': 4,
+                      'mavlink_version': 3}
+        elif name == 'SERVO_OUTPUT_RAW':
+            steer = 1500 + int(400 * sin(phase)) + rng.randint(-5, 5)
+            throttle = 1500 + int(300 * cos(phase / 3)) + rng.randint(-5, 5)
+            fields = {'time_usec': int(t * 1e6) & 0xFFFFFFFF, 'servo1_raw': steer, 'servo3_raw': throttle,
+                      'servo2_raw': 1100, 'servo4_raw': 1900, 'servo9_raw': 1000, 'port': 0}
+        elif name == 'VFR_HUD':
+            fields = {'groundspeed': 1.2 + 0.3 * sin(phase) + rng.gauss(0, 0.05), 'heading': int(t * 10) % 360,
+                      'throttle': 40 + int(10 * sin(phase)), 'alt': 1335.7}
+        elif name == 'GPS_RAW_INT':
+            fields = {'time_usec': int(t * 1e6), 'lat': 333125600 + int(t * 10), 'lon': -1116836600,
+                      'alt': 1335700, 'eph': max(50, int(rng.gauss(70, 20))), 'epv': 120, 'vel': 120,
+                      'cog': 9000, 'fix_type': rng.choice((5, 6, 6, 6, 6)), 'satellites_visible': 24}
+        elif name == 'ATTITUDE':
+            fields = {'time_boot_ms': int(t * 1000), 'roll': rng.gauss(0, 0.02), 'pitch': rng.gauss(0, 0.02),
+                      'yaw': sin(phase), 'yawspeed': cos(phase) * 0.3}
+        elif name == 'SYS_STATUS':
+            fields = {'voltage_battery': 12600 - int(t), 'current_battery': 850 + rng.randint(-50, 50),
+                      'battery_remaining': max(0, 100 - int(t / 60)), 'load': 300}
+        elif name == 'NAV_CONTROLLER_OUTPUT':
+            fields = {'xtrack_error': rng.gauss(0, 0.1), 'wp_dist': int(20 + 10 * sin(phase)),
+                      'nav_bearing': 90, 'target_bearing': 92}
+        else:
+            fields = {'severity': rng.choice((4, 6, 6, 6)), 'text': rng.choice(texts)}
+        yield start_time + t, build_message(name, seq, **fields)
+        seq = (seq + 1) & 0xFF
+
+
+class ReplayResult:
+    def __init__(self, messages, elapsed, span):
+        self.messages = messages
+        self.elapsed = elapsed  # wall clock seconds
+        self.span = span  # seconds of telemetry replayed
+
+    @property
+    def rate(self):
+        return self.messages / self.elapsed if self.elapsed > 0 else float('inf')
+
+    @property
+    def speedup(self):
+        return self.span / self.elapsed if self.elapsed > 0 else float('inf')
+
+    def __str__(self):
+        return '{} messages in {:.3f} s ({:.0f} msg/s), {:.1f} s of telemetry at {:.1f}x real time'.format(
+            self.messages, self.elapsed, self.rate, self.span, self.speedup)
+
+
+class ReplayEngine:
+    def __init__(self, mav, speed=None, on_tick=None, tick_interval=0.1):
+        self.mav = mav
+        self.speed = speed  # multiple of real time, None for as fast as possible
+        self.on_tick = on_tick  # called as on_tick(timestamp) every tick_interval seconds of telemetry time
+        self.tick_interval = tick_interval
+
+    def run(self, source, limit=None):
+        count = 0
+        first = last = None
+        next_tick = None
+        start = default_timer()
+        for timestamp, message in source:
+            if first is None:
+                first = next_tick = timestamp
+            last = timestamp
+            while self.on_tick is not None and timestamp >= next_tick:
+                self.on_tick(next_tick)
+                next_tick += self.tick_interval
+            if self.speed:
+                delay = (timestamp - first) / self.speed - (default_timer() - start)
+                if delay > 0:
+                    sleep(delay)
+            self.mav.inject(message)
+            count += 1
+            if limit is not None and count >= limit:
+                break
+        elapsed = default_timer() - start
+        return ReplayResult(count, elapsed, 0.0 if first is None else last - first)
+
+
+def attach_monitor(handlers, watches=(), definitions=(), params=None):
+    """ wires a MessageMonitor to a dispatch Subscriber the way MinMonitorForm does - watches are
+        'MESSAGE.field[:min:max]' strings, definitions are 'name = expression' derived fields (watch them as
+        'DERIVED.name') """
+    derived = DerivedFields(None if params is None else params.__getitem__)
+    for error in derived.load(definitions):
+        print('Derived field error: ' + error)
+    monitor = MessageMonitor(dict((msgid, msg.name) for msgid, msg in MESSAGES.items()), 0, derived=derived)
+    for watch in watches:
+        name, min_text, max_text = (watch.split(':') + ['', ''])[:3]
+        message_name, field_name = name.split('.', 1)
+        monitor.add_row({'message': message_name, 'field': field_name, 'min': min_text, 'max': max_text})
+    for msgid in MESSAGES:
+        handlers.subscribe(msgid, monitor.get_message_data)
+    if params is not None:
+        handlers.subscribe(MSG_IDS['PARAM_VALUE'], params.handle_param_value)
+    return monitor
+
+
+def attach_servo_monitor(handlers, trace=None):
+    """ wires a ServoMonitor (and optionally a ServoTrace) to a dispatch Subscriber the way ServoTunerForm does """
+    servo_monitor = ServoMonitor()
+
+    def servo_output_received(message):
+        servo_monitor.get_servo_data(message)
+        if trace is not None:
+            trace.record(servo_monitor.value, message.data.time_usec)
+        return True
+
+    handlers.subscribe(MSG_IDS['SERVO_OUTPUT_RAW'], servo_output_received)
+    return servo_monitor
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay telemetry through the MinMonitor/ServoTuner packet paths')
+    parser.add_argument('--tlog', help='recorded .tlog to replay (default: synthetic telemetry)')
+    parser.add_argument('--duration', type=float, default=600.0, help='seconds of synthetic telemetry')
+    parser.add_argument('--seed', type=int, default=0, help='synthetic telemetry seed')
+    parser.add_argument('--speed', type=float, default=None, help='multiple of real time (default: flat out)')
+    parser.add_argument('--watch', action='append', default=None, metavar='MESSAGE.field[:min:max]',
+                        help='monitor row to evaluate, optionally with alert thresholds (repeatable)')
+    parser.add_argument('--derive', action='append', default=[], metavar='NAME=EXPRESSION',
+                        help='derived field, e.g. "xtrack_cm=NAV_CONTROLLER_OUTPUT.xtrack_error*100" (repeatable)')
+    parser.add_argument('--params', help='.param file resolving parameter names in derived fields')
+    parser.add_argument('--trace', choices=('csv', 'npy'), help='export the PWM trace and histograms after replay')
+    parser.add_argument('--timing', action='store_true', help='time every packet handler and print the table')
+    parser.add_argument('--min-rate', type=float, default=None, help='fail if msg/s falls below this')
+    args = parser.parse_args(argv)
+
+    watches = args.watch or ['VFR_HUD.groundspeed', 'GPS_RAW_INT.eph:0:100', 'SYS_STATUS.voltage_battery',
+                             'NAV_CONTROLLER_OUTPUT.xtrack_error', 'ATTITUDE.yawspeed']
+    mav = FakeMAV()
+    params = None
+    if args.params:
+        params = ParamCache()
+        params.load_file(args.params)
+    monitor_handlers = subscriber(mav, 'MinMonitor', args.timing)
+    monitor = attach_monitor(monitor_handlers, watches, args.derive, params)
+    servo_handlers = subscriber(mav, 'ServoTuner')
+    trace = ServoTrace() if args.trace else None
+    servo_monitor = attach_servo_monitor(servo_handlers, trace)
+
+    # decode/generate up front so only the packet handlers are timed
+    source = list(read_tlog(args.tlog) if args.tlog else synthetic_messages(args.duration, args.seed))
+    result = ReplayEngine(mav, args.speed, monitor.evaluate_alerts).run(source)
+    print(result)
+    if args.timing:
+        print(monitor_handlers.dispatcher.status_text())
+        print('\n'.join(monitor_handlers.dispatcher.timing_table()))
+    monitor_handlers.close()
+    servo_handlers.close()
+    print(monitor.alerts.summary())
+    for row in monitor.rows:
+        print('  {}.{}: {}  [{}]'.format(row.message_name, row.field_name, row.text, row.history.stats.summary()))
+    servos = servo_monitor
+    for x in range(servos.num_servos):
+        if servos.has_extremes(x):
+            print('  servo{}: {} min {} max {} ({} samples)'.format(x + 1, servos.value[x], servos.minimum[x],
+                                                                   servos.maximum[x], servos.samples[x]))
+    if trace is not None:
+        trace.export(fmt=args.trace, on_done=lambda files, error: print(error or 'exported ' + ', '.join(files))).join()
+    if args.min_rate is not None and result.rate < args.min_rate:
+        print('FAIL: {:.0f} msg/s is below the {:.0f} msg/s floor'.format(result.rate, args.min_rate))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+    mower/rtcm.py
+
+    Incremental RTCM3 framing, per-message-type statistics and bandwidth-aware filtering for the fixed base
+
+    RtcmFramer finds frames (0xD3 preamble, 10 bit length, CRC-24Q) in arbitrary chunks of a byte stream.
+    Frames lying wholly inside a chunk come back as memoryview slices of it; only a frame split across two
+    chunks is copied, into a carry buffer no bigger than one frame.  RtcmFilter counts frames and bytes per
+    message type and can forward only some types, or every Nth frame of a type, so the corrections fit a
+    57600 baud telemetry link.  It plugs into mower/serial_bridge.py (--rtcm), or analyses a capture:
+        python -m mower.rtcm base.rtcm --budget 57600
+        python -m mower.rtcm --connect 192.168.1.20:2001 --seconds 30 --types 1005 1074 1084 1094 1230
+        python -m mower.rtcm --benchmark 5    # framing throughput, to compare against 460800 baud
+
+"""
+
+from __future__ import division
+
+import argparse
+import socket
+import sys
+from time import perf_counter, time
+
+PREAMBLE = 0xD3
+HEADER_LEN = 3
+CRC_LEN = 3
+MAX_PAYLOAD = 1023
+CRC24Q_POLY = 0x1864CFB
+BITS_PER_BYTE = 10  # 8N1 on the serial links
+DEFAULT_BUDGET = 57600  # baud
+
+MESSAGE_NAMES = {1005: 'Station ARP', 1006: 'Station ARP + height', 1007: 'Antenna descriptor',
+                 1008: 'Antenna descriptor + serial', 1019: 'GPS ephemeris', 1020: 'GLONASS ephemeris',
+                 1033: 'Receiver + antenna descriptor', 1042: 'BeiDou ephemeris', 1046: 'Galileo ephemeris',
+                 1074: 'GPS MSM4', 1075: 'GPS MSM5', 1077: 'GPS MSM7', 1084: 'GLONASS MSM4', 1085: 'GLONASS MSM5',
+                 1087: 'GLONASS MSM7', 1094: 'Galileo MSM4', 1095: 'Galileo MSM5', 1097: 'Galileo MSM7',
+                 1114: 'QZSS MSM4', 1117: 'QZSS MSM7', 1124: 'BeiDou MSM4', 1125: 'BeiDou MSM5',
+                 1127: 'BeiDou MSM7', 1230: 'GLONASS code-phase biases', 4072: 'u-blox proprietary'}
+
+
+def _crc24q_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 16
+        for bit in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= CRC24Q_POLY
+        table.append(crc & 0xFFFFFF)
+    return table
+
+
+CRC24Q_TABLE = _crc24q_table()
+
+
+def crc24q(data, crc=0):
+    table = CRC24Q_TABLE
+    for byte in bytearray(data):
+        crc = ((crc << 8) & 0xFFFFFF) ^ table[(crc >> 16) ^ byte]
+    return crc
+
+
+def frame_length(buf, offset=0):
+    """ total length of the frame starting at buf[offset], None if the header is incomplete, 0 if it is invalid """
+    if len(buf) - offset < HEADER_LEN:
+        return None
+    if buf[offset + 1] & 0xFC:  # 6 reserved bits, always 0
+        return 0
+    return HEADER_LEN + ((buf[offset + 1] & 0x03) << 8 | buf[offset + 2]) + CRC_LEN
+
+
+def message_type(frame):
+    """ the 12 bit message number at the start of the payload (0 for an empty payload) """
+    if len(frame) < HEADER_LEN + CRC_LEN + 2:
+        return 0
+    return frame[HEADER_LEN] << 4 | frame[HEADER_LEN + 1] >> 4
+
+
+def check_crc(frame):
+    """ the CRC-24Q over the header and payload - including the trailing CRC leaves 0 """
+    return crc24q(frame) == 0
+
+
+def pack_frame(msg_type, payload=b''):
+    """ a valid frame of msg_type, the message number followed by payload (for tests and the benchmark) """
+    body = bytearray([msg_type >> 4, (msg_type & 0x0F) << 4]) + bytearray(payload)
+    if len(body) > MAX_PAYLOAD:
+        raise ValueError('payload too long')
+    frame = bytearray([PREAMBLE, len(body) >> 8, len(body) & 0xFF]) + body
+    crc = crc24q(frame)
+    return bytes(frame + bytearray([crc >> 16, (crc >> 8) & 0xFF, crc & 0xFF]))
+
+
+def _source(data):
+    """ the bytes behind a whole-buffer memoryview (as serial_bridge passes), to search it without copying """
+    if isinstance(data, memoryview):
+        if isinstance(data.obj, (bytes, bytearray)) and data.nbytes == len(data.obj):
+            return data.obj
+        return data.tobytes()
+    return data
+
+
+class RtcmFramer:
+    """ incremental RTCM3 framer - feed() arbitrary chunks, complete frames come back in order """
+
+    def __init__(self, validate_crc=True):
+        self.validate_crc = validate_crc
+        self._carry = bytearray()  # a frame split across chunks
+        self.frames = 0
+        self.bad_crc = 0
+        self.skipped_bytes = 0  # not RTCM3 (NMEA, UBX...) or corrupt
+
+    def feed(self, data):
+        """ [memoryview or bytes] of the complete frames """
+        buf = _source(data)
+        frames = []
+        offset = 0
+        if self._carry:
+            offset = self._complete(buf, frames)
+            if offset is None:
+                return frames
+        self._scan(buf, offset, frames)
+        return frames
+
+    def _complete(self, buf, frames):
+        """ extends the carried partial frame from buf - the offset to resume at, None if buf was used up """
+        carry = self._carry
+        offset = 0
+        while True:
+            length = frame_length(carry)
+            need = (HEADER_LEN if length is None else length) - len(carry)
+            if length == 0 or need <= 0:
+                break
+            take = buf[offset:offset + need]
+            carry += take
+            offset += len(take)
+            if len(take) < need:
+                return None
+        frame = bytes(carry)
+        del carry[:]
+        if length and (not self.validate_crc or check_crc(frame)):
+            frames.append(frame)
+            self.frames += 1
+            return offset
+        # not a frame after all - resynchronise from the byte after the false preamble (rare, so copy)
+        if length:
+            self.bad_crc += 1
+        self.skipped_bytes += 1
+        rest = frame[1:] + bytes(buf[offset:])
+        self._scan(rest, 0, frames)
+        return None
+
+    def _scan(self, buf, offset, frames):
+        view = memoryview(buf)
+        size = len(buf)
+        validate = self.validate_crc
+        while offset < size:
+            start = buf.find(b'\xd3', offset)
+            if start < 0:
+                self.skipped_bytes += size - offset
+                return
+            self.skipped_bytes += start - offset
+            length = frame_length(buf, start)
+            if length is None or (length and start + length > size):
+                self._carry += buf[start:]
+                return
+            frame = view[start:start + length]
+            if not length or (validate and not check_crc(frame)):
+                if length:
+                    self.bad_crc += 1
+                self.skipped_bytes += 1
+                offset = start + 1
+                continue
+            frames.append(frame)
+            self.frames += 1
+            offset = start + length
+
+
+class TypeStats:
+    __slots__ = ('count', 'bytes', 'forwarded', 'forwarded_bytes', 'first', 'last')
+
+    def __init__(self, timestamp):
+        self.count = 0
+        self.bytes = 0
+        self.forwarded = 0
+        self.forwarded_bytes = 0
+        self.first = timestamp
+        self.last = timestamp
+
+
+class RtcmFilter:
+    """ frames a stream, counts every message type, and passes on the selected frames
+
+        types: message numbers to forward (None for all), decimate: {type: N} forwards every Nth frame of a type
+        (give the MSM types of one epoch the same N so they stay together).  Call it with each chunk read; it
+        returns the frames to forward, so it serves as a serial_bridge transform. """
+
+    def __init__(self, types=None, decimate=None, validate_crc=True, budget=DEFAULT_BUDGET):
+        self.types = set(types) if types else None
+        self.decimate = dict(decimate or {})
+        if any(every < 1 for every in self.decimate.values()):
+            raise ValueError('decimation must be at least 1')
+        self.budget = budget
+        self.framer = RtcmFramer(validate_crc)
+        self.stats = {}
+        self.started = None
+        self.latest = None
+
+    @property
+    def filtering(self):
+        return self.types is not None or bool(self.decimate)
+
+    def __call__(self, data, timestamp=None):
+        if timestamp is None:
+            timestamp = time()
+        if self.started is None:
+            self.started = timestamp
+        self.latest = timestamp
+        forward = []
+        stats = self.stats
+        for frame in self.framer.feed(data):
+            msg_type = message_type(frame)
+            entry = stats.get(msg_type)
+            if entry is None:
+                entry = stats[msg_type] = TypeStats(timestamp)
+            entry.count += 1
+            entry.bytes += len(frame)
+            entry.last = timestamp
+            if self.types is not None and msg_type not in self.types:
+                continue
+            if (entry.count - 1) % self.decimate.get(msg_type, 1):
+                continue
+            entry.forwarded += 1
+            entry.forwarded_bytes += len(frame)
+            forward.append(frame)
+        return forward
+
+    def elapsed(self):
+        return max(self.latest - self.started, 1e-9) if self.started is not None else 0.0
+
+    def totals(self):
+        """ (bytes/s in, bytes/s forwarded) over the whole run """
+        elapsed = self.elapsed()
+        if not elapsed:
+            return 0.0, 0.0
+        return (sum(entry.bytes for entry in self.stats.values()) / elapsed,
+                sum(entry.forwarded_bytes for entry in self.stats.values()) / elapsed)
+
+    def table(self):
+        elapsed = self.elapsed()
+        lines = ['{:>5} {:<30} {:>7} {:>7} {:>8} {:>7} {:>10}'.format('type', 'message', 'count', 'Hz', 'B/s',
+                                                                        'baud %', 'forwarded')]
+        for msg_type in sorted(self.stats):
+            entry = self.stats[msg_type]
+            rate = entry.bytes / elapsed if elapsed else 0.0
+            lines.append('{:>5} {:<30} {:>7} {:>7.2f} {:>8.0f} {:>6.1f}% {:>10}'.format(
+                msg_type, MESSAGE_NAMES.get(msg_type, ''), entry.count, entry.count / elapsed if elapsed else 0.0,
+                rate, rate * BITS_PER_BYTE / self.budget * 100, entry.forwarded))
+        lines.append(self.status_text())
+        return '\n'.join(lines)
+
+    def status_text(self):
+        rate_in, rate_out = self.totals()
+        text = 'RTCM3 {} frames, {} bad CRC, {} other bytes, {:.0f} B/s in'.format(
+            self.framer.frames, self.framer.bad_crc, self.framer.skipped_bytes, rate_in)
+        if self.filtering:
+            text += ', {:.0f} B/s forwarded'.format(rate_out)
+        else:
+            rate_out = rate_in
+        load = rate_out * BITS_PER_BYTE / self.budget * 100
+        return text + ' = {:.0f}% of {} baud{}'.format(load, self.budget, ' (OVER BUDGET)' if load > 100 else '')
+
+
+def parse_decimate(text):
+    """ TYPE:N, N at least 1 """
+    try:
+        msg_type, every = text.split(':')
+        msg_type, every = int(msg_type), int(every)
+    except ValueError:
+        raise argparse.ArgumentTypeError('{}: expected TYPE:N'.format(text))
+    if every < 1:
+        raise argparse.ArgumentTypeError('{}: N must be at least 1'.format(text))
+    return msg_type, every
+
+
+def synthetic_epoch():
+    """ one second of a typical base station stream (1005, MSM4 for four constellations, 1230) """
+    sizes = ((1005, 19), (1074, 150), (1084, 110), (1094, 130), (1124, 140), (1230, 8))
+    return b''.join(pack_frame(msg_type, bytes(bytearray(size))) for msg_type, size in sizes)
+
+
+def benchmark(seconds=5.0, chunk_size=4096):
+    """ framing throughput in bytes/s (with CRC checks), fed in serial-read-sized chunks """
+    stream = synthetic_epoch() * 200
+    chunks = [stream[offset:offset + chunk_size] for offset in range(0, len(stream), chunk_size)]
+    rtcm = RtcmFilter()
+    total = 0
+    start = perf_counter()
+    while perf_counter() - start < seconds:
+        for chunk in chunks:
+            rtcm(chunk)
+        total += len(stream)
+    return total / (perf_counter() - start), rtcm
+
+
+def read_stream(args, rtcm, output=None):
+    if args.connect:
+        host, port = args.connect.rsplit(':', 1)
+        source = socket.create_connection((host, int(port)), timeout=10)
+        read = source.recv
+    else:
+        source = sys.stdin.buffer if args.capture == '-' else open(args.capture, 'rb')
+        read = source.read
+    start = time()
+    try:
+        while not args.seconds or time() - start < args.seconds:
+            data = read(65536)
+            if not data:
+                break
+            for frame in rtcm(data):
+                if output is not None:
+                    output.write(frame)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        source.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='RTCM3 message statistics and filtering')
+    parser.add_argument('capture', nargs='?', help='raw RTCM3 capture file (- for stdin)')
+    parser.add_argument('--connect', metavar='HOST:PORT', help='read from a TCP stream (serial_bridge, ser2net)')
+    parser.add_argument('--seconds', type=float, default=0.0, help='stop reading after this long')
+    parser.add_argument('--types', type=int, nargs='+', help='message types to forward')
+    parser.add_argument('--decimate', type=parse_decimate, action='append', default=[], metavar='TYPE:N',
+                        help='forward every Nth frame of a type')
+    parser.add_argument('--budget', type=int, default=DEFAULT_BUDGET, help='link baud rate to compare against')
+    parser.add_argument('--output', help='write the forwarded frames to this file')
+    parser.add_argument('--no-crc', action='store_true', help='skip CRC-24Q validation')
+    parser.add_argument('--benchmark', type=float, metavar='SECONDS', help='measure framing throughput')
+    args = parser.parse_args(argv)
+
+    if args.benchmark:
+        rate, rtcm = benchmark(args.benchmark)
+        print('{:.0f} B/s framed = {:.0f}x a saturated 460800 baud port'.format(rate, rate * BITS_PER_BYTE / 460800))
+        return 0
+    if not args.capture and not args.connect:
+        parser.error('a capture file or --connect is required')
+    rtcm = RtcmFilter(args.types, dict(args.decimate), not args.no_crc, args.budget)
+    output = open(args.output, 'wb') if args.output else None
+    try:
+        read_stream(args, rtcm, output)
+    finally:
+        if output is not None:
+            output.close()
+    print(rtcm.table())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,515 @@
+# -*- coding: utf-8 -*-
+"""
+    mower/serial_bridge.py
+
+    asyncio serial to TCP bridge for the RPi fixed base - a ser2net replacement with fan-out and counters
+
+    Each serial device is read once.  Every read becomes a single memoryview that is queued, not copied, to
+    every connected TCP client, so many clients cost no more serial bandwidth than one.  Each client has
+    a queue bounded in bytes; when a slow client fills it, the 'drop' policy discards its oldest queued data
+    (fresh corrections matter more than stale ones) and the 'disconnect' policy closes it.  Bytes received
+    from clients are written to the serial device (e.g. a GCS talking to the vehicle over telemetry).
+    Per-client throughput, drops and latency (serial read to socket write) are logged periodically.
+    If the device goes away (USB adapter unplugged, EOF or EIO) it is closed and reopened with a growing delay,
+    and the TCP clients stay connected meanwhile.
+
+    A port can also carry RTCM3 corrections through mower/rtcm.py (--rtcm TCP_PORT): per-message-type rates are
+    logged with the other counters, and --rtcm-types/--rtcm-decimate forward only the frames that fit the
+    telemetry link (--rtcm-budget) instead of the raw serial data.
+
+    Uses termios directly, so no pyserial is needed (Linux/Raspberry Pi OS only):
+        python3 -m mower.serial_bridge --port /dev/ttyGPS0:460800:2001 --port /dev/ttyTelemetry0:57600:2000
+        python3 -m mower.serial_bridge --self-test    # pseudo-terminal loopback, no hardware required
+
+    "RPi Fixed Base Config/serial-bridge.service" runs it in place of ser2net.
+
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import socket
+import sys
+import termios
+import tty
+from collections import deque
+from time import process_time, time
+
+from mower.history import RollingStats
+from mower.rtcm import DEFAULT_BUDGET, RtcmFilter, parse_decimate
+
+DEFAULT_HOST = '0.0.0.0'
+DEFAULT_QUEUE_BYTES = 256 * 1024  # per client
+DEFAULT_SOCKET_BUFFER = 16 * 1024  # kernel send buffer per client, small so the queue is the real bound
+DEFAULT_STATS_INTERVAL = 10.0  # seconds
+READ_SIZE = 65536
+REOPEN_INTERVAL = 0.5  # seconds before the first attempt to reopen a device that went away, doubling per failure
+MAX_REOPEN_INTERVAL = 30.0  # seconds
+LATENCY_HISTORY = 500  # samples per client
+POLICIES = ('drop', 'disconnect')
+
+log = logging.getLogger('serial_bridge')
+
+
+def open_serial(device, baud):
+    """ non-blocking raw file descriptor at baud (ignored by pseudo-terminals) """
+    fd = os.open(device, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    try:
+        tty.setraw(fd)
+        attributes = termios.tcgetattr(fd)
+        speed = getattr(termios, 'B{}'.format(baud), None)
+        if speed is None:
+            raise ValueError('unsupported baud rate {}'.format(baud))
+        attributes[4] = attributes[5] = speed  # ispeed, ospeed
+        attributes[2] |= termios.CLOCAL | termios.CREAD
+        termios.tcsetattr(fd, termios.TCSANOW, attributes)
+    except Exception:
+        os.close(fd)
+        raise
+    return fd
+
+
+def read_serial(fd):
+    """ what is waiting on a non-blocking device, None if nothing is - raises EOFError once the device has gone,
+        which os.read reports as EOF or EIO and which would otherwise leave the fd readable forever """
+    try:
+        data = os.read(fd, READ_SIZE)
+    except BlockingIOError:
+        return None
+    except OSError as inst:
+        raise EOFError(inst.strerror or str(inst))
+    if not data:
+        raise EOFError('end of file')
+    return data
+
+
+class BridgeClient:
+    def __init__(self, reader, writer, max_queue_bytes=DEFAULT_QUEUE_BYTES, policy='drop'):
+        self.reader = reader
+        self.writer = writer
+        self.peer = writer.get_extra_info('peername')
+        self.max_queue_bytes = max_queue_bytes
+        self.policy = policy
+        self.queue = deque()  # (memoryview, serial read time), shared with the other clients
+        self.queued_bytes = 0
+        self.high_water = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.dropped_bytes = 0
+        self.dropped_chunks = 0
+        self.latency = RollingStats(LATENCY_HISTORY)  # seconds from the serial read to the socket write
+        self.connected_at = time()
+        self.closed = False
+        self.close_reason = None
+        self._wakeup = asyncio.Event()
+
+    def push(self, view, timestamp):
+        """ queues a serial read - never blocks, applies the slow client policy when the queue is full """
+        if self.closed:
+            return
+        size = len(view)
+        if self.queued_bytes + size > self.max_queue_bytes:
+            if self.policy == 'disconnect':
+                self.close('queue full')
+                return
+            while self.queue and self.queued_bytes + size > self.max_queue_bytes:
+                dropped, dropped_time = self.queue.popleft()
+                self.queued_bytes -= len(dropped)
+                self.dropped_bytes += len(dropped)
+                self.dropped_chunks += 1
+        self.queue.append((view, timestamp))
+        self.queued_bytes += size
+        self.high_water = max(self.high_water, self.queued_bytes)
+        self._wakeup.set()
+
+    def close(self, reason):
+        if not self.closed:
+            self.closed = True
+            self.close_reason = reason
+            self.queue.clear()
+            self.queued_bytes = 0
+            self.writer.transport.abort()  # close() would wait for a stalled peer to take the transport buffer
+            self._wakeup.set()
+
+    async def send(self):
+        """ drains the queue into the socket, waiting on the socket's flow control """
+        try:
+            while not self.closed:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self.queue and not self.closed:
+                    view, timestamp = self.queue.popleft()
+                    self.queued_bytes -= len(view)
+                    self.writer.write(view)
+                    await self.writer.drain()
+                    now = time()
+                    self.bytes_sent += len(view)
+                    self.latency.append(now - timestamp, now)
+        except (ConnectionError, OSError) as inst:
+            self.close(str(inst))
+
+    async def receive(self, uplink):
+        """ passes whatever the client sends to uplink(bytes) until it disconnects """
+        try:
+            while not self.closed:
+                data = await self.reader.read(READ_SIZE)
+                if not data:
+                    break
+                self.bytes_received += len(data)
+                if uplink is not None:
+                    uplink(data)
+        except (ConnectionError, OSError) as inst:
+            self.close(str(inst))
+            return
+        self.close('disconnected')
+
+    def status_text(self):
+        elapsed = max(time() - self.connected_at, 1e-9)
+        text = '{}:{} sent {} B ({:.0f} B/s), received {} B, queue high water {}/{} B, dropped {} B in {} ' \
+               'chunks'.format(self.peer[0], self.peer[1], self.bytes_sent, self.bytes_sent / elapsed,
+                               self.bytes_received, self.high_water, self.max_queue_bytes, self.dropped_bytes,
+                               self.dropped_chunks)
+        if len(self.latency):
+            text += ', latency p50 {:.1f} ms p99 {:.1f} ms'.format(self.latency.percentile(50) * 1000,
+                                                                   self.latency.percentile(99) * 1000)
+        return text
+
+
+class BridgePort:
+    def __init__(self, device, baud, tcp_port, host=DEFAULT_HOST, max_queue_bytes=DEFAULT_QUEUE_BYTES,
+                 policy='drop', socket_buffer=DEFAULT_SOCKET_BUFFER, writable=True):
+        if policy not in POLICIES:
+            raise ValueError('policy must be one of ' + ', '.join(POLICIES))
+        self.device = device
+        self.baud = baud
+        self.tcp_port = tcp_port
+        self.host = host
+        self.max_queue_bytes = max_queue_bytes
+        self.policy = policy
+        self.socket_buffer = socket_buffer
+        self.writable = writable  # pass client data to the serial device
+        self.clients = []
+        self.listeners = []  # listener(view, timestamp) sees every serial read, e.g. statistics
+        self.transform = None  # transform(view, timestamp) -> buffers published instead of the read, e.g. RtcmFilter
+        self.bytes_read = 0
+        self.reads = 0
+        self.bytes_written = 0
+        self.uplink_dropped = 0
+        self.hangups = 0
+        self.reopen_interval = REOPEN_INTERVAL
+        self.fd = None
+        self.server = None
+        self._uplink = bytearray()
+        self._tasks = set()
+        self._reopen = None  # task reopening the device after a hangup
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.fd = open_serial(self.device, self.baud)
+        loop.add_reader(self.fd, self._read)
+        self.server = await asyncio.start_server(self._accept, self.host, self.tcp_port)
+        self.tcp_port = self.server.sockets[0].getsockname()[1]  # resolves port 0
+        log.info('%s @ %d -> tcp %s:%d (%s, %d B queue)', self.device, self.baud, self.host, self.tcp_port,
+                 self.policy, self.max_queue_bytes)
+
+    async def stop(self):
+        if self._reopen is not None:
+            self._reopen.cancel()
+            await asyncio.gather(self._reopen, return_exceptions=True)
+            self._reopen = None
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for client in self.clients:
+            client.close('bridge stopped')
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._close_serial()
+
+    def _close_serial(self):
+        if self.fd is not None:
+            loop = asyncio.get_running_loop()
+            loop.remove_reader(self.fd)
+            loop.remove_writer(self.fd)
+            os.close(self.fd)
+            self.fd = None
+        self._uplink.clear()
+
+    def _hang_up(self, reason):
+        """ the device has gone - stop watching it and keep trying to reopen it, clients stay connected """
+        log.warning('%s: %s, reopening', self.device, reason)
+        self.hangups += 1
+        self._close_serial()
+        if self._reopen is None:
+            self._reopen = asyncio.ensure_future(self._reopen_serial())
+
+    async def _reopen_serial(self):
+        delay = self.reopen_interval
+        try:
+            while True:
+                await asyncio.sleep(delay)
+                try:
+                    self.fd = open_serial(self.device, self.baud)
+                except OSError as inst:
+                    log.info('%s: %s', self.device, inst)
+                    delay = min(delay * 2, MAX_REOPEN_INTERVAL)
+                    continue
+                asyncio.get_running_loop().add_reader(self.fd, self._read)
+                log.info('%s reopened', self.device)
+                return
+        finally:
+            self._reopen = None
+
+    def _read(self):
+        try:
+            data = read_serial(self.fd)
+        except EOFError as inst:
+            self._hang_up(str(inst))
+            return
+        if data is None:
+            return
+        timestamp = time()
+        view = memoryview(data)  # one buffer shared by every client queue
+        self.reads += 1
+        self.bytes_read += len(data)
+        for listener in self.listeners:
+            listener(view, timestamp)
+        if self.transform is None:
+            self.publish(view, timestamp)
+        else:
+            for buffer in self.transform(view, timestamp):
+                self.publish(buffer, timestamp)
+
+    def publish(self, view, timestamp):
+        for client in self.clients:
+            client.push(view, timestamp)
+
+    def write_serial(self, data):
+        """ uplink from a client - buffered while the device is busy, bounded like a client queue """
+        if not self.writable or self.fd is None:
+            return
+        if len(self._uplink) + len(data) > self.max_queue_bytes:
+            self.uplink_dropped += len(data)
+            return
+        start_writer = not self._uplink
+        self._uplink += data
+        if start_writer:
+            self._write()
+
+    def _write(self):
+        loop = asyncio.get_running_loop()
+        try:
+            written = os.write(self.fd, self._uplink)
+        except BlockingIOError:
+            written = 0
+        except OSError as inst:
+            self._hang_up(inst.strerror or str(inst))
+            return
+        self.bytes_written += written
+        del self._uplink[:written]
+        if self._uplink:
+            loop.add_writer(self.fd, self._write)
+        else:
+            loop.remove_writer(self.fd)
+
+    async def _accept(self, reader, writer):
+        sock = writer.get_extra_info('socket')
+        if sock is not None and self.socket_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.socket_buffer)
+            writer.transport.set_write_buffer_limits(self.socket_buffer)  # drain() waits, data stays queued here
+        client = BridgeClient(reader, writer, self.max_queue_bytes, self.policy)
+        self.clients.append(client)
+        log.info('%s: client %s:%d connected', self.device, client.peer[0], client.peer[1])
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            await asyncio.gather(client.send(), client.receive(self.write_serial))
+        finally:
+            client.close('disconnected')
+            self.clients.remove(client)
+            self._tasks.discard(task)
+            log.info('%s: client closed (%s) - %s', self.device, client.close_reason, client.status_text())
+
+    def status_text(self):
+        lines = ['{} -> tcp {}: read {} B in {} reads, wrote {} B ({} B uplink dropped), {} clients{}'.format(
+            self.device, self.tcp_port, self.bytes_read, self.reads, self.bytes_written, self.uplink_dropped,
+            len(self.clients), ', {} hangups{}'.format(self.hangups, '' if self.fd is not None else ' (reopening)')
+            if self.hangups else '')]
+        lines.extend('    ' + client.status_text() for client in self.clients)
+        for extra in self.listeners + [self.transform]:
+            if hasattr(extra, 'status_text'):
+                lines.append('    ' + extra.status_text())
+        return '\n'.join(lines)
+
+
+async def report(ports, interval):
+    while True:
+        await asyncio.sleep(interval)
+        for port in ports:
+            log.info(port.status_text())
+
+
+async def run(ports, stats_interval=DEFAULT_STATS_INTERVAL):
+    for port in ports:
+        await port.start()
+    try:
+        await report(ports, stats_interval)
+    finally:
+        for port in ports:
+            await port.stop()
+
+
+async def self_test(policy='drop', clients=3, seconds=2.0, rate=46080, queue_bytes=16 * 1024):
+    """ feeds a pseudo-terminal at rate bytes/s, checks the fast clients got every byte in order and that
+        a client which never reads is handled by the policy - returns True on success """
+    master, slave = os.openpty()
+    port = BridgePort(os.ttyname(slave), 460800, 0, '127.0.0.1', queue_bytes, policy, socket_buffer=4096)
+    await port.start()
+    received = [bytearray() for x in range(clients)]
+
+    async def fast_client(index):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port.tcp_port)
+        try:
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    break
+                received[index] += data
+        finally:
+            writer.close()
+
+    slow = socket.socket()
+    slow.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    slow.connect(('127.0.0.1', port.tcp_port))
+    slow.setblocking(False)
+    tasks = [asyncio.ensure_future(fast_client(index)) for index in range(clients)]
+    await asyncio.sleep(0.2)  # let everyone connect
+
+    pattern = bytes(bytearray(range(256)))
+    sent = 0
+    start = time()
+    while time() - start < seconds:
+        due = int((time() - start) * rate) - sent
+        if due > 0:
+            offset = sent % len(pattern)
+            chunk = (pattern * (due // len(pattern) + 2))[offset:offset + due]
+            os.write(master, chunk)
+            sent += len(chunk)
+        await asyncio.sleep(0.005)
+    await asyncio.sleep(0.5)  # drain
+
+    print(port.status_text())
+    slow_client = [client for client in port.clients if client.peer[1] == slow.getsockname()[1]]
+    await port.stop()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    slow.close()
+    os.close(master)
+    os.close(slave)
+
+    expected = (pattern * (sent // len(pattern) + 1))[:sent]  # the pattern, continued across writes
+    ok = all(data == expected for data in received)
+    print('{} bytes fed, fast clients {}'.format(sent, 'received every byte in order' if ok else
+                                                 'MISSING DATA: ' + ', '.join(str(len(data)) for data in received)))
+    if policy == 'drop':
+        dropped = slow_client and slow_client[0].dropped_bytes > 0
+        print('slow client ' + ('dropped {} B'.format(slow_client[0].dropped_bytes) if dropped else 'NOT THROTTLED'))
+    else:
+        dropped = not slow_client  # already disconnected
+        print('slow client ' + ('disconnected' if dropped else 'STILL CONNECTED'))
+    return ok and bool(dropped)
+
+
+async def hangup_test(seconds=0.5):
+    """ closes the pseudo-terminal under the bridge - checks the device is let go of without spinning on the dead
+        fd, the client stays connected, and data flows again once a device reappears - returns True on success """
+    master, slave = os.openpty()
+    port = BridgePort(os.ttyname(slave), 460800, 0, '127.0.0.1')
+    port.reopen_interval = 0.05
+    await port.start()
+    reader, writer = await asyncio.open_connection('127.0.0.1', port.tcp_port)
+    await asyncio.sleep(0.1)
+    os.write(master, b'before')
+    before = await asyncio.wait_for(reader.read(READ_SIZE), 1.0)
+
+    os.close(master)  # the slave now reads EOF, then EIO
+    os.close(slave)
+    cpu = process_time()
+    await asyncio.sleep(seconds)
+    cpu = process_time() - cpu
+    released = port.fd is None and port.hangups == 1
+
+    master, slave = os.openpty()  # the device comes back (under a new name, as a pseudo-terminal must)
+    port.device = os.ttyname(slave)
+    deadline = time() + 2.0
+    while port.fd is None and time() < deadline:
+        await asyncio.sleep(0.05)
+    os.write(master, b'after')
+    try:
+        after = await asyncio.wait_for(reader.read(READ_SIZE), 1.0)
+    except asyncio.TimeoutError:
+        after = b''
+    print(port.status_text())
+    writer.close()
+    await port.stop()
+    os.close(master)
+    os.close(slave)
+
+    checks = [(before == b'before', 'client received data before the hangup'),
+              (released, 'device closed after the hangup ({} hangups)'.format(port.hangups)),
+              (cpu < seconds / 2, '{:.0f}% CPU while the device was gone'.format(cpu / seconds * 100)),
+              (after == b'after', 'same client received data after the device was reopened')]
+    for ok, text in checks:
+        print(('ok    ' if ok else 'FAIL  ') + text)
+    return all(ok for ok, text in checks)
+
+
+def parse_port(text):
+    """ DEVICE:BAUD:TCP_PORT """
+    device, baud, tcp_port = text.rsplit(':', 2)
+    return device, int(baud), int(tcp_port)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serial to TCP fan-out bridge')
+    parser.add_argument('--port', action='append', default=[], type=parse_port, metavar='DEVICE:BAUD:TCP_PORT',
+                        help='serial device to serve, e.g. /dev/ttyGPS0:460800:2001 (repeatable)')
+    parser.add_argument('--host', default=DEFAULT_HOST, help='address to listen on')
+    parser.add_argument('--queue-bytes', type=int, default=DEFAULT_QUEUE_BYTES, help='per client queue limit')
+    parser.add_argument('--policy', choices=POLICIES, default='drop', help='what to do with a slow client')
+    parser.add_argument('--socket-buffer', type=int, default=DEFAULT_SOCKET_BUFFER, help='SO_SNDBUF per client')
+    parser.add_argument('--read-only', action='store_true', help='ignore data sent by clients')
+    parser.add_argument('--stats', type=float, default=DEFAULT_STATS_INTERVAL, help='seconds between reports')
+    parser.add_argument('--rtcm', type=int, action='append', default=[], metavar='TCP_PORT',
+                        help='parse the RTCM3 corrections served on this port (repeatable)')
+    parser.add_argument('--rtcm-types', type=int, nargs='+', help='forward only these RTCM3 message types')
+    parser.add_argument('--rtcm-decimate', type=parse_decimate, action='append', default=[], metavar='TYPE:N',
+                        help='forward every Nth frame of an RTCM3 message type')
+    parser.add_argument('--rtcm-budget', type=int, default=DEFAULT_BUDGET, help='baud rate the corrections must fit')
+    parser.add_argument('--self-test', action='store_true', help='run the pseudo-terminal self test and exit')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    if args.self_test:
+        ok = all([asyncio.run(self_test(policy)) for policy in POLICIES] + [asyncio.run(hangup_test())])
+        print('PASS' if ok else 'FAIL')
+        return 0 if ok else 1
+    if not args.port:
+        parser.error('at least one --port is required')
+    ports = [BridgePort(device, baud, tcp_port, args.host, args.queue_bytes, args.policy, args.socket_buffer,
+                        not args.read_only) for device, baud, tcp_port in args.port]
+    for port in ports:
+        if port.tcp_port in args.rtcm:
+            rtcm = RtcmFilter(args.rtcm_types, dict(args.rtcm_decimate), budget=args.rtcm_budget)
+            if rtcm.filtering:
+                port.transform = rtcm
+            else:
+                port.listeners.append(rtcm)  # statistics only, the raw data (NMEA, UBX...) still goes through
+    try:
+        asyncio.run(run(ports, args.stats))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+    mower/servo.py
+
+    ServoTuner's SERVO_OUTPUT_RAW handling without the WinForms dialog
+
+    ServoMonitor holds the per-channel statistics in preallocated integer arrays indexed by channel - 1,
+    ServoTunerForm only renders them.
+
+"""
+
+from array import array
+
+MIN_PWM = 800
+MAX_PWM = 2200
+NUM_SERVOS = 16
+UNUSED = 0  # value of a channel reporting less than MIN_PWM
+
+
+class ServoMonitor:
+    def __init__(self, num_servos=NUM_SERVOS, on_servo_update=None):
+        self.num_servos = num_servos
+        self.on_servo_update = on_servo_update  # called as on_servo_update(index) for each reported channel
+        self.field_names = tuple('servo{}_raw'.format(x + 1) for x in range(num_servos))
+        self.value = array('i', [UNUSED] * num_servos)
+        self.minimum = array('i', [MAX_PWM + 1] * num_servos)
+        self.maximum = array('i', [MIN_PWM - 1] * num_servos)
+        self.diff = array('i', [0] * num_servos)
+        self.midpoint = array('i', [0] * num_servos)
+        self.samples = array('i', [0] * num_servos)  # values of at least MIN_PWM since the last reset
+        self.extremes_changed = array('b', [0] * num_servos)  # set by the latest message
+
+    def reset(self, index=None):
+        """ forgets min/max for one channel, or all of them """
+        for x in range(self.num_servos) if index is None else (index,):
+            self.minimum[x] = MAX_PWM + 1
+            self.maximum[x] = MIN_PWM - 1
+            self.diff[x] = 0
+            self.midpoint[x] = 0
+            self.samples[x] = 0
+
+    def has_extremes(self, index):
+        """ diff and midpoint are only meaningful once a channel has reported a value """
+        return self.samples[index] > 0
+
+    def get_servo_data(self, message):
+        data = message.data
+        for x, field_name in enumerate(self.field_names):
+            val = getattr(data, field_name, None)
+            if val is None:
+                continue  # MAVLink 1 messages stop at servo8_raw
+            val = int(val)
+            changed = 0
+            if val < MIN_PWM:
+                self.value[x] = UNUSED
+            else:
+                self.value[x] = val
+                self.samples[x] += 1
+                if val < self.minimum[x]:
+                    self.minimum[x] = val
+                    changed = 1
+                if val > self.maximum[x]:
+                    self.maximum[x] = val
+                    changed = 1
+                if changed:
+                    self.diff[x] = self.maximum[x] - self.minimum[x]
+                    self.midpoint[x] = self.diff[x] // 2 + self.minimum[x]
+            self.extremes_changed[x] = changed
+            if self.on_servo_update is not None:
+                self.on_servo_update(x)
+        return True
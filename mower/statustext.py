@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+    mower/statustext.py
+
+    Bounded STATUSTEXT log that collapses repeated messages
+
+    Each distinct (severity, text) pair is stored once with a repeat count and first/last seen times, indexed
+    by severity.  When the log is full the least recently seen message of the least severe level is dropped,
+    so a burst of INFO chatter cannot push out an earlier ERROR.
+
+    StatusTextView turns log changes into per-item list operations, letting a ListBox follow the log without
+    being rebuilt for every message.
+
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from time import time, localtime, strftime
+
+SEVERITY = ['EMERGENCY: ', 'ALERT: ', 'CRITICAL: ', 'ERROR: ', 'WARNING: ', 'NOTICE: ', 'INFO: ', 'DEBUG: ']
+STATUS_LOG_LENGTH = 500  # distinct messages kept
+
+
+def clean_text(text):
+    """ STATUSTEXT text is a null padded char array """
+    return text.split('\x00', 1)[0].strip()
+
+
+class StatusEntry:
+    def __init__(self, severity, text, timestamp):
+        self.severity = severity
+        self.text = text
+        self.lower_text = text.lower()
+        self.count = 1
+        self.first_seen = timestamp
+        self.last_seen = timestamp
+
+    @property
+    def key(self):
+        return self.severity, self.text
+
+    def __str__(self):
+        text = '{} {}{}'.format(strftime('%H:%M:%S', localtime(self.last_seen)), SEVERITY[self.severity], self.text)
+        if self.count > 1:
+            text += '  (x{} since {})'.format(self.count, strftime('%H:%M:%S', localtime(self.first_seen)))
+        return text
+
+
+class StatusTextLog:
+    def __init__(self, capacity=STATUS_LOG_LENGTH):
+        self.capacity = capacity
+        self.entries = OrderedDict()  # (severity, text): StatusEntry, least recently seen first
+        self.by_severity = [OrderedDict() for x in SEVERITY]  # the same entries split by severity
+        self.received = 0
+        self.lock = Lock()  # add() runs on the packet thread, views read from the UI thread
+        self._changed = OrderedDict()  # key: entry, added or repeated since the last take_changes()
+        self._evicted = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, severity, text, timestamp=None):
+        severity = min(max(int(severity), 0), len(SEVERITY) - 1)
+        text = clean_text(text)
+        if timestamp is None:
+            timestamp = time()
+        key = (severity, text)
+        with self.lock:
+            self.received += 1
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                entry = StatusEntry(severity, text, timestamp)
+                if len(self.entries) >= self.capacity:
+                    self._evict()
+            else:
+                entry.count += 1
+                entry.last_seen = timestamp
+                del self.by_severity[severity][key]
+            self.entries[key] = entry
+            self.by_severity[severity][key] = entry
+            self._changed.pop(key, None)
+            self._changed[key] = entry
+        return entry
+
+    def _evict(self):
+        for bucket in reversed(self.by_severity):
+            if bucket:
+                key, entry = bucket.popitem(last=False)
+                del self.entries[key]
+                self._changed.pop(key, None)
+                self._evicted.append(key)
+                return
+
+    def counts(self):
+        """ distinct messages per severity level """
+        return [len(bucket) for bucket in self.by_severity]
+
+    def search(self, pattern='', max_severity=len(SEVERITY) - 1):
+        """ entries at max_severity or more severe containing pattern (case insensitive), least recent first """
+        pattern = pattern.lower()
+        with self.lock:
+            if not pattern and max_severity >= len(SEVERITY) - 1:
+                return list(self.entries.values())
+            return [entry for entry in self.entries.values()
+                    if entry.severity <= max_severity and pattern in entry.lower_text]
+
+    def take_changes(self):
+        """ returns ([added or repeated entries], [evicted keys]) since the previous call """
+        with self.lock:
+            changed, self._changed = list(self._changed.values()), OrderedDict()
+            evicted, self._evicted = self._evicted, []
+        return changed, evicted
+
+
+class StatusTextView:
+    """ the filtered, displayed subset of a StatusTextLog - entries keep their position when repeated """
+
+    def __init__(self, log, max_severity=len(SEVERITY) - 1, pattern=''):
+        self.log = log
+        self.max_severity = max_severity
+        self.pattern = pattern.lower()
+        self.keys = []  # keys in display order
+
+    def matches(self, entry):
+        return entry.severity <= self.max_severity and self.pattern in entry.lower_text
+
+    def set_filter(self, max_severity, pattern=''):
+        """ changes the filter - returns operations rebuilding the list """
+        self.max_severity = max_severity
+        self.pattern = pattern.lower()
+        self.log.take_changes()
+        entries = sorted(self.log.search(self.pattern, max_severity), key=lambda entry: entry.first_seen)
+        self.keys = [entry.key for entry in entries]
+        return [('clear',)] + [('add', str(entry)) for entry in entries]
+
+    def update(self):
+        """ returns list operations for the log changes since the last call:
+            ('add', text), ('set', index, text), ('remove', index) or ('clear',) """
+        changed, evicted = self.log.take_changes()
+        operations = []
+        for key in evicted:
+            if key in self.keys:
+                index = self.keys.index(key)
+                del self.keys[index]
+                operations.append(('remove', index))
+        for entry in changed:
+            key = entry.key
+            shown = key in self.keys
+            if not self.matches(entry):
+                if shown:
+                    index = self.keys.index(key)
+                    del self.keys[index]
+                    operations.append(('remove', index))
+            elif shown:
+                operations.append(('set', self.keys.index(key), str(entry)))
+            else:
+                self.keys.append(key)
+                operations.append(('add', str(entry)))
+        return operations
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""
+    mower/steering_fit.py
+
+    Steering rate FF, P and I estimated from DataFlash logs, as a recommended change to a .param dump
+
+    The controller's target, filtered error and output come from PIDS (STER if PIDS was not logged) and the
+    log is split into windows with rolling statistics rather than a per-sample loop: a transient follows every
+    step in the target, a steady state is a stretch where target and achieved rate both hold still away from
+    zero and the output is not saturated.
+
+    On the transients, the gains the vehicle was actually flying are fitted by least squares to the differenced
+    control law, which cancels the unknown integrator state:
+        output[k] - output[k-1] = FF * (target[k] - target[k-1]) + P * (error[k] - error[k-1]) + I * error[k] * dt
+    On the steady states, output / achieved rate is the feed-forward the vehicle needs - whatever the I term
+    holds there is FF the tune is missing.  The recommendation sets FF to that and scales P and I with it, so
+    the feedback loop keeps the response it had with the plant gain it was flown with:
+        python -m mower.steering_fit 00000042.BIN --params "20210714 Cube Orange 4.1.0-dev (custom) GPS UART2.param"
+        python -m mower.steering_fit 00000042.BIN --params current.param --output steering_changes.param
+        python -m mower.steering_fit --self-test
+
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import os
+import sys
+import tempfile
+from timeit import default_timer
+
+import numpy as np
+
+from mower.ardupilot_steering import DEFAULTS, RATE_PREFIX, SteeringRateController
+from mower.dataflash import DataFlashLog, LogWriter
+from mower.param_diff import format_value
+from mower.params import ParamCache
+from mower.plants import DEFAULT_TRACK_WIDTH, SkidSteerYaw
+
+STEERING_SCALE = 4500.0  # STER SteerOut at full output
+SATURATED = 0.98  # |output| treated as at the limit (I term frozen, FF not observable)
+GAP_FACTOR = 5.0  # a time step this many times the median starts a new segment (logging paused)
+STEP_THRESHOLD = 0.05  # rad/s change in target between samples that starts a transient
+TRANSIENT_TIME = 1.0  # s after a step used for the gain fit
+STEADY_WINDOW = 0.5  # s rolling window for the steady state test
+STEADY_STD = 0.02  # rad/s, largest rolling standard deviation of target and achieved rate
+STEADY_ERROR = 0.15  # largest |error| / |target| in a steady state
+MIN_RATE = 0.05  # rad/s, steady states slower than this say little about FF
+OUTLIER_MAD = 6.0  # residuals beyond this many median absolute deviations are refitted without
+SELF_TEST_GAINS = (0.2, 0.2, 0.2)  # FF, P, I the self-test vehicle is flown with (ArduRover defaults)
+SELF_TEST_PLANT_FF = 0.3  # steady output per rad/s of the self-test plant - the FF the fit should recommend
+SELF_TEST_NOISE = 0.01  # rad/s, gyro noise on the measured turn rate
+SELF_TEST_HOLD = 3.0  # s between turn rate steps
+
+
+class SteeringData:
+    """ time (s), target and achieved rate (rad/s), error and -1..1 output of the steering rate controller """
+
+    def __init__(self, time, target, actual, error, output, source):
+        self.time = time
+        self.target = target
+        self.actual = actual
+        self.error = error
+        self.output = output
+        self.source = source
+
+    def __len__(self):
+        return len(self.time)
+
+    @classmethod
+    def from_log(cls, log, instance=None):
+        """ PIDS (the output is the sum of its terms) or, failing that, STER (deg/s and centi-output) """
+        counts = log.counts()
+        if counts.get('PIDS'):
+            rows = log.messages('PIDS', instance)
+            terms = [log.column('PIDS', term, messages=rows) for term in ('FF', 'P', 'I', 'D')
+                     if term in log.names['PIDS'].columns]
+            return cls(log.time('PIDS', messages=rows), log.column('PIDS', 'Tar', messages=rows),
+                       log.column('PIDS', 'Act', messages=rows), log.column('PIDS', 'Err', messages=rows),
+                       np.sum(terms, axis=0), 'PIDS')
+        if counts.get('STER'):
+            rows = log.messages('STER', instance)
+            target = np.radians(log.column('STER', 'DesTurnRate', messages=rows))
+            actual = np.radians(log.column('STER', 'TurnRate', messages=rows))
+            return cls(log.time('STER', messages=rows), target, actual, target - actual,
+                       log.column('STER', 'SteerOut', messages=rows) / STEERING_SCALE, 'STER')
+        raise ValueError('the log has no PIDS or STER messages')
+
+    @classmethod
+    def from_file(cls, filename, instance=None):
+        with DataFlashLog(filename) as log:
+            return cls.from_log(log, instance)
+
+
+def rolling_std(values, window):
+    """ standard deviation over the window samples ending at each sample (cumulative sums, no loop) """
+    window = max(int(window), 1)
+    sums = np.concatenate(([0.0], np.cumsum(values)))
+    squares = np.concatenate(([0.0], np.cumsum(values * values)))
+    end = np.arange(1, len(values) + 1)
+    start = np.maximum(end - window, 0)
+    count = end - start
+    mean = (sums[end] - sums[start]) / count
+    return np.sqrt(np.maximum((squares[end] - squares[start]) / count - mean * mean, 0.0))
+
+
+def runs(mask):
+    """ [(start, stop)] of the True stretches of a boolean array """
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return list(zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)))
+
+
+class Segmentation:
+    """ transient and steady state masks over a SteeringData, plus the sample-to-sample steps that are valid """
+
+    def __init__(self, data, step_threshold=STEP_THRESHOLD, transient_time=TRANSIENT_TIME,
+                 steady_window=STEADY_WINDOW, steady_std=STEADY_STD, steady_error=STEADY_ERROR, min_rate=MIN_RATE):
+        count = len(data)
+        self.dt = np.diff(data.time)
+        self.sample_time = float(np.median(self.dt)) if count > 1 else 0.0
+        if not self.sample_time > 0:
+            raise ValueError('not enough samples to segment')
+        # differences across a logging gap or a time jump are not one controller step
+        self.continuous = np.concatenate(([False], (self.dt > 0) & (self.dt < self.sample_time * GAP_FACTOR)))
+        self.unsaturated = np.abs(data.output) < SATURATED
+
+        steps = np.concatenate(([True], np.abs(np.diff(data.target)) > step_threshold)) | ~self.continuous
+        last_step = np.maximum.accumulate(np.where(steps, np.arange(count), 0))
+        since_step = data.time - data.time[last_step]
+        self.transient = since_step < transient_time
+
+        window = int(round(steady_window / self.sample_time))
+        held = ((rolling_std(data.target, window) < steady_std) & (rolling_std(data.actual, window) < steady_std) &
+                (since_step >= steady_window))
+        self.steady = (held & ~self.transient & self.unsaturated & (np.abs(data.target) > min_rate) &
+                       (np.abs(data.error) < steady_error * np.abs(data.target)))
+
+    def summary(self):
+        transients, steady = runs(self.transient), runs(self.steady)
+        return '{} transients ({:.1f} s), {} steady states ({:.1f} s)'.format(
+            len(transients), self.transient.sum() * self.sample_time, len(steady),
+            self.steady.sum() * self.sample_time)
+
+
+def lstsq(columns, values, keep):
+    """ least squares fit of values to the columns on the kept samples, refitted once without outliers -
+        returns (coefficients, rms residual, samples used) """
+    matrix = np.column_stack(columns)[keep]
+    values = values[keep]
+    if len(values) < matrix.shape[1] * 10:
+        raise ValueError('only {} usable samples'.format(len(values)))
+    coefficients = np.linalg.lstsq(matrix, values, rcond=None)[0]
+    residual = values - matrix.dot(coefficients)
+    spread = np.median(np.abs(residual - np.median(residual)))
+    if spread > 0:
+        inliers = np.abs(residual) <= OUTLIER_MAD * spread * 1.4826
+        matrix, values = matrix[inliers], values[inliers]
+        coefficients = np.linalg.lstsq(matrix, values, rcond=None)[0]
+        residual = values - matrix.dot(coefficients)
+    return coefficients, float(np.sqrt(np.mean(residual * residual))), len(values)
+
+
+class SteeringFit:
+    """ the fitted (flown) gains and the recommended ones for one log """
+
+    def __init__(self, data, segmentation=None):
+        self.data = data
+        self.segmentation = segmentation or Segmentation(data)
+        seg = self.segmentation
+
+        # flown gains: the differenced control law over the transients, away from saturation
+        dt = np.concatenate(([seg.sample_time], seg.dt))
+        previous = np.concatenate(([False], seg.unsaturated[:-1]))
+        keep = seg.transient & seg.continuous & seg.unsaturated & previous
+        delta = np.diff(data.output, prepend=data.output[0])
+        columns = (np.diff(data.target, prepend=data.target[0]), np.diff(data.error, prepend=data.error[0]),
+                   data.error * dt)
+        (self.ff, self.kp, self.ki), self.residual, self.fit_samples = lstsq(columns, delta, keep)
+
+        # plant: steady output per rad/s of achieved rate, through the origin
+        steady = seg.steady
+        self.steady_samples = int(steady.sum())
+        if self.steady_samples < 10:
+            raise ValueError('only {} steady state samples - the log needs turns held for {:.1f} s or more'.format(
+                self.steady_samples, STEADY_WINDOW * 2))
+        output, actual = data.output[steady], data.actual[steady]
+        self.steady_ff = float(np.dot(output, actual) / np.dot(actual, actual))
+        # share of the steady output the FF term did not supply (mostly the I term)
+        self.i_share = float(1.0 - np.sum(np.abs(self.ff * data.target[steady])) / np.sum(np.abs(output)))
+
+    def recommended(self):
+        """ {param name: value} - FF from the steady states, P and I scaled with it """
+        scale = self.steady_ff / self.ff if self.ff > 0 else 1.0
+        return {RATE_PREFIX + 'FF': self.steady_ff, RATE_PREFIX + 'P': self.kp * scale,
+                RATE_PREFIX + 'I': self.ki * scale}
+
+    def report(self, params=None):
+        """ text lines comparing the .param values (or ArduRover defaults), the flown and the recommended gains """
+        data, seg = self.data, self.segmentation
+        lines = ['{} samples from {} ({:.1f} s at {:.0f} Hz): {}'.format(
+                     len(data), data.source, data.time[-1] - data.time[0], 1.0 / seg.sample_time, seg.summary()),
+                 'flown (fitted on {} transient samples, rms residual {:.2g}): FF {:.3f} P {:.3f} I {:.3f}'.format(
+                     self.fit_samples, self.residual, self.ff, self.kp, self.ki),
+                 'steady state ({} samples): output / rate {:.3f}, {:.0f}% of the output not from FF'.format(
+                     self.steady_samples, self.steady_ff, self.i_share * 100),
+                 '',
+                 '{:<16} {:>8} {:>8} {:>11} {:>8}'.format('param', 'current', 'flown', 'recommended', 'delta')]
+        flown = {RATE_PREFIX + 'FF': self.ff, RATE_PREFIX + 'P': self.kp, RATE_PREFIX + 'I': self.ki}
+        mismatched = []
+        for name, value in sorted(self.recommended().items()):
+            current = params.get(name, DEFAULTS[name]) if params is not None else DEFAULTS[name]
+            lines.append('{:<16} {:>8.3f} {:>8.3f} {:>11.3f} {:>+8.3f}'.format(name, current, flown[name], value,
+                                                                             value - current))
+            if abs(flown[name] - current) > 0.05 * max(abs(current), 0.01):
+                mismatched.append(name[len(RATE_PREFIX):])
+        if mismatched:
+            lines.append('note: the log was not flown with the current {} - check the .param dump matches'.format(
+                '/'.join(mismatched)))
+        return lines
+
+    def write_changes(self, filename, params=None, digits=3):
+        """ .param file with the recommended values that differ from params (rounded to digits) """
+        changes = []
+        for name, value in sorted(self.recommended().items()):
+            value = round(value, digits)
+            current = params.get(name, DEFAULTS[name]) if params is not None else DEFAULTS[name]
+            if round(current, digits) != value:
+                changes.append(name)
+        with open(filename, 'w') as f:
+            for name in changes:
+                f.write('{},{}\n'.format(name, format_value(round(self.recommended()[name], digits))))
+        return changes
+
+
+def closed_loop_log(f, seconds=300.0, rate=50.0, seed=0, gains=SELF_TEST_GAINS, plant_ff=SELF_TEST_PLANT_FF,
+                    noise=SELF_TEST_NOISE, hold=SELF_TEST_HOLD):
+    """ PIDS of ardupilot_steering's controller flying a plants.SkidSteerYaw whose steady output per rad/s is
+        plant_ff, through random turn rate steps every hold seconds """
+    rng = np.random.RandomState(seed)
+    dt = 1.0 / rate
+    count = int(seconds * rate)
+    steps = int(round(hold * rate))
+    desired = np.repeat(rng.uniform(-1.0, 1.0, count // steps + 1), steps)[:count]  # rad/s
+    ff, kp, ki = gains
+    controller = SteeringRateController(ff, kp, ki, 0.0, accel_max=0.0)  # unlimited, so the steps stay steps
+    controller.reset(dt)
+    plant = SkidSteerYaw(track_speed=DEFAULT_TRACK_WIDTH / (2 * plant_ff))  # full output turns at 1 / plant_ff
+    plant.reset(1, dt)
+    pids = dict((name, np.zeros(count)) for name in ('Tar', 'Act', 'Err', 'P', 'I', 'FF'))
+    measured = np.zeros(1)
+    for index in range(count):
+        output = controller.update(desired[index], measured, dt)
+        for name, value in (('Tar', controller.target), ('Act', measured), ('Err', controller.error),
+                            ('P', controller.kp * controller.error), ('I', controller.integrator),
+                            ('FF', controller.ff * controller.target)):
+            pids[name][index] = value[0]
+        measured = plant.step(output) + rng.normal(0.0, noise)
+    pids['TimeUS'] = (np.arange(count) * dt * 1e6).astype(np.uint64) + 1000000
+    writer = LogWriter(f)
+    writer.define(130, 'PIDS', 'Qffffffffff', ['TimeUS', 'Tar', 'Act', 'Err', 'P', 'I', 'D', 'FF', 'Dmod', 'SRate',
+                                               'Flags'])
+    writer.write_many('PIDS', pids)
+
+
+def self_test(seconds=300.0, tolerance=0.05):
+    """ fits a closed_loop_log() session, checks the gains it was flown with come back and that the recommended
+        FF is the plant's - returns (passed, lines) """
+    handle, filename = tempfile.mkstemp(suffix='.bin')
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            closed_loop_log(f, seconds)
+        start = default_timer()
+        fit = SteeringFit(SteeringData.from_file(filename))
+        elapsed = default_timer() - start
+    finally:
+        os.remove(filename)
+    lines = fit.report()
+    recommended = fit.recommended()
+    checks = [('FF', fit.ff, SELF_TEST_GAINS[0], 'flown with'), ('P', fit.kp, SELF_TEST_GAINS[1], 'flown with'),
+              ('I', fit.ki, SELF_TEST_GAINS[2], 'flown with'),
+              ('FF', recommended[RATE_PREFIX + 'FF'], SELF_TEST_PLANT_FF, 'recommended, plant needs')]
+    passed = True
+    for name, fitted, expected, meaning in checks:
+        ok = abs(fitted - expected) <= tolerance * expected
+        passed &= ok
+        lines.append('{:<3} {:.4f}, {} {:.4f}: {}'.format(name, fitted, meaning, expected, 'ok' if ok else 'WRONG'))
+    lines.append('{:.0f} s session fitted in {:.2f} s: {}'.format(seconds, elapsed, 'PASS' if passed else 'FAIL'))
+    return passed, lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Estimate steering rate FF/P/I from DataFlash logs')
+    parser.add_argument('log', nargs='?', help='.bin log')
+    parser.add_argument('--params', help='.param dump to compare against (default: ArduRover 4.1 defaults)')
+    parser.add_argument('--instance', type=int, help='PIDS/STER instance')
+    parser.add_argument('--output', help='write the recommended changes to this .param file')
+    parser.add_argument('--step-threshold', type=float, default=STEP_THRESHOLD,
+                        help='rad/s target change that starts a transient')
+    parser.add_argument('--transient-time', type=float, default=TRANSIENT_TIME, help='s fitted after each step')
+    parser.add_argument('--steady-window', type=float, default=STEADY_WINDOW, help='s a turn must be held')
+    parser.add_argument('--self-test', action='store_true', help='fit a closed loop simulation with a known plant')
+    args = parser.parse_args(argv)
+
+    if args.self_test:
+        passed, lines = self_test()
+        print('\n'.join(lines))
+        return 0 if passed else 1
+    if not args.log:
+        parser.error('a log file is required')
+    params = None
+    if args.params:
+        params = ParamCache()
+        params.load_file(args.params)
+    start = default_timer()
+    data = SteeringData.from_file(args.log, args.instance)
+    try:
+        fit = SteeringFit(data, Segmentation(data, args.step_threshold, args.transient_time, args.steady_window))
+    except ValueError as inst:
+        print('{}: {}'.format(args.log, inst))
+        return 1
+    print('\n'.join(fit.report(params)))
+    print('({:.2f} s)'.format(default_timer() - start))
+    if args.output:
+        changes = fit.write_changes(args.output, params)
+        print('{} changes -> {}'.format(len(changes), args.output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
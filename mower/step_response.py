@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+    mower/step_response.py
+
+    Scripted PWM step and sweep tests through the RC override path, with per-servo response metrics
+
+    A StepTest drives one RC channel through a plan of (pwm, seconds) segments using an OverrideScheduler and
+    timestamps every SERVO_OUTPUT_RAW sample on arrival.  analyze() then reports, for each servo output that
+    responded, the latency, 10-90% rise time and overshoot of every step, plus the deadband (bracketed by the
+    largest command offset that left the output at rest and the smallest that moved it) and the endpoint
+    asymmetry (difference in gain above and below trim).
+
+    Latency is measured from the moment the new PWM is handed to the scheduler, so it includes the override
+    send interval and the telemetry link - raise OVERRIDE_RATE for finer resolution.
+
+    Runs headless against FakeServoVehicle, a local stand-in with lag, dead time, rate limit, deadband and end limits:
+        python -m mower.step_response --amplitude 300 --tau 0.08 --dead-time 0.04 --deadband 15
+
+"""
+
+from __future__ import division
+
+import argparse
+import sys
+from array import array
+from bisect import bisect_left
+from collections import deque
+from time import time
+
+from mower.mavlink import MSG_IDS
+from mower.overrides import OverrideScheduler, RELEASE
+from mower.servo import NUM_SERVOS, MIN_PWM
+
+NOISE_PWM = 3  # output changes up to this size are not a response
+SETTLED_FRACTION = 0.25  # final value is the median of this trailing fraction of a segment
+
+
+def step_plan(trim, amplitude, hold=1.0, repeats=1):
+    """ trim, +amplitude, trim, -amplitude, trim ... each held for hold seconds """
+    plan = [(trim, hold)]
+    for x in range(repeats):
+        plan += [(trim + amplitude, hold), (trim, hold), (trim - amplitude, hold), (trim, hold)]
+    return plan
+
+
+def sweep_plan(trim, amplitude, increments=10, hold=0.5):
+    """ staircase out to +amplitude and back, then to -amplitude and back - resolves the deadband """
+    levels = [trim + amplitude * x // increments for x in range(increments + 1)]
+    out_and_back = levels + levels[-2::-1]
+    return [(pwm, hold) for pwm in out_and_back + [2 * trim - pwm for pwm in out_and_back[1:]]]
+
+
+def median(values):
+    values = sorted(values)
+    n = len(values)
+    if not n:
+        return None
+    return values[n // 2] if n % 2 else (values[n // 2 - 1] + values[n // 2]) / 2
+
+
+class StepMetrics:
+    def __init__(self, command_from, command_to, initial, final, latency, rise_time, overshoot):
+        self.command_from = command_from
+        self.command_to = command_to
+        self.initial = initial
+        self.final = final
+        self.latency = latency  # seconds, None if the output did not respond
+        self.rise_time = rise_time  # seconds from 10% to 90% of the change
+        self.overshoot = overshoot  # percent of the change
+
+    @property
+    def responded(self):
+        return self.latency is not None
+
+
+class ChannelReport:
+    def __init__(self, servo, steps, rest, deadband, gains):
+        self.servo = servo  # 0 based servo output index
+        self.steps = steps
+        self.rest = rest  # output at the plan's first (trim) command
+        self.deadband = deadband  # (above, below) (largest offset that did not move the output, smallest that did)
+        self.gains = gains  # (above, below) output change per unit command change at the extremes
+
+    @property
+    def asymmetry(self):
+        """ percent difference between the gains above and below trim """
+        above, below = self.gains
+        if above is None or below is None or not above + below:
+            return None
+        return (abs(above) - abs(below)) / ((abs(above) + abs(below)) / 2) * 100
+
+    def __str__(self):
+        responded = [step for step in self.steps if step.responded]
+
+        def fmt(value, scale=1, spec='{:.0f}'):
+            return '--' if value is None else spec.format(value * scale)
+
+        lines = ['servo{}: rest {}  deadband +{}..{}/-{}..{}  gain {}/{}  asymmetry {}%  latency {} ms  rise {} ms  '
+                 'overshoot max {}%'.format(
+                     self.servo + 1, fmt(self.rest), fmt(self.deadband[0][0]), fmt(self.deadband[0][1]),
+                     fmt(self.deadband[1][0]), fmt(self.deadband[1][1]),
+                     fmt(self.gains[0], spec='{:+.2f}'), fmt(self.gains[1], spec='{:+.2f}'),
+                     fmt(self.asymmetry, spec='{:.1f}'),
+                     fmt(median([step.latency for step in responded]), 1000),
+                     fmt(median([step.rise_time for step in responded if step.rise_time is not None]), 1000),
+                     fmt(max([step.overshoot for step in responded] or [None]), spec='{:.1f}'))]
+        for step in self.steps:
+            lines.append('    {:>4} > {:<4}  latency {:>4} ms  rise {:>4} ms  overshoot {:>5}%  output {} > {}'.format(
+                step.command_from, step.command_to, fmt(step.latency, 1000), fmt(step.rise_time, 1000),
+                fmt(step.overshoot, spec='{:.1f}'), fmt(step.initial), fmt(step.final)))
+        return '\n'.join(lines)
+
+
+class StepReport:
+    def __init__(self, channel, segments, num_samples, duration, channels):
+        self.channel = channel
+        self.segments = segments
+        self.num_samples = num_samples
+        self.duration = duration
+        self.channels = channels  # [ChannelReport] for each servo output that responded
+
+    def __str__(self):
+        rate = self.num_samples / self.duration if self.duration > 0 else 0.0
+        lines = ['Step test on RC{}: {} segments, {} SERVO_OUTPUT_RAW samples in {:.1f} s ({:.1f} Hz)'.format(
+            self.channel, len(self.segments), self.num_samples, self.duration, rate)]
+        if not self.channels:
+            lines.append('No servo output responded')
+        lines.extend(str(channel) for channel in self.channels)
+        return '\n'.join(lines)
+
+
+def analyze_step(times, values, start, end, command_from, command_to, initial):
+    first, last = bisect_left(times, start), bisect_left(times, end)
+    if last - first < 2:
+        return None
+    samples = values[first:last]
+    settled = samples[int(len(samples) * (1 - SETTLED_FRACTION)):]
+    final = median(settled)
+    change = final - initial
+    latency = rise_time = overshoot = None
+    if abs(change) > NOISE_PWM:
+        t10 = t90 = None
+        for t, value in zip(times[first:last], samples):
+            progress = (value - initial) / change
+            if latency is None and abs(value - initial) > NOISE_PWM:
+                latency = t - start
+            if t10 is None and progress >= 0.1:
+                t10 = t
+            if t90 is None and progress >= 0.9:
+                t90 = t
+                break
+        if t10 is not None and t90 is not None:
+            rise_time = t90 - t10
+        peak = max((value - final) * (1 if change > 0 else -1) for value in samples)
+        overshoot = peak / abs(change) * 100 if peak > NOISE_PWM else 0.0
+    return StepMetrics(command_from, command_to, initial, final, latency, rise_time, overshoot)
+
+
+def analyze(channel, segments, times, channel_values, end_time):
+    """ segments are [(start_time, pwm)], channel_values one value array per servo output """
+    reports = []
+    bounds = [start for start, pwm in segments[1:]] + [end_time]
+    trim = segments[0][1] if segments else None
+    for servo, values in enumerate(channel_values):
+        if not len(values) or max(values) - min(values) <= NOISE_PWM or max(values) < MIN_PWM:
+            continue
+        finals = []
+        steps = []
+        previous_final = None
+        for (start, pwm), end, index in zip(segments, bounds, range(len(segments))):
+            first, last = bisect_left(times, start), bisect_left(times, end)
+            if last <= first:
+                finals.append(None)
+                continue
+            if index and previous_final is not None:
+                metrics = analyze_step(times, values, start, end, segments[index - 1][1], pwm, previous_final)
+                if metrics is not None:
+                    steps.append(metrics)
+            segment = values[first:last]
+            previous_final = median(segment[int(len(segment) * (1 - SETTLED_FRACTION)):])
+            finals.append(previous_final)
+        rest = median([final for (start, pwm), final in zip(segments, finals) if pwm == trim and final is not None])
+        if rest is None:
+            continue
+        deadband = []
+        gains = []
+        for direction in (1, -1):
+            offsets = [((pwm - trim) * direction, final) for (start, pwm), final in zip(segments, finals)
+                       if final is not None and (pwm - trim) * direction > 0]
+            moved = [offset for offset, final in offsets if abs(final - rest) > NOISE_PWM]
+            still = [offset for offset, final in offsets if offset < min(moved or [offset + 1])]
+            deadband.append((max(still or [0]), min(moved) if moved else None))
+            if offsets:
+                offset, final = max(offsets, key=lambda item: item[0])
+                gains.append((final - rest) / (offset * direction))
+            else:
+                gains.append(None)
+        reports.append(ChannelReport(servo, steps, rest, tuple(deadband), tuple(gains)))
+    duration = (end_time - segments[0][0]) if segments else 0.0
+    return StepReport(channel, segments, len(times), duration, reports)
+
+
+class StepTest:
+    def __init__(self, overrides, channel, plan, num_servos=NUM_SERVOS, clock=time):
+        self.overrides = overrides
+        self.channel = channel  # RC input channel driven through the override path
+        self.plan = plan  # [(pwm, seconds)]
+        self.clock = clock
+        self.field_names = tuple('servo{}_raw'.format(x + 1) for x in range(num_servos))
+        self.segments = []  # [(time the pwm was handed to the scheduler, pwm)]
+        self.times = array('d')
+        self.values = [array('i') for x in range(num_servos)]
+        self.running = False
+        self.end_time = None
+        self._index = 0
+        self._next_change = None
+
+    def start(self):
+        self.running = True
+        self._index = 0
+        self._apply(self.clock())
+
+    def _apply(self, now):
+        pwm, hold = self.plan[self._index]
+        self.overrides.set(self.channel, pwm)
+        self.segments.append((now, pwm))
+        self._next_change = now + hold
+
+    def poll(self):
+        """ advances through the plan - returns False once the test is over """
+        if not self.running:
+            return False
+        now = self.clock()
+        if now >= self._next_change:
+            self._index += 1
+            if self._index >= len(self.plan):
+                self.stop()
+                return False
+            self._apply(now)
+        return True
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.end_time = self.clock()
+            self.overrides.release(self.channel)
+
+    def on_servo_output(self, message):
+        """ SERVO_OUTPUT_RAW handler """
+        if self.running:
+            data = message.data
+            self.times.append(self.clock())
+            for values, field_name in zip(self.values, self.field_names):
+                values.append(int(getattr(data, field_name, 0)))
+        return True
+
+    def report(self):
+        return analyze(self.channel, self.segments, self.times, self.values,
+                       self.end_time if self.end_time is not None else self.clock())
+
+
+class SimClock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class FakeServoVehicle:
+    """ stand-in vehicle: RC override inputs drive servo outputs through a first order lag with dead time,
+        an optional slew rate limit, a deadband around trim and separate end limits - outputs maps an RC channel
+        to [(servo index, sign)] """
+
+    def __init__(self, clock, outputs=None, rate=50.0, trim=1500, tau=0.08, dead_time=0.04, deadband=10,
+                 limits=(1100, 1900), num_servos=NUM_SERVOS, slew_rate=None):
+        self.clock = clock
+        self.outputs = outputs if outputs is not None else {1: [(0, 1)]}
+        self.interval = 1.0 / rate
+        self.trim = trim
+        self.tau = tau
+        self.dead_time = dead_time
+        self.deadband = deadband
+        self.limits = limits
+        self.num_servos = num_servos
+        self.slew_rate = slew_rate  # PWM/s, None for no limit
+        self.inputs = dict((chan, trim) for chan in self.outputs)
+        self.history = deque()  # (time, {channel: pwm}) waiting out the dead time
+        self.state = [float(trim)] * num_servos
+        self.last_update = clock()
+        self.next_message = self.last_update
+
+    def send_override(self, channels):
+        """ OverrideScheduler send function - a released channel returns to trim """
+        for chan, pwm in channels:
+            if chan in self.inputs:
+                self.inputs[chan] = self.trim if pwm == RELEASE else pwm
+        self.history.append((self.clock(), dict(self.inputs)))
+
+    def targets(self, now):
+        effective = dict((chan, self.trim) for chan in self.outputs)
+        while len(self.history) > 1 and self.history[1][0] <= now - self.dead_time:
+            self.history.popleft()
+        if self.history and self.history[0][0] <= now - self.dead_time:
+            effective = self.history[0][1]
+        targets = [float(self.trim)] * self.num_servos
+        for chan, servos in self.outputs.items():
+            offset = effective[chan] - self.trim
+            if abs(offset) <= self.deadband:
+                offset = 0
+            for servo, sign in servos:
+                targets[servo] = min(max(self.trim + sign * offset, self.limits[0]), self.limits[1])
+        return targets
+
+    def advance(self, now):
+        """ returns SERVO_OUTPUT_RAW messages due up to now """
+        from mower.replay import MessageData, ReplayMessage  # replay imports this package's heavier modules
+        messages = []
+        targets = self.targets(now)
+        dt = now - self.last_update
+        self.last_update = now
+        alpha = dt / (self.tau + dt) if self.tau > 0 else 1.0
+        moves = [(target - value) * alpha for value, target in zip(self.state, targets)]
+        if self.slew_rate is not None:
+            limit = self.slew_rate * dt
+            moves = [min(max(move, -limit), limit) for move in moves]
+        self.state = [value + move for value, move in zip(self.state, moves)]
+        while self.next_message <= now:
+            self.next_message += self.interval
+            fields = dict(('servo{}_raw'.format(x + 1), int(round(value))) for x, value in enumerate(self.state))
+            fields['time_usec'] = int(now * 1e6) & 0xFFFFFFFF
+            messages.append(ReplayMessage(MSG_IDS['SERVO_OUTPUT_RAW'], MessageData(**fields)))
+        return messages
+
+
+def run_headless(plan, channel=1, vehicle=None, override_rate=50.0, step=0.002):
+    """ runs a StepTest in simulated time against a FakeServoVehicle - returns the StepReport """
+    clock = SimClock()
+    if vehicle is None:
+        vehicle = FakeServoVehicle(clock, {channel: [(0, 1)]})
+    vehicle.clock = clock
+    overrides = OverrideScheduler(vehicle.send_override, override_rate, clock=clock)
+    test = StepTest(overrides, channel, plan, vehicle.num_servos, clock)
+    test.start()
+    next_tick = 0.0
+    while test.poll():
+        clock.now += step
+        overrides.kick()
+        if clock.now >= next_tick:
+            overrides.tick()
+            next_tick += 1.0 / override_rate
+        for message in vehicle.advance(clock.now):
+            test.on_servo_output(message)
+    overrides.tick()
+    return test.report()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Step/sweep test against a simulated servo')
+    parser.add_argument('--channel', type=int, default=1, help='RC channel to drive')
+    parser.add_argument('--trim', type=int, default=1500)
+    parser.add_argument('--amplitude', type=int, default=300, help='step size in PWM')
+    parser.add_argument('--hold', type=float, default=1.0, help='seconds per step')
+    parser.add_argument('--sweep', action='store_true', help='run a staircase sweep instead of steps')
+    parser.add_argument('--tau', type=float, default=0.08, help='simulated servo time constant (s)')
+    parser.add_argument('--dead-time', type=float, default=0.04, help='simulated dead time (s)')
+    parser.add_argument('--deadband', type=int, default=10, help='simulated deadband around trim (PWM)')
+    parser.add_argument('--slew-rate', type=float, default=None, help='simulated rate limit (PWM/s)')
+    parser.add_argument('--limits', type=int, nargs=2, default=(1100, 1900), help='simulated end limits (PWM)')
+    parser.add_argument('--skid-steer', action='store_true', help='drive servo1 and (reversed) servo3')
+    parser.add_argument('--override-rate', type=float, default=50.0, help='override messages per second')
+    args = parser.parse_args(argv)
+
+    plan = sweep_plan(args.trim, args.amplitude, hold=args.hold / 2) if args.sweep else \
+        step_plan(args.trim, args.amplitude, args.hold)
+    outputs = {args.channel: [(0, 1), (2, -1)] if args.skid_steer else [(0, 1)]}
+    clock = SimClock()
+    vehicle = FakeServoVehicle(clock, outputs, trim=args.trim, tau=args.tau, dead_time=args.dead_time,
+                               deadband=args.deadband, limits=tuple(args.limits), slew_rate=args.slew_rate)
+    print(run_headless(plan, args.channel, vehicle, args.override_rate))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+    mower/trace.py
+
+    Fixed-size SERVO_OUTPUT_RAW trace and PWM histograms for every servo channel
+
+    ServoTrace keeps the last capacity samples of each channel in preallocated ring buffers, timestamped on
+    arrival and with the vehicle's time_usec, plus a per-channel histogram of every PWM value seen since the
+    last reset.  Nothing is allocated on the packet path.
+
+    export() copies the buffers under a short lock and writes them from a background thread, so the packet
+    handler keeps recording while a CSV or NumPy .npy file is written.  The .npy header is written by hand,
+    numpy is only needed to load the files:
+        trace = numpy.load('servo_trace_20240101_120000.npy')  # fields time, time_usec, servo1 ... servo16
+        hist = numpy.load('servo_trace_20240101_120000_hist.npy')  # [channel, (pwm - MIN_PWM) // bin_width]
+
+"""
+
+import sys
+from array import array
+from os import path
+from struct import pack
+from threading import Lock, Thread
+from time import time, strftime, localtime
+
+from mower.servo import MIN_PWM, MAX_PWM, NUM_SERVOS, UNUSED
+
+TRACE_LENGTH = 3000  # samples per channel, a minute of SERVO_OUTPUT_RAW at 50 Hz
+HISTOGRAM_BIN_WIDTH = 1  # PWM per histogram bin
+NPY_ALIGNMENT = 64  # bytes, .npy header length is padded to a multiple of this
+
+
+def array_bytes(values):
+    """ raw little-endian contents of an array (tobytes() is tostring() before Python 3.2) """
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes() if hasattr(values, 'tobytes') else values.tostring()
+
+
+def npy_header(descr, shape):
+    """ version 1.0 .npy header for a C ordered array """
+    header = "{{'descr': {}, 'fortran_order': False, 'shape': {}, }}".format(descr, shape)
+    padding = NPY_ALIGNMENT - (10 + len(header) + 1) % NPY_ALIGNMENT
+    header += ' ' * (padding % NPY_ALIGNMENT) + '\n'
+    return b'\x93NUMPY\x01\x00' + pack('<H', len(header)) + header.encode('latin-1')
+
+
+class TraceSnapshot:
+    """ ordered copy of a ServoTrace, oldest sample first """
+
+    def __init__(self, times, boot_times, values, histograms, min_pwm, bin_width, samples):
+        self.times = times
+        self.boot_times = boot_times
+        self.values = values  # one array per channel
+        self.histograms = histograms  # one array of bin counts per channel
+        self.min_pwm = min_pwm
+        self.bin_width = bin_width
+        self.samples = samples  # total recorded, including those overwritten since
+
+    def __len__(self):
+        return len(self.times)
+
+    def write_csv(self, filename):
+        with open(filename, 'w') as f:
+            f.write(','.join(['time', 'time_usec'] + ['servo{}'.format(x + 1) for x in range(len(self.values))]))
+            f.write('\n')
+            for index in range(len(self.times)):
+                f.write('{:.6f},{:.0f},'.format(self.times[index], self.boot_times[index]))
+                f.write(','.join([str(values[index]) for values in self.values]))
+                f.write('\n')
+
+    def write_histogram_csv(self, filename):
+        """ one row per bin, labelled with the lowest PWM in the bin """
+        with open(filename, 'w') as f:
+            f.write(','.join(['pwm'] + ['servo{}'.format(x + 1) for x in range(len(self.histograms))]))
+            f.write('\n')
+            for index in range(len(self.histograms[0]) if self.histograms else 0):
+                f.write('{},'.format(self.min_pwm + index * self.bin_width))
+                f.write(','.join([str(counts[index]) for counts in self.histograms]))
+                f.write('\n')
+
+    def write_npy(self, filename):
+        """ structured array with fields time (<f8), time_usec (<f8) and servo1... (<u2) """
+        fields = [('time', '<f8'), ('time_usec', '<f8')] + [('servo{}'.format(x + 1), '<u2')
+                                                            for x in range(len(self.values))]
+        descr = '[' + ', '.join("('{}', '{}')".format(name, kind) for name, kind in fields) + ']'
+        row_format = '<dd{}H'.format(len(self.values))
+        with open(filename, 'wb') as f:
+            f.write(npy_header(descr, '({},)'.format(len(self.times))))
+            for index in range(len(self.times)):
+                f.write(pack(row_format, self.times[index], self.boot_times[index],
+                             *[values[index] for values in self.values]))
+
+    def write_histogram_npy(self, filename):
+        """ <u4 array of shape (channels, bins) """
+        counts = array('I')
+        for histogram in self.histograms:
+            counts.extend(histogram)
+        with open(filename, 'wb') as f:
+            f.write(npy_header("'<u4'", '({}, {})'.format(len(self.histograms), len(self.histograms[0]))))
+            f.write(array_bytes(counts))
+
+
+class ServoTrace:
+    def __init__(self, num_servos=NUM_SERVOS, capacity=TRACE_LENGTH, bin_width=HISTOGRAM_BIN_WIDTH,
+                 min_pwm=MIN_PWM, max_pwm=MAX_PWM, clock=time):
+        self.num_servos = num_servos
+        self.capacity = capacity
+        self.bin_width = bin_width
+        self.min_pwm = min_pwm
+        self.max_pwm = max_pwm
+        self.clock = clock
+        self.num_bins = (max_pwm - min_pwm) // bin_width + 1
+        self.times = array('d', [0.0] * capacity)  # arrival, seconds since the epoch
+        self.boot_times = array('d', [0.0] * capacity)  # SERVO_OUTPUT_RAW time_usec
+        self.values = [array('H', [0] * capacity) for x in range(num_servos)]
+        self.histograms = [array('I', [0] * self.num_bins) for x in range(num_servos)]
+        self.head = 0  # index of the next write
+        self.count = 0
+        self.samples = 0
+        self.exporting = False
+        self.last_export = None  # files written by the last export, or the error that stopped it
+        self._lock = Lock()  # record() vs snapshot()/reset() only - held for a copy, never for file I/O
+
+    def __len__(self):
+        return self.count
+
+    def record(self, values, time_usec=0):
+        """ stores one SERVO_OUTPUT_RAW sample - values is indexed by channel, e.g. ServoMonitor.value """
+        now = self.clock()
+        with self._lock:
+            head = self.head
+            self.times[head] = now
+            self.boot_times[head] = time_usec
+            for x in range(self.num_servos):
+                value = values[x]
+                self.values[x][head] = value
+                if value != UNUSED:
+                    bin_index = (min(max(value, self.min_pwm), self.max_pwm) - self.min_pwm) // self.bin_width
+                    self.histograms[x][bin_index] += 1
+            self.head = (head + 1) % self.capacity
+            if self.count < self.capacity:
+                self.count += 1
+            self.samples += 1
+
+    def reset(self):
+        with self._lock:
+            self.head = 0
+            self.count = 0
+            self.samples = 0
+            for histogram in self.histograms:
+                for index in range(self.num_bins):
+                    histogram[index] = 0
+
+    def _ordered(self, buffer, start):
+        if start + self.count <= self.capacity:
+            return buffer[start:start + self.count]
+        return buffer[start:] + buffer[:self.head]
+
+    def snapshot(self):
+        with self._lock:
+            start = (self.head - self.count) % self.capacity
+            return TraceSnapshot(self._ordered(self.times, start), self._ordered(self.boot_times, start),
+                                 [self._ordered(values, start) for values in self.values],
+                                 [array('I', histogram) for histogram in self.histograms],
+                                 self.min_pwm, self.bin_width, self.samples)
+
+    def export(self, directory='.', prefix='servo_trace', fmt='csv', on_done=None):
+        """ writes <prefix>_<time>.<fmt> and <prefix>_<time>_hist.<fmt> in the background - returns the thread,
+            or None if an export is still running.  on_done(files, error) is called from that thread """
+        if self.exporting:
+            return None
+        if fmt not in ('csv', 'npy'):
+            raise ValueError('export format must be csv or npy')
+        self.exporting = True
+        snapshot = self.snapshot()
+        base = path.join(directory, '{}_{}'.format(prefix, strftime('%Y%m%d_%H%M%S', localtime())))
+        thread = Thread(target=self._export, args=(snapshot, base, fmt, on_done))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _export(self, snapshot, base, fmt, on_done):
+        files = [base + '.' + fmt, base + '_hist.' + fmt]
+        error = None
+        try:
+            if fmt == 'npy':
+                snapshot.write_npy(files[0])
+                snapshot.write_histogram_npy(files[1])
+            else:
+                snapshot.write_csv(files[0])
+                snapshot.write_histogram_csv(files[1])
+        except (IOError, OSError) as inst:
+            error = str(inst)
+        self.last_export = error if error is not None else files
+        self.exporting = False
+        if on_done is not None:
+            on_done(files, error)
+
+    def status_text(self):
+        return '{} samples traced ({} kept)'.format(self.samples, self.count)
@@ -1,109 +1,238 @@
 """
     VERY rudimentary PID simulation using matplotlib and simple-pid
 
-    Lots of hard-coded values and global variables - not my finest work, but maybe my fastest
+    The controller (simple-pid, or ArduRover's steering rate controller initialised from PARAM_FILENAME)
+    drives a plant model from mower/plants.py (PLANT below) - 'direct' feeds the output straight back as
+    the measurement, as this script originally did.
+
+    The simulation runs on its own fixed-step clock (SIM_DT), seeded so a run can be repeated, and is
+    advanced SPEED simulated seconds per real second, independent of the frame rate.  The plot keeps
+    persistent line artists fed from fixed-length buffers and redraws with blitting, on the time axis
+    relative to "now" so the axes never need redrawing.  Frame rate and CPU use are shown in the window.
 
     Dependencies:
         matplotlib
+        numpy
         simple-pid
 
     -- Yuri - Aug 2021
 """
 
-import time
 import random
+import time
+from collections import deque
+
 import matplotlib.pyplot as plt
+import numpy as np
 from matplotlib.animation import FuncAnimation
 from matplotlib.widgets import Slider, Button
 from simple_pid import PID
 
-MAX_PLOT_POINTS = 32
-
-
-def animate(i):
-    global achieved, desired, last_plot_time, next_set_time  # yep, I did that...
-    achieved = pid(achieved)
-    time_now = round(time.time() * 1000) - start_time
-    if time_now >= next_set_time:
-        desired = random.uniform(-100.0, 100.0)
-        pid.setpoint = desired
-        next_set_time = time_now + random.randint(1000, 3000)
-    if time_now - last_plot_time > 300:
-        list_time.append(round(time_now / 1000, 3))
-        list_desired.append(desired)
-        list_achieved.append(achieved)
-
-        if len(list_time) > MAX_PLOT_POINTS:
-            list_time.pop(0)
-            list_desired.pop(0)
-            list_achieved.pop(0)
-
-        ax.cla()
-
-        ax.plot(list_time, list_desired, label='PID Desired')
-        ax.plot(list_time, list_achieved, label='PID Achieved')
-        ax.set_ylim([-125, 125])
-        ax.legend(loc='upper left')
-        ax.margins(x=0.001)
-        plt.tight_layout()
-        plt.subplots_adjust(bottom=0.3)
-        last_plot_time = time_now
-
-
-def update(val):
-    # factor of 2 on the Ki term because it *seems* scaled incorrectly in the library
-    # divide Kd by 100 for the same reason
-    pid.tunings = (p_slider.val, i_slider.val * 2.0, d_slider.val / 100.0)
-
-
-def reset_controller(event):
-    pid.reset()
-    pid.setpoint = desired
-    p_slider.reset()
-    i_slider.reset()
-    d_slider.reset()
-
-
-start_time = round(time.time() * 1000)
-last_plot_time = 0
-next_set_time = random.randint(1000, 3000)
-
-desired = random.uniform(-100.0, 100.0)
-achieved = 0.0
-
-pid = PID(0.7, 0.7, 0.0, setpoint=desired, sample_time=None)
-
-list_time = []
-list_desired = []
-list_achieved = []
-
-for t in range(MAX_PLOT_POINTS):
-    list_time.append((t / 4 - 8))
-    list_desired.append(desired)
-    list_achieved.append(achieved)
-
-fig, ax = plt.subplots()
-plt.style.use('fivethirtyeight')
-fig.set_figheight(5)
-fig.set_figwidth(16)
-
-ax_p = plt.axes([0.1, 0.2, 0.7, 0.03])
-ax_i = plt.axes([0.1, 0.12, 0.7, 0.03])
-ax_d = plt.axes([0.1, 0.04, 0.7, 0.03])
-ax_btn = plt.axes([0.88, 0.2, 0.1, 0.04])
-button = Button(ax_btn, 'Reset')
-
-p_slider = Slider(ax_p, 'P', 0.6, 1.0, valinit=pid.Kp, valstep=.0001)
-i_slider = Slider(ax_i, 'I', 0.3, 1.0, valinit=pid.Ki / 2.0, valstep=0.0001)
-d_slider = Slider(ax_d, 'D', 0, 0.5, valinit=pid.Kd * 100.0, valstep=0.00001)
-
-p_slider.on_changed(update)
-i_slider.on_changed(update)
-d_slider.on_changed(update)
-button.on_clicked(reset_controller)
-
-# force the update function to run very quickly to get plenty of PID feedback
-# next_plot_time slows the actual animation down
-ani = FuncAnimation(plt.gcf(), animate, interval=0.001)
-
-plt.show()
+from mower.ardupilot_steering import SteeringRateController
+from mower.params import ParamCache
+from mower.plants import make_plant
+
+CONTROLLER = 'ardupilot'  # 'simple-pid' or 'ardupilot' (ATC_STR_RAT_*, ATC_STR_ACC_MAX from PARAM_FILENAME)
+PLANT = 'skid-steer'  # 'direct', 'lag' or 'skid-steer' (yaw rate in rad/s from a -1..1 steering output)
+PARAM_FILENAME = '20210714 Cube Orange 4.1.0-dev (custom) GPS UART2.param'  # steering gains and limits
+PLANT_TAU = 0.1  # seconds
+PLANT_DEAD_TIME = 0.0  # seconds
+SIM_DT = 0.01  # seconds of simulated time per step
+SPEED = 1.0  # simulated seconds per real second
+SEED = 0  # setpoint sequence seed (None for a different run every time)
+SETPOINT_INTERVAL = (1.0, 3.0)  # simulated seconds between setpoint changes
+PLOT_WINDOW = 8.0  # simulated seconds shown
+PLOT_INTERVAL = 0.05  # simulated seconds between plotted points
+FRAME_INTERVAL = 33  # milliseconds between frames
+MAX_STEPS_PER_FRAME = 10000  # drop simulated time rather than stall if the simulation cannot keep up
+STATS_INTERVAL = 1.0  # seconds between FPS/CPU updates
+
+
+class ArduPilotSteering:
+    """ simple-pid style wrapper around a single SteeringRateController, for the sliders """
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.setpoint = 0.0
+
+    @property
+    def Kp(self):
+        return float(self.controller.kp[0])
+
+    @property
+    def Ki(self):
+        return float(self.controller.ki[0])
+
+    @property
+    def Kd(self):
+        return float(self.controller.kd[0])
+
+    @property
+    def tunings(self):
+        return self.Kp, self.Ki, self.Kd
+
+    @tunings.setter
+    def tunings(self, tunings):
+        self.controller.kp[0], self.controller.ki[0], self.controller.kd[0] = tunings
+
+    def reset(self):
+        self.controller.reset()
+
+    def __call__(self, measurement, dt):
+        return float(self.controller.update(self.setpoint, measurement, dt)[0])
+
+
+class Simulation:
+    """ fixed-step PID + plant simulation with a seeded setpoint sequence - no wall clock involved """
+
+    def __init__(self, plant, setpoint_range, pid=None, dt=SIM_DT, seed=SEED):
+        self.plant = plant
+        self.setpoint_range = setpoint_range
+        self.dt = dt
+        self.seed = seed
+        if pid is None:
+            pid = PID(0.7, 0.7, 0.0, sample_time=None)
+            if setpoint_range <= 1.0:
+                pid.output_limits = (-1.0, 1.0)
+        self.pid = pid
+        points = int(round(PLOT_WINDOW / PLOT_INTERVAL)) + 1
+        self.times = deque(maxlen=points)
+        self.desired = deque(maxlen=points)
+        self.achieved = deque(maxlen=points)
+        self.plot_every = max(int(round(PLOT_INTERVAL / dt)), 1)
+        self.reset()
+
+    def reset(self):
+        self.rng = random.Random(self.seed)
+        self.now = 0.0
+        self.step_count = 0
+        self.achieved_value = 0.0
+        self.pid.reset()
+        self.plant.reset(1, self.dt)
+        self.next_setpoint = 0.0
+        self.times.clear()
+        self.desired.clear()
+        self.achieved.clear()
+
+    def step(self):
+        if self.now >= self.next_setpoint:
+            self.pid.setpoint = self.rng.uniform(-self.setpoint_range, self.setpoint_range)
+            self.next_setpoint = self.now + self.rng.uniform(*SETPOINT_INTERVAL)
+        output = self.pid(self.achieved_value, dt=self.dt)
+        self.achieved_value = float(self.plant.step(np.array([output]))[0])
+        self.step_count += 1
+        self.now = self.step_count * self.dt
+        if self.step_count % self.plot_every == 0:
+            self.times.append(self.now)
+            self.desired.append(self.pid.setpoint)
+            self.achieved.append(self.achieved_value)
+
+    def run(self, seconds, max_steps=None):
+        """ advances by whole steps covering seconds of simulated time - returns the steps taken """
+        steps = int(seconds / self.dt)
+        if max_steps is not None:
+            steps = min(steps, max_steps)
+        for x in range(steps):
+            self.step()
+        return steps
+
+
+class LiveView:
+    def __init__(self, simulation, speed=SPEED):
+        self.sim = simulation
+        self.speed = speed
+        self.pending = 0.0  # simulated seconds owed to the simulation
+        self.last_frame = None
+        self.frames = 0
+        self.stats_wall = time.perf_counter()
+        self.stats_cpu = time.process_time()
+
+        plt.style.use('fivethirtyeight')
+        self.fig, self.ax = plt.subplots()
+        self.fig.set_figheight(5)
+        self.fig.set_figwidth(16)
+        self.fig.subplots_adjust(bottom=0.3)
+        limit = simulation.setpoint_range * 1.25
+        self.ax.set_xlim(-PLOT_WINDOW, 0.0)
+        self.ax.set_ylim(-limit, limit)
+        self.ax.set_xlabel('seconds')
+        self.line_desired, = self.ax.plot([], [], label='PID Desired', animated=True)
+        self.line_achieved, = self.ax.plot([], [], label='PID Achieved', animated=True)
+        self.txt_stats = self.ax.text(0.99, 0.97, '', transform=self.ax.transAxes, ha='right', va='top',
+                                      fontsize=10, animated=True)
+        self.ax.legend(loc='upper left')
+
+        ax_p = self.fig.add_axes([0.1, 0.2, 0.7, 0.03])
+        ax_i = self.fig.add_axes([0.1, 0.12, 0.7, 0.03])
+        ax_d = self.fig.add_axes([0.1, 0.04, 0.7, 0.03])
+        ax_btn = self.fig.add_axes([0.88, 0.2, 0.1, 0.04])
+        pid = simulation.pid
+        self.button = Button(ax_btn, 'Reset')
+        self.p_slider = Slider(ax_p, 'P', 0.0, 2.0, valinit=pid.Kp, valstep=.0001)
+        self.i_slider = Slider(ax_i, 'I', 0.0, 2.0, valinit=pid.Ki, valstep=0.0001)
+        self.d_slider = Slider(ax_d, 'D', 0, 0.1, valinit=pid.Kd, valstep=0.00001)
+        for slider in (self.p_slider, self.i_slider, self.d_slider):
+            slider.on_changed(self.update_tunings)
+        self.button.on_clicked(self.reset)
+
+        self.animation = FuncAnimation(self.fig, self.animate, init_func=self.init_artists, interval=FRAME_INTERVAL,
+                                       blit=True, cache_frame_data=False)
+
+    def init_artists(self):
+        self.line_desired.set_data([], [])
+        self.line_achieved.set_data([], [])
+        return self.line_desired, self.line_achieved, self.txt_stats
+
+    def update_tunings(self, val):
+        self.sim.pid.tunings = (self.p_slider.val, self.i_slider.val, self.d_slider.val)
+
+    def reset(self, event):
+        self.sim.reset()
+        self.pending = 0.0
+        self.p_slider.reset()
+        self.i_slider.reset()
+        self.d_slider.reset()
+
+    def animate(self, frame):
+        now = time.perf_counter()
+        if self.last_frame is not None:
+            self.pending += (now - self.last_frame) * self.speed
+        self.last_frame = now
+        steps = self.sim.run(self.pending, MAX_STEPS_PER_FRAME)
+        self.pending = max(self.pending - steps * self.sim.dt, 0.0)
+        if steps == MAX_STEPS_PER_FRAME:
+            self.pending = 0.0
+
+        times = np.fromiter(self.sim.times, float, len(self.sim.times)) - self.sim.now
+        self.line_desired.set_data(times, self.sim.desired)
+        self.line_achieved.set_data(times, self.sim.achieved)
+
+        self.frames += 1
+        elapsed = now - self.stats_wall
+        if elapsed >= STATS_INTERVAL:
+            cpu = time.process_time()
+            self.txt_stats.set_text('{:.0f} fps  CPU {:.0f}%  sim {:.1f} s ({:.1f}x)'.format(
+                self.frames / elapsed, (cpu - self.stats_cpu) / elapsed * 100, self.sim.now, self.speed))
+            self.frames = 0
+            self.stats_wall = now
+            self.stats_cpu = cpu
+        return self.line_desired, self.line_achieved, self.txt_stats
+
+
+def main():
+    params = ParamCache()
+    if PLANT == 'skid-steer' or CONTROLLER == 'ardupilot':
+        params.load_file(PARAM_FILENAME)
+    plant = make_plant(PLANT, params, PLANT_TAU, PLANT_DEAD_TIME)
+    pid = None
+    if CONTROLLER == 'ardupilot':
+        controller = SteeringRateController.from_params(params)
+        print(controller.summary(0))
+        pid = ArduPilotSteering(controller)
+    view = LiveView(Simulation(plant, 100.0 if PLANT == 'direct' else 1.0, pid))
+    plt.show()
+    return view
+
+
+if __name__ == '__main__':
+    main()
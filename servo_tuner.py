@@ -14,7 +14,9 @@
 print('\n*** ServoTuner ***\n')
 print('Loading modules...')
 
+import sys
 from collections import OrderedDict
+from os import getcwd, path
 import clr
 
 clr.AddReference('MAVLink')
@@ -22,21 +24,57 @@ clr.AddReference('System.Drawing')
 clr.AddReference('System.Windows.Forms')
 
 import MAVLink
-from System import Char, Func, Array
+from System import Char, Array
 from System.Windows.Forms import Application, Screen, Form, Keys, HorizontalAlignment, \
-    FlatStyle, BorderStyle, ProgressBar, CheckBox, Label, NumericUpDown, Button, ToolTip
+    FlatStyle, BorderStyle, ProgressBar, CheckBox, Label, NumericUpDown, Button, ToolTip, ComboBox, ComboBoxStyle, \
+    ListBox, TextBox, Timer, MessageBox, MessageBoxButtons, MessageBoxIcon, DialogResult
 from System.Drawing import Point, Color
 
-SEVERITY = ['EMERGENCY: ', 'ALERT: ', 'CRITICAL: ', 'ERROR: ', 'WARNING: ', 'NOTICE: ', 'INFO: ', 'DEBUG: ']
+# ************************** USER DEFINABLE VALUES ************************** #
+
+LIB_PATH = None  # directory containing the 'mower' package (None for this script's directory)
+RECORD_PATH = None  # directory for recorded .tlog files (None for the current directory)
+RECORD_MAX_FILE_MB = 64  # start a new .tlog file after this many megabytes
+STATUS_LOG_ROWS = 6  # visible lines of the STATUSTEXT log
+STATUS_LOG_INTERVAL = 250  # milliseconds between STATUSTEXT log updates
+OVERRIDE_RATE = 10.0  # RC override messages per second while any channel is overridden
+OVERRIDE_WATCHDOG = 1.0  # seconds of unresponsive UI before all overrides are released
+PARAM_FILENAME = None  # .param file to use if Mission Planner has no parameters loaded (e.g. not connected)
+STEP_TEST_AMPLITUDE = 200  # PWM either side of trim driven by the step test
+STEP_TEST_HOLD = 1.0  # seconds per step (half of this per sweep increment)
+STEP_TEST_SWEEP = False  # True for a staircase sweep (resolves the deadband), False for plain steps
+TRACE_LENGTH = 3000  # SERVO_OUTPUT_RAW samples kept per channel for export
+TRACE_EXPORT_FORMAT = 'csv'  # 'csv' or 'npy' (NumPy)
+
+# *************************************************************************** #
+
+if LIB_PATH is None:
+    try:
+        LIB_PATH = path.dirname(path.abspath(__file__))
+    except NameError:  # Mission Planner does not always define __file__
+        LIB_PATH = getcwd()
+if LIB_PATH not in sys.path:
+    sys.path.append(LIB_PATH)
+
+from mower.backend import MissionPlannerBackend
+from mower.overrides import OverrideScheduler
+from mower.recorder import TelemetryRecorder
+from mower.servo import ServoMonitor, MIN_PWM, MAX_PWM, NUM_SERVOS, UNUSED
+from mower.statustext import SEVERITY, StatusTextLog, StatusTextView
+from mower.step_response import StepTest, step_plan, sweep_plan
+from mower.trace import ServoTrace
+
 SPINNER = ['-', '\\', '|', '/']
+OVERRIDE_KICK_INTERVAL = 200  # milliseconds, must be well below OVERRIDE_WATCHDOG
+STEP_TEST_INTERVAL = 20  # milliseconds between step test plan checks
+
+BACKEND = MissionPlannerBackend(MAV, Script, PARAM_FILENAME)
+PARAMS = BACKEND.params  # kept current from PARAM_VALUE by the backend
+print(BACKEND.status_text())
 
-MIN_PWM = 800
-MAX_PWM = 2200
+RC_OVERRIDES = (('aileron', 'RCMAP_ROLL'), ('elevator', 'RCMAP_PITCH'), ('throttle', 'RCMAP_THROTTLE'),
+                ('rudder', 'RCMAP_YAW'), ('channel', None))  # chk_/spn_ control suffix, parameter mapping its channel
 
-AIL_CH = int(Script.GetParam('RCMAP_ROLL'))
-ELE_CH = int(Script.GetParam('RCMAP_PITCH'))
-THR_CH = int(Script.GetParam('RCMAP_THROTTLE'))
-RUD_CH = int(Script.GetParam('RCMAP_YAW'))
 
 class MPColor:
     """ System.Drawing.Color is a sealed value type that disallows class inheritance
@@ -60,12 +98,23 @@ CustomColor = MPColor()
 
 class ServoTunerForm(Form):
     def __init__(self):
-
-        MAV.SubscribeToPacketType(MAVLink.MAVLINK_MSG_ID.SERVO_OUTPUT_RAW,
-                                  Func[MAVLink.MAVLinkMessage, bool](self.get_servo_data))
-        MAV.SubscribeToPacketType(MAVLink.MAVLINK_MSG_ID.HEARTBEAT,
-                                  Func[MAVLink.MAVLinkMessage, bool](self.heartbeat_received))
-        MAV.OnPacketReceived += self.packet_handler
+        self.servo_monitor = ServoMonitor(NUM_SERVOS, self.display_servo)
+        self.servo_trace = ServoTrace(NUM_SERVOS, TRACE_LENGTH)
+        self.status_log = StatusTextLog()
+        self.status_view = StatusTextView(self.status_log)
+        self.step_test = None
+        self.params_version = None  # of PARAMS when the override channels and ranges were last applied
+        self.rc_ranges = {}  # control suffix: (channel, (min, max, trim) PWM or None)
+
+        self.handlers = BACKEND.subscriber('ServoTuner')
+        self.handlers.subscribe_all(self.record_packet)
+        self.handlers.subscribe(MAVLink.MAVLINK_MSG_ID.SERVO_OUTPUT_RAW, self.servo_output_received)
+        self.handlers.subscribe(MAVLink.MAVLINK_MSG_ID.HEARTBEAT, self.heartbeat_received)
+        self.handlers.subscribe(MAVLink.MAVLINK_MSG_ID.STATUSTEXT, self.statustext_received)
+
+        self.recorder = TelemetryRecorder(RECORD_PATH or getcwd(), 'servo_tuner',
+                                          max_file_size=RECORD_MAX_FILE_MB * 1024 * 1024)
+        self.overrides = OverrideScheduler(BACKEND.send_rc_override, OVERRIDE_RATE, OVERRIDE_WATCHDOG)
 
         self.Text = 'Servo Tuner'
         self.Location = Point(0, 0)
@@ -80,7 +129,7 @@ class ServoTunerForm(Form):
         start_x, start_y = 12, 10
 
         self.servo_widgets = []
-        for x in range(16):
+        for x in range(NUM_SERVOS):
             progress_bar = ProgressBar()
             progress_bar.Width = 150
             progress_bar.Height = 20
@@ -157,13 +206,10 @@ class ServoTunerForm(Form):
         self.spn_aileron.BorderStyle = BorderStyle.FixedSingle
         self.spn_aileron.BackColor = CustomColor.MPLightGray
         self.spn_aileron.ForeColor = CustomColor.White
-        self.spn_aileron.Minimum = int(Script.GetParam('RC' + str(AIL_CH) + '_MIN'))
-        self.spn_aileron.Maximum = int(Script.GetParam('RC' + str(AIL_CH) + '_MAX'))
         self.spn_aileron.Increment = 1
-        self.spn_aileron.Value = int(Script.GetParam('RC' + str(AIL_CH) + '_TRIM'))
 
         self.chk_aileron = CheckBox()
-        self.chk_aileron.Name = str(AIL_CH) + ',spn_aileron'
+        self.chk_aileron.Name = ',spn_aileron'  # channel filled in by refresh_rc_channels()
         self.chk_aileron.FlatAppearance.BorderSize = 1
         self.chk_aileron.FlatAppearance.BorderColor = CustomColor.MPLightGray
         self.chk_aileron.Text = 'Override RC Aileron'
@@ -176,13 +222,10 @@ class ServoTunerForm(Form):
         self.spn_elevator.BorderStyle = BorderStyle.FixedSingle
         self.spn_elevator.BackColor = CustomColor.MPLightGray
         self.spn_elevator.ForeColor = CustomColor.White
-        self.spn_elevator.Minimum = int(Script.GetParam('RC' + str(ELE_CH) + '_MIN'))
-        self.spn_elevator.Maximum = int(Script.GetParam('RC' + str(ELE_CH) + '_MAX'))
         self.spn_elevator.Increment = 1
-        self.spn_elevator.Value = int(Script.GetParam('RC' + str(ELE_CH) + '_TRIM'))
 
         self.chk_elevator = CheckBox()
-        self.chk_elevator.Name = str(ELE_CH) + ',spn_elevator'
+        self.chk_elevator.Name = ',spn_elevator'  # channel filled in by refresh_rc_channels()
         self.chk_elevator.FlatAppearance.BorderSize = 1
         self.chk_elevator.FlatAppearance.BorderColor = CustomColor.MPLightGray
         self.chk_elevator.Text = 'Override RC Elevator'
@@ -195,13 +238,10 @@ class ServoTunerForm(Form):
         self.spn_throttle.BorderStyle = BorderStyle.FixedSingle
         self.spn_throttle.BackColor = CustomColor.MPLightGray
         self.spn_throttle.ForeColor = CustomColor.White
-        self.spn_throttle.Minimum = int(Script.GetParam('RC' + str(THR_CH) + '_MIN'))
-        self.spn_throttle.Maximum = int(Script.GetParam('RC' + str(THR_CH) + '_MAX'))
         self.spn_throttle.Increment = 1
-        self.spn_throttle.Value = int(Script.GetParam('RC' + str(THR_CH) + '_TRIM'))
 
         self.chk_throttle = CheckBox()
-        self.chk_throttle.Name = str(THR_CH) + ',spn_throttle'
+        self.chk_throttle.Name = ',spn_throttle'  # channel filled in by refresh_rc_channels()
         self.chk_throttle.FlatAppearance.BorderSize = 1
         self.chk_throttle.FlatAppearance.BorderColor = CustomColor.MPLightGray
         self.chk_throttle.Text = 'Override RC Throttle'
@@ -214,13 +254,10 @@ class ServoTunerForm(Form):
         self.spn_rudder.BorderStyle = BorderStyle.FixedSingle
         self.spn_rudder.BackColor = CustomColor.MPLightGray
         self.spn_rudder.ForeColor = CustomColor.White
-        self.spn_rudder.Minimum = int(Script.GetParam('RC' + str(RUD_CH) + '_MIN'))
-        self.spn_rudder.Maximum = int(Script.GetParam('RC' + str(RUD_CH) + '_MAX'))
         self.spn_rudder.Increment = 1
-        self.spn_rudder.Value = int(Script.GetParam('RC' + str(RUD_CH) + '_TRIM'))
 
         self.chk_rudder = CheckBox()
-        self.chk_rudder.Name = str(RUD_CH) + ',spn_rudder'
+        self.chk_rudder.Name = ',spn_rudder'  # channel filled in by refresh_rc_channels()
         self.chk_rudder.FlatAppearance.BorderSize = 1
         self.chk_rudder.FlatAppearance.BorderColor = CustomColor.MPLightGray
         self.chk_rudder.Text = 'Override RC Rudder'
@@ -244,13 +281,10 @@ class ServoTunerForm(Form):
         self.spn_channel.BorderStyle = BorderStyle.FixedSingle
         self.spn_channel.BackColor = CustomColor.MPLightGray
         self.spn_channel.ForeColor = CustomColor.White
-        self.spn_channel.Minimum = int(Script.GetParam('RC' + str(self.spn_channel_num.Value) + '_MIN'))
-        self.spn_channel.Maximum = int(Script.GetParam('RC' + str(self.spn_channel_num.Value) + '_MAX'))
         self.spn_channel.Increment = 1
-        self.spn_channel.Value = int(Script.GetParam('RC' + str(self.spn_channel_num.Value) + '_TRIM'))
 
         self.chk_channel = CheckBox()
-        self.chk_channel.Name = str(self.spn_channel_num.Value) + ',spn_channel'
+        self.chk_channel.Name = ',spn_channel'
         self.chk_channel.FlatAppearance.BorderSize = 1
         self.chk_channel.FlatAppearance.BorderColor = CustomColor.MPLightGray
         self.chk_channel.Text = 'Override RC Channel'
@@ -279,6 +313,26 @@ class ServoTunerForm(Form):
         self.btn_inhibit_overrides.Text = 'Return RC Control\nNOW!'
         self.btn_inhibit_overrides.Click += self.handle_overrides
 
+        self.btn_step_test = Button()
+        self.btn_step_test.Width = self.btn_reset.Width
+        self.btn_step_test.FlatStyle = FlatStyle.Flat
+        self.btn_step_test.FlatAppearance.BorderSize = 1
+        self.btn_step_test.FlatAppearance.BorderColor = CustomColor.MPLightGray
+        self.btn_step_test.BackColor = CustomColor.MPLightGray
+        self.btn_step_test.ForeColor = CustomColor.White
+        self.btn_step_test.Text = 'Run Step Test'
+        self.btn_step_test.Click += self.toggle_step_test
+
+        self.btn_export_trace = Button()
+        self.btn_export_trace.Width = self.btn_reset.Width
+        self.btn_export_trace.FlatStyle = FlatStyle.Flat
+        self.btn_export_trace.FlatAppearance.BorderSize = 1
+        self.btn_export_trace.FlatAppearance.BorderColor = CustomColor.MPLightGray
+        self.btn_export_trace.BackColor = CustomColor.MPLightGray
+        self.btn_export_trace.ForeColor = CustomColor.White
+        self.btn_export_trace.Text = 'Export PWM Trace'
+        self.btn_export_trace.Click += self.export_trace
+
         self.chk_sticky = CheckBox()
         self.chk_sticky.FlatAppearance.BorderSize = 1
         self.chk_sticky.FlatAppearance.BorderColor = CustomColor.MPLightGray
@@ -286,6 +340,13 @@ class ServoTunerForm(Form):
         self.chk_sticky.Checked = True
         self.chk_sticky.AutoSize = True
 
+        self.chk_record = CheckBox()
+        self.chk_record.FlatAppearance.BorderSize = 1
+        self.chk_record.FlatAppearance.BorderColor = CustomColor.MPLightGray
+        self.chk_record.Text = 'Record telemetry (.tlog)'
+        self.chk_record.Checked = False
+        self.chk_record.AutoSize = True
+
         self.lbl_status = Label()
         self.lbl_status.Text = 'Waiting for heartbeat...'
         self.lbl_status.BackColor = CustomColor.MPMediumGray
@@ -297,6 +358,44 @@ class ServoTunerForm(Form):
         self.lbl_warning.BackColor = Color.DarkRed
         self.lbl_warning.Height = 30
 
+        self.cbo_severity = ComboBox()
+        self.cbo_severity.Width = 100
+        self.cbo_severity.DropDownStyle = ComboBoxStyle.DropDownList
+        self.cbo_severity.FlatStyle = FlatStyle.Flat
+        self.cbo_severity.BackColor = CustomColor.MPLightGray
+        self.cbo_severity.ForeColor = CustomColor.White
+        for severity in SEVERITY:
+            self.cbo_severity.Items.Add(severity.rstrip(': '))
+        self.cbo_severity.SelectedIndex = len(SEVERITY) - 1
+
+        self.txt_search = TextBox()
+        self.txt_search.Width = 150
+        self.txt_search.BorderStyle = BorderStyle.FixedSingle
+        self.txt_search.BackColor = CustomColor.MPLightGray
+        self.txt_search.ForeColor = CustomColor.White
+
+        self.lst_status = ListBox()
+        self.lst_status.BorderStyle = BorderStyle.FixedSingle
+        self.lst_status.BackColor = CustomColor.MPMediumGray
+        self.lst_status.ForeColor = CustomColor.White
+        self.lst_status.IntegralHeight = False
+        self.lst_status.Height = self.lst_status.ItemHeight * STATUS_LOG_ROWS + 4
+        self.lst_status.HorizontalScrollbar = True
+
+        self.tmr_status = Timer()
+        self.tmr_status.Interval = STATUS_LOG_INTERVAL
+        self.tmr_status.Tick += self.update_status_log
+
+        self.tmr_overrides = Timer()
+        self.tmr_overrides.Interval = OVERRIDE_KICK_INTERVAL
+        self.tmr_overrides.Tick += self.refresh_overrides
+
+        self.tmr_step_test = Timer()
+        self.tmr_step_test.Interval = STEP_TEST_INTERVAL
+        self.tmr_step_test.Tick += self.poll_step_test
+
+        self.refresh_rc_channels()  # overrides stay disabled until the RC parameters are known
+
         # pseudo-responsive form layout
 
         self.add_control_horizontal(self.lbl_warning, start_x, start_y, self.margin)
@@ -322,7 +421,9 @@ class ServoTunerForm(Form):
         x = self.servo_widgets[0]['lbl_min'].Left
 
         x, y, tmp = self.add_control_vertical(self.btn_reset, x, y + self.margin, self.margin)
-        x, y, tmp = self.add_control_horizontal(self.btn_inhibit_overrides, x, y + self.margin, self.margin)
+        x, y, tmp = self.add_control_vertical(self.btn_inhibit_overrides, x, y + self.margin, self.margin)
+        x, y, tmp = self.add_control_vertical(self.btn_step_test, x, y + self.margin, self.margin)
+        x, y, tmp = self.add_control_horizontal(self.btn_export_trace, x, y, self.margin)
 
         x, y, tmp = self.add_control_horizontal(self.spn_aileron, start_x, self.btn_reset.Top, self.margin)
         x, y, tmp = self.add_control_vertical(self.chk_aileron, x, y, self.margin)
@@ -337,9 +438,14 @@ class ServoTunerForm(Form):
         x, y, tmp = self.add_control_vertical(self.spn_channel_num, x, y, self.margin)
 
         x, y, tmp = self.add_control_vertical(self.chk_sticky, start_x, y + 10, self.margin)
+        x, y, tmp = self.add_control_vertical(self.chk_record, start_x, y, self.margin)
 
         self.lbl_status.Width = self.Width - self.margin * 7
         x, y, x_extent = self.add_control_vertical(self.lbl_status, start_x, y + 3, self.margin)
+        x, y, x_extent = self.add_control_horizontal(self.cbo_severity, start_x, y, self.margin)
+        x, y, x_extent = self.add_control_vertical(self.txt_search, x, y, self.margin)
+        self.lst_status.Width = self.lbl_status.Width
+        x, y, x_extent = self.add_control_vertical(self.lst_status, start_x, y, self.margin)
         self.lbl_warning.Width = self.lbl_status.Width
 
         self.lbl_min_hdr.Location = Point(self.servo_widgets[0]['lbl_min'].Left,
@@ -364,6 +470,10 @@ class ServoTunerForm(Form):
         self.Tips.SetToolTip(self.chk_throttle, warning)
         self.Tips.SetToolTip(self.chk_rudder, warning)
         self.Tips.SetToolTip(self.chk_channel, warning)
+        self.Tips.SetToolTip(self.btn_step_test, 'Step the Override RC Channel through a scripted plan and report '
+                                                 'latency, rise time, overshoot and deadband\n' + warning)
+        self.Tips.SetToolTip(self.cbo_severity, 'Show messages of this severity or worse')
+        self.Tips.SetToolTip(self.txt_search, 'Show messages containing this text')
 
 
 
@@ -373,18 +483,61 @@ class ServoTunerForm(Form):
             return
         self.TopMost = False
 
+    def toggle_recording(self, sender, event):
+        if sender.Checked:
+            if not self.recorder.start():
+                self.update_record_status()
+            return
+        if not self.recorder.stop():
+            print('Recorder still writing the queued packets')
+        self.update_record_status()
+        print('Recorder stopped: {}'.format(self.recorder.status_text()))
+
+    def update_record_status(self):
+        text = 'Record telemetry (.tlog)'
+        if self.recorder.error is not None:
+            text += ' - ERROR: ' + self.recorder.error
+        elif self.recorder.files:
+            text += ' - ' + self.recorder.status_text()
+        self.chk_record.Text = text
+
     def set_channel_min_max(self, sender, event):
-        self.chk_channel.Name = str(sender.Value) + ',spn_channel'
-        self.spn_channel.Minimum = int(Script.GetParam('RC' + str(sender.Value) + '_MIN'))
-        self.spn_channel.Maximum = int(Script.GetParam('RC' + str(sender.Value) + '_MAX'))
-        self.spn_channel.Value = int(Script.GetParam('RC' + str(sender.Value) + '_TRIM'))
+        self.set_override_channel('channel', int(sender.Value))
+
+    def refresh_rc_channels(self):
+        """ applies RCMAP_* and RCn_MIN/MAX/TRIM to the overrides whenever the parameter cache changes - an override
+            (and the step test) stays disabled until the vehicle's values are known, never run around a guessed trim """
+        if PARAMS.version == self.params_version:
+            return
+        self.params_version = PARAMS.version
+        for suffix, rcmap in RC_OVERRIDES:
+            self.set_override_channel(suffix, PARAMS.get_int(rcmap) if rcmap else int(self.spn_channel_num.Value))
+
+    def set_override_channel(self, suffix, channel):
+        chk, spinner = getattr(self, 'chk_' + suffix), getattr(self, 'spn_' + suffix)
+        pwm = PARAMS.rc_channel(channel) if channel is not None else None
+        if self.rc_ranges.get(suffix) == (channel, pwm):
+            return
+        self.rc_ranges[suffix] = (channel, pwm)
+        if chk.Checked:  # hand the previous channel back before switching
+            if pwm is None:
+                chk.Checked = False
+            else:
+                self.overrides.release(int(chk.Name.split(',')[0]))
+        chk.Name = '{},spn_{}'.format(channel, suffix)
+        chk.Enabled = spinner.Enabled = pwm is not None
+        if suffix == 'channel' and self.step_test is None:
+            self.btn_step_test.Enabled = pwm is not None
+        if pwm is not None:
+            spinner.Minimum, spinner.Maximum, spinner.Value = pwm
+            if chk.Checked:
+                self.handle_overrides(chk, None)
 
     def reset_min_max(self, sender, event):
-        for x in range(15):
-            self.servo_widgets[x]['lbl_min'].Text = str(MAX_PWM + 1)
-            self.servo_widgets[x]['lbl_max'].Text = str(MIN_PWM - 1)
-            self.servo_widgets[x]['lbl_diff'].Text = ''
-            self.servo_widgets[x]['lbl_midpt'].Text = ''
+        self.servo_monitor.reset()
+        self.servo_trace.reset()
+        for x in range(NUM_SERVOS):
+            self.display_servo_extremes(x)
 
     def add_control_vertical(self, control, x, y, margin):
         control.Location = Point(x, y)
@@ -396,40 +549,91 @@ class ServoTunerForm(Form):
         self.Controls.Add(control)
         return x + control.Width + margin, y, x + control.Width + margin
 
-    def get_servo_data(self, message):
-        for x in range(16):
-            try:
-                val = int(getattr(message.data, 'servo' + str(x + 1) + '_raw'))
-            except AttributeError:
-                continue
-            if val < MIN_PWM:
-                if self.servo_widgets[x]['progress_bar'].Visible:
-                    self.servo_widgets[x]['progress_bar'].Visible = False
-                if self.servo_widgets[x]['lbl_min'].Visible:
-                    self.servo_widgets[x]['lbl_min'].Visible = False
-                if self.servo_widgets[x]['lbl_max'].Visible:
-                    self.servo_widgets[x]['lbl_max'].Visible = False
-                if self.servo_widgets[x]['lbl_diff'].Visible:
-                    self.servo_widgets[x]['lbl_diff'].Visible = False
-                if self.servo_widgets[x]['lbl_midpt'].Visible:
-                    self.servo_widgets[x]['lbl_midpt'].Visible = False
-                self.servo_widgets[x]['lbl_value'].Text = '   --'
-                continue
-            self.servo_widgets[x]['progress_bar'].Value = val
-            self.servo_widgets[x]['lbl_value'].Text = str(val)
-            if val < int(self.servo_widgets[x]['lbl_min'].Text):
-                self.servo_widgets[x]['lbl_min'].Text = str(val)
-                max = int(self.servo_widgets[x]['lbl_max'].Text)
-                self.servo_widgets[x]['lbl_diff'].Text = str(max - val)
-                self.servo_widgets[x]['lbl_midpt'].Text = str(int(round((max - val) / 2) + val))
-            if val > int(self.servo_widgets[x]['lbl_max'].Text):
-                self.servo_widgets[x]['lbl_max'].Text = str(val)
-                min = int(self.servo_widgets[x]['lbl_min'].Text)
-                self.servo_widgets[x]['lbl_diff'].Text = str(val - min)
-                self.servo_widgets[x]['lbl_midpt'].Text = str(int(round((val - min) / 2) + min))
-
+    def display_servo_extremes(self, index):
+        servos = self.servo_monitor
+        widget = self.servo_widgets[index]
+        widget['lbl_min'].Text = str(servos.minimum[index])
+        widget['lbl_max'].Text = str(servos.maximum[index])
+        widget['lbl_diff'].Text = str(servos.diff[index]) if servos.has_extremes(index) else ''
+        widget['lbl_midpt'].Text = str(servos.midpoint[index]) if servos.has_extremes(index) else ''
+
+    def display_servo(self, index):
+        """ renders ServoMonitor state - the labels are never read back """
+        value = self.servo_monitor.value[index]
+        widget = self.servo_widgets[index]
+        if value == UNUSED:
+            for name in ('progress_bar', 'lbl_min', 'lbl_max', 'lbl_diff', 'lbl_midpt'):
+                if widget[name].Visible:
+                    widget[name].Visible = False
+            widget['lbl_value'].Text = '   --'
+            return
+        widget['progress_bar'].Value = value
+        widget['lbl_value'].Text = str(value)
+        if self.servo_monitor.extremes_changed[index]:
+            self.display_servo_extremes(index)
+
+    def servo_output_received(self, message):
+        self.servo_monitor.get_servo_data(message)
+        self.servo_trace.record(self.servo_monitor.value, message.data.time_usec)
+        test = self.step_test
+        if test is not None:
+            test.on_servo_output(message)
         return True
 
+    def toggle_step_test(self, sender, event):
+        if self.step_test is not None:  # a second click aborts
+            self.finish_step_test()
+            return
+        channel = int(self.spn_channel_num.Value)
+        pwm = PARAMS.rc_channel(channel)
+        if pwm is None:
+            MessageBox.Show('RC{} parameters have not been received from the vehicle yet'.format(channel), 'Step Test')
+            return
+        trim = pwm[2]
+        if STEP_TEST_SWEEP:
+            plan = sweep_plan(trim, STEP_TEST_AMPLITUDE, hold=STEP_TEST_HOLD / 2)
+        else:
+            plan = step_plan(trim, STEP_TEST_AMPLITUDE, STEP_TEST_HOLD)
+        prompt = 'RC{} will be driven {} PWM either side of {} for {:.0f} seconds.\n\n' \
+                 'WARNING: The vehicle may move!'.format(channel, STEP_TEST_AMPLITUDE, trim,
+                                                         sum(hold for pwm, hold in plan))
+        if MessageBox.Show(prompt, 'Step Test', MessageBoxButtons.OKCancel,
+                           MessageBoxIcon.Warning) != DialogResult.OK:
+            return
+        self.handle_overrides(self.btn_inhibit_overrides, None)
+        self.step_test = StepTest(self.overrides, channel, plan, NUM_SERVOS)
+        self.step_test.start()
+        self.btn_step_test.Text = 'Abort Step Test'
+        self.btn_step_test.BackColor = Color.DarkRed
+        self.tmr_step_test.Start()
+
+    def poll_step_test(self, sender, event):
+        if self.step_test is not None and not self.step_test.poll():
+            self.finish_step_test()
+
+    def finish_step_test(self):
+        self.tmr_step_test.Stop()
+        test, self.step_test = self.step_test, None
+        test.stop()
+        self.btn_step_test.Text = 'Run Step Test'
+        self.btn_step_test.BackColor = CustomColor.MPLightGray
+        report = str(test.report())
+        print(report)
+        MessageBox.Show(report, 'Step Test')
+
+    def export_trace(self, sender, event):
+        if self.servo_trace.export(RECORD_PATH or getcwd(), 'servo_trace', TRACE_EXPORT_FORMAT,
+                                   self.trace_exported) is None:
+            print('PWM trace export already running')
+
+    @staticmethod
+    def trace_exported(files, error):
+        """ runs on the export thread - must not touch the form """
+        if error is not None:
+            print('PWM trace export failed: ' + error)
+            return
+        print('PWM trace exported: ' + ', '.join(files))
+
     def heartbeat_received(self, message):
         self.heartbeat_count = (self.heartbeat_count + 1) % 4
         text = self.lbl_status.Text
@@ -438,14 +642,32 @@ class ServoTunerForm(Form):
         text = list(text)
         text[0] = SPINNER[self.heartbeat_count]
         self.lbl_status.Text = ''.join(text)
-        self.handle_overrides(self.chk_aileron, None)
-        self.handle_overrides(self.chk_elevator, None)
-        self.handle_overrides(self.chk_throttle, None)
-        self.handle_overrides(self.chk_rudder, None)
-        self.handle_overrides(self.chk_channel, None)
+        if self.recorder.recording:
+            self.update_record_status()
+        self.Tips.SetToolTip(self.btn_inhibit_overrides,
+                             'Inhibit all RC overrides immediately\n' + self.overrides.status_text())
+        self.Tips.SetToolTip(self.btn_export_trace, 'Write the PWM trace and histograms to {} files\n{}'.format(
+            TRACE_EXPORT_FORMAT, self.servo_trace.status_text()))
+
+    def refresh_overrides(self, sender, event):
+        """ runs on the UI thread - if it stops, the scheduler's watchdog releases every override """
+        self.overrides.kick()
+        self.refresh_rc_channels()
+        if self.overrides.tripped:
+            self.overrides.tripped = False
+            print('Override watchdog tripped - RC control returned')
+            self.handle_overrides(self.btn_inhibit_overrides, None)
+            return
+        for chk in (self.chk_aileron, self.chk_elevator, self.chk_throttle, self.chk_rudder, self.chk_channel):
+            if chk.Checked:
+                self.handle_overrides(chk, None)
 
     def handle_overrides(self, sender, event):
+        """ only records the wanted PWM - the scheduler sends all active channels together """
         if sender == self.btn_inhibit_overrides:
+            if self.step_test is not None:
+                self.finish_step_test()
+            self.overrides.release_all()
             if self.chk_aileron.Checked:
                 self.chk_aileron.Checked = False
             if self.chk_elevator.Checked:
@@ -463,33 +685,77 @@ class ServoTunerForm(Form):
 
         if sender.Checked:
             val = int(getattr(self, name).Value)
-            Script.SendRC(chan, val, True)
+            self.overrides.set(chan, val)
             if sender.BackColor != Color.DarkRed:
                 sender.BackColor = Color.DarkRed
             return
 
         if event is not None:  # return RC control for this channel by sending a 0 pwm value
             """ https://diydrones.com/forum/topics/how-to-restore-control-back-to-rc-when-running-a-python-script-in """
-            Script.SendRC(chan, 0, True)
+            self.overrides.release(chan)
             if sender.BackColor != self.BackColor:
                 sender.BackColor = self.BackColor
 
-    def packet_handler(self, obj, message):
-        try:
-            if message.msgid == MAVLink.MAVLINK_MSG_ID.STATUSTEXT.value__:
-                self.lbl_status.Text = SPINNER[self.heartbeat_count] + ' ' + \
-                                       SEVERITY[message.data.severity] + str(bytes(message.data.text))
-        except Exception as inst:
-            print(inst)  # not sure what situation would raise this, so leaving it for debugging
+    def set_status_filter(self, sender, event):
+        self.apply_status_operations(self.status_view.set_filter(self.cbo_severity.SelectedIndex,
+                                                                 self.txt_search.Text))
+
+    def update_status_log(self, sender, event):
+        operations = self.status_view.update()
+        if operations:
+            self.apply_status_operations(operations)
+
+    def apply_status_operations(self, operations):
+        """ edits the list in place rather than rebuilding it """
+        items = self.lst_status.Items
+        visible_items = self.lst_status.ClientSize.Height // self.lst_status.ItemHeight
+        follow = self.lst_status.TopIndex >= items.Count - visible_items
+        self.lst_status.BeginUpdate()
+        for operation in operations:
+            if operation[0] == 'add':
+                items.Add(operation[1])
+            elif operation[0] == 'set':
+                items[operation[1]] = operation[2]
+            elif operation[0] == 'remove':
+                items.RemoveAt(operation[1])
+            else:
+                items.Clear()
+        if follow and items.Count:
+            self.lst_status.TopIndex = items.Count - 1  # keep the newest visible unless scrolled back
+        self.lst_status.EndUpdate()
+
+    def record_packet(self, message):
+        if self.recorder.recording:
+            self.recorder.push(message.buffer)
+        return True
+
+    def statustext_received(self, message):
+        entry = self.status_log.add(message.data.severity, str(bytes(message.data.text)))
+        self.lbl_status.Text = SPINNER[self.heartbeat_count] + ' ' + SEVERITY[entry.severity] + entry.text
+        return True
 
     def on_load(self, sender, event):
         self.chk_sticky.CheckedChanged += self.set_sticky
+        self.chk_record.CheckedChanged += self.toggle_recording
+        self.cbo_severity.SelectedIndexChanged += self.set_status_filter
+        self.txt_search.TextChanged += self.set_status_filter
         self.set_sticky(self.chk_sticky, None)
+        self.tmr_status.Start()
+        self.overrides.start()
+        self.tmr_overrides.Start()
         print('Running...')
 
     def on_exit(self, sender, event):
-        MAV.UnSubscribeToPacketType(MAVLink.MAVLINK_MSG_ID.SERVO_OUTPUT_RAW)
-        MAV.UnSubscribeToPacketType(MAVLink.MAVLINK_MSG_ID.HEARTBEAT)
+        self.tmr_step_test.Stop()
+        if self.step_test is not None:
+            self.step_test.stop()
+        self.tmr_status.Stop()
+        self.tmr_overrides.Stop()
+        self.overrides.stop()
+        self.recorder.stop()
+        print('\n'.join(self.handlers.timing_table()))
+        self.handlers.close()
+        BACKEND.close()
 
 
 print('Loading interface...')
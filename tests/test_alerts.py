@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+""" mower/alerts.py - threshold rules with hysteresis and debounce """
+
+from mower.alerts import AlertEngine, AlertRule
+
+
+def feed(rule, samples):
+    """ [(time, value)] - returns the times at which the rule changed state """
+    changes = []
+    for now, value in samples:
+        rule.value = value
+        if rule.evaluate(now):
+            changes.append(now)
+    return changes
+
+
+def test_rule_without_both_limits_never_raises():
+    rule = AlertRule('x', low=0.0)
+    assert not rule.enabled
+    assert feed(rule, [(t, 100.0) for t in range(5)]) == []
+
+
+def test_raise_waits_for_the_debounce():
+    rule = AlertRule('x', 0.0, 10.0, debounce=0.5)
+    assert feed(rule, [(0.0, 5.0), (1.0, 11.0), (1.2, 11.0), (1.4, 11.0)]) == []
+    assert not rule.active and rule.pending
+    assert feed(rule, [(1.5, 11.0)]) == [1.5]
+    assert rule.active and rule.raised_count == 1
+
+
+def test_a_brief_excursion_is_ignored():
+    rule = AlertRule('x', 0.0, 10.0, debounce=0.5)
+    assert feed(rule, [(0.0, 11.0), (0.3, 5.0), (0.6, 11.0), (0.9, 5.0)]) == []
+    assert not rule.active and not rule.pending
+
+
+def test_clear_needs_the_value_inside_the_hysteresis_band():
+    rule = AlertRule('x', 0.0, 10.0, hysteresis=1.0, debounce=0.0)
+    assert feed(rule, [(0.0, 12.0)]) == [0.0]
+    assert feed(rule, [(1.0, 9.5), (2.0, 9.9)]) == []  # back in range but not past high - hysteresis
+    assert rule.active
+    assert feed(rule, [(3.0, 8.5)]) == [3.0]
+    assert not rule.active
+
+
+def test_hysteresis_defaults_to_a_fraction_of_the_band_and_is_capped():
+    assert AlertRule('x', 0.0, 100.0).hysteresis == 2.0
+    assert AlertRule('x', 0.0, 10.0, hysteresis=20.0).hysteresis == 5.0
+
+
+def test_losing_the_value_clears_an_active_rule():
+    rule = AlertRule('x', 0.0, 10.0, debounce=0.0)
+    feed(rule, [(0.0, 20.0)])
+    rule.value = None
+    assert rule.evaluate(1.0)
+    assert not rule.active
+
+
+def test_engine_records_events_and_rate_limits_the_alarm():
+    rules = [AlertRule('a', 0.0, 10.0, debounce=0.0), AlertRule('b', 0.0, 10.0, debounce=0.0)]
+    engine = AlertEngine(alarm_interval=5.0)
+    rules[0].value, rules[1].value = 20.0, 5.0
+    assert engine.evaluate(rules, 100.0) == [rules[0]]
+    assert engine.active_count == 1
+    assert engine.alarm_due(100.0)
+    assert not engine.alarm_due(104.0)
+    assert engine.alarm_due(105.0)
+    rules[0].value = 5.0
+    assert engine.evaluate(rules, 106.0) == [rules[0]]
+    assert engine.active_count == 0 and not engine.alarm_due(200.0)
+    assert [(event.name, event.active) for event in engine.history] == [('a', True), ('a', False)]
+    assert engine.summary().splitlines()[0] == '0 active alert(s)'
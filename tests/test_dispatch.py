@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+""" mower/dispatch.py - shared msgid dispatcher """
+
+from threading import Thread
+
+from mower import dispatch
+from mower.dispatch import ALL, Dispatcher, Subscriber, subscriber
+from mower.replay import Event, FakeMAV, MessageData, ReplayMessage
+
+HEARTBEAT, STATUSTEXT = 0, 253
+
+
+def message(msgid):
+    return ReplayMessage(msgid, MessageData())
+
+
+class Recorder:
+    def __init__(self):
+        self.received = []
+
+    def __call__(self, msg):
+        self.received.append(msg.msgid)
+        return True
+
+
+def test_routes_by_msgid_and_to_every_packet_handlers():
+    mav = FakeMAV()
+    handlers = subscriber(mav, 'test')
+    heartbeat, every = Recorder(), Recorder()
+    handlers.subscribe(HEARTBEAT, heartbeat)
+    handlers.subscribe_all(every)
+    for msgid in (HEARTBEAT, STATUSTEXT, HEARTBEAT):
+        mav.inject(message(msgid))
+    assert heartbeat.received == [HEARTBEAT, HEARTBEAT]
+    assert every.received == [HEARTBEAT, STATUSTEXT, HEARTBEAT]
+    handlers.close()
+    assert not mav.OnPacketReceived.handlers
+
+
+def test_enum_members_are_keyed_by_value():
+    class EnumMember:
+        value__ = HEARTBEAT
+
+    mav = FakeMAV()
+    handlers = subscriber(mav, 'test')
+    received = Recorder()
+    handlers.subscribe(EnumMember(), received)
+    mav.inject(message(HEARTBEAT))
+    assert received.received == [HEARTBEAT]
+    handlers.close()
+
+
+def test_one_hook_per_mav_and_close_removes_only_its_own_handlers():
+    mav = FakeMAV()
+    first, second = subscriber(mav, 'first'), subscriber(mav, 'second')
+    assert first.dispatcher is second.dispatcher
+    assert len(mav.OnPacketReceived.handlers) == 1
+    shared, own = Recorder(), Recorder()
+    first.subscribe(HEARTBEAT, shared)
+    second.subscribe(HEARTBEAT, shared)  # second reference, still one call per packet
+    second.subscribe(STATUSTEXT, own)
+    mav.inject(message(HEARTBEAT))
+    assert shared.received == [HEARTBEAT]
+    second.close()
+    mav.inject(message(HEARTBEAT))
+    mav.inject(message(STATUSTEXT))
+    assert shared.received == [HEARTBEAT, HEARTBEAT]
+    assert own.received == []
+    first.close()
+    first.close()  # closing twice releases once
+    assert not mav.OnPacketReceived.handlers
+    assert subscriber(mav, 'again').dispatcher is not first.dispatcher
+
+
+def test_reference_counts():
+    dispatcher = Dispatcher(FakeMAV())
+    handler = Recorder()
+    assert dispatcher.add(HEARTBEAT, handler) == 1
+    assert dispatcher.add(HEARTBEAT, handler) == 2
+    assert dispatcher.remove(HEARTBEAT, handler) == 1
+    assert dispatcher.remove(HEARTBEAT, handler) == 0
+    assert dispatcher.remove(HEARTBEAT, handler) == 0
+    assert dispatcher.handler_count() == 0
+
+
+def test_handler_errors_are_counted_not_raised(capsys):
+    mav = FakeMAV()
+    handlers = subscriber(mav, 'test')
+    after = Recorder()
+
+    def broken(msg):
+        raise ValueError('bad packet')
+
+    handlers.subscribe(HEARTBEAT, broken)
+    handlers.subscribe(HEARTBEAT, after)
+    for x in range(dispatch.MAX_PRINTED_ERRORS + 3):
+        mav.inject(message(HEARTBEAT))
+    assert len(after.received) == dispatch.MAX_PRINTED_ERRORS + 3
+    assert capsys.readouterr().out.count('bad packet') == dispatch.MAX_PRINTED_ERRORS
+    stats = [entry for entry in handlers.dispatcher.stats.values() if entry.name == 'broken'][0]
+    assert stats.errors == stats.calls == dispatch.MAX_PRINTED_ERRORS + 3
+    table = handlers.timing_table()
+    assert table[0].split()[:3] == ['owner', 'handler', 'calls'] and len(table) == 3
+    handlers.close()
+
+
+def test_unrouted_packets_are_counted():
+    mav = FakeMAV()
+    handlers = subscriber(mav, 'test', timing=False)
+    handlers.subscribe(HEARTBEAT, Recorder())
+    mav.inject(message(STATUSTEXT))
+    mav.inject(message(HEARTBEAT))
+    assert (handlers.dispatcher.packets, handlers.dispatcher.unrouted) == (2, 1)
+    handlers.close()
+
+
+class RacingEvent(Event):
+    """ OnPacketReceived that lets another thread subscribe while the dispatcher is unhooking """
+
+    def __init__(self, mav):
+        Event.__init__(self)
+        self.mav = mav
+        self.late = []
+        self.thread = None
+
+    def __isub__(self, handler):
+        Event.__isub__(self, handler)
+        if self.thread is None:
+            self.thread = Thread(target=lambda: self.late.append(subscriber(self.mav, 'late')))
+            self.thread.start()
+            self.thread.join(0.2)  # blocked on the registry lock unless release() lets it in
+        return self
+
+
+def test_subscribing_while_the_last_subscriber_closes_leaves_one_dispatcher():
+    mav = FakeMAV()
+    mav.OnPacketReceived = RacingEvent(mav)
+    subscriber(mav, 'first').close()
+    mav.OnPacketReceived.thread.join()
+    late, = mav.OnPacketReceived.late
+    received = Recorder()
+    late.subscribe(HEARTBEAT, received)
+    another = subscriber(mav, 'another')
+    assert another.dispatcher is late.dispatcher
+    mav.inject(message(HEARTBEAT))
+    assert received.received == [HEARTBEAT]  # delivered once
+    assert len(mav.OnPacketReceived.handlers) == 1
+    late.close()
+    another.close()
+    assert not mav.OnPacketReceived.handlers
+
+
+def test_a_subscriber_on_a_released_dispatcher_registers_it_again():
+    mav = FakeMAV()
+    first = subscriber(mav, 'first')
+    first.close()
+    direct = Subscriber(first.dispatcher, 'direct')
+    shared = subscriber(mav, 'shared')
+    assert shared.dispatcher is first.dispatcher
+    assert len(mav.OnPacketReceived.handlers) == 1
+    direct.close()
+    shared.close()
+    assert not mav.OnPacketReceived.handlers
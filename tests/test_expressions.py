@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+""" mower/expressions.py - derived fields """
+
+import pytest
+
+from mower.expressions import DerivedField, DerivedFields, ExpressionError
+
+
+def test_inputs_and_params_are_discovered():
+    field = DerivedField('speed_error', 'VFR_HUD.groundspeed - WP_SPEED + abs(VFR_HUD.groundspeed)')
+    assert field.inputs == [('VFR_HUD', 'groundspeed')]
+    assert field.params == ['WP_SPEED']
+
+
+@pytest.mark.parametrize('source', ['__import__("os")', 'open("x")', 'VFR_HUD.groundspeed +', '().__class__',
+                                    '(lambda: ().__class__.__base__.__subclasses__())()',
+                                    '[x.__class__ for x in (1, 2)]', 'max(x for x in (open,))'])
+def test_unsafe_or_invalid_expressions_are_rejected(source):
+    with pytest.raises(ExpressionError):
+        DerivedField('bad', source)
+
+
+def test_comprehension_of_allowed_names_is_accepted():
+    fields = DerivedFields()
+    fields.add('largest', 'max([abs(x) for x in (ATTITUDE.roll, ATTITUDE.pitch)])')
+    assert fields.update('ATTITUDE', {'roll': -3.0, 'pitch': 2.0}) == {'largest': 3.0}
+
+
+def test_value_waits_for_every_input():
+    fields = DerivedFields()
+    fields.add('power_w', 'SYS_STATUS.voltage_battery / 1000 * VFR_HUD.throttle')
+    assert fields.update('SYS_STATUS', {'voltage_battery': 12000}) == {}
+    assert fields.values['power_w'] is None
+    assert fields.update('VFR_HUD', {'throttle': 50}) == {'power_w': 600.0}
+    assert fields.update('ATTITUDE', {'yaw': 1.0}) is None  # no expression depends on it
+
+
+def test_only_changed_inputs_reevaluate():
+    fields = DerivedFields()
+    fields.add('xtrack_cm', 'NAV_CONTROLLER_OUTPUT.xtrack_error * 100')
+    assert fields.update('NAV_CONTROLLER_OUTPUT', {'xtrack_error': 0.25}) == {'xtrack_cm': 25.0}
+    assert fields.update('NAV_CONTROLLER_OUTPUT', {'xtrack_error': 0.25}) == {}
+    assert fields.update('NAV_CONTROLLER_OUTPUT', {'wp_dist': 3}) == {}
+
+
+def test_parameters_bind_and_rebind():
+    params = {'WP_SPEED': 2.0}
+    fields = DerivedFields(params.__getitem__)
+    fields.add('speed_error', 'VFR_HUD.groundspeed - WP_SPEED')
+    assert fields.update('VFR_HUD', {'groundspeed': 1.5}) == {'speed_error': -0.5}
+    params['WP_SPEED'] = 1.0
+    assert fields.rebind_params() == {'speed_error': 0.5}
+
+
+def test_unknown_parameter_and_missing_source():
+    with pytest.raises(ExpressionError):
+        DerivedFields({}.__getitem__).add('x', 'VFR_HUD.groundspeed * NOT_A_PARAM')
+    with pytest.raises(ExpressionError):
+        DerivedFields().add('x', 'VFR_HUD.groundspeed * WP_SPEED')
+
+
+def test_runtime_errors_become_none():
+    fields = DerivedFields()
+    field = fields.add('ratio', 'VFR_HUD.groundspeed / VFR_HUD.throttle')
+    assert fields.update('VFR_HUD', {'groundspeed': 1.0, 'throttle': 0}) == {}
+    assert fields.values['ratio'] is None and 'division' in field.error
+
+
+def test_load_reports_errors_and_skips_comments():
+    fields = DerivedFields()
+    errors = fields.load(['# comment', '', 'a = VFR_HUD.groundspeed * 2', 'not a definition', 'a = 1',
+                          'b = sqrt(ATTITUDE.roll ** 2 + ATTITUDE.pitch ** 2)'])
+    assert len(fields) == 2
+    assert len(errors) == 2
+    assert fields.update('ATTITUDE', {'roll': 3.0, 'pitch': 4.0}) == {'b': 5.0}
+
+
+def test_constant_expression():
+    fields = DerivedFields()
+    fields.add('half_pi', 'pi / 2')
+    assert fields.values['half_pi'] == pytest.approx(1.5708, abs=1e-4)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+""" mower/headless.py - the built-in framing backend and the headless monitor against mavmux's stand-in vehicle """
+
+import asyncio
+
+from mower.headless import RECONNECT_INTERVAL, FrameBackend, HeadlessMonitor
+from mower.mavlink import MSG_IDS
+from mower.mavmux import StandInVehicle
+
+PARAMS = {'CRUISE_SPEED': 1.5, 'CRUISE_THROTTLE': 40.0, 'RCMAP_YAW': 4.0}
+
+
+def run_with_vehicle(scenario, speed=5.0):
+    """ runs scenario(vehicle, backend) with a FrameBackend connected to a StandInVehicle on an ephemeral port """
+    async def session():
+        vehicle = StandInVehicle(speed=speed, params=PARAMS)
+        await vehicle.start()
+        backend = FrameBackend('tcp:127.0.0.1:{}'.format(vehicle.port))
+        await backend.start()
+        try:
+            assert await backend.wait_link(RECONNECT_INTERVAL * 2)
+            return await scenario(vehicle, backend)
+        finally:
+            await backend.stop()
+            await vehicle.stop()
+    return asyncio.run(session())
+
+
+async def wait_for(condition, timeout=5.0):
+    deadline = asyncio.get_event_loop().time() + timeout
+    while not condition():
+        if asyncio.get_event_loop().time() > deadline:
+            return False
+        await asyncio.sleep(0.05)
+    return True
+
+
+def test_derived_field_binds_parameters_once_fetched():
+    async def scenario(vehicle, backend):
+        monitor = HeadlessMonitor(backend, ['DERIVED.speed_error'],
+                                  ['speed_error = VFR_HUD.groundspeed - CRUISE_SPEED'], echo_status=False)
+        try:
+            await monitor.run(0, 1.0)
+            derived = monitor.monitor.derived
+            assert [field.name for field in derived.fields] == ['speed_error']
+            assert derived.fields[0].namespace['_p0'] == 1.5
+            assert len(monitor.monitor.rows[0].history.stats) > 0
+            assert backend.set_param('CRUISE_SPEED', 2.0) and await backend.wait_param('CRUISE_SPEED', 2.0)
+            await monitor.run(0, 0.5)
+            assert derived.fields[0].namespace['_p0'] == 2.0
+        finally:
+            monitor.close()
+    run_with_vehicle(scenario)
+
+
+def test_param_value_is_applied_once():
+    async def scenario(vehicle, backend):
+        monitor = HeadlessMonitor(backend, echo_status=False)
+        try:
+            routes = backend.param_handlers.dispatcher.routes[MSG_IDS['PARAM_VALUE']]
+            assert [route.stats.name for route in routes].count('ParamCache.handle_param_value') == 1
+            assert await wait_for(backend.params.complete)
+        finally:
+            monitor.close()
+    run_with_vehicle(scenario)
+
+
+def test_subscribers_receive_their_messages():
+    async def scenario(vehicle, backend):
+        received = []
+        handlers = backend.subscriber('test')
+        handlers.subscribe(MSG_IDS['VFR_HUD'], received.append)
+        try:
+            assert await wait_for(lambda: len(received) >= 3)
+        finally:
+            handlers.close()
+        assert all(message.msgid == MSG_IDS['VFR_HUD'] for message in received)
+        assert hasattr(received[0].data, 'groundspeed')
+    run_with_vehicle(scenario)
+
+
+def test_parameters_are_fetched_and_set():
+    async def scenario(vehicle, backend):
+        assert await wait_for(backend.params.complete)
+        assert dict(backend.params.values) == PARAMS
+        assert backend.set_param('CRUISE_THROTTLE', 55.0)
+        assert await backend.wait_param('CRUISE_THROTTLE', 55.0)
+        assert vehicle.params['CRUISE_THROTTLE'] == 55.0
+    run_with_vehicle(scenario)
+
+
+def test_rc_override_and_release_arrive():
+    async def scenario(vehicle, backend):
+        assert backend.send_rc_override([(1, 1600), (3, 1400), (9, 1200)])
+        assert await wait_for(lambda: vehicle.overrides == {1: 1600, 3: 1400, 9: 1200})
+        assert backend.send_rc_override([(1, 0)])
+        assert await wait_for(lambda: vehicle.overrides.get(1) == 0)
+        assert vehicle.overrides[3] == 1400
+        assert await wait_for(lambda: vehicle.received.get((backend.sysid, MSG_IDS['HEARTBEAT']), 0) > 0)
+        assert vehicle.bad_crc == 0
+    run_with_vehicle(scenario)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+""" mower/history.py - ring buffer and incrementally maintained rolling statistics """
+
+import random
+from math import sqrt
+
+import pytest
+
+from mower.history import SPARK_CHARS, RingBuffer, RollingStats
+
+
+def reference_stats(window):
+    n = len(window)
+    mean = sum(window) / n
+    sd = sqrt(sum((x - mean) ** 2 for x in window) / (n - 1)) if n > 1 else 0.0
+    return min(window), max(window), mean, sd
+
+
+def test_ring_buffer_wraps_and_reports_evictions():
+    ring = RingBuffer(3)
+    assert [ring.append(x, x) for x in (1.0, 2.0, 3.0, 4.0, 5.0)] == [None, None, None, 1.0, 2.0]
+    assert list(ring.ordered_values()) == [3.0, 4.0, 5.0]
+    assert list(ring.ordered_times()) == [3.0, 4.0, 5.0]
+    ring.clear()
+    assert len(ring) == 0
+
+
+def test_ring_buffer_rejects_zero_capacity():
+    with pytest.raises(ValueError):
+        RingBuffer(0)
+
+
+def test_rolling_stats_match_a_full_rescan():
+    rng = random.Random(2)
+    stats = RollingStats(50)
+    values = []
+    for x in range(1000):
+        value = rng.gauss(10.0, 3.0)
+        values.append(value)
+        stats.append(value, x)
+        window = values[-50:]
+        minimum, maximum, mean, sd = reference_stats(window)
+        assert stats.minimum == minimum
+        assert stats.maximum == maximum
+        assert stats.mean == pytest.approx(mean, abs=1e-9)
+        assert stats.stddev == pytest.approx(sd, abs=1e-9)
+    window = sorted(values[-50:])
+    assert stats.percentile(0) == window[0]
+    assert stats.percentile(100) == window[-1]
+    assert stats.percentile(50) == pytest.approx((window[24] + window[25]) / 2)
+
+
+def test_empty_and_single_sample():
+    stats = RollingStats(5)
+    assert stats.mean is None and stats.stddev is None and stats.percentile(50) is None
+    assert stats.summary() == 'NO DATA'
+    assert stats.sparkline() == u''
+    stats.append(4.0, 0)
+    assert (stats.minimum, stats.maximum, stats.mean, stats.stddev) == (4.0, 4.0, 4.0, 0.0)
+
+
+@pytest.mark.parametrize('bad', [float('nan'), float('inf'), float('-inf')])
+def test_non_finite_samples_are_rejected(bad):
+    stats = RollingStats(3)
+    for value in (1.0, 2.0):
+        stats.append(value, 0)
+    assert stats.append(bad, 0) is False
+    assert len(stats) == 2 and stats.rejected == 1
+    for value in (3.0, 4.0, 5.0):
+        stats.append(value, 0)
+    assert (stats.minimum, stats.maximum, stats.mean, stats.stddev) == (3.0, 5.0, 4.0, 1.0)
+    assert len(stats.sparkline()) == 3
+
+
+def test_sparkline_spans_the_window():
+    stats = RollingStats(100)
+    for x in range(100):
+        stats.append(float(x), x)
+    line = stats.sparkline(10)
+    assert len(line) == 10
+    assert line[0] == SPARK_CHARS[0] and line[-1] == SPARK_CHARS[-1]
+    assert list(line) == sorted(line)
+
+
+def test_flat_sparkline():
+    stats = RollingStats(10)
+    for x in range(10):
+        stats.append(7.0, x)
+    assert stats.sparkline(5) == SPARK_CHARS[0] * 5
+
+
+def test_clear_resets_everything():
+    stats = RollingStats(4)
+    for value in (1.0, 9.0, float('nan')):
+        stats.append(value, 0)
+    stats.clear()
+    assert len(stats) == 0 and stats.rejected == 0
+    stats.append(2.0, 0)
+    assert (stats.minimum, stats.maximum, stats.mean) == (2.0, 2.0, 2.0)
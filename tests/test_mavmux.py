@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+""" mower/mavmux.py - the --self-test stand-in vehicle session, so a regression fails the suite """
+
+import asyncio
+
+import pytest
+
+from mower.mavmux import self_test
+
+pytestmark = pytest.mark.slow
+
+
+def test_full_rate_and_capped_clients():
+    assert asyncio.run(self_test())
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+""" mower/mission_pack.py - packed .waypoints files, their index and verification """
+
+import pytest
+
+from mower.mission_pack import (RECORD_LEN, format_record, main, parse_record, read_index, read_item,
+                                read_waypoints, verify, write_packed)
+
+
+def mission(count):
+    return [(seq, int(seq == 0), 0 if seq == 0 else 3, 16, 0.0, 0.0, 0.0, 0.0, -35.0 + seq * 1e-5,
+             149.0 + seq * 2e-5, 10.0, 1) for seq in range(count)]
+
+
+@pytest.fixture
+def packed(tmp_path):
+    filename = str(tmp_path / 'LongMission.waypoints')
+    index = write_packed(filename, mission(120), every=50)
+    return filename, index
+
+
+def test_record_round_trip():
+    item = mission(2)[1]
+    record = format_record(item)
+    assert len(record) == RECORD_LEN and record.endswith(b'\n')
+    assert parse_record(record) == item
+
+
+def test_pack_writes_fixed_width_file_and_index(packed):
+    filename, index = packed
+    record_len, count, every, size, entries = read_index(index)
+    assert (record_len, count, every, size) == (RECORD_LEN, 120, 50, RECORD_LEN * 121)
+    assert [entry[0] for entry in entries] == [0, 50, 100]
+    assert read_waypoints(filename) == mission(120)
+    assert verify(filename) == []
+
+
+def test_read_item_seeks_to_any_item(packed):
+    filename, index = packed
+    assert read_item(filename, 0) == mission(120)[0]
+    assert read_item(filename, 77) == mission(120)[77]
+    with pytest.raises(IndexError):
+        read_item(filename, 120)
+
+
+def test_verify_detects_a_changed_record(packed):
+    filename, index = packed
+    with open(filename, 'r+b') as f:
+        f.seek(RECORD_LEN * 61 + 40)
+        f.write(b'9')
+    errors = verify(filename)
+    assert any('items 50-99: CRC' in error for error in errors)
+
+
+def test_verify_detects_a_truncated_file(packed):
+    filename, index = packed
+    with open(filename, 'r+b') as f:
+        f.truncate(RECORD_LEN * 100)
+    assert any('file is' in error for error in verify(filename))
+
+
+def test_verify_item_past_the_end_fails(packed, capsys):
+    filename, index = packed
+    assert main(['verify', filename, '--item', '5']) == 0
+    assert main(['verify', filename, '--item', '5', '--item', '120']) == 1
+    out = capsys.readouterr().out
+    assert 'item 120: out of range, the index has items 0 to 119' in out
+    assert out.rstrip().endswith('FAILED')
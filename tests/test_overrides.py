@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+""" mower/overrides.py - RC override message fields and the scheduler's coalescing and fail-safe watchdog """
+
+from time import sleep
+
+from mower.overrides import NUM_OVERRIDE_CHANNELS, RELEASE, UINT16_MAX, OverrideScheduler, override_fields
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def scheduler(watchdog_timeout=1.0):
+    sent = []
+    clock = FakeClock()
+    return OverrideScheduler(sent.append, watchdog_timeout=watchdog_timeout, clock=clock), sent, clock
+
+
+def test_override_fields_ignore_and_release_values():
+    fields = override_fields([(1, 1600), (3, RELEASE), (9, 1200), (10, RELEASE)], 2, 3)
+    assert (fields['target_system'], fields['target_component']) == (2, 3)
+    assert fields['chan1_raw'] == 1600 and fields['chan9_raw'] == 1200
+    assert fields['chan3_raw'] == 0  # channels 1-8 are released with 0...
+    assert fields['chan10_raw'] == UINT16_MAX - 1  # ...channels 9+ with 65534, as 0 means "ignore" there
+    assert fields['chan2_raw'] == UINT16_MAX and fields['chan8_raw'] == UINT16_MAX
+    assert fields['chan11_raw'] == 0 and fields['chan{}_raw'.format(NUM_OVERRIDE_CHANNELS)] == 0
+
+
+def test_active_channels_are_coalesced_into_one_message_per_tick():
+    overrides, sent, clock = scheduler()
+    assert not overrides.tick()
+    overrides.set(3, 1400)
+    overrides.set(1, 1600)
+    overrides.set(9, 1200)
+    assert overrides.tick()
+    clock.now += 0.1
+    assert overrides.tick()
+    assert sent == [[(1, 1600), (3, 1400), (9, 1200)]] * 2
+    assert overrides.messages_sent == 2
+
+
+def test_release_is_sent_once():
+    overrides, sent, clock = scheduler()
+    overrides.set(1, 1600)
+    overrides.set(3, 1400)
+    overrides.release(1)
+    overrides.tick()
+    overrides.tick()
+    assert sent == [[(3, 1400), (1, RELEASE)], [(3, 1400)]]
+
+
+def test_watchdog_trips_and_releases_after_timeout():
+    overrides, sent, clock = scheduler(watchdog_timeout=1.0)
+    overrides.set(1, 1600)
+    overrides.set(9, 1200)
+    clock.now += 0.9
+    overrides.tick()
+    assert not overrides.tripped and sent[-1] == [(1, 1600), (9, 1200)]
+    overrides.kick()
+    clock.now += 0.9
+    overrides.tick()
+    assert not overrides.tripped  # kicked in time
+    clock.now += 0.2
+    overrides.tick()
+    assert overrides.tripped
+    assert sent[-1] == [(1, RELEASE), (9, RELEASE)]
+    assert overrides.channels == {}
+    assert not overrides.tick()  # nothing left to send
+
+
+def test_stop_releases_everything():
+    overrides, sent, clock = scheduler()
+    overrides.set(1, 1600)
+    overrides.set(4, 1500)
+    overrides.stop()
+    assert sent == [[(1, RELEASE), (4, RELEASE)]]
+    assert not overrides.running and not overrides.tripped
+
+
+def test_thread_sends_and_stops():
+    sent = []
+    overrides = OverrideScheduler(sent.append, rate=100.0)
+    overrides.set(2, 1550)
+    overrides.start()
+    try:
+        for _ in range(200):
+            if len(sent) >= 3:
+                break
+            overrides.kick()
+            sleep(0.01)
+    finally:
+        overrides.stop()
+    assert sent[0] == [(2, 1550)] and len(sent) >= 4
+    assert sent[-1] == [(2, RELEASE)]
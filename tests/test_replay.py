@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+""" mower/replay.py - .tlog reading and the replay path into the monitors """
+
+from struct import pack
+
+from mower.dispatch import subscriber
+from mower.mavlink import MSG_IDS
+from mower.replay import FakeMAV, ReplayEngine, attach_monitor, attach_servo_monitor, read_tlog, synthetic_messages
+
+
+def tlog_record(timestamp, message):
+    return pack('>Q', int(round(timestamp * 1e6))) + message.buffer
+
+
+def write_tlog(tmp_path, records):
+    filename = tmp_path / 'replay.tlog'
+    filename.write_bytes(b''.join(records))
+    return str(filename)
+
+
+def sample_messages(duration=5.0):
+    return list(synthetic_messages(duration, seed=1))
+
+
+def test_synthetic_messages_are_deterministic():
+    first = [(t, m.msgid, m.buffer) for t, m in synthetic_messages(5.0, seed=3)]
+    second = [(t, m.msgid, m.buffer) for t, m in synthetic_messages(5.0, seed=3)]
+    assert first == second
+    assert first != [(t, m.msgid, m.buffer) for t, m in synthetic_messages(5.0, seed=4)]
+
+
+def test_read_tlog_round_trip(tmp_path):
+    messages = sample_messages()
+    filename = write_tlog(tmp_path, [tlog_record(t, m) for t, m in messages])
+    replayed = list(read_tlog(filename))
+    assert [m.buffer for t, m in replayed] == [m.buffer for t, m in messages]
+    assert all(abs(t - expected) < 1e-6 for (t, m), (expected, original) in zip(replayed, messages))
+    assert replayed[0][1].data.__dict__ == messages[0][1].data.__dict__
+
+
+def test_read_tlog_skips_a_frame_with_a_bad_crc(tmp_path):
+    messages = sample_messages()
+    records = [tlog_record(t, m) for t, m in messages]
+    corrupt = bytearray(records[10])
+    corrupt[-3] ^= 0xFF  # last payload byte - the STX and length are still plausible
+    records[10] = bytes(corrupt)
+    replayed = [m.buffer for t, m in read_tlog(write_tlog(tmp_path, records))]
+    assert replayed == [m.buffer for t, m in messages[:10] + messages[11:]]
+
+
+def test_read_tlog_resyncs_past_a_bad_length(tmp_path):
+    messages = sample_messages()
+    records = [tlog_record(t, m) for t, m in messages]
+    corrupt = bytearray(records[5])
+    corrupt[9] = 0xFF  # payload length byte - the frame would run past the following records
+    records[5] = bytes(corrupt)
+    records.insert(20, b'\x00\xfd\x01')  # junk between records
+    replayed = [m.buffer for t, m in read_tlog(write_tlog(tmp_path, records))]
+    assert replayed == [m.buffer for t, m in messages[:5] + messages[6:]]
+
+
+def test_read_tlog_drops_a_truncated_last_record(tmp_path):
+    messages = sample_messages()
+    records = [tlog_record(t, m) for t, m in messages]
+    records[-1] = records[-1][:-4]
+    replayed = list(read_tlog(write_tlog(tmp_path, records)))
+    assert len(replayed) == len(messages) - 1
+
+
+def test_replay_feeds_the_monitor_and_servo_paths():
+    mav = FakeMAV()
+    monitor_handlers = subscriber(mav, 'MinMonitor')
+    monitor = attach_monitor(monitor_handlers, ['VFR_HUD.groundspeed', 'GPS_RAW_INT.eph:0:100'],
+                             ['speed_cm = VFR_HUD.groundspeed * 100'])
+    monitor.add_row({'message': 'DERIVED', 'field': 'speed_cm'})
+    servo_handlers = subscriber(mav, 'ServoTuner')
+    servos = attach_servo_monitor(servo_handlers)
+    messages = sample_messages(10.0)
+    try:
+        result = ReplayEngine(mav, on_tick=monitor.evaluate_alerts).run(messages)
+    finally:
+        monitor_handlers.close()
+        servo_handlers.close()
+
+    assert result.messages == len(messages) == mav.packets_received
+    assert 9.5 < result.span <= 10.0
+    speed, eph, derived = monitor.rows
+    assert len(speed.history.stats) == sum(m.msgid == MSG_IDS['VFR_HUD'] for t, m in messages)
+    assert abs(derived.value - speed.value * 100) < 1e-3
+    assert eph.value is not None
+    assert servos.samples[0] == sum(m.msgid == MSG_IDS['SERVO_OUTPUT_RAW'] for t, m in messages)
+    assert servos.minimum[0] < 1500 < servos.maximum[0]
+    assert not mav.OnPacketReceived.handlers  # the dispatcher unhooked with its last subscriber
+
+
+def test_replay_limit():
+    result = ReplayEngine(FakeMAV()).run(sample_messages(), limit=7)
+    assert result.messages == 7
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+""" mower/rtcm.py - RTCM3 framing, CRC-24Q and per-type filtering """
+
+import argparse
+
+import pytest
+
+from mower.rtcm import RtcmFilter, RtcmFramer, check_crc, frame_length, message_type, pack_frame, parse_decimate
+
+SIZES = ((1005, 19), (1074, 150), (1084, 110), (1230, 8))
+
+
+def epoch():
+    return [pack_frame(msg_type, bytes(bytearray(range(size)))) for msg_type, size in SIZES]
+
+
+def test_pack_frame_round_trip():
+    frame = pack_frame(1074, b'\x01\x02\x03')
+    assert check_crc(frame)
+    assert frame_length(frame) == len(frame)
+    assert message_type(frame) == 1074
+    assert not check_crc(frame[:-1] + bytes(bytearray([frame[-1] ^ 1])))
+
+
+def test_frame_length_incomplete_and_invalid():
+    assert frame_length(b'\xd3\x00') is None
+    assert frame_length(b'\xd3\x04\x00') == 0  # reserved bits set
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 7, 64, 4096])
+def test_framer_reassembles_any_chunking(chunk_size):
+    frames = epoch() * 3
+    stream = b''.join(frames)
+    framer = RtcmFramer()
+    found = []
+    for offset in range(0, len(stream), chunk_size):
+        found.extend(bytes(frame) for frame in framer.feed(stream[offset:offset + chunk_size]))
+    assert found == frames
+    assert framer.bad_crc == 0 and framer.skipped_bytes == 0
+
+
+def test_framer_skips_junk_and_bad_crc():
+    good = epoch()
+    corrupt = bytearray(good[1])
+    corrupt[10] ^= 0xFF
+    stream = b'$GPGGA,junk\r\n' + good[0] + bytes(corrupt) + good[2] + b'\xd3' + good[3]
+    framer = RtcmFramer()
+    found = [bytes(frame) for frame in framer.feed(stream)]
+    assert found == [good[0], good[2], good[3]]
+    assert framer.bad_crc == 1
+    assert framer.skipped_bytes > 0
+
+
+def test_filter_types_and_decimation():
+    rtcm = RtcmFilter(types=[1005, 1074, 1230], decimate={1074: 3})
+    forwarded = []
+    for second in range(9):
+        forwarded.extend(message_type(frame) for frame in rtcm(b''.join(epoch()), timestamp=float(second)))
+    assert forwarded.count(1005) == 9
+    assert forwarded.count(1074) == 3
+    assert forwarded.count(1084) == 0
+    assert rtcm.stats[1084].count == 9
+    assert rtcm.stats[1074].forwarded == 3
+
+
+def test_parse_decimate():
+    assert parse_decimate('1074:5') == (1074, 5)
+    for text in ('1074:0', '1074:-2', '1074', 'MSM:2'):
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_decimate(text)
+
+
+def test_filter_rejects_zero_decimation():
+    with pytest.raises(ValueError):
+        RtcmFilter(decimate={1074: 0})
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+""" mower/serial_bridge.py - the --self-test pseudo-terminal checks, so a regression fails the suite """
+
+import asyncio
+
+import pytest
+
+pytest.importorskip('termios')  # pseudo-terminals, POSIX only
+
+from mower.serial_bridge import POLICIES, hangup_test, self_test  # noqa: E402
+
+pytestmark = pytest.mark.slow
+
+
+@pytest.mark.parametrize('policy', POLICIES)
+def test_fan_out_and_slow_client_policy(policy):
+    assert asyncio.run(self_test(policy))
+
+
+def test_device_hangup_is_reopened():
+    assert asyncio.run(hangup_test())
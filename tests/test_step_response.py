@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+""" mower/step_response.py - step and sweep metrics from StepTest against FakeServoVehicle """
+
+import pytest
+
+from mower.step_response import FakeServoVehicle, SimClock, run_headless, step_plan, sweep_plan
+
+RATE = 500.0  # Hz, override and SERVO_OUTPUT_RAW rate - 2 ms resolution on the timings
+DEAD_TIME = 0.04  # s
+SLEW_RATE = 1500.0  # PWM/s
+DEADBAND = 15  # PWM either side of trim
+AMPLITUDE = 300
+
+
+def servo(tau=0.0, slew_rate=SLEW_RATE, deadband=DEADBAND, outputs=None):
+    return FakeServoVehicle(SimClock(), outputs, rate=RATE, tau=tau, dead_time=DEAD_TIME, deadband=deadband,
+                            slew_rate=slew_rate)
+
+
+def test_step_latency_rise_time_and_overshoot():
+    report = run_headless(step_plan(1500, AMPLITUDE), vehicle=servo(), override_rate=RATE, step=0.0005)
+    assert [channel.servo for channel in report.channels] == [0]
+    steps = report.channels[0].steps
+    assert len(steps) == 4 and all(step.responded for step in steps)
+    for step in steps:
+        assert abs(step.final - step.command_to) <= 1
+        # the new PWM waits for the next override tick, then the dead time, then a few PWM of slew
+        assert DEAD_TIME <= step.latency <= DEAD_TIME + 3 / RATE + 3 / SLEW_RATE
+        assert step.rise_time == pytest.approx(0.8 * AMPLITUDE / SLEW_RATE, abs=2 / RATE)
+        assert step.overshoot == 0.0
+
+
+def test_sweep_brackets_the_deadband():
+    plan = sweep_plan(1500, 100, increments=20, hold=0.3)  # 5 PWM stairs
+    report = run_headless(plan, vehicle=servo(), override_rate=RATE, step=0.0005)
+    channel = report.channels[0]
+    assert channel.rest == 1500
+    assert channel.deadband == ((DEADBAND, DEADBAND + 5), (DEADBAND, DEADBAND + 5))
+    assert channel.gains[0] == pytest.approx(1.0, abs=0.01) and channel.gains[1] == pytest.approx(1.0, abs=0.01)
+    assert channel.asymmetry == pytest.approx(0.0, abs=1.0)
+
+
+def test_reversed_output_and_idle_servos():
+    vehicle = servo(outputs={1: [(0, 1), (2, -1)]})
+    report = run_headless(step_plan(1500, AMPLITUDE), vehicle=vehicle, override_rate=RATE, step=0.0005)
+    assert [channel.servo for channel in report.channels] == [0, 2]
+    reversed_servo = report.channels[1]
+    assert reversed_servo.steps[0].final == pytest.approx(1500 - AMPLITUDE, abs=1)
+    assert reversed_servo.gains[0] == pytest.approx(-1.0, abs=0.01)
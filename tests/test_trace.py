@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+""" mower/trace.py - servo PWM trace, histograms and export """
+
+import csv
+
+import pytest
+
+from mower.servo import UNUSED
+from mower.trace import ServoTrace
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        self.now += 0.02
+        return self.now
+
+
+def filled_trace(samples=10, capacity=4):
+    trace = ServoTrace(num_servos=3, capacity=capacity, clock=Clock())
+    for x in range(samples):
+        trace.record([1000 + x, 1500, UNUSED], time_usec=x * 20000)
+    return trace
+
+
+def test_trace_keeps_the_newest_samples_in_order():
+    trace = filled_trace()
+    snapshot = trace.snapshot()
+    assert len(trace) == len(snapshot) == 4
+    assert snapshot.samples == 10
+    assert list(snapshot.values[0]) == [1006, 1007, 1008, 1009]
+    assert list(snapshot.boot_times) == [120000.0, 140000.0, 160000.0, 180000.0]
+    assert list(snapshot.times) == sorted(snapshot.times)
+
+
+def test_histograms_count_every_sample_and_skip_unused_channels():
+    trace = filled_trace()
+    histograms = trace.snapshot().histograms
+    assert sum(histograms[0]) == 10
+    assert histograms[1][1500 - trace.min_pwm] == 10
+    assert sum(histograms[2]) == 0
+
+
+def test_out_of_range_values_land_in_the_end_bins():
+    trace = ServoTrace(num_servos=1, capacity=2, bin_width=100, min_pwm=800, max_pwm=2200)
+    trace.record([500])
+    trace.record([3000])
+    histogram = trace.snapshot().histograms[0]
+    assert histogram[0] == 1 and histogram[-1] == 1
+
+
+def test_reset():
+    trace = filled_trace()
+    trace.reset()
+    snapshot = trace.snapshot()
+    assert len(snapshot) == 0 and snapshot.samples == 0 and not any(sum(h) for h in snapshot.histograms)
+
+
+def export(trace, directory, fmt):
+    results = []
+    trace.export(str(directory), 'test', fmt, lambda files, error: results.append((files, error))).join()
+    (files, error), = results
+    assert error is None and trace.last_export == files
+    return files
+
+
+def test_csv_export(tmp_path):
+    trace = filled_trace()
+    trace_file, hist_file = export(trace, tmp_path, 'csv')
+    with open(trace_file) as f:
+        rows = list(csv.DictReader(f))
+    assert [int(row['servo1']) for row in rows] == [1006, 1007, 1008, 1009]
+    assert rows[0]['time_usec'] == '120000'
+    with open(hist_file) as f:
+        counts = dict((int(row['pwm']), int(row['servo2'])) for row in csv.DictReader(f))
+    assert counts[1500] == 10
+
+
+def test_npy_export(tmp_path):
+    numpy = pytest.importorskip('numpy')
+    trace = filled_trace()
+    trace_file, hist_file = export(trace, tmp_path, 'npy')
+    data = numpy.load(trace_file)
+    assert list(data['servo1']) == [1006, 1007, 1008, 1009]
+    assert list(data['time_usec']) == [120000.0, 140000.0, 160000.0, 180000.0]
+    hist = numpy.load(hist_file)
+    assert hist.shape == (3, trace.num_bins)
+    assert hist[1, 1500 - trace.min_pwm] == 10
+
+
+def test_export_rejects_unknown_format(tmp_path):
+    with pytest.raises(ValueError):
+        filled_trace().export(str(tmp_path), fmt='xlsx')
@@ -6,6 +6,10 @@
 
     Edit the DEFAULT_PATH variable below with the default directory for your mission files
 
+    'Output as Packed WP' writes fixed-width records plus a .idx offset index (see mower/mission_pack.py) for
+    LongMission.lua - rename both to LongMission.waypoints/LongMission.idx on the SD card.  Requires the
+    'mower' folder from this repository alongside the script (or set LIB_PATH).
+
     Tested under Windows 10, but should be Linux compatible
     (assuming that IronPython sucks less at cross-compatibility than it does ease of coding...)
 
@@ -20,7 +24,8 @@ print('\n*** Waypoint File Tool ***\n')
 print('Loading modules...')
 
 import clr
-from os import listdir
+import sys
+from os import getcwd, listdir
 from os import path
 from os import sep as file_separator
 from re import sub as regex_sub
@@ -44,9 +49,21 @@ OUTPUT_FILE_PREFIX = 'zz_'
 OUTPUT_FILE_SUFFIX = ''
 DEFAULT_ALTITUDE = 30.48  # meters
 ALWAYS_ON_TOP = True
+PACKED_INDEX_INTERVAL = 50  # waypoints per .idx entry for packed output
+LIB_PATH = None  # directory containing the 'mower' package (None for this script's directory)
 
 # *************************************************************************** #
 
+if LIB_PATH is None:
+    try:
+        LIB_PATH = path.dirname(path.abspath(__file__))
+    except NameError:  # Mission Planner does not always define __file__
+        LIB_PATH = getcwd()
+if LIB_PATH not in sys.path:
+    sys.path.append(LIB_PATH)
+
+from mower.mission_pack import write_packed
+
 EARTH_RADIUS = 6371e3  # in meters
 
 
@@ -166,7 +183,9 @@ class WaypointConverter:
                  filename=None,
                  output_file_type=wp_file,
                  num_reverse_passes=0,
-                 default_alt=DEFAULT_ALTITUDE):
+                 default_alt=DEFAULT_ALTITUDE,
+                 index_interval=None):
+        """ index_interval writes a packed (fixed-width) .waypoints file with an index entry every N items """
         self.output_filename = None
         if filename is None:
             return
@@ -176,7 +195,7 @@ class WaypointConverter:
         points = self._raw_to_points(lines, file_info, default_alt)
         if output_file_type == wp_file and num_reverse_passes > 0:
             points = self._reverse_perimeter(points, num_reverse_passes)
-        self.output_filename = self._convert_file(points, filename, output_file_type)
+        self.output_filename = self._convert_file(points, filename, output_file_type, index_interval)
 
     def _read_file(self, filename):
         with open(filename, "r") as f:
@@ -241,8 +260,11 @@ class WaypointConverter:
         points.insert(0, points[num_perimeter_points - 1])  # this used to be waypoint 1, so let's start there
         return points
 
-    def _convert_file(self, points, filename, output_file_type):
+    def _convert_file(self, points, filename, output_file_type, index_interval=None):
         output_filename = self._get_output_filename(filename, output_file_type.file_type)
+        if output_file_type == wp_file and index_interval:
+            write_packed(output_filename, self._wp_items(points), index_interval)
+            return output_filename
         f = open(output_filename, "w")
         if output_file_type == poly_file:
             self._write_poly_file(f, points)
@@ -258,13 +280,18 @@ class WaypointConverter:
             f.write(' '.join([str(point.Lat), str(point.Lng)]) + '\n')
 
     @staticmethod
-    def _write_wp_file(f, points):
-        f.write('QGC WPL 110\n')
+    def _wp_items(points):
+        """ the 12 values of each .waypoints line, home first """
         h = get_home_location()
-        f.write('\t'.join(['0', '1', '0', '16', '0', '0', '0', '0', str(h.Lat), str(h.Lng), str(h.Alt), '1']) + '\n')
+        items = [(0, 1, 0, 16, 0, 0, 0, 0, h.Lat, h.Lng, h.Alt, 1)]
         for x in range(len(points)):
-            f.write('\t'.join([str(x + 1), '0', '3', '16', '0', '0', '0', '0',
-                               str(points[x].Lat), str(points[x].Lng), str(points[x].Alt), '1']) + '\n')
+            items.append((x + 1, 0, 3, 16, 0, 0, 0, 0, points[x].Lat, points[x].Lng, points[x].Alt, 1))
+        return items
+
+    def _write_wp_file(self, f, points):
+        f.write('QGC WPL 110\n')
+        for item in self._wp_items(points):
+            f.write('\t'.join([str(value) for value in item]) + '\n')
 
     @staticmethod
     def _get_output_filename(filename, extension):
@@ -321,7 +348,7 @@ class WaypointFileToolForm(Form):
         self.Location = Point(0, 0)
         self.TopMost = ALWAYS_ON_TOP
         screen_size = Screen.GetWorkingArea(self)
-        num_buttons = 3
+        num_buttons = 4
         btn_width = 150
         margin = 5
         start_x, start_y = 12, 10
@@ -367,6 +394,16 @@ class WaypointFileToolForm(Form):
         self.btn_output_poly.Text = 'Output as POLY'
         self.btn_output_poly.Click += self.convert_file
 
+        self.btn_output_packed = Button()
+        self.btn_output_packed.Width = 150
+        self.btn_output_packed.FlatStyle = FlatStyle.Flat
+        self.btn_output_packed.FlatAppearance.BorderSize = 1
+        self.btn_output_packed.FlatAppearance.BorderColor = CustomColor.MPLightGray
+        self.btn_output_packed.BackColor = CustomColor.MPGreen
+        self.btn_output_packed.ForeColor = CustomColor.Black
+        self.btn_output_packed.Text = 'Output as Packed WP'
+        self.btn_output_packed.Click += self.convert_file
+
         self.btn_refresh_files = Button()
         self.btn_refresh_files.Width = 150
         self.btn_refresh_files.FlatStyle = FlatStyle.Flat
@@ -428,6 +465,7 @@ class WaypointFileToolForm(Form):
         x, y = self.add_control_vertical(self.lst_files, x, y, margin)
         x, y = self.add_control_horizontal(self.btn_output_wp, x, y, margin)
         x, y = self.add_control_horizontal(self.btn_output_poly, x, y, margin)
+        x, y = self.add_control_horizontal(self.btn_output_packed, x, y, margin)
         x, y = self.add_control_vertical(self.btn_refresh_files, x, y, margin + 10)
         x, y = self.add_control_horizontal(self.chk_reverse_perimeter, start_x, y, margin)
         x, y = self.add_control_vertical(self.spn_num_perimeter_passes, x - 5, y, margin + 10)
@@ -502,14 +540,20 @@ class WaypointFileToolForm(Form):
         try:
             output_file_type = poly_file
             num_reverse_passes = 0
-            if sender == self.btn_output_wp:
+            index_interval = None
+            if sender == self.btn_output_wp or sender == self.btn_output_packed:
                 output_file_type = wp_file
+                if sender == self.btn_output_packed:
+                    index_interval = PACKED_INDEX_INTERVAL
                 if self.spn_num_perimeter_passes.Enabled and int(self.spn_num_perimeter_passes.Value):
                     num_reverse_passes = int(self.spn_num_perimeter_passes.Value)
             filename = path.join(self.txt_path.Text, self.lst_files.SelectedItem)
             default_altitude = self.get_default_altitude()
-            result = WaypointConverter(filename, output_file_type, num_reverse_passes, default_altitude).output_filename
+            result = WaypointConverter(filename, output_file_type, num_reverse_passes, default_altitude,
+                                       index_interval).output_filename
             result = '{old_f}   →   {new_f}'.format(old_f=path.basename(filename), new_f=path.basename(result))
+            if index_interval:
+                result += ' (+ .idx)'
         except InvalidFile:
             result = 'Conversion failed - invalid file/filetype'
         self.refresh_filenames(None, None, False)